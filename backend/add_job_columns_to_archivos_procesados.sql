@@ -0,0 +1,29 @@
+-- SQL para agregar las columnas de seguimiento de cargas en segundo plano a archivos_procesados
+-- Ejecutar en el SQL Editor de Supabase
+-- /api/upload y /api/upload/compras-v2 con en_segundo_plano=true devuelven el id
+-- del archivo como job_id; /api/jobs/{id} consulta estas columnas
+
+ALTER TABLE archivos_procesados
+ADD COLUMN IF NOT EXISTS fase VARCHAR(20);
+
+ALTER TABLE archivos_procesados
+ADD COLUMN IF NOT EXISTS registros_totales INTEGER DEFAULT 0;
+
+ALTER TABLE archivos_procesados
+ADD COLUMN IF NOT EXISTS inicio_proceso TIMESTAMP;
+
+ALTER TABLE archivos_procesados
+ADD COLUMN IF NOT EXISTS fin_proceso TIMESTAMP;
+
+ALTER TABLE archivos_procesados
+ADD COLUMN IF NOT EXISTS resultado TEXT;
+
+-- Las cargas activas se buscan por estado
+CREATE INDEX IF NOT EXISTS idx_archivo_estado ON archivos_procesados(estado);
+
+-- Comentarios para documentación
+COMMENT ON COLUMN archivos_procesados.fase IS 'Fase de la carga: en_cola, parseo, validacion, guardado, completado o error';
+COMMENT ON COLUMN archivos_procesados.registros_totales IS 'Registros a guardar, conocidos tras la validación del archivo';
+COMMENT ON COLUMN archivos_procesados.inicio_proceso IS 'Inicio del procesamiento (después de la espera en cola)';
+COMMENT ON COLUMN archivos_procesados.fin_proceso IS 'Fin del procesamiento, con éxito o con error';
+COMMENT ON COLUMN archivos_procesados.resultado IS 'Resumen JSON devuelto por la carga terminada';
@@ -0,0 +1,10 @@
+-- SQL para agregar el índice de paginación por clave de compras_v2
+-- Ejecutar en el SQL Editor de Supabase
+-- /api/compras-v2/data pagina con ORDER BY fecha_pedido DESC, imi DESC y
+-- WHERE (fecha_pedido, imi) < (cursor); el índice se recorre hacia atrás
+
+CREATE INDEX IF NOT EXISTS idx_compras_v2_fecha_pedido_imi
+ON compras_v2(fecha_pedido, imi);
+
+-- Comentarios para documentación
+COMMENT ON INDEX idx_compras_v2_fecha_pedido_imi IS 'Paginación por clave (fecha_pedido, imi) de /api/compras-v2/data';
@@ -0,0 +1,18 @@
+-- SQL para agregar índices de búsqueda por subcadena en proveedor y material
+-- Ejecutar en el SQL Editor de Supabase
+-- Permiten que los filtros ILIKE '%texto%' (texto libre) usen índice; los valores
+-- elegidos en los dropdowns se filtran por igualdad con los índices B-tree existentes
+
+-- Extensión de trigramas
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Índices GIN de trigramas
+CREATE INDEX IF NOT EXISTS idx_compras_v2_proveedor_trgm
+ON compras_v2 USING gin (proveedor gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS idx_compras_v2_mat_material_trgm
+ON compras_v2_materiales USING gin (material_codigo gin_trgm_ops);
+
+-- Comentarios para documentación
+COMMENT ON INDEX idx_compras_v2_proveedor_trgm IS 'Búsqueda ILIKE por subcadena de proveedor (pg_trgm)';
+COMMENT ON INDEX idx_compras_v2_mat_material_trgm IS 'Búsqueda ILIKE por subcadena de material (pg_trgm)';
@@ -0,0 +1,17 @@
+-- SQL para agregar la clave única (compra_id, material_codigo) a compras_v2_materiales
+-- Ejecutar en el SQL Editor de Supabase
+-- Requerida por el upsert masivo de materiales (INSERT ... ON CONFLICT (compra_id, material_codigo))
+
+-- Eliminar duplicados existentes conservando el registro más reciente
+DELETE FROM compras_v2_materiales a
+USING compras_v2_materiales b
+WHERE a.compra_id = b.compra_id
+  AND a.material_codigo = b.material_codigo
+  AND a.id < b.id;
+
+-- Crear índice único
+CREATE UNIQUE INDEX IF NOT EXISTS uq_compras_v2_mat_compra_material
+ON compras_v2_materiales(compra_id, material_codigo);
+
+-- Comentarios para documentación
+COMMENT ON INDEX uq_compras_v2_mat_compra_material IS 'Un material por compra; clave del upsert masivo de materiales';
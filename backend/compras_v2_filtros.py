@@ -0,0 +1,190 @@
+"""
+Compilador de filtros para las consultas SQL directas de compras_v2.
+
+Convierte mes/año/fecha_desde/fecha_hasta en rangos semiabiertos sobre
+fecha_pedido (fecha_pedido >= desde AND fecha_pedido < hasta), que pueden usar
+idx_compras_v2_fecha_pedido, en lugar de EXTRACT(MONTH/YEAR ...) que obliga a
+un recorrido secuencial.
+
+Proveedor y material: los valores elegidos en los dropdowns (que existen tal
+cual en la tabla) se filtran por igualdad y usan los índices B-tree; el texto
+libre usa ILIKE '%...%', que en PostgreSQL se apoya en los índices GIN pg_trgm
+(add_trigram_indexes_compras_v2.sql). En SQLite el texto libre del ORM se busca
+por prefijo sobre la clave normalizada (ver filtro_texto_orm).
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, Callable, List, Optional, Tuple
+from sqlalchemy import and_, func
+from utils.cache import cache, get_data_generation
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _to_int(value) -> Optional[int]:
+    """Convierte mes/año a entero (acepta '03', 3.0, etc.)"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_date(value) -> Optional[date]:
+    """Convierte fecha_desde/fecha_hasta (date, datetime o 'YYYY-MM-DD') a date"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(str(value).strip()[:10])
+    except ValueError:
+        return None
+
+def normalizar_clave(valor) -> str:
+    """Clave normalizada para búsquedas (sin espacios extremos y en minúsculas)"""
+    return str(valor).strip().lower()
+
+def get_valores_exactos(campo: str, cargar: Callable[[], List[str]]) -> frozenset:
+    """
+    Catálogo de valores existentes de proveedor/material, cacheado por generación
+    de datos. Una lista vacía (p. ej. por error de conexión) no se cachea.
+    """
+    key = f"compras_v2_catalogo:g{get_data_generation()}:{campo}"
+    valores = cache.get(key)
+    if valores is None:
+        valores = frozenset(valor for valor in (cargar() or []) if valor)
+        if valores:
+            cache.set(key, valores, ttl=3600)
+    return valores
+
+def rango_prefijo(clave: str) -> Tuple[str, str]:
+    """Rango [clave, siguiente) que contiene exactamente las cadenas que empiezan con clave"""
+    return clave, clave[:-1] + chr(ord(clave[-1]) + 1)
+
+def filtro_texto_orm(columna, valor: str, exactos: Optional[frozenset] = None, dialecto: str = None):
+    """
+    Condición ORM para proveedor/material: igualdad si el valor es del catálogo y
+    contains para texto libre.
+
+    En SQLite (sin trigramas) ambos casos usan la clave normalizada lower(trim(...))
+    para aprovechar su índice de expresión: igualdad si la clave está en el
+    catálogo y, para texto libre, búsqueda por prefijo como rango sobre la clave
+    (equivale a LIKE 'clave%', que SQLite no resuelve con índices de expresión).
+    """
+    if exactos and valor in exactos:
+        return columna == valor
+
+    if dialecto == 'sqlite':
+        clave = normalizar_clave(valor)
+        if clave:
+            columna_normalizada = func.lower(func.trim(columna))
+            if exactos and clave in {normalizar_clave(existente) for existente in exactos}:
+                return columna_normalizada == clave
+            desde, hasta = rango_prefijo(clave)
+            return and_(columna_normalizada >= desde, columna_normalizada < hasta)
+
+    return columna.contains(valor)
+
+def validar_mes(mes) -> Optional[int]:
+    """Mes como entero (None si no se indicó); ValueError si no está entre 1 y 12"""
+    if mes is None or mes == '':
+        return None
+    valor = _to_int(mes)
+    if valor is None or not 1 <= valor <= 12:
+        raise ValueError(f"Mes inválido: {mes}")
+    return valor
+
+def rango_mes_año(mes=None, año=None) -> Optional[Tuple[date, date]]:
+    """
+    Rango semiabierto [desde, hasta) para un año o un mes de un año.
+    Retorna None si no hay año (un mes sin año no es un rango contiguo).
+    Un mes fuera de 1..12 lanza ValueError en lugar de ampliar el rango al año.
+    """
+    mes = validar_mes(mes)
+    año = _to_int(año)
+    if not año:
+        return None
+
+    if mes:
+        desde = date(año, mes, 1)
+        hasta = date(año + 1, 1, 1) if mes == 12 else date(año, mes + 1, 1)
+        return desde, hasta
+
+    return date(año, 1, 1), date(año + 1, 1, 1)
+
+def compilar_filtros_compras(filtros: Optional[Dict[str, Any]], alias: str = 'c2',
+                             material: Optional[str] = 'exists',
+                             material_alias: str = 'c2m',
+                             exactos: Optional[Dict[str, frozenset]] = None) -> Tuple[str, List[Any]]:
+    """
+    Traduce los filtros del dashboard a un fragmento SQL (" AND ...") y sus parámetros.
+
+    - mes + año / año: rango semiabierto sobre {alias}.fecha_pedido
+    - mes sin año: EXTRACT(MONTH ...), se conserva la semántica previa (cualquier año)
+    - mes fuera de 1..12: ValueError
+    - fecha_desde: fecha_pedido >= fecha_desde
+    - fecha_hasta: fecha_pedido < fecha_hasta + 1 día (incluye todo el día)
+    - proveedor: igualdad si está en exactos['proveedor'], si no ILIKE '%proveedor%'
+    - material: 'exists' filtra compras que tengan el material; 'join' filtra las
+      filas de {material_alias} ya unidas en la consulta; None lo ignora. Igual
+      que proveedor, los valores de exactos['material'] se comparan por igualdad
+    - moneda: igualdad
+    """
+    condiciones = []
+    params = []
+
+    if not filtros:
+        return '', params
+
+    columna_fecha = f"{alias}.fecha_pedido"
+
+    rango = rango_mes_año(filtros.get('mes'), filtros.get('año'))
+    if rango:
+        condiciones.append(f"{columna_fecha} >= %s AND {columna_fecha} < %s")
+        params.extend(rango)
+    elif filtros.get('mes'):
+        condiciones.append(f"EXTRACT(MONTH FROM {columna_fecha}) = %s")
+        params.append(validar_mes(filtros['mes']))
+
+    if filtros.get('fecha_desde'):
+        fecha_desde = _to_date(filtros['fecha_desde'])
+        if fecha_desde:
+            condiciones.append(f"{columna_fecha} >= %s")
+            params.append(fecha_desde)
+        else:
+            logger.warning(f"fecha_desde inválida ignorada: {filtros['fecha_desde']}")
+
+    if filtros.get('fecha_hasta'):
+        fecha_hasta = _to_date(filtros['fecha_hasta'])
+        if fecha_hasta:
+            condiciones.append(f"{columna_fecha} < %s")
+            params.append(fecha_hasta + timedelta(days=1))
+        else:
+            logger.warning(f"fecha_hasta inválida ignorada: {filtros['fecha_hasta']}")
+
+    exactos = exactos or {}
+
+    def condicion_texto(columna: str, campo: str) -> str:
+        valor = filtros[campo]
+        if valor in exactos.get(campo, ()):
+            params.append(valor)
+            return f"{columna} = %s"
+        params.append(f"%{valor}%")
+        return f"{columna} ILIKE %s"
+
+    if filtros.get('proveedor'):
+        condiciones.append(condicion_texto(f"{alias}.proveedor", 'proveedor'))
+
+    if filtros.get('material') and material == 'exists':
+        condiciones.append(
+            f"EXISTS (SELECT 1 FROM compras_v2_materiales m "
+            f"WHERE m.compra_imi = {alias}.imi AND {condicion_texto('m.material_codigo', 'material')})"
+        )
+    elif filtros.get('material') and material == 'join':
+        condiciones.append(condicion_texto(f"{material_alias}.material_codigo", 'material'))
+
+    if filtros.get('moneda'):
+        condiciones.append(f"{alias}.moneda = %s")
+        params.append(filtros['moneda'])
+
+    sql = ''.join(f" AND {condicion}" for condicion in condiciones)
+    return sql, params
@@ -4,12 +4,17 @@ Integrado con el nuevo procesador robusto
 """
 
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
-from typing import Dict, Any, List, Optional
+from psycopg2.extras import execute_values
+from datetime import datetime, date
+from typing import Dict, Any, Iterable, List, Optional
 import logging
 from decimal import Decimal
+import pandas as pd
+
+from db_pool import get_pool
+from compras_v2_filtros import compilar_filtros_compras, get_valores_exactos
+from utils.pagination import encode_cursor, decode_cursor
+from utils.cache import bump_data_generation
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +23,80 @@ class ComprasV2Service:
     Servicio para guardar datos en compras_v2 y compras_v2_materiales
     """
     
+    # Columnas de compras_v2 escritas por el upsert masivo y su tipo SQL.
+    # El tipo se usa para castear los VALUES (psycopg2 envía NULL sin tipo).
+    COMPRAS_V2_COLUMNAS = {
+        'proveedor': 'text',
+        'fecha_pedido': 'date',
+        'puerto_origen': 'text',
+        'fecha_salida_estimada': 'date',
+        'fecha_arribo_estimada': 'date',
+        'fecha_planta_estimada': 'date',
+        'fecha_salida_real': 'date',
+        'fecha_arribo_real': 'date',
+        'fecha_planta_real': 'date',
+        'moneda': 'text',
+        'dias_credito': 'integer',
+        'anticipo_pct': 'numeric',
+        'anticipo_monto': 'numeric',
+        'fecha_anticipo': 'date',
+        'fecha_pago_factura': 'date',
+        'tipo_cambio_estimado': 'numeric',
+        'tipo_cambio_real': 'numeric',
+        'gastos_importacion_divisa': 'numeric',
+        'gastos_importacion_mxn': 'numeric',
+        'porcentaje_gastos_importacion': 'numeric',
+        'iva_monto_mxn': 'numeric',
+        'total_con_iva_mxn': 'numeric',
+        'dias_transporte': 'integer',
+        'dias_puerto_planta': 'integer',
+    }
+    
+    CAMPOS_PORCENTAJE = ('anticipo_pct', 'porcentaje_gastos_importacion')
+    CAMPOS_DECIMALES = ('anticipo_monto', 'tipo_cambio_estimado', 'tipo_cambio_real',
+                        'gastos_importacion_divisa', 'gastos_importacion_mxn',
+                        'iva_monto_mxn', 'total_con_iva_mxn')
+    
+    # Columnas de compras_v2_materiales en el orden de los VALUES del upsert
+    COMPRAS_V2_MATERIALES_COLUMNAS = (
+        'compra_id', 'material_codigo', 'kg', 'pu_divisa', 'pu_mxn', 'pu_usd',
+        'costo_total_divisa', 'costo_total_mxn', 'pu_mxn_importacion',
+        'costo_total_mxn_imporacion', 'iva', 'costo_total_con_iva', 'compra_imi'
+    )
+    
+    # Registros enviados por sentencia en los upserts masivos
+    BULK_BATCH_SIZE = 500
+    
+    # KPIs de compras: nombre -> expresión SQL sobre compras filtradas (c, una fila
+    # por compra) y sus materiales preagregados por IMI (m). Ver calculate_kpis.
+    KPI_COMPRAS_SQL = {
+        'total_compras': "COUNT(DISTINCT c.imi)",
+        'total_proveedores': "COUNT(DISTINCT c.proveedor)",
+        'total_kilogramos': "SUM(m.kg)",
+        'total_costo_divisa': "SUM(c.total_con_iva_divisa)",
+        'total_costo_mxn': "SUM(c.total_con_iva_mxn)",
+        'compras_con_anticipo': "SUM(CASE WHEN c.anticipo_monto > 0 THEN 1 ELSE 0 END)",
+        'compras_pagadas': "SUM(CASE WHEN c.fecha_pago_factura IS NOT NULL THEN 1 ELSE 0 END)",
+        'tipo_cambio_promedio': "AVG(c.tipo_cambio_real)",
+        'dias_credito_promedio': "AVG(c.dias_credito)",
+        'compras_pendientes': "SUM(CASE WHEN c.fecha_pago_factura IS NULL THEN c.total_con_iva_mxn ELSE 0 END)",
+        'compras_pendientes_count': "SUM(CASE WHEN c.fecha_pago_factura IS NULL THEN 1 ELSE 0 END)",
+        'promedio_por_proveedor': "SUM(c.total_con_iva_mxn) / NULLIF(COUNT(DISTINCT c.proveedor), 0)",
+        'proveedores_unicos': "COUNT(DISTINCT c.proveedor)",
+        'ciclo_compras_promedio': "AVG(c.fecha_arribo_estimada - c.fecha_salida_estimada)",
+        # Promedios de precio por fila de material (no por compra)
+        'precio_unitario_promedio_usd': "SUM(m.suma_pu_divisa) / NULLIF(SUM(m.num_pu_divisa), 0)",
+        'precio_unitario_promedio_mxn': "SUM(m.suma_pu_mxn) / NULLIF(SUM(m.num_pu_mxn), 0)",
+        'materiales_unicos': "(SELECT COUNT(DISTINCT material_codigo) FROM materiales_filtrados)",
+        'dias_transporte_promedio': "ROUND(AVG(c.dias_transporte)::numeric, 1)",
+        'dias_puerto_planta_promedio': "ROUND(AVG(c.dias_puerto_planta)::numeric, 1)",
+    }
+    
     def __init__(self):
         self.conn = None
+        self.pool = None
+        self.compras_fallidas = []
+        self.materiales_omitidos = []
     
     def load_production_config(self):
         """Carga la configuración desde production.env"""
@@ -39,42 +116,49 @@ class ComprasV2Service:
         
         return config
     
+    def get_database_url(self) -> Optional[str]:
+        """Resuelve DATABASE_URL desde el entorno o production.env"""
+        # En producción (Render), usar variables de entorno directamente
+        database_url = os.getenv("DATABASE_URL")
+        
+        if not database_url:
+            # Fallback: intentar cargar desde archivo
+            config = self.load_production_config()
+            if config:
+                database_url = config.get("DATABASE_URL")
+        
+        return database_url
+    
     def get_connection(self):
-        """Obtiene conexión a Supabase"""
+        """Obtiene conexión a Supabase prestada del pool compartido"""
         if self.conn and not self.conn.closed:
             return self.conn
         
         try:
-            # En producción (Render), usar variables de entorno directamente
-            database_url = os.getenv("DATABASE_URL")
-            
-            if not database_url:
-                # Fallback: intentar cargar desde archivo
-                config = self.load_production_config()
-                if config:
-                    database_url = config.get("DATABASE_URL")
+            database_url = self.get_database_url()
             
             if not database_url:
                 logger.error("DATABASE_URL no encontrada en variables de entorno ni en production.env")
                 return None
             
-            self.conn = psycopg2.connect(
-                database_url,
-                cursor_factory=RealDictCursor,
-                sslmode='require',
-                connect_timeout=30
-            )
+            self.pool = get_pool(database_url)
+            self.conn = self.pool.getconn()
             
             return self.conn
-            
+        
         except Exception as e:
             logger.error(f"Error conectando a Supabase: {str(e)}")
             return None
     
     def close_connection(self):
-        """Cierra la conexión a la base de datos"""
-        if self.conn and not self.conn.closed:
-            self.conn.close()
+        """Devuelve la conexión al pool (ya no cierra el socket)"""
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        if self.pool is not None:
+            self.pool.putconn(conn)
+        elif not conn.closed:
+            conn.close()
     
     def safe_decimal(self, value, default=0.0):
         """Convierte un valor a Decimal de forma segura"""
@@ -113,7 +197,7 @@ class ComprasV2Service:
             else:
                 # Para otras monedas, devolver el valor original
                 return pu_divisa_decimal
-                
+        
         except Exception as e:
             logger.warning(f"Error calculando pu_usd: {str(e)}, usando pu_divisa")
             return self.safe_decimal(pu_divisa)
@@ -217,375 +301,456 @@ class ComprasV2Service:
         return value is not None
     
     
-    def save_compras_v2(self, compras: List[Dict[str, Any]], archivo_id: int) -> int:
-        """Guarda compras en la tabla compras_v2 con actualización parcial"""
+    def _preparar_compra_v2(self, compra: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Prepara una compra para el upsert masivo.
+        
+        Retorna los valores a insertar y la lista de campos que pueden sobrescribir
+        un registro existente (solo campos no vacíos, igual que la actualización parcial).
+        """
+        valores = {}
+        campos_actualizables = []
+        
+        for field in self.COMPRAS_V2_COLUMNAS:
+            if field in ('dias_transporte', 'dias_puerto_planta'):
+                continue
+            value = compra.get(field)
+            if field in self.CAMPOS_PORCENTAJE:
+                valores[field] = self.safe_percentage(value)
+            elif field in self.CAMPOS_DECIMALES:
+                valores[field] = self.safe_decimal(value)
+            else:
+                valores[field] = value
+            if self._is_valid_update_value(value):
+                campos_actualizables.append(field)
+        
+        # Calcular dias_transporte y dias_puerto_planta
+        valores['dias_transporte'] = self.calculate_dias_transporte(
+            compra.get('fecha_salida_real'),
+            compra.get('fecha_arribo_real')
+        )
+        valores['dias_puerto_planta'] = self.calculate_dias_puerto_planta(
+            compra.get('fecha_arribo_real'),
+            compra.get('fecha_planta_real')
+        )
+        for field in ('dias_transporte', 'dias_puerto_planta'):
+            if valores[field] is not None:
+                campos_actualizables.append(field)
+        
+        return {
+            'imi': compra['imi'],
+            'valores': valores,
+            'campos': campos_actualizables,
+            'filas': 1
+        }
+    
+    def _upsert_compras_v2_lote(self, cursor, lote: List[Dict[str, Any]]) -> int:
+        """
+        Escribe un lote de compras con un único INSERT ... ON CONFLICT (imi) DO UPDATE.
+        
+        Las filas nuevas se insertan completas; en las existentes solo se sobrescriben
+        los campos listados en 'campos' de cada compra y siempre updated_at.
+        """
+        columnas = list(self.COMPRAS_V2_COLUMNAS)
+        lista_columnas = ', '.join(columnas)
+        asignaciones = ',\n                    '.join(
+            f"CASE WHEN '{col}' = ANY(s.campos) THEN EXCLUDED.{col} ELSE c.{col} END"
+            for col in columnas
+        )
+        
+        query = f"""
+            WITH staged (imi, {lista_columnas}, campos, ts) AS (VALUES %s)
+            INSERT INTO compras_v2 AS c (imi, {lista_columnas}, created_at, updated_at)
+            SELECT imi, {lista_columnas}, ts, ts FROM staged
+            ON CONFLICT (imi) DO UPDATE SET ({lista_columnas}, updated_at) = (
+                SELECT
+                    {asignaciones},
+                    s.ts
+                FROM staged s
+                WHERE s.imi = EXCLUDED.imi
+            )
+            RETURNING imi
+        """
+        template = '(%s, ' + ', '.join(
+            f'%s::{tipo}' for tipo in self.COMPRAS_V2_COLUMNAS.values()
+        ) + ', %s::text[], %s::timestamp)'
+        
+        ahora = datetime.utcnow()
+        filas = [
+            (compra['imi'],
+             *[compra['valores'][col] for col in columnas],
+             compra['campos'],
+             ahora)
+            for compra in lote
+        ]
+        
+        execute_values(cursor, query, filas, template=template, page_size=len(filas), fetch=True)
+        return sum(compra['filas'] for compra in lote)
+    
+    def _escribir_en_lotes(self, cursor, registros: List[Any], escribir_lote, etiqueta: str, identificar) -> tuple:
+        """
+        Escribe registros por lotes dentro de la transacción abierta.
+        
+        Cada lote corre bajo un SAVEPOINT; si falla se reintenta registro por registro
+        para aislar los que tienen error. Retorna (guardados, fallidos).
+        """
+        guardados = 0
+        fallidos = []
+        
+        for inicio in range(0, len(registros), self.BULK_BATCH_SIZE):
+            lote = registros[inicio:inicio + self.BULK_BATCH_SIZE]
+            
+            cursor.execute("SAVEPOINT lote_bulk")
+            try:
+                guardados += escribir_lote(cursor, lote)
+                cursor.execute("RELEASE SAVEPOINT lote_bulk")
+                continue
+            except Exception as e:
+                logger.warning(f"Error en lote de {len(lote)} {etiqueta}, reintentando uno por uno: {str(e).strip()}")
+                cursor.execute("ROLLBACK TO SAVEPOINT lote_bulk")
+            
+            for registro in lote:
+                cursor.execute("SAVEPOINT registro_bulk")
+                try:
+                    guardados += escribir_lote(cursor, [registro])
+                    cursor.execute("RELEASE SAVEPOINT registro_bulk")
+                except Exception as e:
+                    logger.error(f"Error guardando {etiqueta} {identificar(registro)}: {str(e).strip()}")
+                    cursor.execute("ROLLBACK TO SAVEPOINT registro_bulk")
+                    fallidos.append({'registro': identificar(registro), 'error': str(e).strip()})
+        
+        return guardados, fallidos
+    
+    def _registros(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
+        """Filas del DataFrame como diccionarios, con None en lugar de NaN/NaT/NA"""
+        return df.astype(object).where(df.notna(), None).to_dict('records')
+    
+    def _guardar_por_bloques(self, bloques: Iterable[Any], guardar_bloque, etiqueta: str,
+                             al_fallar, progreso=None, filas_previas: int = 0,
+                             antes=None, commit: bool = True) -> tuple:
+        """
+        Escribe bloques de registros en una sola transacción, cada uno bajo su SAVEPOINT.
+        
+        bloques puede ser un generador: se consume bloque a bloque, de modo que solo
+        hay un bloque en memoria. Si un bloque falla se revierte solo ese bloque y sus
+        registros se reportan con al_fallar(bloque, error). Tras cada bloque se llama
+        progreso("guardado", filas) con las filas acumuladas (más filas_previas).
+        antes(cursor), si se indica, se ejecuta dentro de la misma transacción antes
+        del primer bloque. Con commit=False la transacción queda abierta para que el
+        llamador la continúe; cualquier error la revierte completa.
+        Retorna (guardados, filas).
+        """
         conn = self.get_connection()
         if not conn:
-            return 0
+            return 0, 0
         
+        guardados = 0
+        filas = 0
+        cursor = conn.cursor()
         try:
-            compras_guardadas = 0
+            if antes:
+                antes(cursor)
             
-            for compra in compras:
-                # Usar transacción individual para cada compra
+            for numero, bloque in enumerate(bloques, start=1):
+                if len(bloque) == 0:
+                    continue
+                
+                cursor.execute("SAVEPOINT bloque_carga")
                 try:
-                    cursor = conn.cursor()
-                    # Verificar si ya existe
-                    cursor.execute("SELECT imi FROM compras_v2 WHERE imi = %s", (compra['imi'],))
-                    existing = cursor.fetchone()
-                    
-                    if existing:
-                        logger.info(f"Compra con IMI {compra['imi']} ya existe, verificando actualización parcial...")
-                        
-                        # Construir query de actualización dinámica solo con campos no vacíos
-                        update_fields = []
-                        update_values = []
-                        
-                        # Lista de campos que pueden ser actualizados
-                        updatable_fields = {
-                            'proveedor': compra.get('proveedor'),
-                            'fecha_pedido': compra.get('fecha_pedido'),
-                            'puerto_origen': compra.get('puerto_origen'),
-                            'fecha_salida_estimada': compra.get('fecha_salida_estimada'),
-                            'fecha_arribo_estimada': compra.get('fecha_arribo_estimada'),
-                            'fecha_planta_estimada': compra.get('fecha_planta_estimada'),
-                            'fecha_salida_real': compra.get('fecha_salida_real'),
-                            'fecha_arribo_real': compra.get('fecha_arribo_real'),
-                            'fecha_planta_real': compra.get('fecha_planta_real'),
-                            'moneda': compra.get('moneda'),
-                            'dias_credito': compra.get('dias_credito'),
-                            'anticipo_pct': compra.get('anticipo_pct'),
-                            'anticipo_monto': compra.get('anticipo_monto'),
-                            'fecha_anticipo': compra.get('fecha_anticipo'),
-                            'fecha_pago_factura': compra.get('fecha_pago_factura'),
-                            'tipo_cambio_estimado': compra.get('tipo_cambio_estimado'),
-                            'tipo_cambio_real': compra.get('tipo_cambio_real'),
-                            'gastos_importacion_divisa': compra.get('gastos_importacion_divisa'),
-                            'gastos_importacion_mxn': compra.get('gastos_importacion_mxn'),
-                            'porcentaje_gastos_importacion': compra.get('porcentaje_gastos_importacion'),
-                            'iva_monto_mxn': compra.get('iva_monto_mxn'),
-                            'total_con_iva_mxn': compra.get('total_con_iva_mxn')
-                        }
-                        
-                        # Solo agregar campos que tienen valores no vacíos
-                        for field, value in updatable_fields.items():
-                            # Verificar si el valor es válido para actualización
-                            if self._is_valid_update_value(value):
-                                if field in ['anticipo_pct', 'porcentaje_gastos_importacion']:
-                                    update_fields.append(f"{field} = %s")
-                                    update_values.append(self.safe_percentage(value))
-                                elif field in ['anticipo_monto', 'tipo_cambio_estimado', 'tipo_cambio_real', 
-                                             'gastos_importacion_divisa', 'gastos_importacion_mxn', 
-                                             'iva_monto_mxn', 'total_con_iva_mxn']:
-                                    update_fields.append(f"{field} = %s")
-                                    update_values.append(self.safe_decimal(value))
-                                else:
-                                    update_fields.append(f"{field} = %s")
-                                    update_values.append(value)
-                        
-                        # Calcular dias_transporte y dias_puerto_planta
-                        dias_transporte = self.calculate_dias_transporte(
-                            compra.get('fecha_salida_real'),
-                            compra.get('fecha_arribo_real')
-                        )
-                        dias_puerto_planta = self.calculate_dias_puerto_planta(
-                            compra.get('fecha_arribo_real'),
-                            compra.get('fecha_planta_real')
-                        )
-                        
-                        # Agregar columnas calculadas si tienen valor
-                        if dias_transporte is not None:
-                            update_fields.append("dias_transporte = %s")
-                            update_values.append(dias_transporte)
-                        
-                        if dias_puerto_planta is not None:
-                            update_fields.append("dias_puerto_planta = %s")
-                            update_values.append(dias_puerto_planta)
-                        
-                        # Siempre actualizar el timestamp
-                        update_fields.append("updated_at = %s")
-                        update_values.append(datetime.utcnow())
-                        
-                        # Agregar el IMI para la condición WHERE
-                        update_values.append(compra['imi'])
-                        
-                        if update_fields:
-                            # Construir query dinámico
-                            update_query = f"""
-                            UPDATE compras_v2 SET
-                                    {', '.join(update_fields)}
-                            WHERE imi = %s
-                            """
-                            
-                            cursor.execute(update_query, update_values)
-                            logger.info(f"Actualizando compra IMI {compra['imi']} con {len(update_fields)-1} campos")
-                        else:
-                            logger.info(f"No hay campos para actualizar en compra IMI {compra['imi']}")
-                    else:
-                        # Insertar nuevo registro
-                        logger.info(f"Insertando nueva compra IMI {compra['imi']}...")
-                        
-                        # Calcular dias_transporte y dias_puerto_planta
-                        dias_transporte = self.calculate_dias_transporte(
-                            compra.get('fecha_salida_real'),
-                            compra.get('fecha_arribo_real')
-                        )
-                        dias_puerto_planta = self.calculate_dias_puerto_planta(
-                            compra.get('fecha_arribo_real'),
-                            compra.get('fecha_planta_real')
-                        )
-                        
-                        cursor.execute("""
-                            INSERT INTO compras_v2 (
-                                imi, proveedor, fecha_pedido, puerto_origen,
-                                fecha_salida_estimada, fecha_arribo_estimada, fecha_planta_estimada,
-                                moneda, dias_credito, anticipo_pct, anticipo_monto,
-                                fecha_anticipo, fecha_pago_factura,
-                                tipo_cambio_estimado, tipo_cambio_real,
-                                gastos_importacion_divisa, gastos_importacion_mxn,
-                                porcentaje_gastos_importacion,
-                                iva_monto_mxn, total_con_iva_mxn,
-                                dias_transporte, dias_puerto_planta,
-                                created_at, updated_at
-                            )
-                            VALUES (
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                            )
-                        """, (
-                            compra['imi'],
-                            compra['proveedor'],
-                            compra['fecha_pedido'],
-                            compra['puerto_origen'],
-                            compra['fecha_salida_estimada'],
-                            compra['fecha_arribo_estimada'],
-                            compra['fecha_planta_estimada'],
-                            compra['moneda'],
-                            compra['dias_credito'],
-                            self.safe_percentage(compra['anticipo_pct']),
-                            self.safe_decimal(compra['anticipo_monto']),
-                            compra['fecha_anticipo'],
-                            compra['fecha_pago_factura'],
-                            self.safe_decimal(compra['tipo_cambio_estimado']),
-                            self.safe_decimal(compra['tipo_cambio_real']),
-                            self.safe_decimal(compra['gastos_importacion_divisa']),
-                            self.safe_decimal(compra['gastos_importacion_mxn']),
-                            self.safe_percentage(compra['porcentaje_gastos_importacion']),
-                            self.safe_decimal(compra['iva_monto_mxn']),
-                            self.safe_decimal(compra['total_con_iva_mxn']),
-                            dias_transporte,
-                            dias_puerto_planta,
-                            datetime.utcnow(),
-                            datetime.utcnow()
-                        ))
-                    
-                    # Commit individual para esta compra
-                    conn.commit()
-                    compras_guardadas += 1
-                    logger.info(f"Compra IMI {compra['imi']} guardada exitosamente")
-                    
+                    guardados += guardar_bloque(cursor, bloque)
+                    cursor.execute("RELEASE SAVEPOINT bloque_carga")
                 except Exception as e:
-                    logger.error(f"Error guardando compra IMI {compra['imi']}: {str(e)}")
-                    # Rollback individual para esta compra
-                    conn.rollback()
-                    continue
-                finally:
-                    # Cerrar cursor individual
-                    if 'cursor' in locals():
-                        cursor.close()
-            
-            logger.info(f"Guardadas {compras_guardadas} compras en compras_v2")
-            
-            cursor.close()
-            return compras_guardadas
-            
+                    logger.error(f"Error en bloque {numero} de {etiqueta} ({len(bloque)} registros), se omite: {str(e).strip()}")
+                    cursor.execute("ROLLBACK TO SAVEPOINT bloque_carga")
+                    al_fallar(bloque, str(e).strip())
+                
+                filas += len(bloque)
+                if progreso:
+                    progreso("guardado", filas_previas + filas)
+            
+            if commit:
+                conn.commit()
+                bump_data_generation(f"compras_v2 {etiqueta}")
+            logger.info(f"Guardados {guardados} de {filas} {etiqueta}")
+            return guardados, filas
+        
         except Exception as e:
-            logger.error(f"Error guardando compras_v2: {str(e)}")
+            logger.error(f"Error guardando {etiqueta}: {str(e)}")
             conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    
+    def _guardar_bloque_compras(self, cursor, compras) -> int:
+        """
+        Escribe un bloque de compras (lista de diccionarios o DataFrame) con upserts por lotes.
+        Si un lote falla se reintenta compra por compra; las que fallan quedan en self.compras_fallidas.
+        """
+        if isinstance(compras, pd.DataFrame):
+            compras = self._registros(compras)
+        
+        # Preparar y consolidar por IMI: una compra repetida en el archivo se
+        # comporta como inserción seguida de actualización parcial
+        staged = {}
+        for compra in compras:
+            try:
+                preparada = self._preparar_compra_v2(compra)
+            except Exception as e:
+                logger.error(f"Error preparando compra IMI {compra.get('imi')}: {str(e)}")
+                self.compras_fallidas.append({'imi': compra.get('imi'), 'error': str(e)})
+                continue
+            
+            existente = staged.get(preparada['imi'])
+            if existente:
+                for field in preparada['campos']:
+                    existente['valores'][field] = preparada['valores'][field]
+                    if field not in existente['campos']:
+                        existente['campos'].append(field)
+                existente['filas'] += 1
+            else:
+                staged[preparada['imi']] = preparada
+        
+        compras_guardadas, fallidas = self._escribir_en_lotes(
+            cursor, list(staged.values()), self._upsert_compras_v2_lote, 'compra IMI',
+            lambda compra: compra['imi']
+        )
+        self.compras_fallidas.extend(
+            {'imi': fallida['registro'], 'error': fallida['error']} for fallida in fallidas
+        )
+        return compras_guardadas
+    
+    def _marcar_compras_fallidas(self, compras, error: str):
+        imis = compras['imi'].tolist() if isinstance(compras, pd.DataFrame) else [compra.get('imi') for compra in compras]
+        self.compras_fallidas.extend({'imi': imi, 'error': error} for imi in imis)
+    
+    def save_compras_v2(self, compras: List[Dict[str, Any]], archivo_id: int) -> int:
+        """
+        Guarda compras en la tabla compras_v2 con actualización parcial.
+        
+        Todas las compras se escriben en una sola transacción mediante upserts por lotes.
+        Si un lote falla se reintenta compra por compra para aislar las filas con error,
+        que quedan registradas en self.compras_fallidas.
+        """
+        self.compras_fallidas = []
+        try:
+            compras_guardadas, _ = self._guardar_por_bloques(
+                [compras], self._guardar_bloque_compras, 'compras', self._marcar_compras_fallidas
+            )
+            return compras_guardadas
+        except Exception:
             return 0
     
+    def _cargar_compras_para_materiales(self, cursor, imis: List[Any]) -> pd.DataFrame:
+        """Carga en una sola consulta los datos de las compras padre, indexados por IMI"""
+        columnas = ['imi', 'moneda', 'tipo_cambio_real', 'tipo_cambio_estimado',
+                    'gastos_importacion_mxn', 'porcentaje_gastos_importacion', 'costo_total_mxn']
+        if not imis:
+            return pd.DataFrame(columns=columnas)
+        
+        cursor.execute(f"""
+            SELECT {', '.join(columnas)}
+            FROM compras_v2
+            WHERE imi = ANY(%s)
+        """, (list(imis),))
+        compras_map = {row['imi']: dict(row) for row in cursor.fetchall()}
+        return pd.DataFrame(list(compras_map.values()), columns=columnas)
+    
+    def _calcular_precios_materiales(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Calcula pu_usd, pu_mxn, pu_mxn_importacion, IVA y costo_total_con_iva por columnas.
+        
+        Aplica las mismas reglas que calculate_pu_usd y el cálculo por material:
+        los valores que vienen del Excel se respetan y solo se calculan los que vienen en 0.
+        """
+        def numerico(columna):
+            return pd.to_numeric(df[columna], errors='coerce')
+        
+        moneda = df['moneda']
+        tc_real = numerico('tipo_cambio_real')
+        tc_estimado = numerico('tipo_cambio_estimado')
+        
+        kg = numerico('kg').fillna(0.0)
+        pu_divisa = numerico('pu_divisa').fillna(0.0)
+        pu_mxn = numerico('pu_mxn').fillna(0.0)
+        costo_total_mxn = numerico('costo_total_mxn').fillna(0.0)
+        pu_mxn_importacion = numerico('pu_mxn_importacion').fillna(0.0)
+        costo_total_mxn_importacion = numerico('costo_total_mxn_imporacion').fillna(0.0)
+        iva = numerico('iva').fillna(0.0)
+        costo_total_con_iva = numerico('costo_total_con_iva').fillna(0.0)
+        
+        # pu_usd: MXN se convierte con tipo_cambio_real o estimado (0 y 1.0 se tratan como NULL)
+        tc_mxn = tc_real.where((tc_real > 0) & (tc_real != 1.0),
+                               tc_estimado.where((tc_estimado > 0) & (tc_estimado != 1.0)))
+        pu_usd = pu_divisa.where(~((moneda == 'MXN') & (tc_mxn > 0)), pu_divisa / tc_mxn)
+        
+        # pu_mxn si no viene del Excel: tipo de cambio real, sino estimado, sino 20
+        tc_efectivo = tc_real.where(tc_real.fillna(0) != 0,
+                                    tc_estimado.where(tc_estimado.fillna(0) != 0, 20.0))
+        calcular_pu_mxn = (pu_mxn == 0) & (pu_divisa > 0) & (moneda == 'USD')
+        pu_mxn = pu_mxn.where(~calcular_pu_mxn, pu_divisa * tc_efectivo)
+        
+        # porcentaje_gastos_importacion de la compra, derivado de gastos/costo si viene en 0
+        porcentaje_gastos = numerico('porcentaje_gastos_importacion').fillna(0.0)
+        gastos_mxn = numerico('gastos_importacion_mxn').fillna(0.0)
+        costo_compra = numerico('costo_total_mxn_compra').fillna(0.0)
+        derivar = (porcentaje_gastos == 0) & (gastos_mxn > 0) & (costo_compra > 0)
+        porcentaje_gastos = porcentaje_gastos.where(~derivar, gastos_mxn / costo_compra * 100)
+        factor_gastos = 1 + porcentaje_gastos / 100
+        
+        pu_mxn_importacion = pu_mxn_importacion.where(
+            ~((pu_mxn_importacion == 0) & (pu_mxn > 0)), pu_mxn * factor_gastos)
+        
+        costo_mxn_calculado = costo_total_mxn.where(
+            ~((costo_total_mxn == 0) & (pu_mxn > 0)), kg * pu_mxn)
+        costo_total_mxn_importacion = costo_total_mxn_importacion.where(
+            ~((costo_total_mxn_importacion == 0) & (costo_mxn_calculado > 0)),
+            costo_mxn_calculado * factor_gastos)
+        
+        # IVA del 16% si no viene especificado
+        iva = iva.where(~((iva == 0) & (costo_total_mxn_importacion > 0)),
+                        costo_total_mxn_importacion * 0.16)
+        costo_total_con_iva = costo_total_con_iva.where(
+            costo_total_con_iva != 0, costo_total_mxn_importacion + iva)
+        
+        return pd.DataFrame({
+            'compra_id': df['compra_id'],
+            'material_codigo': df['material_codigo'],
+            'kg': kg,
+            'pu_divisa': pu_divisa,
+            'pu_mxn': pu_mxn,
+            'pu_usd': pu_usd,
+            'costo_total_divisa': numerico('costo_total_divisa').fillna(0.0),
+            'costo_total_mxn': costo_total_mxn,
+            'pu_mxn_importacion': pu_mxn_importacion,
+            'costo_total_mxn_imporacion': costo_total_mxn_importacion,
+            'iva': iva,
+            'costo_total_con_iva': costo_total_con_iva,
+            'compra_imi': df['compra_imi'],
+        })
+    
+    def _upsert_materiales_lote(self, cursor, lote: List[tuple]) -> int:
+        """Escribe un lote de materiales con INSERT ... ON CONFLICT (compra_id, material_codigo)"""
+        columnas = ', '.join(self.COMPRAS_V2_MATERIALES_COLUMNAS)
+        asignaciones = ',\n                '.join(
+            f"{col} = EXCLUDED.{col}"
+            for col in self.COMPRAS_V2_MATERIALES_COLUMNAS
+            if col not in ('compra_id', 'material_codigo')
+        )
+        
+        query = f"""
+            INSERT INTO compras_v2_materiales ({columnas}, created_at, updated_at)
+            VALUES %s
+            ON CONFLICT (compra_id, material_codigo) DO UPDATE SET
+                {asignaciones},
+                updated_at = EXCLUDED.updated_at
+        """
+        ahora = datetime.utcnow()
+        execute_values(cursor, query, [fila + (ahora, ahora) for fila in lote], page_size=len(lote))
+        return len(lote)
+    
+    def _guardar_bloque_materiales(self, cursor, materiales) -> int:
+        """
+        Escribe un bloque de materiales (DataFrame o lista de diccionarios).
+        
+        Carga una sola vez las compras padre del bloque, calcula los precios por columnas
+        y escribe con upserts por lotes. Los materiales huérfanos y los que fallan quedan
+        registrados en self.materiales_omitidos.
+        """
+        df = materiales if isinstance(materiales, pd.DataFrame) else pd.DataFrame(materiales)
+        compras_df = self._cargar_compras_para_materiales(cursor, df['compra_id'].dropna().unique().tolist())
+        compras_df = compras_df.rename(columns={'costo_total_mxn': 'costo_total_mxn_compra'})
+        compras_df = compras_df.astype({'imi': df['compra_id'].dtype})
+        
+        # Anti-join: materiales cuya compra no existe en compras_v2
+        df = df.merge(compras_df, how='left', left_on='compra_id', right_on='imi', indicator=True)
+        huerfanos = df[df['_merge'] == 'left_only']
+        for material_codigo, compra_id in zip(huerfanos['material_codigo'], huerfanos['compra_id']):
+            logger.warning(f"⚠️  Material huérfano: {material_codigo} - IMI {compra_id} no existe en compras_v2. Omitiendo...")
+            self.materiales_omitidos.append({'compra_id': compra_id, 'material_codigo': material_codigo, 'error': 'compra inexistente'})
+        df = df[df['_merge'] == 'both']
+        
+        calculados = self._calcular_precios_materiales(df)
+        # Un material repetido para la misma compra conserva la última fila del archivo
+        calculados = calculados.drop_duplicates(subset=['compra_id', 'material_codigo'], keep='last')
+        
+        filas = list(zip(*[calculados[col].tolist() for col in self.COMPRAS_V2_MATERIALES_COLUMNAS]))
+        materiales_guardados, fallidos = self._escribir_en_lotes(
+            cursor, filas, self._upsert_materiales_lote, 'material',
+            lambda fila: f"{fila[1]} para compra {fila[0]}"
+        )
+        self.materiales_omitidos.extend(fallidos)
+        return materiales_guardados
+    
+    def _marcar_materiales_omitidos(self, materiales, error: str):
+        df = materiales if isinstance(materiales, pd.DataFrame) else pd.DataFrame(materiales)
+        self.materiales_omitidos.extend(
+            {'compra_id': compra_id, 'material_codigo': material_codigo, 'error': error}
+            for compra_id, material_codigo in zip(df['compra_id'], df['material_codigo'])
+        )
+    
     def save_compras_v2_materiales(self, materiales: List[Dict[str, Any]]) -> int:
-        """Guarda materiales en la tabla compras_v2_materiales"""
-        conn = self.get_connection()
-        if not conn:
+        """
+        Guarda materiales en la tabla compras_v2_materiales en una sola transacción.
+        Los materiales huérfanos y los que fallan quedan registrados en self.materiales_omitidos.
+        """
+        self.materiales_omitidos = []
+        if not len(materiales):
             return 0
-        
         try:
-            cursor = conn.cursor()
-            
-            materiales_guardados = 0
-            
-            for material in materiales:
-                try:
-                    # Verificar primero si la compra existe y obtener datos necesarios
-                    cursor.execute("""
-                        SELECT moneda, tipo_cambio_real, tipo_cambio_estimado,
-                               gastos_importacion_mxn, porcentaje_gastos_importacion,
-                               costo_total_mxn, gastos_importacion_divisa, iva_monto_divisa,
-                               total_con_iva_divisa
-                        FROM compras_v2 
-                        WHERE imi = %s
-                    """, (material['compra_id'],))
-                    compra_info = cursor.fetchone()
-                    
-                    # Si la compra no existe, skip este material (material huérfano)
-                    if not compra_info:
-                        logger.warning(f"⚠️  Material huérfano: {material['material_codigo']} - IMI {material['compra_id']} no existe en compras_v2. Omitiendo...")
-                        continue
-                    
-                    # Calcular pu_usd
-                    pu_usd = self.calculate_pu_usd(
-                        material['pu_divisa'],
-                        compra_info['moneda'] if compra_info else 'USD',  # moneda
-                        compra_info['tipo_cambio_real'] if compra_info else None,   # tipo_cambio_real
-                        compra_info['tipo_cambio_estimado'] if compra_info else None    # tipo_cambio_estimado
-                    )
-                    
-                    # Calcular pu_mxn si no viene del Excel
-                    pu_divisa = self.safe_decimal(material['pu_divisa'])
-                    pu_mxn = self.safe_decimal(material['pu_mxn'])
-                    
-                    if pu_mxn == 0 and pu_divisa > 0:
-                        # Usar tipo de cambio real si existe, sino el estimado
-                        tipo_cambio_efectivo = compra_info.get('tipo_cambio_real') or compra_info.get('tipo_cambio_estimado') or 20.0
-                        if compra_info.get('moneda') == 'USD':
-                            pu_mxn = pu_divisa * tipo_cambio_efectivo
-                    
-                    # Calcular porcentaje_gastos_importacion si no viene
-                    porcentaje_gastos = self.safe_decimal(compra_info.get('porcentaje_gastos_importacion', 0))
-                    gastos_importacion_mxn = self.safe_decimal(compra_info.get('gastos_importacion_mxn', 0))
-                    costo_total_mxn_compra = self.safe_decimal(compra_info.get('costo_total_mxn', 0))
-                    
-                    if porcentaje_gastos == 0 and gastos_importacion_mxn > 0 and costo_total_mxn_compra > 0:
-                        porcentaje_gastos = (gastos_importacion_mxn / costo_total_mxn_compra) * 100
-                    
-                    # Calcular pu_mxn_importacion
-                    if material.get('pu_mxn_importacion', 0) == 0 and pu_mxn > 0:
-                        pu_mxn_importacion = pu_mxn * (1 + porcentaje_gastos / 100)
-                    else:
-                        pu_mxn_importacion = self.safe_decimal(material['pu_mxn_importacion'])
-                    
-                    # Calcular costo_total_mxn
-                    kg = self.safe_decimal(material['kg'])
-                    costo_total_mxn = self.safe_decimal(material['costo_total_mxn'])
-                    
-                    if costo_total_mxn == 0 and pu_mxn > 0:
-                        costo_total_mxn = kg * pu_mxn
-                    
-                    # Calcular costo_total_mxn_importacion
-                    if material.get('costo_total_mxn_imporacion', 0) == 0 and costo_total_mxn > 0:
-                        costo_total_mxn_importacion = costo_total_mxn * (1 + porcentaje_gastos / 100)
-                    else:
-                        costo_total_mxn_importacion = self.safe_decimal(material['costo_total_mxn_imporacion'])
-                    
-                    # Calcular IVA si no viene
-                    iva = self.safe_decimal(material.get('iva', 0))
-                    if iva == 0 and costo_total_mxn_importacion > 0:
-                        # Asumir 16% de IVA si no viene especificado
-                        iva = costo_total_mxn_importacion * 0.16
-                    
-                    # Calcular costo_total_con_iva
-                    if material.get('costo_total_con_iva', 0) == 0:
-                        costo_total_con_iva = costo_total_mxn_importacion + iva
-                    else:
-                        costo_total_con_iva = self.safe_decimal(material['costo_total_con_iva'])
-                    
-                    # Verificar si ya existe (usar compra_id + material_codigo como clave compuesta)
-                    cursor.execute("""
-                        SELECT compra_id FROM compras_v2_materiales 
-                        WHERE compra_id = %s AND material_codigo = %s
-                    """, (material['compra_id'], material['material_codigo']))
-                    existing = cursor.fetchone()
-                    
-                    if existing:
-                        logger.warning(f"Material {material['material_codigo']} para compra {material['compra_id']} ya existe, actualizando...")
-                        
-                        # Actualizar registro existente
-                        cursor.execute("""
-                            UPDATE compras_v2_materiales SET
-                                kg = %s,
-                                pu_divisa = %s,
-                                pu_mxn = %s,
-                                pu_usd = %s,
-                                costo_total_divisa = %s,
-                                costo_total_mxn = %s,
-                                pu_mxn_importacion = %s,
-                                costo_total_mxn_imporacion = %s,
-                                iva = %s,
-                                costo_total_con_iva = %s,
-                                compra_imi = %s,
-                                updated_at = %s
-                            WHERE compra_id = %s AND material_codigo = %s
-                        """, (
-                            kg,
-                            self.safe_decimal(material['pu_divisa']),
-                            pu_mxn,
-                            pu_usd,
-                            self.safe_decimal(material['costo_total_divisa']),
-                            self.safe_decimal(material['costo_total_mxn']),
-                            pu_mxn_importacion,
-                            costo_total_mxn_importacion,
-                            iva,
-                            costo_total_con_iva,
-                            material['compra_imi'],
-                            datetime.utcnow(),
-                            material['compra_id'],
-                            material['material_codigo']
-                        ))
-                    else:
-                        # Insertar nuevo registro
-                        cursor.execute("""
-                            INSERT INTO compras_v2_materiales (
-                                compra_id, material_codigo, kg, pu_divisa, pu_mxn, pu_usd,
-                                costo_total_divisa, costo_total_mxn, pu_mxn_importacion,
-                                costo_total_mxn_imporacion, iva, costo_total_con_iva,
-                                compra_imi, created_at, updated_at
-                            )
-                            VALUES (
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                            )
-                        """, (
-                            material['compra_id'],
-                            material['material_codigo'],
-                            kg,
-                            self.safe_decimal(material['pu_divisa']),
-                            pu_mxn,
-                            pu_usd,
-                            self.safe_decimal(material['costo_total_divisa']),
-                            self.safe_decimal(material['costo_total_mxn']),
-                            pu_mxn_importacion,
-                            costo_total_mxn_importacion,
-                            iva,
-                            costo_total_con_iva,
-                            material['compra_imi'],
-                            datetime.utcnow(),
-                            datetime.utcnow()
-                        ))
-                    
-                    # Commit individual para este material
-                    conn.commit()
-                    materiales_guardados += 1
-                    logger.info(f"Material {material['material_codigo']} para compra IMI {material['compra_id']} guardado exitosamente")
-                    
-                except Exception as e:
-                    error_msg = str(e) if str(e) else repr(e)
-                    logger.error(f"Error guardando material {material['material_codigo']} para compra {material['compra_id']}: {error_msg}")
-                    import traceback
-                    logger.error(f"Traceback: {traceback.format_exc()}")
-                    # Rollback individual para este material
-                    conn.rollback()
-                    continue
-            
-            logger.info(f"✅ Guardados {materiales_guardados} materiales en compras_v2_materiales")
-            
-            cursor.close()
+            materiales_guardados, _ = self._guardar_por_bloques(
+                [materiales], self._guardar_bloque_materiales, 'materiales', self._marcar_materiales_omitidos
+            )
             return materiales_guardados
-            
-        except Exception as e:
-            logger.error(f"Error guardando compras_v2_materiales: {str(e)}")
-            conn.rollback()
+        except Exception:
             return 0
     
+    def _borrar_compras_existentes(self, cursor):
+        """Borra compras_v2 y sus materiales (en orden por las foreign keys)"""
+        cursor.execute("DELETE FROM compras_v2_materiales")
+        cursor.execute("DELETE FROM compras_v2")
+        logger.info("Datos existentes de compras_v2 borrados (se confirman junto con la carga)")
+    
+    def save_compras_stream(self, compras_bloques: Iterable[Any], materiales_bloques: Iterable[Any],
+                            archivo_id: int, progreso=None, reemplazar: bool = False) -> Dict[str, Any]:
+        """
+        Guarda compras y luego materiales consumiendo los bloques uno a uno.
+        
+        Cada tabla se escribe en su propia transacción con un SAVEPOINT por bloque, así
+        que la memoria usada depende del tamaño del bloque y no del archivo. Los errores
+        que no son de un bloque (p. ej. al leer el archivo) revierten la tabla en curso y
+        se propagan.
+        
+        Con reemplazar=True los datos existentes se borran al inicio de una única
+        transacción que abarca ambas tablas: si algo falla antes del commit final,
+        quedan los datos anteriores completos.
+        """
+        self.compras_fallidas = []
+        self.materiales_omitidos = []
+        
+        compras_guardadas, compras_filas = self._guardar_por_bloques(
+            compras_bloques, self._guardar_bloque_compras, 'compras',
+            self._marcar_compras_fallidas, progreso,
+            antes=self._borrar_compras_existentes if reemplazar else None,
+            commit=not reemplazar
+        )
+        materiales_guardados, materiales_filas = self._guardar_por_bloques(
+            materiales_bloques, self._guardar_bloque_materiales, 'materiales',
+            self._marcar_materiales_omitidos, progreso, filas_previas=compras_filas
+        )
+        
+        compras_omitidas = len(self.compras_fallidas)
+        materiales_omitidos = len(self.materiales_omitidos)
+        
+        return {
+            'compras_guardadas': compras_guardadas,
+            'compras_omitidas': compras_omitidas,
+            'compras_fallidas': self.compras_fallidas,
+            'materiales_guardados': materiales_guardados,
+            'materiales_omitidos': materiales_omitidos,
+            'total_procesados': compras_filas + materiales_filas,
+            'total_omitidos': compras_omitidas + materiales_omitidos
+        }
+    
     def save_compras_data(self, processed_data: Dict[str, Any], archivo_id: int) -> Dict[str, int]:
         """Guarda datos procesados en las tablas compras_v2 y compras_v2_materiales"""
         try:
@@ -594,18 +759,8 @@ class ComprasV2Service:
             
             logger.info(f"Iniciando guardado de {len(compras)} compras y {len(materiales)} materiales")
             
-            # Guardar compras
-            compras_guardadas = self.save_compras_v2(compras, archivo_id)
-            
-            # Guardar materiales
-            materiales_guardados = self.save_compras_v2_materiales(materiales)
-            
-            return {
-                'compras_guardadas': compras_guardadas,
-                'materiales_guardados': materiales_guardados,
-                'total_procesados': len(compras) + len(materiales)
-            }
-            
+            return self.save_compras_stream([compras], [materiales], archivo_id)
+        
         except Exception as e:
             logger.error(f"Error guardando datos de compras: {str(e)}")
             return {
@@ -616,14 +771,35 @@ class ComprasV2Service:
     
     def get_compras_simple(self, limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
         """Obtiene datos básicos de compras con todos los campos necesarios para el dashboard"""
+        return self.get_compras_pagina(limit=limit, offset=offset)['compras']
+    
+    def get_compras_pagina(self, filtros: Dict[str, Any] = None, limit: int = 100,
+                           cursor: Optional[str] = None, offset: int = 0) -> Dict[str, Any]:
+        """
+        Página de compras filtradas ordenada por (fecha_pedido DESC, imi DESC).
+        
+        Con `cursor` (next_cursor de la página anterior) usa paginación por clave,
+        que cuesta lo mismo en cualquier página; sin cursor acepta `offset` por
+        compatibilidad. Los códigos de material se consultan solo para los IMIs de
+        la página. Lanza ValueError si el cursor no es válido.
+        """
+        resultado = {'compras': [], 'next_cursor': None, 'has_more': False}
+        
+        posicion = None
+        if cursor:
+            fecha_cursor, imi_cursor = decode_cursor(cursor, 2, [(str,), (int,)])
+            try:
+                posicion = (date.fromisoformat(fecha_cursor), imi_cursor)
+            except (TypeError, ValueError):
+                raise ValueError("Cursor de paginación inválido")
+        
         conn = self.get_connection()
         if not conn:
-            return []
+            return resultado
         
         try:
-            cursor = conn.cursor()
+            db_cursor = conn.cursor()
             
-            # Query que incluye todos los campos necesarios para el dashboard
             query = """
                 SELECT 
                     c2.imi,
@@ -633,60 +809,81 @@ class ComprasV2Service:
                     c2.fecha_salida_estimada,
                     c2.fecha_arribo_estimada,
                     c2.fecha_salida_real,
-                    c2.fecha_arribo_real,
-                    ARRAY_AGG(DISTINCT c2m.material_codigo) FILTER (WHERE c2m.material_codigo IS NOT NULL) as materiales_codigos
+                    c2.fecha_arribo_real
                 FROM compras_v2 c2
-                LEFT JOIN compras_v2_materiales c2m ON c2.imi = c2m.compra_imi
                 WHERE c2.fecha_pedido IS NOT NULL
-                GROUP BY c2.imi, c2.proveedor, c2.puerto_origen, c2.fecha_pedido, 
-                         c2.fecha_salida_estimada, c2.fecha_arribo_estimada, 
-                         c2.fecha_salida_real, c2.fecha_arribo_real
-                ORDER BY c2.fecha_pedido DESC
-                LIMIT %s OFFSET %s
             """
             
-            cursor.execute(query, [limit, offset])
-            compras_raw = cursor.fetchall()
+            filtros_sql, params = compilar_filtros_compras(filtros, exactos=self._valores_exactos(filtros))
+            query += filtros_sql
             
-            logger.info(f"Query ejecutada: {query}")
-            logger.info(f"Parámetros: {[limit, offset]}")
-            logger.info(f"Resultados obtenidos: {len(compras_raw)} registros")
+            if posicion:
+                query += " AND (c2.fecha_pedido, c2.imi) < (%s, %s)"
+                params.extend(posicion)
+            
+            # Se pide una fila de más para saber si hay página siguiente
+            query += " ORDER BY c2.fecha_pedido DESC, c2.imi DESC LIMIT %s"
+            params.append(limit + 1)
+            if offset and not posicion:
+                query += " OFFSET %s"
+                params.append(offset)
+            
+            db_cursor.execute(query, params)
+            compras_raw = db_cursor.fetchall()
+            
+            resultado['has_more'] = len(compras_raw) > limit
+            compras_raw = compras_raw[:limit]
             
-            # Log de los primeros registros para debug
+            # Materiales solo de los IMIs de la página
+            materiales_por_imi = {}
             if compras_raw:
-                logger.info(f"Primer registro raw: {compras_raw[0]}")
-                logger.info(f"Tipo del primer registro: {type(compras_raw[0])}")
+                db_cursor.execute("""
+                    SELECT compra_imi, ARRAY_AGG(DISTINCT material_codigo) as materiales_codigos
+                    FROM compras_v2_materiales
+                    WHERE compra_imi = ANY(%s) AND material_codigo IS NOT NULL
+                    GROUP BY compra_imi
+                """, ([row['imi'] for row in compras_raw],))
+                materiales_por_imi = {row['compra_imi']: row['materiales_codigos'] for row in db_cursor.fetchall()}
             
-            # Convertir a diccionarios
-            compras = []
-            for i, row in enumerate(compras_raw):
-                try:
-                    logger.info(f"Procesando fila {i}: {row}")
-                    compra = {
-                        'imi': str(row['imi']) if row['imi'] is not None else None,
-                        'proveedor': str(row['proveedor']) if row['proveedor'] is not None else None,
-                        'puerto_origen': str(row['puerto_origen']) if row['puerto_origen'] is not None else None,
-                        'fecha_pedido': row['fecha_pedido'].isoformat() if row['fecha_pedido'] is not None else None,
-                        'fecha_salida_estimada': row['fecha_salida_estimada'].isoformat() if row['fecha_salida_estimada'] is not None else None,
-                        'fecha_arribo_estimada': row['fecha_arribo_estimada'].isoformat() if row['fecha_arribo_estimada'] is not None else None,
-                        'fecha_salida_real': row['fecha_salida_real'].isoformat() if row['fecha_salida_real'] is not None else None,
-                        'fecha_arribo_real': row['fecha_arribo_real'].isoformat() if row['fecha_arribo_real'] is not None else None,
-                        'materiales_codigos': row['materiales_codigos'] if row['materiales_codigos'] is not None else []
-                    }
-                    compras.append(compra)
-                    logger.info(f"Fila {i} convertida exitosamente: {compra}")
-                except Exception as e:
-                    logger.error(f"Error convirtiendo fila {i} {row}: {str(e)}")
-                    continue
+            db_cursor.close()
             
-            logger.info(f"Total compras convertidas: {len(compras)}")
-            cursor.close()
-            return compras
+            def iso(valor):
+                return valor.isoformat() if valor is not None else None
             
+            for row in compras_raw:
+                resultado['compras'].append({
+                    'imi': str(row['imi']) if row['imi'] is not None else None,
+                    'proveedor': str(row['proveedor']) if row['proveedor'] is not None else None,
+                    'puerto_origen': str(row['puerto_origen']) if row['puerto_origen'] is not None else None,
+                    'fecha_pedido': iso(row['fecha_pedido']),
+                    'fecha_salida_estimada': iso(row['fecha_salida_estimada']),
+                    'fecha_arribo_estimada': iso(row['fecha_arribo_estimada']),
+                    'fecha_salida_real': iso(row['fecha_salida_real']),
+                    'fecha_arribo_real': iso(row['fecha_arribo_real']),
+                    'materiales_codigos': materiales_por_imi.get(row['imi']) or []
+                })
+            
+            if resultado['has_more']:
+                ultima = compras_raw[-1]
+                resultado['next_cursor'] = encode_cursor([ultima['fecha_pedido'], ultima['imi']])
+            
+            logger.info(f"Página de compras: {len(resultado['compras'])} registros (has_more={resultado['has_more']})")
+            return resultado
+        
         except Exception as e:
-            logger.error(f"Error en get_compras_simple: {str(e)}")
-            return []
-
+            logger.error(f"Error en get_compras_pagina: {str(e)}")
+            conn.rollback()
+            return resultado
+    
+    def _valores_exactos(self, filtros: Optional[Dict[str, Any]]) -> Dict[str, frozenset]:
+        """Catálogos de proveedor/material para filtrar por igualdad los valores de dropdown"""
+        exactos = {}
+        if filtros and filtros.get('proveedor'):
+            exactos['proveedor'] = get_valores_exactos('proveedor', self.get_proveedores)
+        if filtros and filtros.get('material'):
+            exactos['material'] = get_valores_exactos('material', self.get_materiales)
+        return exactos
+    
     def get_compras_count(self, filtros: Dict[str, Any] = None) -> int:
         """Obtiene el conteo total de compras con filtros"""
         conn = self.get_connection()
@@ -697,41 +894,26 @@ class ComprasV2Service:
             cursor = conn.cursor()
             
             query = """
-                SELECT COUNT(DISTINCT c2.imi)
+                SELECT COUNT(DISTINCT c2.imi) as total
                 FROM compras_v2 c2
                 WHERE c2.fecha_pedido IS NOT NULL
             """
             
-            params = []
-            
             # Aplicar filtros
-            if filtros:
-                if filtros.get('mes'):
-                    query += " AND EXTRACT(MONTH FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['mes'])
-                
-                if filtros.get('año'):
-                    query += " AND EXTRACT(YEAR FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['año'])
-                
-                if filtros.get('proveedor'):
-                    query += " AND c2.proveedor ILIKE %s"
-                    params.append(f"%{filtros['proveedor']}%")
-                
-                if filtros.get('material'):
-                    query += " AND EXISTS (SELECT 1 FROM compras_v2_materiales c2m WHERE c2m.compra_id = c2.imi AND c2m.material_codigo ILIKE %s)"
-                    params.append(f"%{filtros['material']}%")
+            filtros_sql, params = compilar_filtros_compras(filtros, exactos=self._valores_exactos(filtros))
+            query += filtros_sql
             
             cursor.execute(query, params)
             result = cursor.fetchone()
             cursor.close()
             
-            return result[0] if result else 0
-            
+            # El cursor es RealDictCursor: acceder por nombre de columna
+            return result['total'] if result else 0
+        
         except Exception as e:
             logger.error(f"Error obteniendo conteo de compras: {str(e)}")
             return 0
-
+    
     def get_compras_by_filtros(self, filtros: Dict[str, Any], limit: int = 100) -> List[Dict[str, Any]]:
         """Obtiene compras filtradas de compras_v2"""
         conn = self.get_connection()
@@ -750,36 +932,14 @@ class ComprasV2Service:
                 WHERE 1=1
             """
             
-            params = []
-            
-            # Aplicar filtros
-            if filtros.get('proveedor'):
-                query += " AND c2.proveedor ILIKE %s"
-                params.append(f"%{filtros['proveedor']}%")
-            
-            if filtros.get('material'):
-                query += " AND EXISTS (SELECT 1 FROM compras_v2_materiales WHERE compra_id = c2.imi AND material_codigo ILIKE %s)"
-                params.append(f"%{filtros['material']}%")
-            
-            if filtros.get('mes') and filtros.get('año'):
-                query += " AND EXTRACT(MONTH FROM c2.fecha_pedido) = %s AND EXTRACT(YEAR FROM c2.fecha_pedido) = %s"
-                params.append(filtros['mes'])
-                params.append(filtros['año'])
-            elif filtros.get('año'):
-                query += " AND EXTRACT(YEAR FROM c2.fecha_pedido) = %s"
-                params.append(filtros['año'])
-            
-            if filtros.get('fecha_desde'):
-                query += " AND c2.fecha_pedido >= %s"
-                params.append(filtros['fecha_desde'])
-            
-            if filtros.get('fecha_hasta'):
-                query += " AND c2.fecha_pedido <= %s"
-                params.append(filtros['fecha_hasta'])
-            
-            if filtros.get('moneda'):
-                query += " AND c2.moneda = %s"
-                params.append(filtros['moneda'])
+            # Aplicar filtros (aquí un mes sin año se ignora, como antes)
+            filtros_fecha = dict(filtros)
+            if not filtros_fecha.get('año'):
+                filtros_fecha.pop('mes', None)
+            filtros_sql, params = compilar_filtros_compras(
+                filtros_fecha, exactos=self._valores_exactos(filtros_fecha)
+            )
+            query += filtros_sql
             
             # Agrupar y ordenar (necesario por el LEFT JOIN)
             query += " GROUP BY c2.imi, c2.proveedor, c2.fecha_pedido ORDER BY c2.fecha_pedido DESC"
@@ -809,7 +969,7 @@ class ComprasV2Service:
             
             cursor.close()
             return compras
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo compras: {str(e)}")
             return []
@@ -854,13 +1014,19 @@ class ComprasV2Service:
             
             cursor.close()
             return materiales_list
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo materiales para compra {imi}: {str(e)}")
             return []
     
     def calculate_kpis(self, filtros: Dict[str, Any] = None) -> Dict[str, Any]:
-        """Calcula KPIs de compras"""
+        """
+        Calcula KPIs de compras en una sola consulta.
+        
+        Los materiales se preagregan por IMI en un CTE y se unen una sola vez a las
+        compras filtradas, así los montos de cabecera (total_con_iva_*) no se
+        multiplican por cada material. Nuevos KPIs se agregan en KPI_COMPRAS_SQL.
+        """
         conn = self.get_connection()
         if not conn:
             return {}
@@ -868,90 +1034,55 @@ class ComprasV2Service:
         try:
             cursor = conn.cursor()
             
-            # Query base para KPIs principales
-            base_query = """
-                SELECT 
-                    COUNT(DISTINCT c2.imi) as total_compras,
-                    COUNT(DISTINCT c2.proveedor) as total_proveedores,
-                    SUM(c2m.kg) as total_kilogramos,
-                    SUM(c2.total_con_iva_divisa) as total_costo_divisa,
-                    SUM(c2.total_con_iva_mxn) as total_costo_mxn,
-                    SUM(CASE WHEN c2.anticipo_monto > 0 THEN 1 ELSE 0 END) as compras_con_anticipo,
-                    SUM(CASE WHEN c2.fecha_pago_factura IS NOT NULL THEN 1 ELSE 0 END) as compras_pagadas,
-                    AVG(c2.tipo_cambio_real) as tipo_cambio_promedio,
-                    AVG(c2.dias_credito) as dias_credito_promedio,
-                    SUM(CASE WHEN c2.fecha_pago_factura IS NULL THEN c2.total_con_iva_mxn ELSE 0 END) as compras_pendientes,
-                    SUM(CASE WHEN c2.fecha_pago_factura IS NULL THEN 1 ELSE 0 END) as compras_pendientes_count,
-                    SUM(c2.total_con_iva_mxn) / NULLIF(COUNT(DISTINCT c2.proveedor), 0) as promedio_por_proveedor,
-                    COUNT(DISTINCT c2.proveedor) as proveedores_unicos
-                FROM compras_v2 c2
-                LEFT JOIN compras_v2_materiales c2m ON c2.imi = c2m.compra_imi
-                WHERE 1=1
-            """
+            exactos = self._valores_exactos(filtros)
             
-            params = []
+            # Compras filtradas (el material se filtra con EXISTS sobre sus materiales)
+            filtros_compras_sql, params = compilar_filtros_compras(filtros, exactos=exactos)
             
-            # Aplicar filtros si existen
-            if filtros:
-                if filtros.get('mes'):
-                    base_query += " AND EXTRACT(MONTH FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['mes'])
-                
-                if filtros.get('año'):
-                    base_query += " AND EXTRACT(YEAR FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['año'])
-                
-                if filtros.get('proveedor'):
-                    base_query += " AND c2.proveedor ILIKE %s"
-                    params.append(f"%{filtros['proveedor']}%")
-                
-                if filtros.get('material'):
-                    base_query += " AND c2m.material_codigo ILIKE %s"
-                    params.append(f"%{filtros['material']}%")
+            # Filas de materiales que cuentan para kg, precios y materiales únicos
+            filtros_materiales_sql, params_materiales = compilar_filtros_compras(
+                {'material': filtros.get('material')} if filtros else None,
+                material='join', exactos=exactos
+            )
+            params = params + params_materiales
             
-            cursor.execute(base_query, params)
-            kpis_basicos = cursor.fetchone()
+            kpis_select = ',\n                    '.join(
+                f"{expresion} as {nombre}" for nombre, expresion in self.KPI_COMPRAS_SQL.items()
+            )
             
-            # Query adicional para KPIs avanzados
-            kpis_avanzados_query = """
+            query = f"""
+                WITH compras AS (
+                    SELECT c2.*
+                    FROM compras_v2 c2
+                    WHERE 1=1{filtros_compras_sql}
+                ),
+                materiales_filtrados AS (
+                    SELECT c2m.compra_imi, c2m.material_codigo, c2m.kg, c2m.pu_divisa, c2m.pu_mxn
+                    FROM compras_v2_materiales c2m
+                    WHERE c2m.compra_imi IN (SELECT imi FROM compras){filtros_materiales_sql}
+                ),
+                materiales AS (
+                    SELECT 
+                        compra_imi,
+                        SUM(kg) as kg,
+                        SUM(pu_divisa) as suma_pu_divisa,
+                        COUNT(pu_divisa) as num_pu_divisa,
+                        SUM(pu_mxn) as suma_pu_mxn,
+                        COUNT(pu_mxn) as num_pu_mxn
+                    FROM materiales_filtrados
+                    GROUP BY compra_imi
+                )
                 SELECT 
-                    AVG(CASE 
-                        WHEN c2.fecha_salida_estimada IS NOT NULL AND c2.fecha_arribo_estimada IS NOT NULL 
-                        THEN (c2.fecha_arribo_estimada - c2.fecha_salida_estimada)
-                        ELSE NULL 
-                    END) as ciclo_compras_promedio,
-                    AVG(c2m.pu_divisa) as precio_unitario_promedio_usd,
-                    AVG(c2m.pu_mxn) as precio_unitario_promedio_mxn,
-                    COUNT(DISTINCT c2m.material_codigo) as materiales_unicos,
-                    ROUND(AVG(c2.dias_transporte)::numeric, 1) as dias_transporte_promedio,
-                    ROUND(AVG(c2.dias_puerto_planta)::numeric, 1) as dias_puerto_planta_promedio
-                FROM compras_v2 c2
-                LEFT JOIN compras_v2_materiales c2m ON c2.imi = c2m.compra_imi
-                WHERE 1=1
+                    {kpis_select}
+                FROM compras c
+                LEFT JOIN materiales m ON m.compra_imi = c.imi
             """
             
-            # Aplicar los mismos filtros
-            if filtros:
-                if filtros.get('mes'):
-                    kpis_avanzados_query += " AND EXTRACT(MONTH FROM c2.fecha_pedido) = %s"
-                if filtros.get('año'):
-                    kpis_avanzados_query += " AND EXTRACT(YEAR FROM c2.fecha_pedido) = %s"
-                if filtros.get('proveedor'):
-                    kpis_avanzados_query += " AND c2.proveedor ILIKE %s"
-                if filtros.get('material'):
-                    kpis_avanzados_query += " AND c2m.material_codigo ILIKE %s"
-            
-            cursor.execute(kpis_avanzados_query, params)
-            kpis_avanzados = cursor.fetchone()
-            
+            cursor.execute(query, params)
+            fila = cursor.fetchone()
             cursor.close()
             
-            # Combinar resultados
-            resultado = {}
-            if kpis_basicos:
-                resultado.update(dict(kpis_basicos))
-            if kpis_avanzados:
-                resultado.update(dict(kpis_avanzados))
+            resultado = dict(fila) if fila else {}
             
             # Calcular KPIs derivados
             if resultado.get('total_compras', 0) > 0:
@@ -974,7 +1105,7 @@ class ComprasV2Service:
             resultado['ciclo_compras'] = resultado.get('ciclo_compras_promedio', 0) or 0
             
             return resultado
-            
+        
         except Exception as e:
             logger.error(f"Error calculando KPIs: {str(e)}")
             return {}
@@ -1004,25 +1135,9 @@ class ComprasV2Service:
                 AND c2m.{precio_field} > 0
             """
             
-            params = []
-            
-            # Aplicar filtros
-            if filtros:
-                if filtros.get('material'):
-                    query += " AND c2m.material_codigo ILIKE %s"
-                    params.append(f"%{filtros['material']}%")
-                
-                if filtros.get('mes'):
-                    query += " AND EXTRACT(MONTH FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['mes'])
-                
-                if filtros.get('año'):
-                    query += " AND EXTRACT(YEAR FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['año'])
-                
-                if filtros.get('proveedor'):
-                    query += " AND c2.proveedor ILIKE %s"
-                    params.append(f"%{filtros['proveedor']}%")
+            # Aplicar filtros (material sobre las filas unidas de c2m)
+            filtros_sql, params = compilar_filtros_compras(filtros, material='join', exactos=self._valores_exactos(filtros))
+            query += filtros_sql
             
             query += """
                 GROUP BY DATE_TRUNC('month', c2.fecha_pedido)
@@ -1062,7 +1177,7 @@ class ComprasV2Service:
                 'data': data,
                 'titulo': titulo
             }
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo evolución de precios: {str(e)}")
             return {'labels': [], 'data': [], 'titulo': 'Error'}
@@ -1122,19 +1237,10 @@ class ComprasV2Service:
             
             params = [moneda, moneda, moneda]  # Parámetros para los CASE statements
             
-            # Aplicar filtros
-            if filtros:
-                if filtros.get('mes'):
-                    query += " AND EXTRACT(MONTH FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['mes'])
-                
-                if filtros.get('año'):
-                    query += " AND EXTRACT(YEAR FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['año'])
-                
-                if filtros.get('proveedor'):
-                    query += " AND c2.proveedor ILIKE %s"
-                    params.append(f"%{filtros['proveedor']}%")
+            # Aplicar filtros (el flujo no filtra por material)
+            filtros_sql, filtros_params = compilar_filtros_compras(filtros, material=None, exactos=self._valores_exactos(filtros))
+            query += filtros_sql
+            params.extend(filtros_params)
             
             cursor.execute(query, params)
             resultados = cursor.fetchall()
@@ -1244,7 +1350,7 @@ class ComprasV2Service:
                 ],
                 'titulo': titulo
             }
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo flujo de pagos: {str(e)}")
             return {'labels': [], 'datasets': [], 'titulo': 'Error'}
@@ -1272,32 +1378,17 @@ class ComprasV2Service:
                         WHEN c2.fecha_vencimiento <= CURRENT_DATE + INTERVAL '90 days' THEN '61-90 días'
                         ELSE '90+ días'
                     END as periodo,
-                        c2.total_con_iva_mxn as monto,
-                        c2.fecha_pedido,
-                        c2.proveedor
+                        c2.total_con_iva_mxn as monto
                 FROM compras_v2 c2
                 WHERE c2.fecha_pago_factura IS NULL
-                ) subquery
-                WHERE 1=1
             """
             
-            params = []
-            
-            # Aplicar filtros
-            if filtros:
-                if filtros.get('mes'):
-                    query += " AND EXTRACT(MONTH FROM subquery.fecha_pedido) = %s"
-                    params.append(filtros['mes'])
-                
-                if filtros.get('año'):
-                    query += " AND EXTRACT(YEAR FROM subquery.fecha_pedido) = %s"
-                    params.append(filtros['año'])
-                
-                if filtros.get('proveedor'):
-                    query += " AND subquery.proveedor ILIKE %s"
-                    params.append(f"%{filtros['proveedor']}%")
+            # Aplicar filtros dentro de la subconsulta (el aging no filtra por material)
+            filtros_sql, params = compilar_filtros_compras(filtros, material=None, exactos=self._valores_exactos(filtros))
+            query += filtros_sql
             
             query += """
+                ) subquery
                 GROUP BY periodo
                 ORDER BY 
                     CASE periodo
@@ -1334,7 +1425,7 @@ class ComprasV2Service:
                 'data': data,
                 'titulo': titulo
             }
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo aging de cuentas por pagar: {str(e)}")
             return {'labels': [], 'data': [], 'titulo': 'Error'}
@@ -1363,7 +1454,7 @@ class ComprasV2Service:
             logger.info(f"Materiales obtenidos: {len(materiales)}")
             
             return materiales
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo materiales: {str(e)}")
             import traceback
@@ -1394,7 +1485,7 @@ class ComprasV2Service:
             logger.info(f"Proveedores obtenidos: {len(proveedores)}")
             
             return proveedores
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo proveedores: {str(e)}")
             import traceback
@@ -1425,7 +1516,7 @@ class ComprasV2Service:
             logger.info(f"Años disponibles obtenidos: {años}")
             
             return años
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo años disponibles: {str(e)}")
             import traceback
@@ -1454,21 +1545,9 @@ class ComprasV2Service:
                 WHERE c2.fecha_pedido IS NOT NULL
             """
             
-            params = []
-            
-            # Aplicar filtros
-            if filtros:
-                if filtros.get('mes'):
-                    query += " AND EXTRACT(MONTH FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['mes'])
-                
-                if filtros.get('año'):
-                    query += " AND EXTRACT(YEAR FROM c2.fecha_pedido) = %s"
-                    params.append(filtros['año'])
-                
-                if filtros.get('proveedor'):
-                    query += " AND c2.proveedor ILIKE %s"
-                    params.append(f"%{filtros['proveedor']}%")
+            # Aplicar filtros (el ranking es por material, no se filtra por material)
+            filtros_sql, params = compilar_filtros_compras(filtros, material=None, exactos=self._valores_exactos(filtros))
+            query += filtros_sql
             
             query += """
                 GROUP BY c2m.material_codigo
@@ -1507,7 +1586,7 @@ class ComprasV2Service:
                 'data_kg': data_kg,  # Nuevos datos de kg
                 'titulo': f'Top {len(labels)} Materiales'
             }
-            
+        
         except Exception as e:
             logger.error(f"Error obteniendo compras por material: {str(e)}")
             import traceback
@@ -1515,5 +1594,11 @@ class ComprasV2Service:
             return {'labels': [], 'data': [], 'data_kg': [], 'titulo': 'Sin datos'}
     
     def __del__(self):
-        """Destructor para cerrar conexión"""
-        self.close_connection()
+        """
+        Último recurso para devolver la conexión al pool; los llamadores deben
+        liberarla explícitamente con close_connection()
+        """
+        try:
+            self.close_connection()
+        except Exception:
+            pass
@@ -3,54 +3,105 @@ Servicio actualizado para upload de compras_v2 y compras_v2_materiales
 Integrado con el nuevo procesador robusto y servicio de guardado
 """
 
-from sqlalchemy.orm import Session
 from database import (
     ArchivoProcesado, get_db
 )
-from .compras_v2_service import ComprasV2Service
+from compras_v2_service import ComprasV2Service
+from utils.cache import bump_data_generation
+from utils.excel_reader import ExcelWorkbook
+import itertools
 import logging
 import os
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Callable, Iterator, Optional
+import numpy as np
 import pandas as pd
-import io
 
 logger = logging.getLogger(__name__)
 
+# Filas del Excel que se convierten y guardan por bloque; acota la memoria de la carga
+CHUNK_SIZE = int(os.getenv("COMPRAS_V2_CHUNK_SIZE", "2000"))
+
+HOJA_COMPRAS = "Compras Generales"
+HOJA_MATERIALES = "Materiales Detalle"
+
 class ComprasV2UploadService:
     """Servicio especializado para manejar uploads de compras_v2 con nueva arquitectura"""
     
     def __init__(self):
         self.compras_service = ComprasV2Service()
+        self._proveedores = {}
     
-    def upload_compras_file(self, file_content: bytes, filename: str, replace_data: bool = False) -> Dict[str, Any]:
+    def upload_compras_file(self, file_content: bytes, filename: str, replace_data: bool = False,
+                            progreso: Optional[Callable] = None) -> Dict[str, Any]:
         """
         Procesa y guarda archivo de compras usando el nuevo sistema compras_v2
+        
+        progreso: callable opcional progreso(fase, registros, registros_totales)
+        que se llama al cambiar de fase (lo usan las cargas en segundo plano)
         """
+        archivo_id = None
         try:
             logger.info(f"[COMPRAS_V2_SERVICE] Iniciando procesamiento de: {filename}")
             
-            # Paso 1: Procesar archivo en memoria
-            logger.info("[COMPRAS_V2_SERVICE] Paso 1: Procesando archivo Excel...")
-            processed_data_dict, kpis = self._process_compras_excel(file_content, filename)
-            
-            compras_count = len(processed_data_dict.get('compras_v2', []))
-            materiales_count = len(processed_data_dict.get('compras_v2_materiales', []))
-            
-            logger.info(f"[COMPRAS_V2_SERVICE] Datos procesados: {compras_count} compras, {materiales_count} materiales")
-            
-            # Paso 2: Crear registro de archivo en sesión separada
-            logger.info("[COMPRAS_V2_SERVICE] Paso 2: Creando registro de archivo...")
-            archivo_id = self._create_archivo_record(filename, len(file_content), replace_data)
-            
-            if not archivo_id:
-                raise Exception("No se pudo crear el registro de archivo")
+            # Paso 1: Abrir el archivo y validar el primer bloque de compras.
+            # Las filas se leen, convierten y guardan por bloques de CHUNK_SIZE,
+            # así que nunca está el archivo completo en memoria.
+            logger.info("[COMPRAS_V2_SERVICE] Paso 1: Procesando archivo Excel por bloques...")
+            if progreso:
+                progreso("parseo")
+            
+            with ExcelWorkbook(file_content) as libro:
+                hoja_compras = HOJA_COMPRAS if libro.has_sheet(HOJA_COMPRAS) else libro.sheet_name(0)
+                hoja_materiales = HOJA_MATERIALES if libro.has_sheet(HOJA_MATERIALES) else hoja_compras
+                logger.info(f"[COMPRAS_V2_SERVICE] Hoja de compras: '{hoja_compras}', hoja de materiales: '{hoja_materiales}'")
+                
+                # Las dimensiones se consultan antes de recorrer las hojas
+                registros_estimados = self._estimar_registros(libro, hoja_compras, hoja_materiales)
+                
+                resumen = {'compras': 0, 'materiales': 0, 'proveedores': set()}
+                self._proveedores = {}
+                compras_bloques = self._iter_compras(libro, hoja_compras, resumen)
+                
+                # Un archivo sin compras no debe reemplazar los datos existentes
+                primer_bloque = next(compras_bloques, None)
+                if primer_bloque is None:
+                    raise ValueError("No se encontraron compras válidas en el archivo")
+                if progreso:
+                    progreso("validacion", 0, registros_estimados)
+                
+                # Paso 2: Crear registro de archivo en sesión separada
+                logger.info("[COMPRAS_V2_SERVICE] Paso 2: Creando registro de archivo...")
+                archivo_id = self._create_archivo_record(filename, len(file_content), replace_data)
+                
+                if not archivo_id:
+                    raise Exception("No se pudo crear el registro de archivo")
+                
+                logger.info(f"[COMPRAS_V2_SERVICE] Archivo creado con ID: {archivo_id}")
+                
+                # Paso 3: Guardar los bloques conforme se leen (SAVEPOINT por bloque)
+                logger.info(f"[COMPRAS_V2_SERVICE] Paso 3: Guardando datos en bloques de {CHUNK_SIZE} filas...")
+                if progreso:
+                    progreso("guardado", 0)
+                # En modo reemplazo los datos existentes se borran en la misma
+                # transacción que la carga, así que un error deja los anteriores intactos
+                save_results = self.compras_service.save_compras_stream(
+                    itertools.chain([primer_bloque], compras_bloques),
+                    self._iter_materiales(libro, hoja_materiales, resumen),
+                    archivo_id,
+                    progreso,
+                    reemplazar=replace_data
+                )
             
-            logger.info(f"[COMPRAS_V2_SERVICE] Archivo creado con ID: {archivo_id}")
+            if replace_data:
+                self._clear_archivos_anteriores(conservar_archivo=filename)
             
-            # Paso 3: Guardar datos usando el nuevo servicio
-            logger.info("[COMPRAS_V2_SERVICE] Paso 3: Guardando datos con nuevo servicio...")
-            save_results = self.compras_service.save_compras_data(processed_data_dict, archivo_id)
+            kpis = {
+                'total_compras': resumen['compras'],
+                'total_materiales': resumen['materiales'],
+                'proveedores_unicos': len(resumen['proveedores'])
+            }
+            logger.info(f"[COMPRAS_V2_SERVICE] Datos procesados: {resumen['compras']} compras, {resumen['materiales']} materiales")
             
             # Paso 4: Actualizar estado del archivo
             logger.info("[COMPRAS_V2_SERVICE] Paso 4: Actualizando estado del archivo...")
@@ -76,21 +127,26 @@ class ComprasV2UploadService:
                 "kpis": kpis,
                 "mensaje": f"Archivo procesado exitosamente. Guardados: {save_results['compras_guardadas']} compras, {save_results['materiales_guardados']} materiales. Omitidos: {save_results.get('compras_omitidas', 0)} compras, {save_results.get('materiales_omitidos', 0)} materiales."
             }
-            
+        
         except Exception as e:
             logger.error(f"[COMPRAS_V2_SERVICE] Error en procesamiento: {str(e)}")
             import traceback
             logger.error(f"[COMPRAS_V2_SERVICE] Traceback: {traceback.format_exc()}")
+            # El registro del archivo no debe quedar "en_proceso" para siempre
+            if archivo_id:
+                self._update_archivo_status(archivo_id, "error", 0, error_message=str(e))
             return {"success": False, "error": str(e)}
+        finally:
+            # Devolver la conexión al pool en cuanto termina la carga
+            self.compras_service.close_connection()
     
     def _create_archivo_record(self, filename: str, file_size: int, replace_data: bool) -> int:
         """Crea registro de archivo en sesión separada"""
         db = next(get_db())
         try:
-            # Si se debe reemplazar datos, limpiar existentes
+            # En modo reemplazo los datos se borran al guardar (save_compras_stream)
             if replace_data:
-                logger.info("[COMPRAS_V2_SERVICE] Modo reemplazo: Limpiando datos existentes...")
-                self._clear_existing_data(db)
+                logger.info("[COMPRAS_V2_SERVICE] Modo reemplazo: los datos existentes se reemplazan al confirmar la carga")
             else:
                 logger.info("[COMPRAS_V2_SERVICE] Modo incremental: Conservando datos existentes, actualizando/insertando según corresponda...")
             
@@ -124,7 +180,7 @@ class ComprasV2UploadService:
                 
                 logger.info(f"[COMPRAS_V2_SERVICE] Archivo creado: ID={archivo.id}, nombre={filename}")
                 return archivo.id
-            
+        
         except Exception as e:
             logger.error(f"[COMPRAS_V2_SERVICE] Error creando archivo: {str(e)}")
             db.rollback()
@@ -132,50 +188,47 @@ class ComprasV2UploadService:
         finally:
             db.close()
     
-    def _update_archivo_status(self, archivo_id: int, estado: str, registros_procesados: int):
-        """Actualiza estado del archivo en sesión separada"""
+    def _update_archivo_status(self, archivo_id: int, estado: str, registros_procesados: int,
+                               error_message: Optional[str] = None):
+        """Actualiza estado (y mensaje de error) del archivo en sesión separada"""
         db = next(get_db())
         try:
             archivo = db.query(ArchivoProcesado).filter(ArchivoProcesado.id == archivo_id).first()
             if archivo:
                 archivo.estado = estado
                 archivo.registros_procesados = registros_procesados
+                archivo.error_message = error_message
                 archivo.updated_at = datetime.utcnow()
                 db.commit()
                 logger.info(f"[COMPRAS_V2_SERVICE] Archivo {archivo_id} actualizado a estado {estado}")
             else:
                 logger.error(f"[COMPRAS_V2_SERVICE] No se encontró archivo con ID {archivo_id}")
-                
+        
         except Exception as e:
             logger.error(f"[COMPRAS_V2_SERVICE] Error actualizando archivo: {str(e)}")
             db.rollback()
         finally:
             db.close()
     
-    def _clear_existing_data(self, db: Session):
-        """Limpia datos existentes de compras_v2"""
+    def _clear_archivos_anteriores(self, conservar_archivo: str = None):
+        """
+        Tras un reemplazo confirmado, borra los registros de los archivos anteriores
+        (conservar_archivo: nombre del archivo que se acaba de cargar)
+        """
+        db = next(get_db())
         try:
-            # Usar el servicio para limpiar datos
-            conn = self.compras_service.get_connection()
-            if conn:
-                cursor = conn.cursor()
-                
-                # Limpiar en orden debido a foreign keys
-                cursor.execute("DELETE FROM compras_v2_materiales")
-                cursor.execute("DELETE FROM compras_v2")
-                cursor.execute("DELETE FROM archivos_procesados")
-                
-                conn.commit()
-                cursor.close()
-                logger.info("[COMPRAS_V2_SERVICE] Datos existentes de compras_v2 limpiados")
-            
-            # También limpiar usando SQLAlchemy para consistencia
-            db.query(ArchivoProcesado).delete()
+            db.query(ArchivoProcesado).filter(
+                ArchivoProcesado.nombre_archivo.is_distinct_from(conservar_archivo)
+            ).delete(synchronize_session=False)
             db.commit()
-            
+            bump_data_generation("compras_v2 replace")
+            logger.info("[COMPRAS_V2_SERVICE] Registros de archivos anteriores eliminados")
+        
         except Exception as e:
-            logger.error(f"[COMPRAS_V2_SERVICE] Error limpiando datos: {str(e)}")
+            logger.error(f"[COMPRAS_V2_SERVICE] Error limpiando archivos anteriores: {str(e)}")
             db.rollback()
+        finally:
+            db.close()
     
     def get_compras_data(self, filtros: Dict[str, Any] = None) -> Dict[str, Any]:
         """Obtiene datos de compras usando el nuevo servicio"""
@@ -189,7 +242,7 @@ class ComprasV2UploadService:
                 "kpis": kpis,
                 "total_compras": len(compras)
             }
-            
+        
         except Exception as e:
             logger.error(f"[COMPRAS_V2_SERVICE] Error obteniendo datos: {str(e)}")
             return {
@@ -209,7 +262,7 @@ class ComprasV2UploadService:
                 "materiales": materiales,
                 "total_materiales": len(materiales)
             }
-            
+        
         except Exception as e:
             logger.error(f"[COMPRAS_V2_SERVICE] Error obteniendo materiales: {str(e)}")
             return {
@@ -221,34 +274,19 @@ class ComprasV2UploadService:
     def validate_file_structure(self, file_content: bytes, filename: str) -> Dict[str, Any]:
         """Valida la estructura del archivo antes del procesamiento"""
         try:
-            import pandas as pd
-            import io
-            
-            # Leer Excel para validar estructura
-            excel_file = io.BytesIO(file_content)
-            
-            # Intentar leer diferentes hojas
+            # Leer Excel para validar estructura: solo se necesitan los encabezados
             try:
-                compras_df = pd.read_excel(excel_file, sheet_name="Compras Generales")
-                compras_sheet_found = True
-            except:
-                try:
-                    excel_file.seek(0)
-                    compras_df = pd.read_excel(excel_file, sheet_name=0)
-                    compras_sheet_found = False
-                except:
-                    return {
-                        "valid": False,
-                        "error": "No se pudo leer el archivo Excel",
-                        "recommendations": ["Verificar que el archivo sea un Excel válido"]
-                    }
-            
-            try:
-                excel_file.seek(0)
-                materiales_df = pd.read_excel(excel_file, sheet_name="Materiales Detalle")
-                materiales_sheet_found = True
-            except:
-                materiales_sheet_found = False
+                with ExcelWorkbook(file_content) as libro:
+                    compras_sheet_found = libro.has_sheet("Compras Generales")
+                    materiales_sheet_found = libro.has_sheet("Materiales Detalle")
+                    compras_df = libro.parse("Compras Generales" if compras_sheet_found else 0, nrows=0)
+                    materiales_df = libro.parse("Materiales Detalle", nrows=0) if materiales_sheet_found else None
+            except Exception:
+                return {
+                    "valid": False,
+                    "error": "No se pudo leer el archivo Excel",
+                    "recommendations": ["Verificar que el archivo sea un Excel válido"]
+                }
             
             # Validar columnas requeridas
             required_compras_columns = ['imi', 'proveedor', 'fecha_pedido']
@@ -284,7 +322,7 @@ class ComprasV2UploadService:
                 "missing_materiales": missing_materiales,
                 "recommendations": recommendations
             }
-            
+        
         except Exception as e:
             logger.error(f"[COMPRAS_V2_SERVICE] Error validando archivo: {str(e)}")
             return {
@@ -293,67 +331,50 @@ class ComprasV2UploadService:
                 "recommendations": ["Verificar formato del archivo"]
             }
     
-    def _process_compras_excel(self, file_content: bytes, filename: str) -> tuple:
+    def _estimar_registros(self, libro: ExcelWorkbook, hoja_compras: str, hoja_materiales: str) -> Optional[int]:
+        """Registros a procesar según las dimensiones de las hojas (None si se desconocen)"""
+        filas_compras = libro.estimate_rows(hoja_compras)
+        if filas_compras is None:
+            return None
+        if hoja_materiales == hoja_compras:
+            return max(filas_compras - 1, 0) * 2
+        filas_materiales = libro.estimate_rows(hoja_materiales)
+        if filas_materiales is None:
+            return None
+        return max(filas_compras - 1, 0) + max(filas_materiales - 1, 0)
+    
+    def _iter_bloques(self, libro: ExcelWorkbook, hoja: str) -> Iterator[pd.DataFrame]:
         """
-        Procesa archivo Excel de compras_v2 específicamente
-        Retorna: (processed_data_dict, kpis)
+        Bloques de la hoja con columnas normalizadas y las celdas sin convertir.
+        El índice de cada bloque continúa el del anterior (posición de la fila en la hoja).
         """
-        try:
-            logger.info(f"[COMPRAS_V2_PROCESSOR] Procesando Excel de compras: {filename}")
-            
-            # Leer archivo Excel
-            excel_file = io.BytesIO(file_content)
-            
-            # Intentar leer hojas específicas
-            try:
-                compras_df = pd.read_excel(excel_file, sheet_name="Compras Generales")
-                logger.info(f"[COMPRAS_V2_PROCESSOR] Hoja 'Compras Generales' encontrada: {len(compras_df)} filas")
-            except:
-                excel_file.seek(0)
-                compras_df = pd.read_excel(excel_file, sheet_name=0)
-                logger.info(f"[COMPRAS_V2_PROCESSOR] Usando primera hoja como compras: {len(compras_df)} filas")
-            
-            try:
-                excel_file.seek(0)
-                materiales_df = pd.read_excel(excel_file, sheet_name="Materiales Detalle")
-                logger.info(f"[COMPRAS_V2_PROCESSOR] Hoja 'Materiales Detalle' encontrada: {len(materiales_df)} filas")
-            except:
-                # Si no hay hoja de materiales separada, intentar buscar en la misma hoja
-                materiales_df = compras_df.copy()
-                logger.info(f"[COMPRAS_V2_PROCESSOR] Usando hoja de compras también para materiales")
-            
-            # Normalizar nombres de columnas
-            compras_df.columns = [self._normalize_column_name(col) for col in compras_df.columns]
-            materiales_df.columns = [self._normalize_column_name(col) for col in materiales_df.columns]
-            
-            logger.info(f"[COMPRAS_V2_PROCESSOR] Columnas compras: {list(compras_df.columns)}")
-            logger.info(f"[COMPRAS_V2_PROCESSOR] Columnas materiales: {list(materiales_df.columns)}")
-            
-            # Procesar compras
-            compras_list = self._process_compras_df(compras_df)
-            materiales_list = self._process_materiales_df(materiales_df)
-            
-            # Calcular KPIs básicos
-            kpis = {
-                'total_compras': len(compras_list),
-                'total_materiales': len(materiales_list),
-                'proveedores_unicos': len(set([c.get('proveedor') for c in compras_list if c.get('proveedor')]))
-            }
-            
-            processed_data = {
-                'compras_v2': compras_list,
-                'compras_v2_materiales': materiales_list
-            }
-            
-            logger.info(f"[COMPRAS_V2_PROCESSOR] Procesamiento completado: {len(compras_list)} compras, {len(materiales_list)} materiales")
-            
-            return processed_data, kpis
-            
-        except Exception as e:
-            logger.error(f"[COMPRAS_V2_PROCESSOR] Error procesando Excel: {str(e)}")
-            import traceback
-            logger.error(f"[COMPRAS_V2_PROCESSOR] Traceback: {traceback.format_exc()}")
-            raise
+        filas_previas = 0
+        for numero, df in enumerate(libro.iter_chunks(hoja, CHUNK_SIZE, dtype=object), start=1):
+            df.columns = [self._normalize_column_name(col) for col in df.columns]
+            df.index = pd.RangeIndex(filas_previas, filas_previas + len(df))
+            filas_previas += len(df)
+            if numero == 1:
+                logger.info(f"[COMPRAS_V2_PROCESSOR] Columnas de '{hoja}': {list(df.columns)}")
+            yield df
+    
+    def _iter_compras(self, libro: ExcelWorkbook, hoja: str, resumen: dict) -> Iterator[pd.DataFrame]:
+        """Compras de la hoja por bloques ya convertidos (omite bloques sin compras válidas)"""
+        for df in self._iter_bloques(libro, hoja):
+            compras = self._process_compras_df(df)
+            if compras.empty:
+                continue
+            resumen['compras'] += len(compras)
+            resumen['proveedores'].update(compras.loc[compras['proveedor'] != '', 'proveedor'])
+            yield compras
+    
+    def _iter_materiales(self, libro: ExcelWorkbook, hoja: str, resumen: dict) -> Iterator[pd.DataFrame]:
+        """Materiales de la hoja por bloques ya convertidos (omite bloques sin materiales válidos)"""
+        for df in self._iter_bloques(libro, hoja):
+            materiales = self._process_materiales_df(df)
+            if materiales.empty:
+                continue
+            resumen['materiales'] += len(materiales)
+            yield materiales
     
     def _normalize_column_name(self, col: str) -> str:
         """Normaliza nombre de columna a snake_case"""
@@ -367,272 +388,217 @@ class ComprasV2UploadService:
         col = re.sub(r'\s+', '_', col)
         return col
     
-    def _process_compras_df(self, df: pd.DataFrame) -> list:
-        """Procesa DataFrame de compras y retorna lista de diccionarios"""
-        compras = []
+    def _columna(self, df: pd.DataFrame, nombre: str) -> pd.Series:
+        """Columna del bloque, o una columna vacía si el Excel no la trae"""
+        if nombre in df.columns:
+            return df[nombre]
+        return pd.Series(np.nan, index=df.index, dtype=object)
+    
+    def _columnas_numericas(self, df: pd.DataFrame, nombres: list) -> tuple:
+        """
+        Convierte columnas a float (NaN donde la celda está vacía).
+        Retorna (valores por columna, máscara de filas con algún valor no numérico).
+        """
+        valores = {}
+        invalidas = pd.Series(False, index=df.index)
+        for nombre in nombres:
+            original = self._columna(df, nombre)
+            numerico = pd.to_numeric(original, errors='coerce').astype(float)
+            invalidas |= original.notna() & numerico.isna()
+            valores[nombre] = numerico
+        return valores, invalidas
+    
+    def _columna_texto(self, df: pd.DataFrame, nombre: str, default: str = '') -> pd.Series:
+        columna = self._columna(df, nombre)
+        return columna.astype(str).where(columna.notna(), default)
+    
+    def _columna_fecha(self, df: pd.DataFrame, nombre: str) -> pd.Series:
+        columna = self._columna(df, nombre)
+        if columna.dtype == object:
+            return pd.to_datetime(columna, errors='coerce', format='mixed')
+        return pd.to_datetime(columna, errors='coerce')
+    
+    def _advertir_filas_invalidas(self, invalidas: pd.Series, tabla: str):
+        if invalidas.any():
+            indices = invalidas[invalidas].index
+            filas = ', '.join(str(idx) for idx in indices[:10]) + ('...' if len(indices) > 10 else '')
+            logger.warning(f"[COMPRAS_V2_PROCESSOR] {len(indices)} filas de {tabla} omitidas por valores no numéricos (filas {filas})")
+    
+    def _process_compras_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Convierte un bloque de compras del Excel con operaciones por columna.
+        Omite filas sin IMI y filas con valores no numéricos en columnas numéricas.
+        """
+        columnas_numericas = [
+            'imi', 'tipo_cambio_estimado', 'tipo_cambio_real', 'gastos_importacion_divisa',
+            'gastos_importacion_mxn', 'iva_monto_divisa', 'iva_monto_mxn', 'total_con_iva_divisa',
+            'total_con_iva_mxn', 'dias_credito', 'anticipo_pct', 'anticipo_monto',
+            'porcentaje_gastos_importacion'
+        ]
+        numeros, invalidas = self._columnas_numericas(df, columnas_numericas)
         
-        for idx, row in df.iterrows():
-            try:
-                # Validar que tenga IMI
-                if 'imi' not in row or pd.isna(row['imi']) or row['imi'] == '':
-                    continue
-                
-                # Helper para convertir fechas y manejar NaT
-                def safe_date(value):
-                    if value is None or pd.isna(value):
-                        return None
-                    try:
-                        dt = pd.to_datetime(value, errors='coerce')
-                        return None if pd.isna(dt) else dt
-                    except:
-                        return None
-                
-                # Obtener fechas
-                fecha_salida_real = safe_date(row.get('fecha_salida_real'))
-                fecha_arribo_real = safe_date(row.get('fecha_arribo_real'))
-                fecha_planta_real = safe_date(row.get('fecha_planta_real'))
-                
-                # Calcular días automáticamente
-                dias_transporte = None
-                dias_puerto_planta = None
-                
-                if fecha_salida_real and fecha_arribo_real:
-                    dias_transporte = (fecha_arribo_real - fecha_salida_real).days
-                
-                if fecha_arribo_real and fecha_planta_real:
-                    dias_puerto_planta = (fecha_planta_real - fecha_arribo_real).days
-                
-                # Obtener datos del proveedor
-                proveedor_nombre = str(row['proveedor']) if 'proveedor' in row and pd.notna(row['proveedor']) else ''
-                proveedor_info = self._get_proveedor_info(proveedor_nombre) if proveedor_nombre else {}
-                
-                # Puerto origen: primero buscar en Excel, luego en tabla proveedores
-                puerto_origen = str(row['puerto_origen']) if 'puerto_origen' in row and pd.notna(row['puerto_origen']) else ''
-                if not puerto_origen and proveedor_info:
-                    puerto_origen = proveedor_info.get('puerto_origen', '')
-                
-                # Tipo de cambio estimado: por defecto 20, o lo que venga en Excel
-                tipo_cambio_estimado = float(row['tipo_cambio_estimado']) if 'tipo_cambio_estimado' in row and pd.notna(row['tipo_cambio_estimado']) else 20.0
-                tipo_cambio_real = float(row['tipo_cambio_real']) if 'tipo_cambio_real' in row and pd.notna(row['tipo_cambio_real']) else 0
-                
-                # Usar tipo de cambio real si existe, sino el estimado
-                tipo_cambio_efectivo = tipo_cambio_real if tipo_cambio_real > 0 else tipo_cambio_estimado
-                
-                # Calcular gastos de importación en MXN si no viene
-                gastos_importacion_divisa = float(row['gastos_importacion_divisa']) if 'gastos_importacion_divisa' in row and pd.notna(row['gastos_importacion_divisa']) else 0
-                gastos_importacion_mxn = float(row['gastos_importacion_mxn']) if 'gastos_importacion_mxn' in row and pd.notna(row['gastos_importacion_mxn']) else 0
-                
-                if gastos_importacion_mxn == 0 and gastos_importacion_divisa > 0 and tipo_cambio_efectivo > 0:
-                    gastos_importacion_mxn = gastos_importacion_divisa * tipo_cambio_efectivo
-                
-                # Calcular IVA en MXN si no viene
-                iva_monto_divisa = float(row['iva_monto_divisa']) if 'iva_monto_divisa' in row and pd.notna(row['iva_monto_divisa']) else 0
-                iva_monto_mxn = float(row['iva_monto_mxn']) if 'iva_monto_mxn' in row and pd.notna(row['iva_monto_mxn']) else 0
-                
-                if iva_monto_mxn == 0 and iva_monto_divisa > 0 and tipo_cambio_efectivo > 0:
-                    iva_monto_mxn = iva_monto_divisa * tipo_cambio_efectivo
-                
-                # Calcular total con IVA en MXN si no viene
-                total_con_iva_divisa = float(row['total_con_iva_divisa']) if 'total_con_iva_divisa' in row and pd.notna(row['total_con_iva_divisa']) else 0
-                total_con_iva_mxn = float(row['total_con_iva_mxn']) if 'total_con_iva_mxn' in row and pd.notna(row['total_con_iva_mxn']) else 0
-                
-                if total_con_iva_mxn == 0 and total_con_iva_divisa > 0 and tipo_cambio_efectivo > 0:
-                    total_con_iva_mxn = total_con_iva_divisa * tipo_cambio_efectivo
-                
-                # Calcular fecha de vencimiento
-                fecha_vencimiento = safe_date(row.get('fecha_vencimiento'))
-                dias_credito = int(row['dias_credito']) if 'dias_credito' in row and pd.notna(row['dias_credito']) else None
-                
-                if not fecha_vencimiento and fecha_salida_real and dias_credito:
-                    from datetime import timedelta
-                    fecha_vencimiento = fecha_salida_real + timedelta(days=dias_credito)
-                elif not fecha_vencimiento and fecha_salida_estimada and dias_credito:
-                    from datetime import timedelta
-                    fecha_vencimiento = fecha_salida_estimada + timedelta(days=dias_credito)
-                
-                # Calcular fechas estimadas usando datos del proveedor
-                fecha_pedido = safe_date(row.get('fecha_pedido'))
-                fecha_salida_estimada = safe_date(row.get('fecha_salida_estimada'))
-                fecha_arribo_estimada = safe_date(row.get('fecha_arribo_estimada'))
-                fecha_planta_estimada = safe_date(row.get('fecha_planta_estimada'))
-                
-                # Solo calcular si no vienen en Excel y tenemos fecha_pedido y datos del proveedor
-                if fecha_pedido and proveedor_info and not fecha_salida_estimada:
-                    from datetime import timedelta
-                    dias_produccion = proveedor_info.get('dias_produccion', 0)
-                    if dias_produccion > 0:
-                        fecha_salida_estimada = fecha_pedido + timedelta(days=int(dias_produccion))
-                        
-                        # Calcular fecha_arribo_estimada
-                        if not fecha_arribo_estimada:
-                            dias_transporte = proveedor_info.get('dias_transporte', 0)
-                            if dias_transporte > 0:
-                                fecha_arribo_estimada = fecha_salida_estimada + timedelta(days=int(dias_transporte))
-                                
-                                # Calcular fecha_planta_estimada (arribo + 15 días)
-                                if not fecha_planta_estimada:
-                                    fecha_planta_estimada = fecha_arribo_estimada + timedelta(days=15)
-                
-                compra = {
-                    'imi': int(row['imi']) if 'imi' in row and pd.notna(row['imi']) else 0,
-                    'proveedor': proveedor_nombre,
-                    'fecha_pedido': fecha_pedido,
-                    'puerto_origen': puerto_origen,
-                    'fecha_salida_estimada': fecha_salida_estimada,
-                    'fecha_arribo_estimada': fecha_arribo_estimada,
-                    'fecha_planta_estimada': fecha_planta_estimada,
-                    'fecha_salida_real': fecha_salida_real,
-                    'fecha_arribo_real': fecha_arribo_real,
-                    'fecha_planta_real': fecha_planta_real,
-                    'moneda': str(row['moneda']) if 'moneda' in row and pd.notna(row['moneda']) else 'USD',
-                    'dias_credito': int(row['dias_credito']) if 'dias_credito' in row and pd.notna(row['dias_credito']) else None,
-                    'anticipo_pct': float(row['anticipo_pct']) if 'anticipo_pct' in row and pd.notna(row['anticipo_pct']) else 0,
-                    'anticipo_monto': float(row['anticipo_monto']) if 'anticipo_monto' in row and pd.notna(row['anticipo_monto']) else 0,
-                    'fecha_anticipo': safe_date(row.get('fecha_anticipo')),
-                    'fecha_pago_factura': safe_date(row.get('fecha_pago_factura')),
-                    'tipo_cambio_estimado': tipo_cambio_estimado,
-                    'tipo_cambio_real': tipo_cambio_real,
-                    'gastos_importacion_divisa': gastos_importacion_divisa,
-                    'gastos_importacion_mxn': gastos_importacion_mxn,
-                    'porcentaje_gastos_importacion': float(row['porcentaje_gastos_importacion']) if 'porcentaje_gastos_importacion' in row and pd.notna(row['porcentaje_gastos_importacion']) else 0,
-                    'iva_monto_divisa': iva_monto_divisa,
-                    'iva_monto_mxn': iva_monto_mxn,
-                    'total_con_iva_divisa': total_con_iva_divisa,
-                    'total_con_iva_mxn': total_con_iva_mxn,
-                    'fecha_vencimiento': fecha_vencimiento,
-                    'dias_transporte': dias_transporte,
-                    'dias_puerto_planta': dias_puerto_planta,
-                }
-                
-                compras.append(compra)
-                
-            except Exception as e:
-                logger.warning(f"[COMPRAS_V2_PROCESSOR] Error procesando fila {idx} de compras: {str(e)}")
-                continue
+        # Validar que tenga IMI
+        validas = self._columna(df, 'imi').notna() & ~invalidas
+        self._advertir_filas_invalidas(self._columna(df, 'imi').notna() & invalidas, 'compras')
+        if not validas.any():
+            return pd.DataFrame()
+        
+        df = df[validas]
+        numeros = {nombre: serie[validas] for nombre, serie in numeros.items()}
+        
+        compras = pd.DataFrame(index=df.index)
+        compras['imi'] = np.trunc(numeros['imi']).astype('int64')
+        compras['proveedor'] = self._columna_texto(df, 'proveedor')
+        
+        # Puerto origen: primero buscar en Excel, luego en tabla proveedores
+        proveedores = self._get_proveedores_info(compras['proveedor'].unique())
+        tiene_info = compras['proveedor'].isin(proveedores.index)
+        info = proveedores.reindex(compras['proveedor'].values).set_axis(compras.index)
+        compras['puerto_origen'] = self._columna_texto(df, 'puerto_origen')
+        sin_puerto = (compras['puerto_origen'] == '') & tiene_info
+        compras['puerto_origen'] = compras['puerto_origen'].mask(sin_puerto, info['puerto_origen'])
+        
+        # Calcular fechas estimadas usando datos del proveedor, solo si no vienen en Excel
+        fechas = {
+            nombre: self._columna_fecha(df, nombre) for nombre in (
+                'fecha_pedido', 'fecha_salida_estimada', 'fecha_arribo_estimada', 'fecha_planta_estimada',
+                'fecha_salida_real', 'fecha_arribo_real', 'fecha_planta_real', 'fecha_anticipo', 'fecha_pago_factura'
+            )
+        }
+        dias_produccion = np.trunc(pd.to_numeric(info['dias_produccion'], errors='coerce').fillna(0))
+        dias_transporte = np.trunc(pd.to_numeric(info['dias_transporte'], errors='coerce').fillna(0))
+        
+        calcular_salida = (fechas['fecha_pedido'].notna() & tiene_info
+                           & fechas['fecha_salida_estimada'].isna() & (dias_produccion > 0))
+        fechas['fecha_salida_estimada'] = fechas['fecha_salida_estimada'].mask(
+            calcular_salida, fechas['fecha_pedido'] + pd.to_timedelta(dias_produccion, unit='D'))
+        
+        calcular_arribo = calcular_salida & fechas['fecha_arribo_estimada'].isna() & (dias_transporte > 0)
+        fechas['fecha_arribo_estimada'] = fechas['fecha_arribo_estimada'].mask(
+            calcular_arribo, fechas['fecha_salida_estimada'] + pd.to_timedelta(dias_transporte, unit='D'))
+        
+        # fecha_planta_estimada = arribo + 15 días
+        calcular_planta = calcular_arribo & fechas['fecha_planta_estimada'].isna()
+        fechas['fecha_planta_estimada'] = fechas['fecha_planta_estimada'].mask(
+            calcular_planta, fechas['fecha_arribo_estimada'] + pd.Timedelta(days=15))
+        
+        for nombre in ('fecha_pedido', 'fecha_salida_estimada', 'fecha_arribo_estimada', 'fecha_planta_estimada',
+                       'fecha_salida_real', 'fecha_arribo_real', 'fecha_planta_real'):
+            compras[nombre] = fechas[nombre]
+        
+        compras['moneda'] = self._columna_texto(df, 'moneda', 'USD')
+        compras['dias_credito'] = np.trunc(numeros['dias_credito']).astype('Int64')
+        compras['anticipo_pct'] = numeros['anticipo_pct'].fillna(0)
+        compras['anticipo_monto'] = numeros['anticipo_monto'].fillna(0)
+        compras['fecha_anticipo'] = fechas['fecha_anticipo']
+        compras['fecha_pago_factura'] = fechas['fecha_pago_factura']
+        
+        # Tipo de cambio estimado: por defecto 20, o lo que venga en Excel;
+        # se usa el real si existe, si no el estimado
+        compras['tipo_cambio_estimado'] = numeros['tipo_cambio_estimado'].fillna(20.0)
+        compras['tipo_cambio_real'] = numeros['tipo_cambio_real'].fillna(0)
+        tipo_cambio_efectivo = compras['tipo_cambio_real'].where(
+            compras['tipo_cambio_real'] > 0, compras['tipo_cambio_estimado'])
+        
+        # Montos en MXN calculados desde la divisa si no vienen
+        for prefijo in ('gastos_importacion', 'iva_monto', 'total_con_iva'):
+            divisa = numeros[f'{prefijo}_divisa'].fillna(0)
+            mxn = numeros[f'{prefijo}_mxn'].fillna(0)
+            calcular = (mxn == 0) & (divisa > 0) & (tipo_cambio_efectivo > 0)
+            if prefijo == 'gastos_importacion':
+                compras['gastos_importacion_divisa'] = divisa
+            compras[f'{prefijo}_mxn'] = mxn.mask(calcular, divisa * tipo_cambio_efectivo)
+        
+        compras['porcentaje_gastos_importacion'] = numeros['porcentaje_gastos_importacion'].fillna(0)
         
         return compras
     
-    def _process_materiales_df(self, df: pd.DataFrame) -> list:
-        """Procesa DataFrame de materiales y retorna lista de diccionarios"""
-        materiales = []
+    def _process_materiales_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Convierte un bloque de materiales del Excel con operaciones por columna.
+        Omite filas sin IMI o material_codigo y filas con valores no numéricos.
+        """
+        columnas_numericas = [
+            'imi', 'kg', 'pu_divisa', 'pu_mxn', 'costo_total_divisa', 'costo_total_mxn',
+            'pu_mxn_importacion', 'costo_total_mxn_importacion', 'iva', 'costo_total_con_iva'
+        ]
+        numeros, invalidas = self._columnas_numericas(df, columnas_numericas)
         
-        # Primero obtener el mapeo de IMI a compra_id de la base de datos
-        compras_map = self._get_compras_id_map()
+        # Validar que tenga IMI y material_codigo
+        completas = self._columna(df, 'imi').notna() & self._columna(df, 'material_codigo').notna()
+        self._advertir_filas_invalidas(completas & invalidas, 'materiales')
+        validas = completas & ~invalidas
+        if not validas.any():
+            return pd.DataFrame()
         
-        for idx, row in df.iterrows():
-            try:
-                # Validar que tenga IMI y material_codigo
-                if 'imi' not in row or pd.isna(row['imi']):
-                    continue
-                if 'material_codigo' not in row or pd.isna(row['material_codigo']):
-                    continue
-                
-                imi = int(row['imi'])
-                compra_id = compras_map.get(imi, imi)  # Usar el ID de compra_v2 si existe, sino usar IMI
-                
-                # Obtener datos básicos del Excel
-                kg = float(row['kg']) if 'kg' in row and pd.notna(row['kg']) else 0
-                pu_divisa = float(row['pu_divisa']) if 'pu_divisa' in row and pd.notna(row['pu_divisa']) else 0
-                
-                # Obtener datos de la compra para cálculos
-                # Nota: Los datos de la compra se obtendrán en el servicio, aquí solo preparamos los datos básicos
-                
-                # Calcular campos automáticamente
-                pu_mxn = float(row['pu_mxn']) if 'pu_mxn' in row and pd.notna(row['pu_mxn']) else 0
-                costo_total_divisa = float(row['costo_total_divisa']) if 'costo_total_divisa' in row and pd.notna(row['costo_total_divisa']) else (kg * pu_divisa)
-                
-                # Si pu_mxn no viene, se calculará en el servicio usando tipo de cambio
-                # Por ahora solo guardamos lo que viene del Excel
-                
-                # Calcular costo_total_mxn solo si tenemos pu_mxn
-                costo_total_mxn = float(row['costo_total_mxn']) if 'costo_total_mxn' in row and pd.notna(row['costo_total_mxn']) else (kg * pu_mxn) if pu_mxn > 0 else 0
-                
-                # Los siguientes campos se calcularán en el servicio usando datos de la compra:
-                # - pu_mxn (si no viene)
-                # - porcentaje_gastos_importacion
-                # - pu_mxn_importacion
-                # - costo_total_mxn_importacion
-                # - iva (si no viene)
-                # - costo_total_con_iva
-                
-                pu_mxn_importacion = float(row['pu_mxn_importacion']) if 'pu_mxn_importacion' in row and pd.notna(row['pu_mxn_importacion']) else 0
-                costo_total_mxn_imporacion = float(row['costo_total_mxn_importacion']) if 'costo_total_mxn_importacion' in row and pd.notna(row['costo_total_mxn_importacion']) else 0
-                iva = float(row['iva']) if 'iva' in row and pd.notna(row['iva']) else 0
-                costo_total_con_iva = float(row['costo_total_con_iva']) if 'costo_total_con_iva' in row and pd.notna(row['costo_total_con_iva']) else 0
-                
-                material = {
-                    'compra_id': compra_id,
-                    'compra_imi': imi,
-                    'material_codigo': str(row['material_codigo']),
-                    'kg': kg,
-                    'pu_divisa': pu_divisa,
-                    'pu_mxn': pu_mxn,
-                    'costo_total_divisa': costo_total_divisa,
-                    'costo_total_mxn': costo_total_mxn,
-                    'pu_mxn_importacion': pu_mxn_importacion,
-                    'costo_total_mxn_imporacion': costo_total_mxn_imporacion,
-                    'iva': iva,
-                    'costo_total_con_iva': costo_total_con_iva,
-                }
-                
-                materiales.append(material)
-                
-            except Exception as e:
-                logger.warning(f"[COMPRAS_V2_PROCESSOR] Error procesando fila {idx} de materiales: {str(e)}")
-                continue
+        df = df[validas]
+        numeros = {nombre: serie[validas] for nombre, serie in numeros.items()}
+        
+        materiales = pd.DataFrame(index=df.index)
+        # En compras_v2, imi es la clave primaria: compra_id es el mismo IMI
+        materiales['compra_id'] = np.trunc(numeros['imi']).astype('int64')
+        materiales['compra_imi'] = materiales['compra_id']
+        materiales['material_codigo'] = df['material_codigo'].astype(str)
+        
+        kg = numeros['kg'].fillna(0)
+        pu_divisa = numeros['pu_divisa'].fillna(0)
+        pu_mxn = numeros['pu_mxn'].fillna(0)
+        materiales['kg'] = kg
+        materiales['pu_divisa'] = pu_divisa
+        materiales['pu_mxn'] = pu_mxn
+        materiales['costo_total_divisa'] = numeros['costo_total_divisa'].fillna(kg * pu_divisa)
+        # costo_total_mxn solo se calcula si viene pu_mxn; el resto de precios lo completa el servicio
+        materiales['costo_total_mxn'] = numeros['costo_total_mxn'].fillna((kg * pu_mxn).where(pu_mxn > 0, 0))
+        materiales['pu_mxn_importacion'] = numeros['pu_mxn_importacion'].fillna(0)
+        materiales['costo_total_mxn_imporacion'] = numeros['costo_total_mxn_importacion'].fillna(0)
+        materiales['iva'] = numeros['iva'].fillna(0)
+        materiales['costo_total_con_iva'] = numeros['costo_total_con_iva'].fillna(0)
         
         return materiales
     
-    def _get_compras_id_map(self) -> dict:
-        """Obtiene mapeo de IMI a compra_id desde la base de datos"""
-        try:
-            conn = self.compras_service.get_connection()
-            if not conn:
-                return {}
-            
-            cursor = conn.cursor()
-            # En compras_v2, imi ES la clave primaria, no hay columna id separada
-            cursor.execute("SELECT imi FROM compras_v2")
-            results = cursor.fetchall()
-            cursor.close()
-            
-            # Mapear imi a sí mismo ya que es la clave primaria
-            return {row['imi']: row['imi'] for row in results}
-            
-        except Exception as e:
-            logger.warning(f"[COMPRAS_V2_PROCESSOR] No se pudo obtener mapeo de IDs: {str(e)}")
-            return {}
-    
-    def _get_proveedor_info(self, nombre_proveedor: str) -> dict:
-        """Obtiene información del proveedor desde la base de datos"""
-        try:
+    def _get_proveedores_info(self, nombres) -> pd.DataFrame:
+        """
+        Información de los proveedores indicados, indexada por nombre.
+        Consulta en una sola sentencia los nombres que no se han visto en esta carga.
+        """
+        pendientes = [nombre for nombre in nombres if nombre and nombre not in self._proveedores]
+        if pendientes:
+            encontrados = {}
             conn = self.compras_service.get_connection()
-            if not conn:
-                return {}
-            
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT "Puerto", promedio_dias_produccion, promedio_dias_transporte_maritimo
-                FROM "Proveedores"
-                WHERE "Nombre" = %s
-            """, (nombre_proveedor,))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            
-            if result:
-                return {
-                    'puerto_origen': result['Puerto'],
-                    'dias_produccion': result['promedio_dias_produccion'],
-                    'dias_transporte': result['promedio_dias_transporte_maritimo']
-                }
-            else:
-                logger.warning(f"[COMPRAS_V2_PROCESSOR] Proveedor '{nombre_proveedor}' no encontrado en tabla Proveedores")
-                return {}
-                
-        except Exception as e:
-            logger.warning(f"[COMPRAS_V2_PROCESSOR] Error obteniendo info de proveedor: {str(e)}")
-            return {}
+            if conn:
+                # La conexión es la misma del guardado por bloques: un error aquí
+                # no debe abortar la transacción en curso
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("SAVEPOINT consulta_proveedores")
+                    cursor.execute("""
+                        SELECT "Nombre", "Puerto", promedio_dias_produccion, promedio_dias_transporte_maritimo
+                        FROM "Proveedores"
+                        WHERE "Nombre" = ANY(%s)
+                    """, (pendientes,))
+                    for result in cursor.fetchall():
+                        encontrados[result['Nombre']] = {
+                            'puerto_origen': result['Puerto'],
+                            'dias_produccion': result['promedio_dias_produccion'],
+                            'dias_transporte': result['promedio_dias_transporte_maritimo']
+                        }
+                    cursor.execute("RELEASE SAVEPOINT consulta_proveedores")
+                except Exception as e:
+                    logger.warning(f"[COMPRAS_V2_PROCESSOR] Error obteniendo info de proveedores: {str(e)}")
+                    cursor.execute("ROLLBACK TO SAVEPOINT consulta_proveedores")
+                finally:
+                    cursor.close()
+            
+            for nombre in pendientes:
+                if nombre not in encontrados:
+                    logger.warning(f"[COMPRAS_V2_PROCESSOR] Proveedor '{nombre}' no encontrado en tabla Proveedores")
+                # Los no encontrados también se recuerdan para no volver a consultarlos
+                self._proveedores[nombre] = encontrados.get(nombre)
+        
+        info = {nombre: self._proveedores[nombre] for nombre in nombres if self._proveedores.get(nombre)}
+        return pd.DataFrame.from_dict(
+            info, orient='index', columns=['puerto_origen', 'dias_produccion', 'dias_transporte']
+        )
     
     def __del__(self):
         """Destructor para limpiar recursos"""
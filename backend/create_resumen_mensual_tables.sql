@@ -0,0 +1,58 @@
+-- SQL para crear las tablas de resúmenes mensuales (RollupService)
+-- Ejecutar en el SQL Editor de Supabase
+-- Los KPIs y gráficos sin filtro de pedidos suman estas filas en lugar de recorrer
+-- facturacion, cobranza y pedidos_compras. Mientras no existan (o estén vacías)
+-- los KPIs se calculan en vivo. Después de crearlas, poblarlas con
+-- POST /api/system/rollups/refresh
+
+CREATE TABLE IF NOT EXISTS resumen_facturacion_mensual (
+    id SERIAL PRIMARY KEY,
+    archivo_id INTEGER,
+    "año" INTEGER,
+    mes INTEGER,
+    cliente VARCHAR,
+    total_registros INTEGER DEFAULT 0,
+    total_facturas INTEGER DEFAULT 0,
+    facturacion_total DOUBLE PRECISION DEFAULT 0.0,
+    facturacion_sin_iva DOUBLE PRECISION DEFAULT 0.0,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_resumen_facturacion_mensual_id ON resumen_facturacion_mensual(id);
+CREATE INDEX IF NOT EXISTS ix_resumen_facturacion_mensual_archivo_id ON resumen_facturacion_mensual(archivo_id);
+CREATE INDEX IF NOT EXISTS "idx_resumen_fact_año_mes" ON resumen_facturacion_mensual("año", mes);
+
+CREATE TABLE IF NOT EXISTS resumen_cobranza_mensual (
+    id SERIAL PRIMARY KEY,
+    archivo_id INTEGER,
+    "año" INTEGER,
+    mes INTEGER,
+    relacionada BOOLEAN DEFAULT TRUE,
+    cobranza_total DOUBLE PRECISION DEFAULT 0.0,
+    cobranza_sin_iva DOUBLE PRECISION DEFAULT 0.0,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_resumen_cobranza_mensual_id ON resumen_cobranza_mensual(id);
+CREATE INDEX IF NOT EXISTS ix_resumen_cobranza_mensual_archivo_id ON resumen_cobranza_mensual(archivo_id);
+CREATE INDEX IF NOT EXISTS "idx_resumen_cob_año_mes" ON resumen_cobranza_mensual("año", mes);
+
+CREATE TABLE IF NOT EXISTS resumen_pedidos_mensual (
+    id SERIAL PRIMARY KEY,
+    archivo_id INTEGER,
+    "año" INTEGER,
+    mes INTEGER,
+    material VARCHAR,
+    kg DOUBLE PRECISION DEFAULT 0.0,
+    importe_sin_iva DOUBLE PRECISION DEFAULT 0.0,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_resumen_pedidos_mensual_id ON resumen_pedidos_mensual(id);
+CREATE INDEX IF NOT EXISTS ix_resumen_pedidos_mensual_archivo_id ON resumen_pedidos_mensual(archivo_id);
+CREATE INDEX IF NOT EXISTS "idx_resumen_ped_año_mes" ON resumen_pedidos_mensual("año", mes);
+
+-- Comentarios para documentación
+COMMENT ON TABLE resumen_facturacion_mensual IS 'Facturación por (archivo_id, año, mes, cliente); datos derivados de facturacion';
+COMMENT ON TABLE resumen_cobranza_mensual IS 'Cobranza por archivo y periodo de la factura relacionada (año/mes NULL si no está relacionada)';
+COMMENT ON TABLE resumen_pedidos_mensual IS 'Kg e importe de pedidos_compras por (archivo_id, año, mes, material de 7 caracteres)';
@@ -11,6 +11,8 @@ import re
 from typing import Dict, List, Optional, Tuple
 import logging
 from pathlib import Path
+from utils.excel_reader import ExcelWorkbook
+from relaciones_utils import calcular_relaciones_cobranza, propagar_datos_factura
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -30,6 +32,24 @@ class ImmermexDataProcessor:
         self.pedidos_df = None
         self.maestro_df = None
         self.processed_data = {}
+        self.workbook = None
+        self.workbook_path = None
+    
+    def _get_workbook(self, path: str) -> ExcelWorkbook:
+        """Libro abierto de path; cada hoja se parsea una sola vez durante el procesamiento"""
+        if self.workbook is None or self.workbook_path != path:
+            self.close_workbook()
+            self.workbook = ExcelWorkbook(path)
+            self.workbook_path = path
+            logger.info(f"Libro abierto con motor {self.workbook.engine}: {path}")
+        return self.workbook
+    
+    def close_workbook(self):
+        """Cierra el libro abierto y libera sus filas en memoria"""
+        if self.workbook is not None:
+            self.workbook.close()
+        self.workbook = None
+        self.workbook_path = None
     
     def detect_header_row(self, path: str, sheet_name: str, keywords: list) -> int:
         """
@@ -39,30 +59,22 @@ class ImmermexDataProcessor:
             path: Ruta del archivo Excel
             sheet_name: Nombre de la hoja
             keywords: Lista de palabras clave para identificar encabezados
-            
+        
         Returns:
             Número de fila donde están los encabezados
         """
         try:
-            # Leer las primeras 20 filas para buscar encabezados
-            preview = pd.read_excel(path, sheet_name=sheet_name, nrows=20, header=None)
-            
-            # Buscar la fila que contenga más palabras clave
-            best_match = (0, 0)  # (fila, número_de_coincidencias)
+            # Buscar en las primeras 20 filas (ya parseadas) la que contenga más
+            # palabras clave, con al menos 3 coincidencias
+            header_row = self._get_workbook(path).detect_header_row(sheet_name, keywords, min_matches=3)
             
-            for idx, row in preview.iterrows():
-                row_str = ' '.join(row.astype(str).fillna(''))
-                matches = sum(1 for keyword in keywords if keyword.lower() in row_str.lower())
-                if matches > best_match[1]:
-                    best_match = (idx, matches)
-            
-            if best_match[1] >= 3:  # Al menos 3 coincidencias
-                logger.info(f"Encabezados encontrados en fila {best_match[0]} para hoja '{sheet_name}' ({best_match[1]} coincidencias)")
-                return best_match[0]
+            if header_row is not None:
+                logger.info(f"Encabezados encontrados en fila {header_row} para hoja '{sheet_name}'")
+                return header_row
             else:
                 logger.warning(f"No se encontraron encabezados en hoja '{sheet_name}', usando fila 0")
                 return 0
-            
+        
         except Exception as e:
             logger.error(f"Error detectando encabezados en hoja '{sheet_name}': {str(e)}")
             return 0
@@ -78,7 +90,7 @@ class ImmermexDataProcessor:
         uuid_pattern = r'^[A-F0-9]{8}-[A-F0-9]{4}-[A-F0-9]{4}-[A-F0-9]{4}-[A-F0-9]{12}$'
         cleaned = cleaned.where(cleaned.str.match(uuid_pattern), '')
         return cleaned.replace(['NAN', 'NONE', ''], np.nan)
-        
+    
     def load_excel_file(self, file_path: str) -> Dict[str, pd.DataFrame]:
         """
         Carga archivo Excel y extrae todas las hojas
@@ -86,15 +98,16 @@ class ImmermexDataProcessor:
         try:
             logger.info(f"Cargando archivo: {file_path}")
             
-            # Leer todas las hojas del Excel
-            excel_file = pd.ExcelFile(file_path)
+            # Leer todas las hojas del Excel (las filas quedan en el libro para
+            # releer con otra fila de encabezados sin volver a parsear)
+            libro = self._get_workbook(file_path)
             sheets_data = {}
             
-            logger.info(f"Hojas encontradas: {excel_file.sheet_names}")
+            logger.info(f"Hojas encontradas: {libro.sheet_names}")
             
-            for sheet_name in excel_file.sheet_names:
+            for sheet_name in libro.sheet_names:
                 logger.info(f"Procesando hoja: {sheet_name}")
-                df = pd.read_excel(file_path, sheet_name=sheet_name)
+                df = libro.parse(sheet_name)
                 sheets_data[sheet_name] = df
                 logger.info(f"Hoja '{sheet_name}' cargada: {df.shape[0]} filas, {df.shape[1]} columnas")
                 
@@ -110,7 +123,7 @@ class ImmermexDataProcessor:
                             break
             
             return sheets_data
-            
+        
         except Exception as e:
             logger.error(f"Error cargando archivo Excel: {str(e)}")
             raise
@@ -127,7 +140,7 @@ class ImmermexDataProcessor:
                 keywords = ['fecha', 'serie', 'folio', 'cliente', 'razón social', 'neto', 'total']
                 header_row = self.detect_header_row(file_path, "facturacion", keywords)
                 if header_row > 0:
-                    df = pd.read_excel(file_path, sheet_name="facturacion", header=header_row)
+                    df = self._get_workbook(file_path).parse("facturacion", header=header_row)
                     logger.info(f"Releyendo facturación con encabezados en fila {header_row}")
             
             # Mapeo de columnas flexible y completo
@@ -309,7 +322,7 @@ class ImmermexDataProcessor:
             self.facturacion_df = clean_df
             logger.info(f"Facturación normalizada: {clean_df.shape[0]} registros")
             return clean_df
-            
+        
         except Exception as e:
             logger.error(f"Error normalizando facturación: {str(e)}")
             return pd.DataFrame()
@@ -326,7 +339,7 @@ class ImmermexDataProcessor:
                 keywords = ['fecha', 'pago', 'cliente', 'importe', 'uuid']
                 header_row = self.detect_header_row(file_path, "cobranza", keywords)
                 if header_row > 0:
-                    df = pd.read_excel(file_path, sheet_name="cobranza", header=header_row)
+                    df = self._get_workbook(file_path).parse("cobranza", header=header_row)
                     logger.info(f"Releyendo cobranza con encabezados en fila {header_row}")
             
             # Mapeo de columnas flexible y completo
@@ -448,7 +461,7 @@ class ImmermexDataProcessor:
             self.cobranza_df = clean_df
             logger.info(f"Cobranza normalizada: {clean_df.shape[0]} registros")
             return clean_df
-            
+        
         except Exception as e:
             logger.error(f"Error normalizando cobranza: {str(e)}")
             return pd.DataFrame()
@@ -465,7 +478,7 @@ class ImmermexDataProcessor:
                 keywords = ['xml', 'cliente', 'tipo', 'relacion', 'importe', 'uuid']
                 header_row = self.detect_header_row(file_path, "cfdi relacionados", keywords)
                 if header_row > 0:
-                    df = pd.read_excel(file_path, sheet_name="cfdi relacionados", header=header_row)
+                    df = self._get_workbook(file_path).parse("cfdi relacionados", header=header_row)
                     logger.info(f"Releyendo CFDI con encabezados en fila {header_row}")
             
             # Mapeo de columnas flexible y completo
@@ -547,7 +560,7 @@ class ImmermexDataProcessor:
             self.cfdi_relacionados_df = clean_df
             logger.info(f"CFDIs relacionados normalizados: {clean_df.shape[0]} registros")
             return clean_df
-            
+        
         except Exception as e:
             logger.error(f"Error normalizando CFDI: {str(e)}")
             return pd.DataFrame()
@@ -565,7 +578,7 @@ class ImmermexDataProcessor:
                 keywords = ['factura', 'pedido', 'kg', 'precio', 'material']
                 header_row = self.detect_header_row(file_path, sheet_name, keywords)
                 if header_row > 0:
-                    df = pd.read_excel(file_path, sheet_name=sheet_name, header=header_row)
+                    df = self._get_workbook(file_path).parse(sheet_name, header=header_row)
                     logger.info(f"Releyendo pedidos con encabezados en fila {header_row}")
             
             # Mapeo de columnas flexible y completo
@@ -716,11 +729,34 @@ class ImmermexDataProcessor:
             self.pedidos_df = clean_df
             logger.info(f"Pedidos normalizados: {clean_df.shape[0]} registros")
             return clean_df
-            
+        
         except Exception as e:
             logger.error(f"Error normalizando pedidos: {str(e)}")
             return pd.DataFrame()
     
+    def propagate_factura_data(self, facturacion_df: pd.DataFrame, pedidos_df: pd.DataFrame) -> tuple:
+        """
+        Propaga días de crédito y fecha de factura de facturación a pedidos por folio,
+        en una sola unión por columnas. La factura es la fuente de verdad.
+        
+        Args:
+            facturacion_df: DataFrame de facturación
+            pedidos_df: DataFrame de pedidos
+        
+        Returns:
+            tuple: (pedidos_df_corregido, conteos por campo {'asignados', 'corregidos'})
+        """
+        try:
+            if facturacion_df.empty or pedidos_df.empty:
+                logger.info("No hay datos para propagar datos de factura a pedidos")
+                return pedidos_df, {}
+            
+            return propagar_datos_factura(facturacion_df, pedidos_df)
+        
+        except Exception as e:
+            logger.error(f"Error propagando datos de factura a pedidos: {str(e)}")
+            return pedidos_df, {}
+    
     def ensure_credit_days_consistency(self, facturacion_df: pd.DataFrame, pedidos_df: pd.DataFrame) -> tuple:
         """
         Garantiza que los días de crédito sean congruentes entre facturas y pedidos relacionados.
@@ -729,7 +765,7 @@ class ImmermexDataProcessor:
         Args:
             facturacion_df: DataFrame de facturación
             pedidos_df: DataFrame de pedidos
-            
+        
         Returns:
             tuple: (facturacion_df_corregida, pedidos_df_corregida, discrepancias_corregidas)
         """
@@ -738,56 +774,11 @@ class ImmermexDataProcessor:
                 logger.info("No hay datos para verificar congruencia de días de crédito")
                 return facturacion_df, pedidos_df, 0
             
-            # Crear una copia para trabajar
-            facturacion_corregida = facturacion_df.copy()
-            pedidos_corregidos = pedidos_df.copy()
-            
-            # Crear un diccionario de días de crédito por folio de factura
-            dias_credito_por_folio = {}
-            
-            # Usar facturas como fuente de verdad
-            for _, factura in facturacion_corregida.iterrows():
-                folio = factura.get('folio_factura')
-                dias_credito = factura.get('dias_credito')
-                
-                if folio and pd.notna(dias_credito):
-                    dias_credito_por_folio[folio] = dias_credito
-            
-            logger.info(f"Se encontraron {len(dias_credito_por_folio)} facturas con días de crédito definidos")
-            
-            # Corregir días de crédito en pedidos
-            discrepancias_corregidas = 0
-            
-            for idx, pedido in pedidos_corregidos.iterrows():
-                folio = pedido.get('folio_factura')
-                dias_credito_pedido = pedido.get('dias_credito')
-                
-                if folio in dias_credito_por_folio:
-                    dias_credito_factura = dias_credito_por_folio[folio]
-                    
-                    # Si hay discrepancia, corregir usando la factura como fuente de verdad
-                    if pd.notna(dias_credito_pedido) and dias_credito_pedido != dias_credito_factura:
-                        pedidos_corregidos.at[idx, 'dias_credito'] = dias_credito_factura
-                        discrepancias_corregidas += 1
-                        
-                        logger.debug(f"Corregido pedido {pedido.get('pedido', 'N/A')} "
-                                   f"(folio {folio}): {dias_credito_pedido} → {dias_credito_factura}")
-                    
-                    # Si el pedido no tiene días de crédito, usar el de la factura
-                    elif pd.isna(dias_credito_pedido):
-                        pedidos_corregidos.at[idx, 'dias_credito'] = dias_credito_factura
-                        discrepancias_corregidas += 1
-                        
-                        logger.debug(f"Asignado días de crédito a pedido {pedido.get('pedido', 'N/A')} "
-                                   f"(folio {folio}): {dias_credito_factura}")
-            
-            if discrepancias_corregidas > 0:
-                logger.info(f"✅ Se corrigieron {discrepancias_corregidas} discrepancias de días de crédito")
-            else:
-                logger.info("✅ Los días de crédito ya eran congruentes entre pedidos y facturas")
-            
-            return facturacion_corregida, pedidos_corregidos, discrepancias_corregidas
+            pedidos_corregidos, conteos = propagar_datos_factura(facturacion_df, pedidos_df, campos=('dias_credito',))
+            discrepancias_corregidas = conteos['dias_credito']['asignados'] + conteos['dias_credito']['corregidos']
             
+            return facturacion_df.copy(), pedidos_corregidos, discrepancias_corregidas
+        
         except Exception as e:
             logger.error(f"Error garantizando congruencia de días de crédito: {str(e)}")
             return facturacion_df, pedidos_df, 0
@@ -798,8 +789,8 @@ class ImmermexDataProcessor:
         
         Args:
             facturacion_df: DataFrame de facturación
-            pedidos_df: DataFrame de pedidos
-            
+            pedidos_df: DataFrame de pedidos (se modifica en el lugar)
+        
         Returns:
             int: Número de fechas asignadas
         """
@@ -808,43 +799,11 @@ class ImmermexDataProcessor:
                 logger.info("No hay datos para asignar fechas de factura")
                 return 0
             
-            # Crear un diccionario de fechas de factura por folio
-            fechas_por_folio = {}
-            
-            for _, factura in facturacion_df.iterrows():
-                folio = factura.get('folio_factura')
-                fecha_factura = factura.get('fecha_factura')
-                
-                if folio and pd.notna(fecha_factura):
-                    fechas_por_folio[folio] = fecha_factura
-            
-            logger.info(f"Se encontraron {len(fechas_por_folio)} facturas con fechas definidas")
-            
-            # Asignar fechas a pedidos
-            fechas_asignadas = 0
-            
-            for idx, pedido in pedidos_df.iterrows():
-                folio = pedido.get('folio_factura')
-                fecha_actual = pedido.get('fecha_factura')
-                
-                if folio in fechas_por_folio:
-                    fecha_factura = fechas_por_folio[folio]
-                    
-                    # Si el pedido no tiene fecha_factura o es diferente, asignar la de la factura
-                    if pd.isna(fecha_actual) or fecha_actual != fecha_factura:
-                        pedidos_df.at[idx, 'fecha_factura'] = fecha_factura
-                        fechas_asignadas += 1
-                        
-                        logger.debug(f"Asignada fecha de factura a pedido {pedido.get('pedido', 'N/A')} "
-                                   f"(folio {folio}): {fecha_factura}")
-            
-            if fechas_asignadas > 0:
-                logger.info(f"✅ Se asignaron {fechas_asignadas} fechas de factura a pedidos")
-            else:
-                logger.info("✅ Las fechas de factura ya estaban asignadas correctamente")
-            
-            return fechas_asignadas
+            pedidos_con_fecha, conteos = propagar_datos_factura(facturacion_df, pedidos_df, campos=('fecha_factura',))
+            pedidos_df['fecha_factura'] = pedidos_con_fecha['fecha_factura']
             
+            return conteos['fecha_factura']['asignados'] + conteos['fecha_factura']['corregidos']
+        
         except Exception as e:
             logger.error(f"Error asignando fechas de factura a pedidos: {str(e)}")
             return 0
@@ -856,41 +815,17 @@ class ImmermexDataProcessor:
         Args:
             facturacion: DataFrame de facturación
             cobranza: DataFrame de cobranza
-            
+        
         Returns:
             DataFrame de facturación con relaciones calculadas
         """
         try:
-            facturacion_rel = facturacion.copy()
-            
-            # Agregar columnas de relación
-            facturacion_rel['importe_cobrado'] = 0.0
-            facturacion_rel['fecha_cobro'] = pd.NaT
-            facturacion_rel['dias_cobro'] = 0
-            
-            # Relacionar por UUID
-            for idx, factura in facturacion_rel.iterrows():
-                uuid_factura = factura['uuid_factura']
-                if pd.notna(uuid_factura) and uuid_factura != '':
-                    cobranzas_relacionadas = cobranza[
-                        cobranza['uuid_factura_relacionada'] == uuid_factura
-                    ]
-                    
-                    if not cobranzas_relacionadas.empty:
-                        facturacion_rel.at[idx, 'importe_cobrado'] = cobranzas_relacionadas['importe_pagado'].sum()
-                        facturacion_rel.at[idx, 'fecha_cobro'] = cobranzas_relacionadas['fecha_pago'].max()
-                        
-                        # Calcular días de cobro
-                        if pd.notna(factura['fecha_factura']) and pd.notna(facturacion_rel.at[idx, 'fecha_cobro']):
-                            dias = (facturacion_rel.at[idx, 'fecha_cobro'] - factura['fecha_factura']).days
-                            facturacion_rel.at[idx, 'dias_cobro'] = max(0, dias)
-            
-            # Recalcular saldo pendiente
-            facturacion_rel['saldo_pendiente'] = facturacion_rel['monto_total'] - facturacion_rel['importe_cobrado']
+            # Agrupación de cobranza por UUID unida a las facturas (sin recorrer fila por fila)
+            facturacion_rel = calcular_relaciones_cobranza(facturacion, cobranza)
             
             logger.info("Relaciones calculadas exitosamente")
             return facturacion_rel
-            
+        
         except Exception as e:
             logger.error(f"Error calculando relaciones: {str(e)}")
             return facturacion
@@ -968,7 +903,7 @@ class ImmermexDataProcessor:
             master_df['dias_vencimiento'] = (master_df['fecha_cobro'] - master_df['fecha_factura']).dt.days
         else:
             master_df['dias_vencimiento'] = 0
-            
+        
         if not master_df.empty:
             master_df['estado_cobro'] = master_df.apply(self._determinar_estado_cobro, axis=1)
         master_df['margen'] = master_df['total'] - master_df.get('anticipos', 0)
@@ -1087,21 +1022,21 @@ class ImmermexDataProcessor:
             if self.facturacion_df is not None and self.cobranza_df is not None:
                 self.facturacion_df = self.calculate_relationships(self.facturacion_df, self.cobranza_df)
             
-            # Garantizar congruencia de días de crédito entre facturas y pedidos
+            # Garantizar congruencia de días de crédito y fecha de factura entre
+            # facturas y pedidos (una sola unión por folio)
             if self.facturacion_df is not None and self.pedidos_df is not None:
-                logger.info("🔍 Verificando congruencia de días de crédito...")
-                self.facturacion_df, self.pedidos_df, discrepancias_corregidas = self.ensure_credit_days_consistency(
-                    self.facturacion_df, self.pedidos_df
-                )
+                logger.info("🔍 Propagando días de crédito y fecha de factura a pedidos...")
+                self.pedidos_df, conteos = self.propagate_factura_data(self.facturacion_df, self.pedidos_df)
                 
+                dias_credito = conteos.get('dias_credito', {})
+                discrepancias_corregidas = dias_credito.get('asignados', 0) + dias_credito.get('corregidos', 0)
                 if discrepancias_corregidas > 0:
                     logger.info(f"✅ Se corrigieron {discrepancias_corregidas} discrepancias de días de crédito durante el procesamiento")
                 else:
                     logger.info("✅ Los días de crédito ya eran congruentes")
                 
-                # Llenar automáticamente fecha_factura en pedidos usando la fecha de la factura asociada
-                logger.info("📅 Llenando fecha_factura en pedidos usando datos de facturas...")
-                fechas_asignadas = self.fill_pedidos_fecha_factura(self.facturacion_df, self.pedidos_df)
+                fechas = conteos.get('fecha_factura', {})
+                fechas_asignadas = fechas.get('asignados', 0) + fechas.get('corregidos', 0)
                 logger.info(f"✅ Se asignaron {fechas_asignadas} fechas de factura a pedidos")
             
             # Crear DataFrame maestro
@@ -1121,10 +1056,13 @@ class ImmermexDataProcessor:
             
             logger.info("Procesamiento completado exitosamente")
             return master_df, kpis
-            
+        
         except Exception as e:
             logger.error(f"Error en procesamiento de archivo: {str(e)}")
             raise
+        
+        finally:
+            self.close_workbook()
     
     def get_processed_data(self) -> Dict[str, pd.DataFrame]:
         """
@@ -1161,132 +1099,208 @@ def process_immermex_file(file_path: str, output_path: str = None) -> Tuple[pd.D
     
     return master_df, kpis
 
+# Tipos de las columnas estándar que se persisten, por clave de salida.
+# 'texto', 'numero', 'entero' y 'fecha' siguen las reglas de DataValidator;
+# 'dias_credito' extrae los días de textos como '30 días' o 'Contado'.
+TIPOS_COLUMNAS = {
+    "facturacion_clean": {
+        'fecha_factura': 'fecha',
+        'serie_factura': 'texto',
+        'folio_factura': 'entero',
+        'cliente': 'texto',
+        'agente': 'texto',
+        'monto_neto': 'numero',
+        'monto_total': 'numero',
+        'saldo_pendiente': 'numero',
+        'dias_credito': 'dias_credito',
+        'uuid_factura': 'texto'
+    },
+    "cobranza_clean": {
+        'fecha_pago': 'fecha',
+        'serie_pago': 'texto',
+        'folio_pago': 'texto',
+        'cliente': 'texto',
+        'moneda': 'texto',
+        'tipo_cambio': 'numero',
+        'forma_pago': 'texto',
+        'numero_parcialidades': 'entero',
+        'importe_pagado': 'numero',
+        'uuid_relacionado': 'texto'
+    },
+    "cfdi_clean": {
+        'xml': 'texto',
+        'cliente_receptor': 'texto',
+        'tipo_relacion': 'texto',
+        'importe_relacion': 'numero',
+        'uuid_factura_relacionada': 'texto'
+    },
+    "pedidos_compras_clean": {
+        # folio_factura se conserva tal cual: PedidosService extrae el número
+        # de textos como '29,975 PT.202506124013IM251849/10'
+        'pedido': 'entero',
+        'kg': 'numero',
+        'precio_unitario': 'numero',
+        'importe_sin_iva': 'numero',
+        'material': 'texto',
+        'cliente': 'texto',
+        'dias_credito': 'entero',
+        'fecha_factura': 'fecha'
+    }
+}
+
+def _clasificar_hoja(sheet_name: str) -> str:
+    """Clave de salida según el nombre de la hoja (las hojas no reconocidas son pedidos)"""
+    nombre = sheet_name.lower()
+    if 'facturacion' in nombre:
+        return "facturacion_clean"
+    if 'cobranza' in nombre:
+        return "cobranza_clean"
+    if 'cfdi' in nombre or 'relacionado' in nombre:
+        return "cfdi_clean"
+    return "pedidos_compras_clean"
+
+def _coerce_columns(df: pd.DataFrame, tipos: Dict[str, str]) -> pd.DataFrame:
+    """
+    Convierte por columna (sin recorrer filas) a tipos de pandas. Los faltantes
+    quedan como NaN/NaT/None para que cada servicio aplique su valor por defecto.
+    """
+    from utils.validators import DataValidator
+    
+    for columna, tipo in tipos.items():
+        if columna not in df.columns:
+            continue
+        if tipo == 'fecha':
+            df[columna] = DataValidator.safe_date_series(df[columna])
+        elif tipo == 'numero':
+            df[columna] = DataValidator.safe_float_series(df[columna], default=None)
+        elif tipo == 'entero':
+            df[columna] = DataValidator.safe_int_series(df[columna], default=None)
+        elif tipo == 'dias_credito':
+            df[columna] = DataValidator.dias_credito_series(df[columna])
+        else:
+            df[columna] = DataValidator.safe_string_series(df[columna], default=None)
+    return df
+
 def process_excel_from_bytes(file_bytes: bytes, filename: str) -> Tuple[Dict[str, pd.DataFrame], Dict]:
     """
     Procesa archivo Excel desde bytes en memoria (compatible con entornos serverless)
-    Versión simplificada que evita errores de normalización
+    
+    Cada hoja se reduce a sus columnas estándar (selección y renombrado, sin
+    copiar la hoja completa), los bloques se concatenan una sola vez por tipo y
+    fechas, números y días de crédito se convierten por columna. Retorna
+    DataFrames tipados listos para la ingesta masiva.
     """
     logger.info(f"Procesando archivo desde bytes: {filename}")
     
     try:
-        import io
-        
-        # Crear archivo temporal en memoria usando BytesIO
-        file_like = io.BytesIO(file_bytes)
-        
-        # Leer Excel directamente desde bytes
-        excel_data = pd.read_excel(file_like, sheet_name=None, engine='openpyxl')
-        logger.info(f"Hojas encontradas: {list(excel_data.keys())}")
-        
-        processed_data = {
-            "facturacion_clean": pd.DataFrame(),
-            "cobranza_clean": pd.DataFrame(), 
-            "cfdi_clean": pd.DataFrame(),
-            "pedidos_compras_clean": pd.DataFrame()  # Cambiado a pedidos_compras_clean
+        # Leer Excel directamente desde bytes; cada hoja se parsea al procesarla
+        libro = ExcelWorkbook(file_bytes)
+        hojas = libro.sheet_names
+        logger.info(f"Hojas encontradas ({libro.engine}): {hojas}")
+        
+        mapeadores = {
+            "facturacion_clean": _map_facturacion_columns,
+            "cobranza_clean": _map_cobranza_columns,
+            "cfdi_clean": _map_cfdi_columns,
+            "pedidos_compras_clean": _map_pedidos_columns
         }
+        bloques = {key: [] for key in mapeadores}
         
-            # Procesar cada hoja de forma básica (sin normalización compleja)
-        for sheet_name, df in excel_data.items():
-            logger.info(f"Procesando hoja: {sheet_name} con {len(df)} filas")
-            logger.info(f"Columnas en {sheet_name}: {list(df.columns)}")
-            
-            if df.empty:
-                continue
-            
-            # Limpiar datos básicos
-            df_clean = df.copy()
-            
-            # Eliminar filas completamente vacías
-            df_clean = df_clean.dropna(how='all')
-            
-            # Eliminar columnas completamente vacías
-            df_clean = df_clean.dropna(axis=1, how='all')
-            
-            # Mapear columnas según el tipo de hoja
-            if 'facturacion' in sheet_name.lower():
-                df_clean = _map_facturacion_columns(df_clean)
-            elif 'cobranza' in sheet_name.lower():
-                df_clean = _map_cobranza_columns(df_clean)
-            elif 'cfdi' in sheet_name.lower() or 'relacionado' in sheet_name.lower():
-                df_clean = _map_cfdi_columns(df_clean)
-            else:
-                df_clean = _map_pedidos_columns(df_clean)
-            
-            # Log de mapeo para debugging
-            logger.info(f"Columnas mapeadas en {sheet_name}: {[col for col in df_clean.columns if col in ['fecha_factura', 'serie_factura', 'folio_factura', 'cliente', 'monto_total', 'fecha_pago', 'importe_pagado', 'pedido', 'material']]}")
-            
-            # Agregar información de la hoja
-            df_clean['hoja_origen'] = sheet_name
-            df_clean['archivo_origen'] = filename
-            
-            # Clasificar según el tipo de hoja
-            if 'facturacion' in sheet_name.lower():
-                processed_data["facturacion_clean"] = pd.concat([processed_data["facturacion_clean"], df_clean], ignore_index=True)
-            elif 'cobranza' in sheet_name.lower():
-                processed_data["cobranza_clean"] = pd.concat([processed_data["cobranza_clean"], df_clean], ignore_index=True)
-            elif 'cfdi' in sheet_name.lower() or 'relacionado' in sheet_name.lower():
-                processed_data["cfdi_clean"] = pd.concat([processed_data["cfdi_clean"], df_clean], ignore_index=True)
-            else:
-                # Asumir que es una hoja de pedidos por mes
-                processed_data["pedidos_compras_clean"] = pd.concat([processed_data["pedidos_compras_clean"], df_clean], ignore_index=True)
-        
-        # Convertir DataFrames a listas de diccionarios para la base de datos
-        processed_data_dict = {}
-        for key, df in processed_data.items():
-            if not df.empty:
-                # Convertir DataFrame a lista de diccionarios
-                processed_data_dict[key] = df.to_dict('records')
-                logger.info(f"{key}: {len(processed_data_dict[key])} registros convertidos")
-            else:
-                processed_data_dict[key] = []
+        with libro:
+            for sheet_name in hojas:
+                df = libro.parse(sheet_name, release=True)
+                if df.empty:
+                    continue
+                
+                # Eliminar filas y columnas completamente vacías
+                df = df.dropna(how='all').dropna(axis=1, how='all')
+                
+                key = _clasificar_hoja(sheet_name)
+                df_mapped = _coerce_columns(mapeadores[key](df), TIPOS_COLUMNAS[key])
+                df_mapped['hoja_origen'] = sheet_name
+                df_mapped['archivo_origen'] = filename
+                bloques[key].append(df_mapped)
+                
+                logger.info(f"Hoja {sheet_name} -> {key}: {len(df)} filas leídas, {len(df_mapped)} mapeadas")
+        
+        # Una sola concatenación por tipo de datos
+        processed_data = {}
+        for key, frames in bloques.items():
+            processed_data[key] = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+            logger.info(f"{key}: {len(processed_data[key])} registros")
         
         # Calcular KPIs básicos
         kpis = {
-            "total_facturas": len(processed_data_dict["facturacion_clean"]),
-            "total_cobranzas": len(processed_data_dict["cobranza_clean"]),
-            "total_cfdi": len(processed_data_dict["cfdi_clean"]),
-            "total_pedidos": len(processed_data_dict["pedidos_compras_clean"]),  # Cambiado a pedidos_compras_clean
+            "total_facturas": len(processed_data["facturacion_clean"]),
+            "total_cobranzas": len(processed_data["cobranza_clean"]),
+            "total_cfdi": len(processed_data["cfdi_clean"]),
+            "total_pedidos": len(processed_data["pedidos_compras_clean"]),
             "fecha_procesamiento": datetime.now().isoformat(),
             "archivo": filename,
-            "hojas_procesadas": list(excel_data.keys())
+            "hojas_procesadas": hojas
         }
         
         logger.info(f"Procesamiento desde bytes completado - Facturas: {kpis['total_facturas']}, Pedidos: {kpis['total_pedidos']}")
-        return processed_data_dict, kpis
-        
+        return processed_data, kpis
+    
     except Exception as e:
         logger.error(f"Error procesando archivo desde bytes: {str(e)}")
         import traceback
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise
 
-def _convert_dias_credito(value):
-    """Convierte valores de texto de días de crédito a números"""
-    if pd.isna(value) or value is None:
-        return 0
-    
-    # Convertir a string si no lo es
-    str_value = str(value).strip().lower()
+def _resolve_columns(df: pd.DataFrame, column_mapping: Dict[str, str], destinos: List[str] = None) -> Dict[str, int]:
+    """
+    Posición en df de la columna origen de cada columna estándar.
     
-    # Si dice "contado", retornar 0 días
-    if 'contado' in str_value:
-        return 0
+    Los alias se comparan sin distinguir mayúsculas; si varios alias de un mismo
+    destino existen en la hoja gana el último del mapeo. Los destinos sin alias
+    encontrado usan una columna que ya tenga exactamente ese nombre.
+    """
+    posiciones = {}
+    for posicion, col in enumerate(df.columns):
+        if isinstance(col, str):
+            posiciones.setdefault(col.lower(), posicion)
     
-    # Extraer solo números del texto
-    import re
-    numbers = re.findall(r'\d+', str_value)
+    origen = {}
+    for old_name, new_name in column_mapping.items():
+        posicion = posiciones.get(old_name.lower())
+        if posicion is not None:
+            origen[new_name] = posicion
     
-    if numbers:
-        return int(numbers[0])  # Tomar el primer número encontrado
+    for destino in destinos or []:
+        if destino not in origen and destino in df.columns:
+            origen[destino] = list(df.columns).index(destino)
     
-    return 0
+    return origen
+
+def _apply_positional_fallback(origen: Dict[str, int], df: pd.DataFrame, posiciones: Dict[str, int]) -> Dict[str, int]:
+    """Completa los destinos no encontrados por nombre con su posición en la hoja"""
+    for destino, posicion in posiciones.items():
+        if destino not in origen and posicion < len(df.columns):
+            origen[destino] = posicion
+    return origen
+
+def _select_columns(df: pd.DataFrame, origen: Dict[str, int]) -> pd.DataFrame:
+    """Nuevo DataFrame solo con las columnas mapeadas, ya con su nombre estándar"""
+    return df.iloc[:, list(origen.values())].set_axis(list(origen.keys()), axis=1, copy=False)
+
+def _folios_con_negativos(series: pd.Series) -> pd.Series:
+    """Folios numéricos; los faltantes reciben folios únicos negativos (-1, -2, ...)"""
+    folios = pd.to_numeric(series, errors='coerce')
+    mask_na = folios.isna()
+    folios.loc[mask_na] = range(-1, -mask_na.sum() - 1, -1)
+    return folios.astype(int)
+
+def _fill_defaults(df: pd.DataFrame, default_values: Dict) -> pd.DataFrame:
+    """Agrega las columnas estándar faltantes con su valor por defecto"""
+    for field, default_value in default_values.items():
+        if field not in df.columns:
+            df[field] = default_value
+    return df
 
 def _map_facturacion_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Mapea columnas de facturación usando enfoque híbrido: nombre + posición"""
-    logger.info(f"=== INICIANDO MAPEO FACTURACION ===")
-    logger.info(f"Columnas originales: {list(df.columns)}")
-    df_mapped = df.copy()
-    
     # Mapeo por nombre de columna (flexible)
     column_mapping = {
         # Fecha - múltiples variaciones
@@ -1349,71 +1363,36 @@ def _map_facturacion_columns(df: pd.DataFrame) -> pd.DataFrame:
         'crédito': 'dias_credito'
     }
     
-    # Mapeo por nombre (case-insensitive)
-    for old_name, new_name in column_mapping.items():
-        for col in df_mapped.columns:
-            if isinstance(col, str) and col.lower() == old_name.lower():
-                df_mapped[new_name] = df_mapped[col]
-                break
-    
     # Mapeo por posición como fallback (solo si no se encontró por nombre)
-    columns = list(df_mapped.columns)
-    
-    if 'fecha_factura' not in df_mapped.columns and len(columns) >= 1:
-        df_mapped['fecha_factura'] = df_mapped.iloc[:, 0]
-    if 'serie_factura' not in df_mapped.columns and len(columns) >= 2:
-        df_mapped['serie_factura'] = df_mapped.iloc[:, 1]
-    if 'folio_factura' not in df_mapped.columns and len(columns) >= 3:
-        folio_series = pd.to_numeric(df_mapped.iloc[:, 2], errors='coerce')
-        # Generar folios únicos negativos para valores faltantes
-        mask_na = folio_series.isna()
-        folio_series.loc[mask_na] = range(-1, -mask_na.sum() - 1, -1)
-        df_mapped['folio_factura'] = folio_series.astype(int)
-    if 'cliente' not in df_mapped.columns and len(columns) >= 4:
-        df_mapped['cliente'] = df_mapped.iloc[:, 3]
-    if 'monto_neto' not in df_mapped.columns and len(columns) >= 5:
-        df_mapped['monto_neto'] = df_mapped.iloc[:, 4]
-    if 'monto_total' not in df_mapped.columns and len(columns) >= 6:
-        df_mapped['monto_total'] = df_mapped.iloc[:, 5]
-    if 'saldo_pendiente' not in df_mapped.columns and len(columns) >= 7:
-        df_mapped['saldo_pendiente'] = df_mapped.iloc[:, 6]
-    if 'dias_credito' not in df_mapped.columns and len(columns) >= 8:
-        df_mapped['dias_credito'] = df_mapped.iloc[:, 7]    # Columna H
-    if 'agente' not in df_mapped.columns and len(columns) >= 11:
-        df_mapped['agente'] = df_mapped.iloc[:, 10]        # 'Unnamed: 10'
-    if 'uuid_factura' not in df_mapped.columns and len(columns) >= 14:
-        df_mapped['uuid_factura'] = df_mapped.iloc[:, 13]
-    
-    # Convertir días de crédito de texto a número
-    if 'dias_credito' in df_mapped.columns:
-        df_mapped['dias_credito'] = df_mapped['dias_credito'].apply(_convert_dias_credito)
+    posiciones = {
+        'fecha_factura': 0,
+        'serie_factura': 1,
+        'folio_factura': 2,
+        'cliente': 3,
+        'monto_neto': 4,
+        'monto_total': 5,
+        'saldo_pendiente': 6,
+        'dias_credito': 7,     # Columna H
+        'agente': 10,          # 'Unnamed: 10'
+        'uuid_factura': 13
+    }
     
-    # Log para debugging
-    mapped_cols = [col for col in df_mapped.columns if col in ['fecha_factura', 'serie_factura', 'folio_factura', 'cliente', 'monto_neto', 'monto_total', 'saldo_pendiente', 'dias_credito', 'agente', 'uuid_factura']]
-    logger.info(f"Mapeo final facturación: {len(mapped_cols)} columnas mapeadas: {mapped_cols}")
+    origen = _resolve_columns(df, column_mapping, list(posiciones))
+    por_nombre = set(origen)
+    origen = _apply_positional_fallback(origen, df, posiciones)
+    df_mapped = _select_columns(df, origen)
     
-    # Log de muestra de datos para debugging
-    if 'fecha_factura' in df_mapped.columns:
-        sample_dates = df_mapped['fecha_factura'].head(3).tolist()
-        logger.info(f"Muestra de fechas factura: {sample_dates}")
-    if 'dias_credito' in df_mapped.columns:
-        sample_credito = df_mapped['dias_credito'].head(3).tolist()
-        logger.info(f"Muestra de días crédito: {sample_credito}")
+    if 'folio_factura' in origen and 'folio_factura' not in por_nombre:
+        df_mapped['folio_factura'] = _folios_con_negativos(df_mapped['folio_factura'])
     
-    logger.info(f"=== FINALIZANDO MAPEO FACTURACION ===")
+    logger.info(f"Mapeo facturación: {len(origen)} columnas ({sorted(por_nombre)} por nombre)")
     return df_mapped
 
 def _map_cobranza_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Mapea columnas de cobranza basado en estructura visual: Documentos Relacionados al Pago"""
-    logger.info("=== EJECUTANDO _map_cobranza_columns ===")
-    logger.info(f"Columnas originales en _map_cobranza_columns: {list(df.columns)}")
-    
-    df_mapped = df.copy()
+    filas_leidas = len(df)
     
     # Filtrar filas de encabezado que contienen texto descriptivo
-    logger.info(f"Total filas antes del filtro: {len(df_mapped)}")
-    
-    # Identificar filas que contienen texto de encabezado
     header_keywords = [
         'documentos relacionados al pago',
         'recibo electrónico',
@@ -1431,91 +1410,35 @@ def _map_cobranza_columns(df: pd.DataFrame) -> pd.DataFrame:
         'xml',
         'encabezado'
     ]
+    # Valores que parecen encabezados; 3 o más en una fila la descartan
+    header_like_keywords = ['recibo', 'documento', 'encabezado', 'xml', 'relacionado', 'electronico']
+    header_count_threshold = 3
     
-    # Filtrar filas que contienen texto de encabezado en cualquier columna
-    mask = pd.Series([True] * len(df_mapped))
-    
-    for col in df_mapped.columns:
-        if df_mapped[col].dtype == 'object':  # Solo columnas de texto
-            # Filtro por keywords
-            col_mask = df_mapped[col].astype(str).str.lower().str.contains(
-                '|'.join(header_keywords), 
-                na=False, 
-                regex=True
-            )
-            mask = mask & ~col_mask  # Excluir filas que contienen keywords de encabezado
-            
-            # Filtro adicional para fechas de período (ej: "Del: 01/SEP/2025 Al: 28/SEP/2025")
-            period_mask = df_mapped[col].astype(str).str.contains(
-                r'del:\s*\d{1,2}/[a-z]{3}/\d{4}\s*al:\s*\d{1,2}/[a-z]{3}/\d{4}',
-                na=False,
-                regex=True,
-                case=False
-            )
-            mask = mask & ~period_mask  # Excluir filas con fechas de período
-    
-    df_mapped = df_mapped[mask]
-    logger.info(f"Filas después del filtro de encabezados: {len(df_mapped)}")
-    
-    # Filtro adicional: eliminar filas que contienen múltiples valores de encabezado
-    # (indica que es una fila de encabezado con múltiples columnas de texto)
-    header_count_threshold = 3  # Si una fila tiene 3+ valores que parecen encabezados, eliminarla
-    
-    # Usar índices del DataFrame actual para evitar problemas de alineación
-    rows_to_remove = []
-    
-    for idx, row in df_mapped.iterrows():
-        header_count = 0
-        for col in df_mapped.columns:
-            if df_mapped[col].dtype == 'object':  # Solo columnas de texto
-                cell_value = str(row[col]).lower().strip()
-                # Contar si el valor parece un encabezado (texto descriptivo, no datos)
-                if (cell_value and 
-                    cell_value not in ['nan', 'none', 'null', ''] and
-                    any(keyword in cell_value for keyword in ['recibo', 'documento', 'encabezado', 'xml', 'relacionado', 'electronico'])):
-                    header_count += 1
-        
-        # Si tiene muchos valores que parecen encabezados, marcarla para eliminar
-        if header_count >= header_count_threshold:
-            rows_to_remove.append(idx)
-    
-    # Eliminar filas marcadas
-    df_mapped = df_mapped.drop(index=rows_to_remove)
-    logger.info(f"Filas después del filtro adicional de encabezados múltiples: {len(df_mapped)}")
-    
-    # Manejar columnas especiales (datetime, etc.)
-    # Buscar la columna que contiene la fecha real de pago (no UUID)
-    datetime_found = False
-    for col in df_mapped.columns:
-        if isinstance(col, datetime):
-            # Verificar si esta columna datetime contiene fechas reales o UUID
-            sample_values = df_mapped[col].dropna().head(3)
-            # Si los valores parecen fechas (datetime objects), usar esta columna
-            if len(sample_values) > 0 and all(isinstance(val, datetime) for val in sample_values):
-                logger.info(f"✅ Detectada columna datetime con fechas reales en _map_cobranza_columns: {col} -> fecha_pago")
-                df_mapped['fecha_pago'] = df_mapped[col]
-                datetime_found = True
-                break
-            else:
-                logger.info(f"⚠️ Columna datetime {col} contiene UUID, buscando otra columna con fechas reales")
-    
-    # Si no encontramos columna datetime con fechas reales, buscar en columnas regulares
-    if not datetime_found:
-        # Buscar en columnas regulares que puedan contener fechas
-        for col in df_mapped.columns:
-            if str(col).lower() == 'contpaq i':  # Esta columna contiene las fechas reales
-                sample_values = df_mapped[col].dropna().head(3)
-                if len(sample_values) > 0 and all(isinstance(val, datetime) for val in sample_values):
-                    logger.info(f"✅ Detectada columna 'CONTPAQ i' con fechas reales -> fecha_pago")
-                    df_mapped['fecha_pago'] = df_mapped[col]
-                    datetime_found = True
-                    break
+    texto_columnas = {
+        col: df[col].astype(str).str.lower()
+        for col in df.columns if df[col].dtype == 'object'  # Solo columnas de texto
+    }
     
-    if not datetime_found:
-        logger.info("⚠️ No se encontraron columnas con fechas reales en _map_cobranza_columns")
+    # Excluir filas con keywords de encabezado o fechas de período
+    # (ej: "Del: 01/SEP/2025 Al: 28/SEP/2025") en cualquier columna de texto
+    mask = pd.Series(True, index=df.index)
+    for texto in texto_columnas.values():
+        mask &= ~texto.str.contains('|'.join(header_keywords), na=False, regex=True)
+        mask &= ~texto.str.contains(
+            r'del:\s*\d{1,2}/[a-z]{3}/\d{4}\s*al:\s*\d{1,2}/[a-z]{3}/\d{4}', na=False, regex=True
+        )
+    
+    # Excluir filas con múltiples valores de encabezado
+    if texto_columnas:
+        conteo = sum(
+            texto.str.strip().str.contains('|'.join(header_like_keywords), na=False, regex=True).astype(int)
+            for texto in texto_columnas.values()
+        )
+        mask &= conteo < header_count_threshold
+    
+    df = df[mask]
     
     # Mapeo completo basado en la referencia visual
-    # RECIBO ELECTRÓNICO DE PAGO section
     column_mapping = {
         # Sección RECIBO ELECTRÓNICO DE PAGO
         'fecha pago': 'fecha_pago',
@@ -1618,60 +1541,46 @@ def _map_cobranza_columns(df: pd.DataFrame) -> pd.DataFrame:
         'uuid_factura_relacionada': 'uuid_relacionado'
     }
     
-    # Mapeo por nombre (case-insensitive)
-    for old_name, new_name in column_mapping.items():
-        for col in df_mapped.columns:
-            if isinstance(col, str) and col.lower() == old_name.lower():
-                df_mapped[new_name] = df_mapped[col]
-                break
-    
     # Mapeo por posición basado en la estructura visual
-    columns = list(df_mapped.columns)
-    
-    # RECIBO ELECTRÓNICO DE PAGO (columnas 0-11)
-    # Solo mapear fecha_pago si no se detectó automáticamente como datetime
-    if 'fecha_pago' not in df_mapped.columns and len(columns) >= 1:
-        df_mapped['fecha_pago'] = df_mapped.iloc[:, 0]  # "Fecha Pago"
-    if 'serie_pago' not in df_mapped.columns and len(columns) >= 2:
-        df_mapped['serie_pago'] = df_mapped.iloc[:, 1]  # "Serie Pago"
-    if 'folio_pago' not in df_mapped.columns and len(columns) >= 3:
-        df_mapped['folio_pago'] = df_mapped.iloc[:, 2]  # "Folio Pago"
-    if 'concepto_pago' not in df_mapped.columns and len(columns) >= 4:
-        df_mapped['concepto_pago'] = df_mapped.iloc[:, 3]  # "Concepto Pago"
-    if 'uuid_pago' not in df_mapped.columns and len(columns) >= 5:
-        df_mapped['uuid_pago'] = df_mapped.iloc[:, 4]  # "UUID del Pago"
-    if 'cliente' not in df_mapped.columns and len(columns) >= 6:
-        df_mapped['cliente'] = df_mapped.iloc[:, 5]  # "Cliente"
-    if 'moneda' not in df_mapped.columns and len(columns) >= 7:
-        df_mapped['moneda'] = df_mapped.iloc[:, 6]  # "Moneda"
-    if 'tipo_cambio' not in df_mapped.columns and len(columns) >= 8:
-        df_mapped['tipo_cambio'] = df_mapped.iloc[:, 7]  # "Tipo Cambio"
-    if 'forma_pago' not in df_mapped.columns and len(columns) >= 9:
-        df_mapped['forma_pago'] = df_mapped.iloc[:, 8]  # "Forma Pago"
-    if 'numero_parcialidades' not in df_mapped.columns and len(columns) >= 10:
-        df_mapped['numero_parcialidades'] = df_mapped.iloc[:, 9]  # "No. de Parciali"
-    if 'importe_pagado' not in df_mapped.columns and len(columns) >= 11:
-        df_mapped['importe_pagado'] = df_mapped.iloc[:, 10]  # "Importe Pagado"
-    if 'numero_operacion' not in df_mapped.columns and len(columns) >= 12:
-        df_mapped['numero_operacion'] = df_mapped.iloc[:, 11]  # "Número Operación"
-    
-    # ENCABEZADO XML (columnas 12-13)
-    if 'fecha_emision' not in df_mapped.columns and len(columns) >= 13:
-        df_mapped['fecha_emision'] = df_mapped.iloc[:, 12]  # "Fecha Emisión"
-    if 'estatus' not in df_mapped.columns and len(columns) >= 14:
-        df_mapped['estatus'] = df_mapped.iloc[:, 13]  # "Estatus"
+    posiciones = {
+        # RECIBO ELECTRÓNICO DE PAGO (columnas 0-11)
+        'fecha_pago': 0,
+        'serie_pago': 1,
+        'folio_pago': 2,
+        'concepto_pago': 3,
+        'uuid_pago': 4,
+        'cliente': 5,
+        'moneda': 6,
+        'tipo_cambio': 7,
+        'forma_pago': 8,
+        'numero_parcialidades': 9,
+        'importe_pagado': 10,
+        'numero_operacion': 11,
+        # ENCABEZADO XML (columnas 12-13)
+        'fecha_emision': 12,
+        'estatus': 13,
+        # DOCUMENTO RELACIONADO (columnas 14-18)
+        'fecha_relacionado': 14,
+        'serie_relacionado': 15,
+        'folio_relacionado': 16,
+        'concepto_relacionado': 17,
+        'uuid_relacionado': 18
+    }
     
-    # DOCUMENTO RELACIONADO (columnas 14-18)
-    if 'fecha_relacionado' not in df_mapped.columns and len(columns) >= 15:
-        df_mapped['fecha_relacionado'] = df_mapped.iloc[:, 14]  # "Fecha"
-    if 'serie_relacionado' not in df_mapped.columns and len(columns) >= 16:
-        df_mapped['serie_relacionado'] = df_mapped.iloc[:, 15]  # "Serie"
-    if 'folio_relacionado' not in df_mapped.columns and len(columns) >= 17:
-        df_mapped['folio_relacionado'] = df_mapped.iloc[:, 16]  # "Folio"
-    if 'concepto_relacionado' not in df_mapped.columns and len(columns) >= 18:
-        df_mapped['concepto_relacionado'] = df_mapped.iloc[:, 17]  # "Concepto"
-    if 'uuid_relacionado' not in df_mapped.columns and len(columns) >= 19:
-        df_mapped['uuid_relacionado'] = df_mapped.iloc[:, 18]  # "UUID"
+    # La fecha real de pago puede venir en una columna cuyo encabezado es una
+    # fecha o en 'CONTPAQ i' (si sus valores son fechas y no UUID)
+    origen = {}
+    candidatas = [col for col in df.columns if isinstance(col, datetime)]
+    candidatas += [col for col in df.columns if str(col).lower() == 'contpaq i']
+    for col in candidatas:
+        sample_values = df[col].dropna().head(3)
+        if len(sample_values) > 0 and all(isinstance(val, datetime) for val in sample_values):
+            origen['fecha_pago'] = list(df.columns).index(col)
+            break
+    
+    origen.update(_resolve_columns(df, column_mapping, list(posiciones)))
+    origen = _apply_positional_fallback(origen, df, posiciones)
+    df_mapped = _select_columns(df, origen)
     
     # Valores por defecto para campos no encontrados
     default_values = {
@@ -1695,46 +1604,16 @@ def _map_cobranza_columns(df: pd.DataFrame) -> pd.DataFrame:
         'concepto_relacionado': '',
         'uuid_relacionado': ''
     }
+    df_mapped = _fill_defaults(df_mapped, default_values)
     
-    for field, default_value in default_values.items():
-        if field not in df_mapped.columns:
-            df_mapped[field] = default_value
-    
-    # Log para debugging
-    mapped_cols = [col for col in df_mapped.columns if col in default_values.keys()]
-    logger.info(f"Mapeo final cobranza: {len(mapped_cols)} columnas mapeadas: {mapped_cols}")
-    
-    # Filtro para eliminar filas con valor cero o no numérico en monto (DESPUÉS del mapeo completo)
-    rows_to_remove_monto = []
-    
-    for idx, row in df_mapped.iterrows():
-        valid_monto = False
-        
-        # Verificar específicamente la columna importe_pagado que ya está mapeada
-        if 'importe_pagado' in df_mapped.columns:
-            try:
-                # Intentar convertir a número
-                value = pd.to_numeric(row['importe_pagado'], errors='coerce')
-                # Si es un número válido y mayor que 0
-                if not pd.isna(value) and value > 0:
-                    valid_monto = True
-            except (ValueError, TypeError):
-                pass
-        
-        # Si no se encontró un monto válido, marcarla para eliminar
-        if not valid_monto:
-            rows_to_remove_monto.append(idx)
-    
-    # Eliminar filas marcadas
-    df_mapped = df_mapped.drop(index=rows_to_remove_monto)
-    logger.info(f"Filas después del filtro de monto válido (mayor a 0): {len(df_mapped)}")
+    # Solo filas con importe numérico mayor a 0
+    df_mapped = df_mapped[pd.to_numeric(df_mapped['importe_pagado'], errors='coerce') > 0]
     
+    logger.info(f"Mapeo cobranza: {len(origen)} columnas, {filas_leidas} filas -> {len(df_mapped)} pagos")
     return df_mapped
 
 def _map_cfdi_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Mapea columnas de CFDI a nombres estándar"""
-    df_mapped = df.copy()
-    
     # Mapeo completo para CFDI
     column_mapping = {
         'xml': 'xml',
@@ -1746,49 +1625,34 @@ def _map_cfdi_columns(df: pd.DataFrame) -> pd.DataFrame:
         'Tipo Relación': 'tipo_relacion'
     }
     
-    # Mapeo por nombre (case-insensitive)
-    for old_name, new_name in column_mapping.items():
-        for col in df_mapped.columns:
-            if isinstance(col, str) and col.lower() == old_name.lower():
-                df_mapped[new_name] = df_mapped[col]
-                break
-    
     # Mapeo por posición como fallback
-    columns = list(df_mapped.columns)
-    if 'xml' not in df_mapped.columns and len(columns) >= 1:
-        df_mapped['xml'] = df_mapped.iloc[:, 0]             # 'XML'
-    if 'fecha_cfdi' not in df_mapped.columns and len(columns) >= 14:
-        df_mapped['fecha_cfdi'] = df_mapped.iloc[:, 13]     # 'Fecha'
-    if 'importe_relacion' not in df_mapped.columns and len(columns) >= 21:
-        df_mapped['importe_relacion'] = df_mapped.iloc[:, 20] # 'Total'
-    if 'uuid_factura_relacionada' not in df_mapped.columns and len(columns) >= 22:
-        df_mapped['uuid_factura_relacionada'] = df_mapped.iloc[:, 21] # 'UUID'
-    if 'cliente_receptor' not in df_mapped.columns and len(columns) >= 7:
-        df_mapped['cliente_receptor'] = df_mapped.iloc[:, 6] # 'Nombre Receptor'
-    if 'tipo_relacion' not in df_mapped.columns and len(columns) >= 34:
-        df_mapped['tipo_relacion'] = df_mapped.iloc[:, 33]  # 'Tipo Relación'
-    
-    # Valores por defecto
-    if 'xml' not in df_mapped.columns:
-        df_mapped['xml'] = ''
-    if 'importe_relacion' not in df_mapped.columns:
-        df_mapped['importe_relacion'] = 0.0
-    if 'cliente_receptor' not in df_mapped.columns:
-        df_mapped['cliente_receptor'] = ''
-    if 'tipo_relacion' not in df_mapped.columns:
-        df_mapped['tipo_relacion'] = ''
-    if 'uuid_factura_relacionada' not in df_mapped.columns:
-        df_mapped['uuid_factura_relacionada'] = ''
+    posiciones = {
+        'xml': 0,                          # 'XML'
+        'fecha_cfdi': 13,                  # 'Fecha'
+        'importe_relacion': 20,            # 'Total'
+        'uuid_factura_relacionada': 21,    # 'UUID'
+        'cliente_receptor': 6,             # 'Nombre Receptor'
+        'tipo_relacion': 33                # 'Tipo Relación'
+    }
     
-    # Log para debugging
-    logger.info(f"Mapeo final CFDI: {len([col for col in df_mapped.columns if col in ['xml', 'fecha_cfdi', 'importe_relacion', 'cliente_receptor', 'tipo_relacion', 'uuid_factura_relacionada']])} columnas mapeadas")
+    origen = _resolve_columns(df, column_mapping, list(posiciones))
+    origen = _apply_positional_fallback(origen, df, posiciones)
+    df_mapped = _select_columns(df, origen)
     
+    # Valores por defecto
+    df_mapped = _fill_defaults(df_mapped, {
+        'xml': '',
+        'importe_relacion': 0.0,
+        'cliente_receptor': '',
+        'tipo_relacion': '',
+        'uuid_factura_relacionada': ''
+    })
+    
+    logger.info(f"Mapeo CFDI: {len(origen)} columnas mapeadas")
     return df_mapped
 
 def _map_pedidos_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Mapea columnas de pedidos a nombres estándar usando estructura real de Excel"""
-    df_mapped = df.copy()
-    
     # Mapeo completo para pedidos basado en la estructura real
     column_mapping = {
         'no de factura': 'folio_factura',
@@ -1811,64 +1675,43 @@ def _map_pedidos_columns(df: pd.DataFrame) -> pd.DataFrame:
         'fecha_factura': 'fecha_factura'
     }
     
-    # Mapeo por nombre (case-insensitive)
-    for old_name, new_name in column_mapping.items():
-        for col in df_mapped.columns:
-            if isinstance(col, str) and col.lower() == old_name.lower():
-                df_mapped[new_name] = df_mapped[col]
-                break
-    
-    # Mapeo por posición como fallback basado en la estructura real
-    columns = list(df_mapped.columns)
-    
     # Mapeo por posición según la estructura real de Excel
-    if 'folio_factura' not in df_mapped.columns and len(columns) >= 1:
-        folio_series = pd.to_numeric(df_mapped.iloc[:, 0], errors='coerce')  # A6: "No de factura"
-        # Generar folios únicos negativos para valores faltantes
-        mask_na = folio_series.isna()
-        folio_series.loc[mask_na] = range(-1, -mask_na.sum() - 1, -1)
-        df_mapped['folio_factura'] = folio_series.astype(int)
-    if 'pedido' not in df_mapped.columns and len(columns) >= 3:
-        df_mapped['pedido'] = df_mapped.iloc[:, 2]         # C6: "Pedido"
-    if 'kg' not in df_mapped.columns and len(columns) >= 4:
-        df_mapped['kg'] = df_mapped.iloc[:, 3]             # D6: "KGS"
-    if 'precio_unitario' not in df_mapped.columns and len(columns) >= 5:
-        df_mapped['precio_unitario'] = df_mapped.iloc[:, 4] # E6: "Precio unitario"
-    if 'importe_sin_iva' not in df_mapped.columns and len(columns) >= 6:
-        df_mapped['importe_sin_iva'] = df_mapped.iloc[:, 5] # F6: "Importe mxn sin iva"
-    if 'material' not in df_mapped.columns and len(columns) >= 7:
-        df_mapped['material'] = df_mapped.iloc[:, 6]       # G6: "Matertial"
-    if 'cliente' not in df_mapped.columns and len(columns) >= 8:
-        df_mapped['cliente'] = df_mapped.iloc[:, 7]        # H6: "nom,bre de cliente"
-    if 'dias_credito' not in df_mapped.columns and len(columns) >= 9:
-        df_mapped['dias_credito'] = df_mapped.iloc[:, 8]   # I6: "dias de credito"
-    if 'fecha_factura' not in df_mapped.columns and len(columns) >= 10:
-        df_mapped['fecha_factura'] = df_mapped.iloc[:, 9]  # J6: "fecha factura"
+    posiciones = {
+        'folio_factura': 0,     # A6: "No de factura"
+        'pedido': 2,            # C6: "Pedido"
+        'kg': 3,                # D6: "KGS"
+        'precio_unitario': 4,   # E6: "Precio unitario"
+        'importe_sin_iva': 5,   # F6: "Importe mxn sin iva"
+        'material': 6,          # G6: "Matertial"
+        'cliente': 7,           # H6: "nom,bre de cliente"
+        'dias_credito': 8,      # I6: "dias de credito"
+        'fecha_factura': 9      # J6: "fecha factura"
+    }
     
-    # Valores por defecto para campos no encontrados
-    if 'folio_factura' not in df_mapped.columns:
+    origen = _resolve_columns(df, column_mapping, list(posiciones))
+    por_nombre = set(origen)
+    origen = _apply_positional_fallback(origen, df, posiciones)
+    df_mapped = _select_columns(df, origen)
+    
+    if 'folio_factura' in origen and 'folio_factura' not in por_nombre:
+        df_mapped['folio_factura'] = _folios_con_negativos(df_mapped['folio_factura'])
+    elif 'folio_factura' not in origen:
         # Generar folios únicos negativos para evitar conflictos con facturas reales
         df_mapped['folio_factura'] = range(-1, -len(df_mapped) - 1, -1)
-    if 'pedido' not in df_mapped.columns:
-        df_mapped['pedido'] = ''
-    if 'kg' not in df_mapped.columns:
-        df_mapped['kg'] = 0.0
-    if 'precio_unitario' not in df_mapped.columns:
-        df_mapped['precio_unitario'] = 0.0
-    if 'importe_sin_iva' not in df_mapped.columns:
-        df_mapped['importe_sin_iva'] = 0.0
-    if 'material' not in df_mapped.columns:
-        df_mapped['material'] = ''
-    if 'cliente' not in df_mapped.columns:
-        df_mapped['cliente'] = ''
-    if 'dias_credito' not in df_mapped.columns:
-        df_mapped['dias_credito'] = 30
-    if 'fecha_factura' not in df_mapped.columns:
-        df_mapped['fecha_factura'] = None
     
-    # Log para debugging
-    logger.info(f"Mapeo final pedidos: {len([col for col in df_mapped.columns if col in ['folio_factura', 'pedido', 'kg', 'precio_unitario', 'importe_sin_iva', 'material', 'cliente', 'dias_credito', 'fecha_factura']])} columnas mapeadas")
+    # Valores por defecto para campos no encontrados
+    df_mapped = _fill_defaults(df_mapped, {
+        'pedido': '',
+        'kg': 0.0,
+        'precio_unitario': 0.0,
+        'importe_sin_iva': 0.0,
+        'material': '',
+        'cliente': '',
+        'dias_credito': 30,
+        'fecha_factura': None
+    })
     
+    logger.info(f"Mapeo pedidos: {len(origen)} columnas mapeadas")
     return df_mapped
 
 def load_and_clean_excel(file_path: str) -> Dict[str, pd.DataFrame]:
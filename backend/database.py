@@ -289,6 +289,9 @@ class ComprasV2(Base):
     fecha_salida_estimada = Column(Date)
     fecha_arribo_estimada = Column(Date)
     fecha_planta_estimada = Column(Date)
+    fecha_salida_real = Column(Date)
+    fecha_arribo_real = Column(Date)
+    fecha_planta_real = Column(Date)
     moneda = Column(String, default='USD')
     dias_credito = Column(Integer, default=0)
     anticipo_pct = Column(Float, default=0.0)  # NUMERIC(5,4)
@@ -303,6 +306,8 @@ class ComprasV2(Base):
     porcentaje_gastos_importacion = Column(Float, default=0.0)  # NUMERIC(5,4)
     iva_monto_mxn = Column(Float, default=0.0)
     total_con_iva_mxn = Column(Float, default=0.0)
+    dias_transporte = Column(Integer)  # fecha_arribo_real - fecha_salida_real
+    dias_puerto_planta = Column(Integer)  # fecha_planta_real - fecha_arribo_real
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -313,6 +318,7 @@ class ComprasV2(Base):
         Index('idx_compras_v2_imi', 'imi'),
         Index('idx_compras_v2_proveedor', 'proveedor'),
         Index('idx_compras_v2_fecha_pedido', 'fecha_pedido'),
+        Index('idx_compras_v2_fecha_pedido_imi', 'fecha_pedido', 'imi'),
     )
 
 class ComprasV2Materiales(Base):
@@ -342,6 +348,7 @@ class ComprasV2Materiales(Base):
         Index('idx_compras_v2_mat_compra_id', 'compra_id'),
         Index('idx_compras_v2_mat_material', 'material_codigo'),
         Index('idx_compras_v2_mat_imi', 'compra_imi'),
+        Index('uq_compras_v2_mat_compra_material', 'compra_id', 'material_codigo', unique=True),
     )
 
 class ArchivoProcesado(Base):
@@ -358,17 +365,102 @@ class ArchivoProcesado(Base):
     hash_archivo = Column(String, unique=True, index=True)  # Para evitar duplicados
     tamaño_archivo = Column(Integer)  # En bytes
     algoritmo_usado = Column(String, default="advanced_cleaning")
+    # Seguimiento de cargas en segundo plano (upload_jobs.py)
+    fase = Column(String)  # 'en_cola', 'parseo', 'validacion', 'guardado', 'completado', 'error'
+    registros_totales = Column(Integer, default=0)  # Registros a guardar, conocidos tras la validación
+    inicio_proceso = Column(DateTime)
+    fin_proceso = Column(DateTime)
+    resultado = Column(Text)  # Resumen JSON de la carga terminada
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     __table_args__ = (
         Index('idx_archivo_mes_año', 'mes', 'año'),
         Index('idx_archivo_fecha', 'fecha_procesamiento'),
+        Index('idx_archivo_estado', 'estado'),
     )
 
+# Resúmenes mensuales precalculados (RollupService). Se recalculan por archivo_id
+# en cada carga; no tienen ForeignKey porque son datos derivados.
+class ResumenFacturacionMensual(Base):
+    __tablename__ = "resumen_facturacion_mensual"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    archivo_id = Column(Integer, index=True)
+    año = Column(Integer)
+    mes = Column(Integer)
+    cliente = Column(String)
+    total_registros = Column(Integer, default=0)  # Incluye facturas con folio inválido
+    total_facturas = Column(Integer, default=0)  # Solo folios válidos
+    facturacion_total = Column(Float, default=0.0)
+    facturacion_sin_iva = Column(Float, default=0.0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_resumen_fact_año_mes', 'año', 'mes'),
+    )
+
+class ResumenCobranzaMensual(Base):
+    __tablename__ = "resumen_cobranza_mensual"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    archivo_id = Column(Integer, index=True)
+    año = Column(Integer)  # Periodo de la factura relacionada (NULL si no está relacionada)
+    mes = Column(Integer)
+    relacionada = Column(Boolean, default=True)  # Pago de una factura válida
+    cobranza_total = Column(Float, default=0.0)
+    cobranza_sin_iva = Column(Float, default=0.0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_resumen_cob_año_mes', 'año', 'mes'),
+    )
+
+class ResumenPedidosMensual(Base):
+    __tablename__ = "resumen_pedidos_mensual"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    archivo_id = Column(Integer, index=True)
+    año = Column(Integer)  # Periodo de fecha_factura del pedido
+    mes = Column(Integer)
+    material = Column(String)  # material_codigo truncado a 7 caracteres
+    kg = Column(Float, default=0.0)
+    importe_sin_iva = Column(Float, default=0.0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_resumen_ped_año_mes', 'año', 'mes'),
+    )
+
+# Índices de búsqueda de proveedor/material que no se expresan con Index() del modelo
+SEARCH_INDEXES = {
+    'postgresql': [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX IF NOT EXISTS idx_compras_v2_proveedor_trgm ON compras_v2 USING gin (proveedor gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS idx_compras_v2_mat_material_trgm ON compras_v2_materiales USING gin (material_codigo gin_trgm_ops)",
+    ],
+    # SQLite no tiene trigramas: índice sobre la clave normalizada lower(trim(...)),
+    # que usan la igualdad y la búsqueda por prefijo de filtro_texto_orm
+    'sqlite': [
+        "CREATE INDEX IF NOT EXISTS idx_compras_v2_proveedor_norm ON compras_v2 (lower(trim(proveedor)))",
+        "CREATE INDEX IF NOT EXISTS idx_compras_v2_mat_material_norm ON compras_v2_materiales (lower(trim(material_codigo)))",
+    ],
+}
+
+def create_search_indexes():
+    """Crea los índices de búsqueda del motor actual (si faltan permisos solo se advierte)"""
+    from sqlalchemy import text
+    for statement in SEARCH_INDEXES.get(engine.dialect.name, []):
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(statement))
+        except Exception as e:
+            logger.warning(f"No se pudo crear índice de búsqueda ({statement[:60]}...): {str(e)}")
+
 # Crear todas las tablas
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    create_search_indexes()
 
 # Dependency para obtener sesión de DB
 def get_db():
@@ -402,6 +494,9 @@ def clear_data_by_archivo(db, archivo_id: int):
         db.query(CFDIRelacionado).filter(CFDIRelacionado.archivo_id == archivo_id).delete()
         db.query(Cobranza).filter(Cobranza.archivo_id == archivo_id).delete()
         db.query(Facturacion).filter(Facturacion.archivo_id == archivo_id).delete()
+        # Recalcular los resúmenes mensuales con lo que queda del archivo
+        from services.rollup_service import RollupService
+        RollupService(db).refresh_archivo(archivo_id)
         db.commit()
         logger.info(f"Datos limpiados para archivo_id: {archivo_id}")
         return True
@@ -4,19 +4,22 @@ Utiliza servicios especializados para operaciones específicas
 """
 
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_
+from sqlalchemy import func, and_, or_, case, cast, Integer
 from database import (
     Facturacion, Cobranza, CFDIRelacionado, Inventario, Pedido, PedidosCompras,
-    ArchivoProcesado, KPI, get_latest_data_summary
+    ArchivoProcesado, KPI, get_latest_data_summary, clear_data_by_archivo
 )
-from services import FacturacionService, CobranzaService, PedidosService, KPIAggregator
+from services import FacturacionService, CobranzaService, PedidosService, KPIAggregator, BulkIngestionService, RollupService
 from utils.validators import DataValidator
 from utils.logging_config import setup_logging, log_performance
+from utils.cache import bump_data_generation
+from compras_v2_filtros import rango_mes_año, get_valores_exactos, filtro_texto_orm
 from datetime import datetime, timedelta
 import logging
 import hashlib
 import time
 import numpy as np
+import pandas as pd
 
 logger = setup_logging()
 
@@ -51,10 +54,15 @@ class DatabaseService:
         self.cobranza_service = CobranzaService(db)
         self.pedidos_service = PedidosService(db)
         self.kpi_aggregator = KPIAggregator(db)
+        self.rollup_service = RollupService(db)
     
-    def save_processed_data(self, processed_data_dict: dict, archivo_info: dict) -> dict:
+    def save_processed_data(self, processed_data_dict: dict, archivo_info: dict, progreso=None) -> dict:
         """
         Guarda los datos procesados en la base de datos
+        
+        progreso: callable opcional progreso(fase, registros) que se llama con
+        los registros guardados después de cada tipo de datos (lo usan las
+        cargas en segundo plano de upload_jobs.py)
         """
         try:
             logger.info(f"VERSIÓN ACTUALIZADA V2 EJECUTÁNDOSE - INICIANDO save_processed_data")
@@ -88,7 +96,7 @@ class DatabaseService:
             
             # Limpiar datos anteriores si es necesario
             if archivo_info.get("reemplazar_datos", False):
-                self._clear_existing_data()
+                self._clear_existing_data(conservar_archivo_id=archivo.id)
             
             # CRITICAL: Guardar el ID del archivo ANTES de usarlo para evitar ObjectDeletedError
             archivo_id = archivo.id
@@ -97,10 +105,16 @@ class DatabaseService:
             # Guardar cada tipo de datos usando servicios especializados
             logger.info("Guardando facturas...")
             facturas_count = self.facturacion_service.save_facturas(processed_data_dict.get("facturacion_clean", []), archivo_id)
+            if progreso:
+                progreso("guardado", facturas_count)
             logger.info("Guardando cobranzas...")
             cobranzas_count = self.cobranza_service.save_cobranzas(processed_data_dict.get("cobranza_clean", []), archivo_id)
+            if progreso:
+                progreso("guardado", facturas_count + cobranzas_count)
             logger.info("Guardando anticipos...")
             anticipos_count = self._save_anticipos(processed_data_dict.get("cfdi_clean", []), archivo_id)
+            if progreso:
+                progreso("guardado", facturas_count + cobranzas_count + anticipos_count)
             logger.info("Guardando pedidos...")
             # FIX: Usar la clave correcta "pedidos_compras_clean" en lugar de "pedidos_clean"
             print(f"DEBUG: processed_data_dict type: {type(processed_data_dict)}")
@@ -112,9 +126,18 @@ class DatabaseService:
             pedidos_data_to_save = processed_data_dict.get("pedidos_compras_clean", [])
             print(f"ANTES DE save_pedidos: Recibidos {len(pedidos_data_to_save)} pedidos para guardar")
             print(f"Claves disponibles en processed_data_dict: {list(processed_data_dict.keys())}")
-            pedidos_count = self.pedidos_service.save_pedidos(pedidos_data_to_save, archivo_id)
+            # Los folios de la facturación de este mismo archivo se resuelven en memoria
+            pedidos_count = self.pedidos_service.save_pedidos(
+                pedidos_data_to_save, archivo_id,
+                facturacion_data=processed_data_dict.get("facturacion_clean")
+            )
             print(f"DESPUÉS DE save_pedidos: Guardados {pedidos_count} pedidos")
             
+            # Resúmenes mensuales del archivo, en la misma transacción que los datos
+            # (si fallan, la carga continúa y los KPIs se calculan en vivo)
+            logger.info("Actualizando resúmenes mensuales...")
+            self.rollup_service.refresh_archivo(archivo_id)
+            
             # Compras no se procesan en este endpoint (solo para ComprasV2)
             compras_count = 0
             
@@ -126,6 +149,7 @@ class DatabaseService:
             try:
                 # Hacer commit inmediato de todos los datos guardados
                 self.db.commit()
+                bump_data_generation("save_processed_data")
                 logger.info(f"✅ Commit exitoso de todos los datos guardados")
                 
                 # Actualizar el archivo con una nueva consulta
@@ -267,27 +291,26 @@ class DatabaseService:
     
     
     
-    def _save_anticipos(self, anticipos_data: list, archivo_id: int) -> int:
-        """Guarda datos de anticipos (CFDI relacionados)"""
-        count = 0
-        for anticipo_data in anticipos_data:
-            try:
-                anticipo = CFDIRelacionado(
-                    xml=DataValidator.safe_string(anticipo_data.get('xml', '')),
-                    cliente_receptor=DataValidator.safe_string(anticipo_data.get('cliente_receptor', '')),
-                    tipo_relacion=DataValidator.safe_string(anticipo_data.get('tipo_relacion', '')),
-                    importe_relacion=DataValidator.safe_float(anticipo_data.get('importe_relacion', 0)),
-                    uuid_factura_relacionada=DataValidator.safe_string(anticipo_data.get('uuid_factura_relacionada', '')),
-                    archivo_id=archivo_id
-                )
-                self.db.add(anticipo)
-                count += 1
-            except Exception as e:
-                logger.warning(f"Error guardando anticipo: {str(e)}")
-                continue
+    def _save_anticipos(self, anticipos_data, archivo_id: int) -> int:
+        """Guarda datos de anticipos (CFDI relacionados) con ingesta masiva, por columnas"""
+        df = DataValidator.as_frame(anticipos_data)
+        if df.empty:
+            return 0
         
-        self.db.commit()
-        return count
+        def columna(nombre):
+            return DataValidator.get_column(df, nombre)
+        
+        registros = pd.DataFrame({
+            'xml': DataValidator.safe_string_series(columna('xml')),
+            'cliente_receptor': DataValidator.safe_string_series(columna('cliente_receptor')),
+            'tipo_relacion': DataValidator.safe_string_series(columna('tipo_relacion')),
+            'importe_relacion': DataValidator.safe_float_series(columna('importe_relacion')),
+            'uuid_factura_relacionada': DataValidator.safe_string_series(columna('uuid_factura_relacionada')),
+            'archivo_id': archivo_id
+        })
+        
+        # Sin commit intermedio: se confirma junto con el resto en save_processed_data
+        return BulkIngestionService(self.db).insert_dataframe(CFDIRelacionado, registros)
     
     def _save_pedidos(self, pedidos_data: list, archivo_id: int) -> int:
         """Guarda datos de pedidos con asignación automática de fecha_factura y dias_credito"""
@@ -436,46 +459,46 @@ class DatabaseService:
         
         return count
     
-    def _clear_existing_data(self):
-        """Limpia todos los datos existentes"""
+    def _clear_existing_data(self, conservar_archivo_id: int = None):
+        """Limpia todos los datos existentes (conservar_archivo_id: registro del archivo que se está cargando)"""
         try:
             self.db.query(Pedido).delete()
             self.db.query(CFDIRelacionado).delete()
             self.db.query(Cobranza).delete()
             self.db.query(Facturacion).delete()
             self.db.query(KPI).delete()
-            self.db.query(ArchivoProcesado).delete()  # Limpiar también archivos procesados
+            # Limpiar también archivos procesados, salvo el de la carga en curso
+            archivos = self.db.query(ArchivoProcesado)
+            if conservar_archivo_id is not None:
+                archivos = archivos.filter(ArchivoProcesado.id != conservar_archivo_id)
+            archivos.delete(synchronize_session=False)
+            self.rollup_service.refresh_all()  # pedidos_compras se conserva
             self.db.commit()
+            bump_data_generation("_clear_existing_data")
             logger.info("Datos existentes limpiados")
         except Exception as e:
             self.db.rollback()
             logger.error(f"Error limpiando datos: {str(e)}")
     
-    def _get_facturas_related_to_pedidos(self, pedidos_filtrados: list) -> list:
+    def clear_data_by_archivo(self, archivo_id: int) -> bool:
+        """Limpia los datos de un archivo e invalida el caché si la limpieza tuvo éxito"""
+        limpiado = clear_data_by_archivo(self.db, archivo_id)
+        if limpiado:
+            bump_data_generation("clear_data_by_archivo")
+        return limpiado
+    
+    def _get_facturas_related_to_pedidos(self, pedidos_filtrados: list, facturas_por_folio: dict = None) -> list:
         """
         Obtiene todas las facturas relacionadas con los pedidos filtrados.
         Considera la relación many-to-many: un pedido puede estar en múltiples facturas.
-        Solo busca por folio_factura directo, no por cliente.
+        Solo busca por folio_factura directo (consultas IN por bloques), no por cliente.
         """
-        facturas_relacionadas = []
-        
-        for pedido in pedidos_filtrados:
-            # Buscar todas las facturas donde aparece este pedido por folio_factura
-            if pedido.folio_factura:
-                facturas_folio = self.db.query(Facturacion).filter(
-                    Facturacion.folio_factura == pedido.folio_factura
-                ).all()
-                facturas_relacionadas.extend(facturas_folio)
-                logger.debug(f"Pedido {pedido.pedido} -> Facturas por folio {pedido.folio_factura}: {len(facturas_folio)}")
-        
-        # Eliminar duplicados por UUID
-        facturas_unicas = {}
-        for factura in facturas_relacionadas:
-            if factura.uuid_factura:
-                facturas_unicas[factura.uuid_factura] = factura
+        facturas_unicas = self.facturacion_service.get_facturas_related_to_pedidos(
+            pedidos_filtrados, facturas_por_folio
+        )
         
         logger.info(f"Facturas relacionadas con pedidos filtrados: {len(facturas_unicas)}")
-        return list(facturas_unicas.values())
+        return facturas_unicas
 
     def calculate_kpis(self, filtros: dict = None) -> dict:
         """
@@ -483,6 +506,14 @@ class DatabaseService:
         """
         return self.kpi_aggregator.calculate_kpis(filtros)
     
+    def get_top_clientes(self, filtros: dict = None, limite: int = 10) -> dict:
+        """Top clientes por facturación (resúmenes mensuales o SQL en vivo)"""
+        return self.kpi_aggregator.get_top_clientes(filtros, limite)
+    
+    def get_consumo_material(self, filtros: dict = None, limite: int = 10) -> dict:
+        """Consumo por material (resúmenes mensuales o SQL en vivo)"""
+        return self.kpi_aggregator.get_consumo_material(filtros, limite)
+    
     def _calculate_aging_cartera(self, facturas: list) -> dict:
         """Calcula aging de cartera por monto pendiente"""
         aging = {"0-30 dias": 0, "31-60 dias": 0, "61-90 dias": 0, "90+ dias": 0}
@@ -870,173 +901,154 @@ class DatabaseService:
 
     # ==================== MÉTODOS DE COMPRAS_V2 ====================
 
+    def _dias_entre(self, fecha_fin, fecha_inicio):
+        """Expresión SQL con los días entre dos columnas de fecha según el motor"""
+        if self.db.get_bind().dialect.name == 'postgresql':
+            return fecha_fin - fecha_inicio
+        return func.julianday(fecha_fin) - func.julianday(fecha_inicio)
+    
+    def _promedio_dias_positivos(self, real_inicio, real_fin, estimada_inicio, estimada_fin):
+        """
+        AVG en SQL de los días entre fechas reales (o estimadas si faltan las reales),
+        considerando solo diferencias positivas
+        """
+        dias = case(
+            (and_(real_inicio.isnot(None), real_fin.isnot(None)), self._dias_entre(real_fin, real_inicio)),
+            (and_(estimada_inicio.isnot(None), estimada_fin.isnot(None)), self._dias_entre(estimada_fin, estimada_inicio))
+        )
+        return func.avg(case((dias > 0, dias)))
+    
+    def _filtro_texto_compras(self, columna, valor: str):
+        """
+        Filtro de proveedor/material: igualdad para valores de dropdown (catálogo
+        cacheado por generación de datos) y contains para texto libre (prefijo de
+        la clave normalizada en SQLite)
+        """
+        exactos = get_valores_exactos(
+            columna.key,
+            lambda: [fila[0] for fila in self.db.query(columna).distinct().all()]
+        )
+        return filtro_texto_orm(columna, valor, exactos, self.db.get_bind().dialect.name)
+    
     def get_compras_v2_kpis(self, filtros: dict = None) -> dict:
-        """Calcula KPIs principales de compras_v2 con filtros opcionales"""
+        """
+        Calcula KPIs principales de compras_v2 con filtros opcionales.
+        
+        Todo se agrega en SQL: una consulta sobre las compras filtradas, una sobre
+        sus materiales (unidos por IMI) y una sobre los precios de pedidos_compras.
+        """
         try:
-            from database import ComprasV2, ComprasV2Materiales
+            from database import ComprasV2, ComprasV2Materiales, PedidosCompras
 
-            # Query base para compras_v2
-            query = self.db.query(ComprasV2)
+            # Subconsulta de compras filtradas
+            compras_filtradas = self.db.query(ComprasV2.imi)
 
             # Aplicar filtros
             if filtros:
-                if filtros.get('mes') and filtros.get('año'):
-                    # Para compras_v2, usamos fecha_pedido para filtrar por mes/año
-                    from sqlalchemy import extract
-                    query = query.filter(
-                        extract('month', ComprasV2.fecha_pedido) == filtros['mes'],
-                        extract('year', ComprasV2.fecha_pedido) == filtros['año']
+                # Para compras_v2, usamos fecha_pedido para filtrar por mes/año (rango semiabierto)
+                rango = rango_mes_año(filtros.get('mes'), filtros.get('año'))
+                if rango:
+                    compras_filtradas = compras_filtradas.filter(
+                        ComprasV2.fecha_pedido >= rango[0],
+                        ComprasV2.fecha_pedido < rango[1]
                     )
-                elif filtros.get('mes') and not filtros.get('año'):
+                elif filtros.get('mes'):
                     logger.warning("Filtro de mes ignorado porque no hay año seleccionado")
-                elif filtros.get('año'):
-                    from sqlalchemy import extract
-                    query = query.filter(extract('year', ComprasV2.fecha_pedido) == filtros['año'])
 
                 if filtros.get('proveedor'):
-                    query = query.filter(ComprasV2.proveedor.contains(filtros['proveedor']))
+                    compras_filtradas = compras_filtradas.filter(
+                        self._filtro_texto_compras(ComprasV2.proveedor, filtros['proveedor'])
+                    )
+                if filtros.get('material'):
+                    compras_filtradas = compras_filtradas.filter(
+                        self.db.query(ComprasV2Materiales.id).filter(
+                            ComprasV2Materiales.compra_imi == ComprasV2.imi,
+                            self._filtro_texto_compras(ComprasV2Materiales.material_codigo, filtros['material'])
+                        ).exists()
+                    )
 
-            compras = query.all()
+            imis_filtrados = compras_filtradas.filter(ComprasV2.imi.isnot(None)).statement
 
-            if not compras:
-                return self._get_default_compras_v2_kpis()
+            # 1. Métricas por compra
+            resumen = compras_filtradas.with_entities(
+                func.count().label('total_compras'),
+                func.count(func.distinct(case((ComprasV2.proveedor != '', ComprasV2.proveedor)))).label('proveedores_unicos'),
+                func.avg(case((ComprasV2.dias_credito > 0, ComprasV2.dias_credito))).label('dias_credito_promedio'),
+                # Días de transporte (fecha arribo - fecha salida)
+                self._promedio_dias_positivos(
+                    ComprasV2.fecha_salida_real, ComprasV2.fecha_arribo_real,
+                    ComprasV2.fecha_salida_estimada, ComprasV2.fecha_arribo_estimada
+                ).label('dias_transporte_promedio'),
+                # Días puerto-planta (fecha planta - fecha arribo)
+                self._promedio_dias_positivos(
+                    ComprasV2.fecha_arribo_real, ComprasV2.fecha_planta_real,
+                    ComprasV2.fecha_arribo_estimada, ComprasV2.fecha_planta_estimada
+                ).label('dias_puerto_planta_promedio'),
+                # Tipo de cambio promedio solo para compras en USD (solo tipo_cambio_real)
+                func.avg(case(
+                    (and_(func.upper(ComprasV2.moneda) == 'USD', ComprasV2.tipo_cambio_real > 0), ComprasV2.tipo_cambio_real)
+                )).label('tipo_cambio_promedio')
+            ).one()
 
-            # Calcular métricas principales
-            total_compras = len(compras)
-            proveedores_unicos = len(set(c.proveedor for c in compras if c.proveedor))
+            if not resumen.total_compras:
+                return self._get_default_compras_v2_kpis()
 
-            # Calcular totales desde materiales
-            total_kg = 0
-            total_costo_divisa = 0
-            total_costo_mxn = 0
+            total_compras = resumen.total_compras
+            proveedores_unicos = resumen.proveedores_unicos or 0
 
-            for compra in compras:
-                materiales = self.db.query(ComprasV2Materiales).filter(
-                    ComprasV2Materiales.compra_id == compra.id
-                ).all()
+            # 2. Totales de materiales y costo ponderado por kg de (pu_mxn_importacion + pu_mxn)
+            kg_positivo = ComprasV2Materiales.kg > 0
+            materiales = self.db.query(
+                func.sum(func.coalesce(ComprasV2Materiales.kg, 0)).label('total_kg'),
+                func.sum(func.coalesce(ComprasV2Materiales.costo_total_divisa, 0)).label('total_costo_divisa'),
+                func.sum(func.coalesce(ComprasV2Materiales.costo_total_con_iva, 0)).label('total_costo_mxn'),
+                func.sum(case((
+                    kg_positivo,
+                    (func.coalesce(ComprasV2Materiales.pu_mxn_importacion, 0) + func.coalesce(ComprasV2Materiales.pu_mxn, 0)) * ComprasV2Materiales.kg
+                ), else_=0)).label('total_costo_ponderado'),
+                func.sum(case((kg_positivo, ComprasV2Materiales.kg), else_=0)).label('total_kg_costo')
+            ).filter(ComprasV2Materiales.compra_imi.in_(imis_filtrados)).one()
 
-                for material in materiales:
-                    total_kg += material.kg or 0
-                    total_costo_divisa += material.costo_total_divisa or 0
-                    total_costo_mxn += material.costo_total_con_iva or 0
+            total_kg = materiales.total_kg or 0
+            total_costo_divisa = materiales.total_costo_divisa or 0
+            total_costo_mxn = materiales.total_costo_mxn or 0
 
             # Calcular promedios
             promedio_por_proveedor = total_compras / proveedores_unicos if proveedores_unicos > 0 else 0
             costo_promedio_kg = total_costo_mxn / total_kg if total_kg > 0 else 0
 
-            # Calcular días de crédito promedio
-            dias_credito_values = [c.dias_credito for c in compras if c.dias_credito and c.dias_credito > 0]
-            dias_credito_promedio = sum(dias_credito_values) / len(dias_credito_values) if dias_credito_values else 0
-
-            # Calcular días de transporte promedio (fecha arribo - fecha salida)
-            dias_transporte_values = []
-            for c in compras:
-                if c.fecha_salida_real and c.fecha_arribo_real:
-                    dias_transporte = (c.fecha_arribo_real - c.fecha_salida_real).days
-                    if dias_transporte > 0:
-                        dias_transporte_values.append(dias_transporte)
-                elif c.fecha_salida_estimada and c.fecha_arribo_estimada:
-                    dias_transporte = (c.fecha_arribo_estimada - c.fecha_salida_estimada).days
-                    if dias_transporte > 0:
-                        dias_transporte_values.append(dias_transporte)
-            
-            dias_transporte_promedio = sum(dias_transporte_values) / len(dias_transporte_values) if dias_transporte_values else 0
-
-            # Calcular días puerto-planta promedio (fecha planta - fecha arribo)
-            dias_puerto_planta_values = []
-            for c in compras:
-                if c.fecha_arribo_real and c.fecha_planta_real:
-                    dias_puerto_planta = (c.fecha_planta_real - c.fecha_arribo_real).days
-                    if dias_puerto_planta > 0:
-                        dias_puerto_planta_values.append(dias_puerto_planta)
-                elif c.fecha_arribo_estimada and c.fecha_planta_estimada:
-                    dias_puerto_planta = (c.fecha_planta_estimada - c.fecha_arribo_estimada).days
-                    if dias_puerto_planta > 0:
-                        dias_puerto_planta_values.append(dias_puerto_planta)
-            
-            dias_puerto_planta_promedio = sum(dias_puerto_planta_values) / len(dias_puerto_planta_values) if dias_puerto_planta_values else 0
+            dias_credito_promedio = float(resumen.dias_credito_promedio or 0)
+            dias_transporte_promedio = float(resumen.dias_transporte_promedio or 0)
+            dias_puerto_planta_promedio = float(resumen.dias_puerto_planta_promedio or 0)
 
             # Calcular días crédito neto (días crédito - días transporte - días puerto-planta)
             dias_credito_neto = dias_credito_promedio - dias_transporte_promedio - dias_puerto_planta_promedio
 
-            # Calcular tipo de cambio promedio solo para compras en USD
-            compras_usd = [c for c in compras if c.moneda and c.moneda.upper() == 'USD']
-            tipo_cambio_promedio = 0.0
-            
-            if compras_usd:
-                # Solo usar tipo_cambio_real, ignorar estimado
-                tipos_cambio = []
-                for c in compras_usd:
-                    if c.tipo_cambio_real and c.tipo_cambio_real > 0:
-                        tipos_cambio.append(c.tipo_cambio_real)
-                
-                if tipos_cambio:
-                    tipo_cambio_promedio = sum(tipos_cambio) / len(tipos_cambio)
+            tipo_cambio_promedio = float(resumen.tipo_cambio_promedio or 0)
 
             # Calcular Unit Economics correctamente
             # 1. Costo por kg: Promedio ponderado por kg de (pu_mxn_importacion + pu_mxn)
             costo_unitario_promedio = 0.0
-            
-            try:
-                # Obtener IMI de las compras filtradas
-                imi_list = [c.imi for c in compras if c.imi]
-                
-                if imi_list and total_kg > 0:
-                    # Consultar materiales de las compras filtradas
-                    materiales_filtrados = self.db.query(ComprasV2Materiales).filter(
-                        ComprasV2Materiales.compra_imi.in_(imi_list)
-                    ).all()
-                    
-                    # Calcular promedio ponderado por kg de (pu_mxn_importacion + pu_mxn)
-                    total_costo_ponderado = 0.0
-                    total_kg_costo = 0.0
-                    
-                    for material in materiales_filtrados:
-                        if material.kg and material.kg > 0:
-                            # Costo por kg = pu_mxn_importacion + pu_mxn
-                            costo_kg = (material.pu_mxn_importacion or 0) + (material.pu_mxn or 0)
-                            kg = material.kg
-                            
-                            total_costo_ponderado += costo_kg * kg
-                            total_kg_costo += kg
-                    
-                    if total_kg_costo > 0:
-                        costo_unitario_promedio = total_costo_ponderado / total_kg_costo
-                        
-            except Exception as e:
-                logger.error(f"Error calculando costo unitario: {str(e)}")
-                costo_unitario_promedio = 0.0
+            if materiales.total_kg_costo and total_kg > 0:
+                costo_unitario_promedio = materiales.total_costo_ponderado / materiales.total_kg_costo
             
             # 2. Precio por kg: Promedio ponderado por kg de precio_unitario de pedidos_compras
             precio_unitario_promedio = 0.0
             
             try:
-                # Obtener IMI de las compras filtradas
-                imi_list = [c.imi for c in compras if c.imi]
+                precios = self.db.query(
+                    func.sum(PedidosCompras.precio_unitario * PedidosCompras.kg).label('total_precio_ponderado'),
+                    func.sum(PedidosCompras.kg).label('total_kg_precios')
+                ).filter(
+                    PedidosCompras.compra_imi.in_(
+                        compras_filtradas.filter(ComprasV2.imi.isnot(None)).with_entities(cast(ComprasV2.imi, Integer)).statement
+                    ),
+                    PedidosCompras.precio_unitario > 0,
+                    PedidosCompras.kg > 0
+                ).one()
                 
-                if imi_list:
-                    # Consultar pedidos_compras para obtener precios
-                    from database import PedidosCompras
-                    
-                    pedidos_filtrados = self.db.query(PedidosCompras).filter(
-                        PedidosCompras.compra_imi.in_(imi_list),
-                        PedidosCompras.precio_unitario > 0,
-                        PedidosCompras.kg > 0
-                    ).all()
-                    
-                    if pedidos_filtrados:
-                        # Calcular promedio ponderado por kg
-                        total_precio_ponderado = 0.0
-                        total_kg_precios = 0.0
-                        
-                        for pedido in pedidos_filtrados:
-                            precio_kg = pedido.precio_unitario
-                            kg = pedido.kg
-                            total_precio_ponderado += precio_kg * kg
-                            total_kg_precios += kg
-                        
-                        if total_kg_precios > 0:
-                            precio_unitario_promedio = total_precio_ponderado / total_kg_precios
+                if precios.total_kg_precios and precios.total_kg_precios > 0:
+                    precio_unitario_promedio = precios.total_precio_ponderado / precios.total_kg_precios
                             
             except Exception as e:
                 logger.error(f"Error calculando precio unitario: {str(e)}")
@@ -1091,7 +1103,7 @@ class DatabaseService:
 
             # Aplicar filtro de material si se especifica
             if material:
-                query = query.filter(ComprasV2Materiales.material_codigo.contains(material))
+                query = query.filter(self._filtro_texto_compras(ComprasV2Materiales.material_codigo, material))
 
             results = query.all()
 
@@ -1191,15 +1203,12 @@ class DatabaseService:
 
             # Aplicar filtros
             if filtros:
-                if filtros.get('mes') and filtros.get('año'):
-                    from sqlalchemy import extract
+                rango = rango_mes_año(filtros.get('mes'), filtros.get('año'))
+                if rango:
                     query = query.filter(
-                        extract('month', ComprasV2.fecha_pedido) == filtros['mes'],
-                        extract('year', ComprasV2.fecha_pedido) == filtros['año']
+                        ComprasV2.fecha_pedido >= rango[0],
+                        ComprasV2.fecha_pedido < rango[1]
                     )
-                elif filtros.get('año'):
-                    from sqlalchemy import extract
-                    query = query.filter(extract('year', ComprasV2.fecha_pedido) == filtros['año'])
 
             # Agrupar por proveedor y ordenar por total kg
             result = query.group_by(ComprasV2.proveedor).order_by(
@@ -1241,18 +1250,15 @@ class DatabaseService:
 
             # Aplicar filtros
             if filtros:
-                if filtros.get('mes') and filtros.get('año'):
-                    from sqlalchemy import extract
+                rango = rango_mes_año(filtros.get('mes'), filtros.get('año'))
+                if rango:
                     query = query.filter(
-                        extract('month', ComprasV2.fecha_pedido) == filtros['mes'],
-                        extract('year', ComprasV2.fecha_pedido) == filtros['año']
+                        ComprasV2.fecha_pedido >= rango[0],
+                        ComprasV2.fecha_pedido < rango[1]
                     )
-                elif filtros.get('año'):
-                    from sqlalchemy import extract
-                    query = query.filter(extract('year', ComprasV2.fecha_pedido) == filtros['año'])
 
                 if filtros.get('proveedor'):
-                    query = query.filter(ComprasV2.proveedor.contains(filtros['proveedor']))
+                    query = query.filter(self._filtro_texto_compras(ComprasV2.proveedor, filtros['proveedor']))
 
             # Ordenar por total y limitar
             result = query.order_by(func.sum(ComprasV2Materiales.costo_total_con_iva).desc()).limit(limite).all()
@@ -0,0 +1,220 @@
+"""
+Pool compartido de conexiones psycopg2 para las consultas SQL directas
+(compras_v2, resúmenes y mantenimiento). Evita pagar el handshake TLS con el
+pooler de Supabase en cada petición.
+"""
+
+from contextlib import contextmanager
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import RealDictCursor
+import threading
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PooledConnectionManager:
+    """
+    Envuelve un ThreadedConnectionPool con espera acotada cuando el pool está
+    lleno, verificación de conexiones inactivas al prestarlas y métricas.
+    """
+    
+    # Tamaño del pool (configurable por variables de entorno). Se abren
+    # MIN_CONNECTIONS al crear el pool y se conservan inactivas hasta
+    # MAX_CONNECTIONS, para no repetir el handshake TLS con cada préstamo
+    MIN_CONNECTIONS = int(os.getenv("RAW_DB_POOL_MIN", "2"))
+    MAX_CONNECTIONS = int(os.getenv("RAW_DB_POOL_MAX", "5"))
+    
+    # Segundos máximos esperando una conexión libre
+    BORROW_TIMEOUT = 30
+    
+    # Conexiones inactivas por más de estos segundos se verifican con SELECT 1
+    HEALTH_CHECK_IDLE_SECONDS = 30
+    
+    def __init__(self, database_url: str):
+        connect_kwargs = {'cursor_factory': RealDictCursor, 'connect_timeout': 30}
+        if 'sslmode=' not in database_url:
+            connect_kwargs['sslmode'] = 'require'
+    
+        self._pool = pg_pool.ThreadedConnectionPool(
+            self.MIN_CONNECTIONS, self.MAX_CONNECTIONS, database_url, **connect_kwargs
+        )
+        # psycopg2 cierra al devolverlas las conexiones que exceden minconn; una vez
+        # abiertas las iniciales, se conservan todas las que quepan en el pool
+        self._pool.minconn = self.MAX_CONNECTIONS
+        self._slots = threading.BoundedSemaphore(self.MAX_CONNECTIONS)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._stats = {
+            'borrows': 0,
+            'returns': 0,
+            'in_use': 0,
+            'discarded': 0,
+            'health_checks': 0,
+            'timeouts': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0
+        }
+    
+    def _is_healthy(self, conn) -> bool:
+        """Verifica una conexión inactiva con SELECT 1"""
+        if conn.closed:
+            return False
+    
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.time() - last_used < self.HEALTH_CHECK_IDLE_SECONDS:
+            return True
+    
+        with self._lock:
+            self._stats['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Conexión del pool descartada por health check: {str(e)}")
+            return False
+    
+    def _discard(self, conn):
+        """Cierra y retira una conexión del pool (y su marca de último uso)"""
+        with self._lock:
+            self._stats['discarded'] += 1
+            self._last_used.pop(id(conn), None)
+        try:
+            self._pool.putconn(conn, close=True)
+        except Exception:
+            pass
+    
+    def getconn(self):
+        """Presta una conexión sana del pool (espera hasta BORROW_TIMEOUT si está lleno)"""
+        inicio = time.time()
+        if not self._slots.acquire(timeout=self.BORROW_TIMEOUT):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise pg_pool.PoolError(f"No hay conexiones libres tras {self.BORROW_TIMEOUT}s")
+    
+        try:
+            # Como máximo se descartan todas las conexiones existentes antes de abrir una nueva
+            for _ in range(self.MAX_CONNECTIONS + 1):
+                conn = self._pool.getconn()
+                if self._is_healthy(conn):
+                    break
+                self._discard(conn)
+            else:
+                raise pg_pool.PoolError("No se pudo obtener una conexión sana del pool")
+        except Exception:
+            self._slots.release()
+            raise
+    
+        espera_ms = (time.time() - inicio) * 1000
+        with self._lock:
+            self._stats['borrows'] += 1
+            self._stats['in_use'] += 1
+            self._stats['total_wait_ms'] += espera_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], espera_ms)
+        return conn
+    
+    def putconn(self, conn):
+        """Devuelve una conexión al pool (hace rollback de transacciones abiertas)"""
+        try:
+            if conn.closed:
+                self._discard(conn)
+            else:
+                try:
+                    with self._lock:
+                        self._last_used[id(conn)] = time.time()
+                    self._pool.putconn(conn)
+                    if conn.closed:
+                        # psycopg2 la cerró (conexión perdida con el servidor); su id puede reutilizarse
+                        self._last_used.pop(id(conn), None)
+                except Exception as e:
+                    logger.warning(f"Error devolviendo conexión al pool, se descarta: {str(e)}")
+                    self._discard(conn)
+        finally:
+            with self._lock:
+                self._stats['returns'] += 1
+                self._stats['in_use'] -= 1
+            self._slots.release()
+    
+    @contextmanager
+    def connection(self):
+        """Presta una conexión durante el bloque; hace rollback si hay error y la devuelve"""
+        conn = self.getconn()
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            raise
+        finally:
+            self.putconn(conn)
+    
+    @contextmanager
+    def cursor(self, commit: bool = False):
+        """Cursor (RealDictCursor) sobre una conexión prestada; opcionalmente hace commit al final"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                if commit:
+                    conn.commit()
+            finally:
+                cursor.close()
+    
+    def get_stats(self) -> dict:
+        """Métricas del pool"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['min_connections'] = self.MIN_CONNECTIONS
+        stats['max_connections'] = self.MAX_CONNECTIONS
+        stats['idle'] = len(self._pool._pool)
+        stats['open'] = len(self._pool._pool) + len(self._pool._used)
+        stats['avg_wait_ms'] = round(stats['total_wait_ms'] / stats['borrows'], 2) if stats['borrows'] else 0.0
+        return stats
+    
+    def closeall(self):
+        """Cierra todas las conexiones del pool"""
+        self._pool.closeall()
+        with self._lock:
+            self._last_used.clear()
+
+# Pools por URL de base de datos (normalmente uno solo por proceso)
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(database_url: str) -> PooledConnectionManager:
+    """Obtiene (o crea la primera vez) el pool compartido para la URL dada"""
+    manager = _pools.get(database_url)
+    if manager is not None:
+        return manager
+
+    with _pools_lock:
+        manager = _pools.get(database_url)
+        if manager is None:
+            manager = PooledConnectionManager(database_url)
+            _pools[database_url] = manager
+            logger.info(f"Pool de conexiones psycopg2 creado (max {manager.MAX_CONNECTIONS})")
+    return manager
+
+def get_pool_stats() -> dict:
+    """Métricas de todos los pools creados en el proceso"""
+    if not _pools:
+        return {'enabled': False}
+
+    stats = {'enabled': True, 'pools': []}
+    for manager in list(_pools.values()):
+        stats['pools'].append(manager.get_stats())
+    return stats
+
+def close_all_pools():
+    """Cierra todas las conexiones de todos los pools (apagado de la aplicación)"""
+    with _pools_lock:
+        for manager in _pools.values():
+            manager.closeall()
+        _pools.clear()
@@ -10,6 +10,8 @@ import re
 import logging
 from typing import Dict, Optional, Tuple
 from pathlib import Path
+from utils.excel_reader import ExcelWorkbook
+from relaciones_utils import calcular_relaciones_cobranza
 
 # Configurar logging
 logger = logging.getLogger(__name__)
@@ -21,7 +23,24 @@ class ImmermexExcelProcessor:
     
     def __init__(self):
         self.processed_data = {}
+        self.workbook = None
+        self.workbook_path = None
         
+    def _get_workbook(self, path: str) -> ExcelWorkbook:
+        """Libro abierto de path; cada hoja se parsea una sola vez"""
+        if self.workbook is None or self.workbook_path != path:
+            self.close_workbook()
+            self.workbook = ExcelWorkbook(path)
+            self.workbook_path = path
+        return self.workbook
+    
+    def close_workbook(self):
+        """Cierra el libro abierto y libera sus filas en memoria"""
+        if self.workbook is not None:
+            self.workbook.close()
+        self.workbook = None
+        self.workbook_path = None
+    
     def detect_header_row(self, path: str, sheet_name: str, keywords: list) -> int:
         """
         Detecta dinámicamente la fila de encabezados basándose en palabras clave
@@ -35,8 +54,8 @@ class ImmermexExcelProcessor:
             Número de fila donde están los encabezados
         """
         try:
-            # Leer las primeras 20 filas para buscar encabezados
-            preview = pd.read_excel(path, sheet_name=sheet_name, nrows=20, header=None)
+            # Primeras 20 filas de la hoja ya parseada para buscar encabezados
+            preview = self._get_workbook(path).preview(sheet_name, nrows=20)
             
             for idx, row in preview.iterrows():
                 row_str = ' '.join(row.astype(str).fillna(''))
@@ -79,7 +98,7 @@ class ImmermexExcelProcessor:
             header_row = self.detect_header_row(path, "facturacion", keywords)
             
             # Leer datos
-            df = pd.read_excel(path, sheet_name="facturacion", header=header_row)
+            df = self._get_workbook(path).parse("facturacion", header=header_row)
             logger.info(f"Facturación: {len(df)} registros leídos")
             
             # Mapeo de columnas (flexible para diferentes formatos)
@@ -218,7 +237,7 @@ class ImmermexExcelProcessor:
             header_row = self.detect_header_row(path, "cobranza", keywords)
             
             # Leer datos
-            df = pd.read_excel(path, sheet_name="cobranza", header=header_row)
+            df = self._get_workbook(path).parse("cobranza", header=header_row)
             logger.info(f"Cobranza: {len(df)} registros leídos")
             
             # Mapeo de columnas
@@ -343,7 +362,7 @@ class ImmermexExcelProcessor:
             header_row = self.detect_header_row(path, "cfdi relacionados", keywords)
             
             # Leer datos
-            df = pd.read_excel(path, sheet_name="cfdi relacionados", header=header_row)
+            df = self._get_workbook(path).parse("cfdi relacionados", header=header_row)
             logger.info(f"CFDI: {len(df)} registros leídos")
             
             # Mapeo de columnas
@@ -440,8 +459,7 @@ class ImmermexExcelProcessor:
         try:
             # Detectar hoja de pedidos si no se especifica
             if sheet_name is None:
-                excel_file = pd.ExcelFile(path)
-                pedido_sheets = [s for s in excel_file.sheet_names 
+                pedido_sheets = [s for s in self._get_workbook(path).sheet_names 
                                if any(keyword in s.lower() for keyword in ['pedido', 'sep', 'oct', 'nov', 'dic'])]
                 if pedido_sheets:
                     sheet_name = pedido_sheets[0]
@@ -455,7 +473,7 @@ class ImmermexExcelProcessor:
             header_row = self.detect_header_row(path, sheet_name, keywords)
             
             # Leer datos
-            df = pd.read_excel(path, sheet_name=sheet_name, header=header_row)
+            df = self._get_workbook(path).parse(sheet_name, header=header_row)
             logger.info(f"Pedidos: {len(df)} registros leídos")
             
             # Mapeo de columnas
@@ -570,32 +588,8 @@ class ImmermexExcelProcessor:
             DataFrame de facturación con relaciones calculadas
         """
         try:
-            facturacion_rel = facturacion.copy()
-            
-            # Agregar columnas de relación
-            facturacion_rel['importe_cobrado'] = 0.0
-            facturacion_rel['fecha_cobro'] = pd.NaT
-            facturacion_rel['dias_cobro'] = 0
-            
-            # Relacionar por UUID
-            for idx, factura in facturacion_rel.iterrows():
-                uuid_factura = factura['uuid_factura']
-                if pd.notna(uuid_factura) and uuid_factura != '':
-                    cobranzas_relacionadas = cobranza[
-                        cobranza['uuid_factura_relacionada'] == uuid_factura
-                    ]
-                    
-                    if not cobranzas_relacionadas.empty:
-                        facturacion_rel.at[idx, 'importe_cobrado'] = cobranzas_relacionadas['importe_pagado'].sum()
-                        facturacion_rel.at[idx, 'fecha_cobro'] = cobranzas_relacionadas['fecha_pago'].max()
-                        
-                        # Calcular días de cobro
-                        if pd.notna(factura['fecha_factura']) and pd.notna(facturacion_rel.at[idx, 'fecha_cobro']):
-                            dias = (facturacion_rel.at[idx, 'fecha_cobro'] - factura['fecha_factura']).days
-                            facturacion_rel.at[idx, 'dias_cobro'] = max(0, dias)
-            
-            # Recalcular saldo pendiente
-            facturacion_rel['saldo_pendiente'] = facturacion_rel['monto_total'] - facturacion_rel['importe_cobrado']
+            # Agrupación de cobranza por UUID unida a las facturas (sin recorrer fila por fila)
+            facturacion_rel = calcular_relaciones_cobranza(facturacion, cobranza)
             
             logger.info("Relaciones calculadas exitosamente")
             return facturacion_rel
@@ -654,6 +648,9 @@ class ImmermexExcelProcessor:
                 "cfdi_clean": pd.DataFrame(),
                 "pedidos_compras_clean": pd.DataFrame()
             }
+        
+        finally:
+            self.close_workbook()
 
 
 # Función de conveniencia para uso directo
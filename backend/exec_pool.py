@@ -0,0 +1,259 @@
+"""
+Ejecución del trabajo bloqueante fuera del event loop.
+
+Los endpoints de main_with_db.py usan sesiones SQLAlchemy, cursores psycopg2 y
+pandas, que bloquean el event loop si se llaman directamente desde un
+`async def`: una carga de 40 s congelaba todas las demás peticiones del worker.
+Este módulo los envía a:
+
+- un pool de hilos acotado para consultas y guardado (E/S)
+- un pool de procesos para el parseo de Excel (CPU), con respaldo al pool de
+  hilos si no se pueden crear procesos en el entorno
+
+Cada clase de endpoint ('read', 'upload', 'background') tiene su propio límite de peticiones
+simultáneas. Las peticiones que exceden el límite esperan su turno sin bloquear
+el event loop y se reportan como profundidad de cola en get_execution_stats().
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial, wraps
+import multiprocessing
+import threading
+import asyncio
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Límites de concurrencia por clase de endpoint (configurables por variables de entorno)
+ENDPOINT_LIMITS = {
+    'read': int(os.getenv("EXEC_READ_CONCURRENCY", "8")),
+    'upload': int(os.getenv("EXEC_UPLOAD_CONCURRENCY", "1")),
+    'background': int(os.getenv("EXEC_BACKGROUND_CONCURRENCY", "1"))  # cargas en segundo plano (upload_jobs.py)
+}
+
+# Hilos para trabajo bloqueante: por defecto alcanza para todas las clases a la vez
+THREAD_WORKERS = int(os.getenv("EXEC_THREAD_WORKERS", str(sum(ENDPOINT_LIMITS.values()))))
+
+# Procesos para parseo de Excel; 0 lo ejecuta en el pool de hilos
+PROCESS_WORKERS = int(os.getenv("EXEC_PROCESS_WORKERS", "1"))
+
+class ExecutionPool:
+    """
+    Executor de hilos o procesos creado al primer uso, con métricas de cola.
+    
+    Los executors atienden en orden de llegada con max_workers tareas a la vez,
+    así que lo que excede max_workers está esperando en cola.
+    """
+    
+    def __init__(self, name: str, kind: str, max_workers: int):
+        self.name = name
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'in_flight': 0,
+            'max_queued': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0
+        }
+    
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.kind == 'process':
+                        # spawn: los workers no heredan hilos ni conexiones abiertas del proceso web
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.max_workers,
+                            mp_context=multiprocessing.get_context('spawn')
+                        )
+                    else:
+                        self._executor = ThreadPoolExecutor(
+                            max_workers=self.max_workers,
+                            thread_name_prefix=f"exec-{self.name}"
+                        )
+                    logger.info(f"Pool de ejecución '{self.name}' creado ({self.kind}, max {self.max_workers})")
+        return self._executor
+    
+    async def run(self, func, *args, **kwargs):
+        """Ejecuta func(*args, **kwargs) en el pool y espera el resultado sin bloquear el event loop"""
+        executor = self._get_executor()
+        loop = asyncio.get_running_loop()
+        
+        inicio = time.time()
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._stats['in_flight'] += 1
+            en_cola = self._stats['in_flight'] - self.max_workers
+            self._stats['max_queued'] = max(self._stats['max_queued'], en_cola)
+        
+        exito = False
+        try:
+            resultado = await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+            exito = True
+            return resultado
+        finally:
+            duracion_ms = (time.time() - inicio) * 1000
+            with self._lock:
+                self._stats['in_flight'] -= 1
+                self._stats['completed' if exito else 'failed'] += 1
+                self._stats['total_ms'] += duracion_ms
+                self._stats['max_ms'] = max(self._stats['max_ms'], duracion_ms)
+    
+    def get_stats(self) -> dict:
+        """Métricas del pool (queued = tareas esperando un worker libre)"""
+        with self._lock:
+            stats = dict(self._stats)
+        terminadas = stats['completed'] + stats['failed']
+        stats['name'] = self.name
+        stats['kind'] = self.kind
+        stats['max_workers'] = self.max_workers
+        stats['started'] = self._executor is not None
+        stats['running'] = min(stats['in_flight'], self.max_workers)
+        stats['queued'] = max(0, stats['in_flight'] - self.max_workers)
+        stats['avg_ms'] = round(stats['total_ms'] / terminadas, 2) if terminadas else 0.0
+        return stats
+    
+    def shutdown(self):
+        """Detiene el executor (las tareas en curso terminan)"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+class EndpointLimiter:
+    """Límite de peticiones simultáneas de una clase de endpoint, con métricas de espera"""
+    
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self._semaphore = None
+        self._stats = {
+            'requests': 0,
+            'active': 0,
+            'waiting': 0,
+            'max_waiting': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0
+        }
+    
+    async def __aenter__(self):
+        # El semáforo se crea dentro del event loop que lo usa
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        
+        inicio = time.time()
+        self._stats['requests'] += 1
+        self._stats['waiting'] += 1
+        self._stats['max_waiting'] = max(self._stats['max_waiting'], self._stats['waiting'])
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._stats['waiting'] -= 1
+        
+        espera_ms = (time.time() - inicio) * 1000
+        self._stats['active'] += 1
+        self._stats['total_wait_ms'] += espera_ms
+        self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], espera_ms)
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self._stats['active'] -= 1
+        self._semaphore.release()
+    
+    def get_stats(self) -> dict:
+        """Métricas de la clase (waiting = peticiones en cola por el límite)"""
+        stats = dict(self._stats)
+        stats['limit'] = self.limit
+        stats['avg_wait_ms'] = round(stats['total_wait_ms'] / stats['requests'], 2) if stats['requests'] else 0.0
+        return stats
+
+thread_pool = ExecutionPool('io', 'thread', THREAD_WORKERS)
+process_pool = ExecutionPool('cpu', 'process', PROCESS_WORKERS) if PROCESS_WORKERS > 0 else None
+
+_limiters = {name: EndpointLimiter(name, limit) for name, limit in ENDPOINT_LIMITS.items()}
+
+def get_limiter(endpoint_class: str) -> EndpointLimiter:
+    """Limitador de la clase de endpoint ('read', 'upload' o 'background')"""
+    try:
+        return _limiters[endpoint_class]
+    except KeyError:
+        raise ValueError(f"Clase de endpoint desconocida: {endpoint_class}")
+
+async def run_blocking(func, *args, **kwargs):
+    """Ejecuta una llamada bloqueante (DB, pandas) en el pool de hilos"""
+    return await thread_pool.run(func, *args, **kwargs)
+
+async def run_cpu(func, *args, **kwargs):
+    """
+    Ejecuta trabajo de CPU (parseo de Excel) en el pool de procesos.
+    func, argumentos y resultado deben poder serializarse con pickle. Si el
+    pool de procesos no está disponible se usa el pool de hilos.
+    """
+    global process_pool
+    if process_pool is not None:
+        try:
+            process_pool._get_executor()
+        except (OSError, NotImplementedError) as e:
+            # Entornos sin soporte de multiprocessing (p. ej. sin /dev/shm)
+            logger.warning(f"Pool de procesos no disponible ({type(e).__name__}: {e}), usando pool de hilos")
+            process_pool = None
+    
+    if process_pool is None:
+        return await thread_pool.run(func, *args, **kwargs)
+    
+    try:
+        return await process_pool.run(func, *args, **kwargs)
+    except BrokenProcessPool:
+        # Un worker murió (p. ej. por memoria): se recrea el pool en la siguiente llamada
+        logger.error("Pool de procesos roto, se recreará en la siguiente tarea")
+        process_pool.shutdown()
+        raise
+
+def endpoint_class(name: str):
+    """
+    Decorador para endpoints de FastAPI: limita las peticiones simultáneas de la
+    clase y, si el endpoint es síncrono, lo ejecuta en el pool de hilos.
+    
+    Se coloca debajo del decorador de ruta; la firma se conserva para que
+    FastAPI resuelva parámetros y dependencias del endpoint original.
+    """
+    limiter = get_limiter(name)
+    
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with limiter:
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with limiter:
+                    return await thread_pool.run(func, *args, **kwargs)
+        return wrapper
+    
+    return decorator
+
+def get_execution_stats() -> dict:
+    """Métricas de pools y clases de endpoint"""
+    pools = [thread_pool.get_stats()]
+    if process_pool is not None:
+        pools.append(process_pool.get_stats())
+    return {
+        'pools': pools,
+        'endpoint_classes': {name: limiter.get_stats() for name, limiter in _limiters.items()}
+    }
+
+def shutdown_pools():
+    """Detiene los pools de ejecución (apagado de la aplicación)"""
+    thread_pool.shutdown()
+    if process_pool is not None:
+        process_pool.shutdown()
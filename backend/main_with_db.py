@@ -22,11 +22,15 @@ from database import get_db, init_db, ArchivoProcesado
 from database_service import DatabaseService
 try:
     from utils import setup_logging, handle_api_error, FileProcessingError, DatabaseError
+    from utils.cache import bump_data_generation
 except ImportError:
     # Para desarrollo local
     from .utils import setup_logging, handle_api_error, FileProcessingError, DatabaseError
+    from .utils.cache import bump_data_generation
 from datetime import datetime
 from data_processor import process_immermex_file_advanced
+from exec_pool import endpoint_class, run_blocking, run_cpu, get_execution_stats
+from upload_jobs import upload_jobs
 from fastapi import HTTPException, Query
 from sqlalchemy.orm import Session
 from typing import Optional
@@ -127,6 +131,12 @@ async def cors_test():
 
 # Fully commented out startup event
 
+@app.on_event("shutdown")
+def shutdown_execution_pools():
+    """Detiene los pools de hilos y procesos al apagar la aplicación"""
+    from exec_pool import shutdown_pools
+    shutdown_pools()
+
 @app.get("/")
 async def root():
     """Endpoint de salud de la API"""
@@ -148,7 +158,8 @@ async def simple_health():
     }
 
 @app.get("/api/health")
-async def health_check(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def health_check(db: Session = Depends(get_db)):
     """Endpoint de verificación de salud con base de datos"""
     try:
         # Verificar conexión a base de datos
@@ -176,7 +187,8 @@ async def health_check(db: Session = Depends(get_db)):
         }
 
 @app.get("/api/kpis")
-async def get_kpis(
+@endpoint_class("read")
+def get_kpis(
     mes: Optional[int] = Query(None, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
     pedidos: Optional[str] = Query(None, description="Lista de pedidos separados por coma"),
@@ -204,7 +216,8 @@ async def get_kpis(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/filtros/disponibles")
-async def get_filtros_disponibles(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_filtros_disponibles(db: Session = Depends(get_db)):
     """Obtiene opciones disponibles para filtros"""
     try:
         db_service = DatabaseService(db)
@@ -215,7 +228,8 @@ async def get_filtros_disponibles(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/filtros/pedidos")
-async def get_pedidos_filtro(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_pedidos_filtro(db: Session = Depends(get_db)):
     """Obtiene lista de pedidos para filtros (compatible con frontend actual)"""
     try:
         db_service = DatabaseService(db)
@@ -232,7 +246,8 @@ def test_after_filtros():
     return {"message": "test after filtros works"}
 
 @app.get("/api/filtros/clientes")
-async def get_clientes_filtro(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_clientes_filtro(db: Session = Depends(get_db)):
     """Obtiene lista de clientes para filtros"""
     try:
         db_service = DatabaseService(db)
@@ -243,7 +258,8 @@ async def get_clientes_filtro(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/filtros/materiales")
-async def get_materiales_filtro(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_materiales_filtro(db: Session = Depends(get_db)):
     """Obtiene lista de materiales para filtros"""
     try:
         db_service = DatabaseService(db)
@@ -254,7 +270,8 @@ async def get_materiales_filtro(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/filtros/aplicar")
-async def aplicar_filtros(
+@endpoint_class("read")
+def aplicar_filtros(
     mes: Optional[int] = Query(None),
     año: Optional[int] = Query(None),
     db: Session = Depends(get_db)
@@ -271,7 +288,8 @@ async def aplicar_filtros(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/filtros/pedidos/aplicar")
-async def aplicar_filtros_pedido(
+@endpoint_class("read")
+def aplicar_filtros_pedido(
     pedidos: List[str] = Query([]),
     db: Session = Depends(get_db)
 ):
@@ -288,9 +306,11 @@ async def aplicar_filtros_pedido(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/upload")
+@endpoint_class("upload")
 async def upload_file(
     file: UploadFile = File(...),
     reemplazar_datos: bool = Query(True, description="Si true, reemplaza todos los datos existentes"),
+    en_segundo_plano: bool = Query(False, description="Si true, responde con job_id de inmediato; consultar avance en /api/jobs/{job_id}"),
     db: Session = Depends(get_db)
 ):
     """Endpoint para subir archivos Excel con persistencia en base de datos"""
@@ -308,6 +328,9 @@ async def upload_file(
         if len(contents) > 10 * 1024 * 1024:
             raise FileProcessingError("El archivo es demasiado grande. Máximo 10MB permitido.")
         
+        if en_segundo_plano:
+            return await _encolar_carga("immermex", contents, file.filename, reemplazar_datos)
+        
         # Procesar archivo directamente desde memoria (compatible con entornos serverless)
         try:
             import io
@@ -319,7 +342,7 @@ async def upload_file(
             # Procesar usando la nueva función desde bytes
             print(f"🔥🔥🔥 ANTES de process_excel_from_bytes - Timestamp: {datetime.now().isoformat()}")
             logger.info(f"🔥 ANTES de process_excel_from_bytes - Timestamp: {datetime.now().isoformat()}")
-            processed_data_dict, kpis = process_excel_from_bytes(contents, file.filename)
+            processed_data_dict, kpis = await run_cpu(process_excel_from_bytes, contents, file.filename)
             print(f"🔥🔥🔥 DESPUÉS de process_excel_from_bytes - Timestamp: {datetime.now().isoformat()}")
             logger.info(f"🔥 DESPUÉS de process_excel_from_bytes - Timestamp: {datetime.now().isoformat()}")
             print(f"🔥🔥🔥 Datos procesados exitosamente. Claves: {list(processed_data_dict.keys())}")
@@ -329,7 +352,7 @@ async def upload_file(
             for key, data in processed_data_dict.items():
                 logger.info(f"{key}: {len(data)} registros")
                 if len(data) > 0:
-                    logger.info(f"  Primer registro de {key}: {list(data[0].keys()) if isinstance(data, list) else 'No es lista'}")
+                    logger.info(f"  Columnas de {key}: {list(data.columns)}")
             
             # Preparar información del archivo
             archivo_info = {
@@ -346,7 +369,7 @@ async def upload_file(
             logger.info("Iniciando guardado en base de datos...")
             db_service = DatabaseService(db)
             print(f"🔥🔥🔥 DatabaseService creado, llamando a save_processed_data...")
-            result = db_service.save_processed_data(processed_data_dict, archivo_info)
+            result = await run_blocking(db_service.save_processed_data, processed_data_dict, archivo_info)
             print(f"🔥🔥🔥 save_processed_data completado - Result: {result.get('success', 'unknown')}")
             
             # Verificar si hubo error en el guardado
@@ -398,9 +421,11 @@ async def upload_file(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/upload/compras-v2")
+@endpoint_class("upload")
 async def upload_compras_v2_file(
     file: UploadFile = File(...),
-    reemplazar_datos: bool = Query(True, description="Si true, reemplaza todos los datos existentes")
+    reemplazar_datos: bool = Query(True, description="Si true, reemplaza todos los datos existentes"),
+    en_segundo_plano: bool = Query(False, description="Si true, responde con job_id de inmediato; consultar avance en /api/jobs/{job_id}")
 ):
     """Endpoint específico para subir archivos Excel de compras_v2 - SISTEMA COMPRAS_V2"""
     try:
@@ -424,6 +449,9 @@ async def upload_compras_v2_file(
             logger.error(f"❌ Archivo demasiado grande: {len(content)/1024/1024:.2f} MB")
             raise HTTPException(status_code=400, detail="El archivo es demasiado grande. Máximo 10MB permitido.")
         
+        if en_segundo_plano:
+            return await _encolar_carga("compras_v2", content, file.filename, reemplazar_datos)
+        
         # Usar el nuevo servicio especializado de compras_v2
         logger.info("🔧 Importando ComprasV2UploadService...")
         from compras_v2_upload_service import ComprasV2UploadService
@@ -432,7 +460,7 @@ async def upload_compras_v2_file(
         service = ComprasV2UploadService()
         
         logger.info("🚀 Iniciando procesamiento del archivo...")
-        result = service.upload_compras_file(content, file.filename, reemplazar_datos)
+        result = await run_blocking(service.upload_compras_file, content, file.filename, reemplazar_datos)
         
         if result.get("success"):
             logger.info("="*60)
@@ -474,8 +502,32 @@ async def upload_compras_v2_file(
         logger.error("="*60)
         raise HTTPException(status_code=500, detail=f"Error crítico: {str(e)}")
 
+async def _encolar_carga(tipo: str, contenido: bytes, nombre_archivo: str, reemplazar_datos: bool):
+    """Registra la carga en segundo plano y responde 202 con el job_id"""
+    job = await run_blocking(upload_jobs.submit, tipo, nombre_archivo, len(contenido))
+    if not job["duplicado"]:
+        upload_jobs.start(job["job_id"], tipo, contenido, nombre_archivo, reemplazar_datos)
+    
+    return JSONResponse(status_code=202, content={
+        "mensaje": "Carga ya en proceso" if job["duplicado"] else "Carga registrada, procesando en segundo plano",
+        "job_id": job["job_id"],
+        "duplicado": job["duplicado"],
+        "nombre_archivo": nombre_archivo,
+        "estado_url": f"/api/jobs/{job['job_id']}"
+    })
+
+@app.get("/api/jobs/{job_id}")
+@endpoint_class("read")
+def get_upload_job(job_id: int):
+    """Estado de una carga en segundo plano: fase, registros procesados y registros por segundo"""
+    job = upload_jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No existe la carga {job_id}")
+    return job
+
 @app.get("/api/archivos")
-async def get_archivos_procesados(
+@endpoint_class("read")
+def get_archivos_procesados(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     db: Session = Depends(get_db)
@@ -506,7 +558,8 @@ async def get_archivos_procesados(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/api/archivos/{archivo_id}")
-async def eliminar_archivo(
+@endpoint_class("upload")
+def eliminar_archivo(
     archivo_id: int,
     db: Session = Depends(get_db)
 ):
@@ -538,7 +591,8 @@ async def eliminar_archivo(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/data/summary")
-async def get_data_summary(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_data_summary(db: Session = Depends(get_db)):
     """Obtiene resumen de datos disponibles"""
     try:
         db_service = DatabaseService(db)
@@ -549,7 +603,8 @@ async def get_data_summary(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/graficos/aging")
-async def get_grafico_aging(
+@endpoint_class("read")
+def get_grafico_aging(
     mes: Optional[int] = Query(None),
     año: Optional[int] = Query(None),
     db: Session = Depends(get_db)
@@ -576,7 +631,8 @@ async def get_grafico_aging(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/graficos/top-clientes")
-async def get_grafico_top_clientes(
+@endpoint_class("read")
+def get_grafico_top_clientes(
     limite: int = Query(10, ge=1, le=50),
     mes: Optional[int] = Query(None),
     año: Optional[int] = Query(None),
@@ -591,11 +647,8 @@ async def get_grafico_top_clientes(
         if año:
             filtros['año'] = año
         
-        kpis = db_service.calculate_kpis(filtros)
-        clientes = kpis.get("top_clientes", {})
-        
-        # Limitar resultados
-        clientes_limitados = dict(list(clientes.items())[:limite])
+        # Resúmenes mensuales (o SQL en vivo) sin calcular todos los KPIs
+        clientes_limitados = db_service.get_top_clientes(filtros, limite)
         
         return {
             "labels": list(clientes_limitados.keys()),
@@ -607,7 +660,8 @@ async def get_grafico_top_clientes(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/graficos/consumo-material")
-async def get_grafico_consumo_material(
+@endpoint_class("read")
+def get_grafico_consumo_material(
     limite: int = Query(10, ge=1, le=50),
     mes: Optional[int] = Query(None),
     año: Optional[int] = Query(None),
@@ -622,11 +676,8 @@ async def get_grafico_consumo_material(
         if año:
             filtros['año'] = año
         
-        kpis = db_service.calculate_kpis(filtros)
-        materiales = kpis.get("consumo_material", {})
-        
-        # Limitar resultados
-        materiales_limitados = dict(list(materiales.items())[:limite])
+        # Resúmenes mensuales (o SQL en vivo) sin calcular todos los KPIs
+        materiales_limitados = db_service.get_consumo_material(filtros, limite)
         
         return {
             "labels": list(materiales_limitados.keys()),
@@ -638,6 +689,7 @@ async def get_grafico_consumo_material(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/debug/upload")
+@endpoint_class("upload")
 async def debug_upload(file: UploadFile = File(...)):
     """Endpoint de debugging temporal para diagnosticar problemas de upload"""
     try:
@@ -658,7 +710,7 @@ async def debug_upload(file: UploadFile = File(...)):
         # Probar procesamiento
         try:
             from data_processor import process_excel_from_bytes
-            processed_data_dict, kpis = process_excel_from_bytes(contents, file.filename)
+            processed_data_dict, kpis = await run_cpu(process_excel_from_bytes, contents, file.filename)
             logger.info(f"🔍 DEBUG: Procesamiento exitoso")
             
             return {
@@ -669,7 +721,7 @@ async def debug_upload(file: UploadFile = File(...)):
                 "record_counts": {key: len(data) for key, data in processed_data_dict.items()},
                 "kpis": kpis,
                 "first_record_keys": {
-                    key: list(data[0].keys()) if len(data) > 0 else [] 
+                    key: list(data.columns) if len(data) > 0 else [] 
                     for key, data in processed_data_dict.items()
                 }
             }
@@ -761,10 +813,12 @@ async def debug_upload_no_decorator(file: UploadFile = File(...)):
     }
 
 @app.get("/api/system/performance")
-async def get_system_performance(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_system_performance(db: Session = Depends(get_db)):
     """Endpoint para monitorear el rendimiento del sistema"""
     try:
         from utils.cache import cache
+        from db_pool import get_pool_stats
         import psutil
         import time
         
@@ -799,6 +853,9 @@ async def get_system_performance(db: Session = Depends(get_db)):
                 "has_data": data_summary.get("has_data", False),
                 "total_records": sum(data_summary.get("conteos", {}).values())
             },
+            "db_pool": get_pool_stats(),
+            "execution": get_execution_stats(),
+            "upload_jobs_activos": upload_jobs.active_jobs(),
             "status": "healthy"
         }
         
@@ -806,6 +863,11 @@ async def get_system_performance(db: Session = Depends(get_db)):
         logger.error(f"Error obteniendo métricas de rendimiento: {str(e)}")
         return {"error": str(e), "status": "error"}
 
+@app.get("/api/system/execution")
+async def get_system_execution():
+    """Profundidad de cola y tiempos de los pools de ejecución y de cada clase de endpoint"""
+    return get_execution_stats()
+
 @app.post("/api/system/cache/clear")
 async def clear_cache():
     """Endpoint para limpiar el caché del sistema"""
@@ -821,55 +883,118 @@ async def clear_cache():
         logger.error(f"Error limpiando caché: {str(e)}")
         return {"error": str(e), "status": "error"}
 
+@app.post("/api/system/rollups/refresh")
+@endpoint_class("upload")
+def refresh_rollups(db: Session = Depends(get_db)):
+    """Reconstruye los resúmenes mensuales (p. ej. para datos cargados antes de existir)"""
+    try:
+        from services import RollupService
+        import time
+        start_time = time.time()
+        if not RollupService(db).refresh_all():
+            # Persistir los resúmenes vaciados para que los KPIs pasen a calcularse en vivo
+            db.commit()
+            bump_data_generation("refresh_rollups")
+            return {
+                "error": "No se pudieron reconstruir los resúmenes mensuales "
+                         "(ver logs; ¿se ejecutó create_resumen_mensual_tables.sql?). KPIs en vivo",
+                "status": "error"
+            }
+        db.commit()
+        bump_data_generation("refresh_rollups")
+        return {
+            "success": True,
+            "message": "Resúmenes mensuales reconstruidos",
+            "duration": round(time.time() - start_time, 3)
+        }
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error reconstruyendo resúmenes mensuales: {str(e)}")
+        return {"error": str(e), "status": "error"}
+
 @app.get("/api/data/paginated")
-async def get_paginated_data(
-    page: int = Query(1, ge=1, description="Número de página"),
+@endpoint_class("read")
+def get_paginated_data(
+    page: int = Query(1, ge=1, description="Número de página (se ignora si hay cursor)"),
     per_page: int = Query(50, ge=1, le=100, description="Elementos por página"),
     table: str = Query("facturacion", description="Tabla a consultar (facturacion, cobranza, pedidos)"),
+    cursor: Optional[str] = Query(None, description="Cursor de la página siguiente (next_cursor)"),
+    incluir_total: bool = Query(True, description="Calcular el total (cacheado por carga de datos); false lo omite"),
     db: Session = Depends(get_db)
 ):
-    """Endpoint optimizado para obtener datos con paginación"""
+    """
+    Endpoint optimizado para obtener datos con paginación.
+    Con cursor la paginación es por clave sobre el índice de fecha (costo constante);
+    solo se leen las columnas listadas, sin hidratar entidades ORM.
+    """
     try:
-        from utils.pagination import paginate, get_pagination_params
+        from utils.pagination import (
+            paginate, paginate_keyset, order_for_keyset, get_pagination_params, encode_cursor
+        )
         from database import Facturacion, Cobranza, Pedido
         
         # Validar parámetros
         page, per_page = get_pagination_params(page, per_page)
         
-        # Seleccionar tabla
+        # Seleccionar tabla: columnas proyectadas, columna de fecha y desempate únicos
         if table == "facturacion":
-            query = db.query(Facturacion).order_by(Facturacion.fecha_factura.desc())
+            columnas = [
+                Facturacion.folio_factura, Facturacion.serie_factura, Facturacion.fecha_factura,
+                Facturacion.cliente, Facturacion.agente, Facturacion.monto_neto, Facturacion.monto_total,
+                Facturacion.saldo_pendiente, Facturacion.dias_credito, Facturacion.uuid_factura,
+                Facturacion.importe_cobrado, Facturacion.fecha_cobro, Facturacion.dias_cobro,
+                Facturacion.mes, Facturacion.año, Facturacion.archivo_id
+            ]
+            orden, desempate = Facturacion.fecha_factura, Facturacion.folio_factura
         elif table == "cobranza":
-            query = db.query(Cobranza).order_by(Cobranza.fecha_pago.desc())
+            columnas = [
+                Cobranza.id, Cobranza.fecha_pago, Cobranza.serie_pago, Cobranza.folio_pago,
+                Cobranza.cliente, Cobranza.moneda, Cobranza.tipo_cambio, Cobranza.forma_pago,
+                Cobranza.parcialidad, Cobranza.importe_pagado, Cobranza.uuid_factura_relacionada,
+                Cobranza.archivo_id
+            ]
+            orden, desempate = Cobranza.fecha_pago, Cobranza.id
         elif table == "pedidos":
-            query = db.query(Pedido).order_by(Pedido.fecha_factura.desc())
+            columnas = [
+                Pedido.id, Pedido.folio_factura, Pedido.pedido, Pedido.kg, Pedido.precio_unitario,
+                Pedido.importe_sin_iva, Pedido.material, Pedido.dias_credito, Pedido.fecha_factura,
+                Pedido.fecha_pago, Pedido.archivo_id
+            ]
+            orden, desempate = Pedido.fecha_factura, Pedido.id
         else:
             raise HTTPException(status_code=400, detail="Tabla no válida")
         
+        query = db.query(*columnas)
+        
         # Paginar resultados
-        result = paginate(query, page, per_page)
+        if cursor:
+            try:
+                result = paginate_keyset(
+                    query, orden, desempate, per_page, cursor,
+                    with_total=incluir_total, total_cache_key=table
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        else:
+            result = paginate(
+                order_for_keyset(query, orden, desempate), page, per_page,
+                with_total=incluir_total, total_cache_key=table
+            )
+            # Cursor para continuar por clave desde esta página
+            if result.has_next and result.items:
+                ultimo = result.items[-1]
+                result.next_cursor = encode_cursor([getattr(ultimo, orden.key), getattr(ultimo, desempate.key)])
         
         # Convertir a diccionario
-        items = []
-        for item in result.items:
-            if hasattr(item, '__dict__'):
-                item_dict = {k: v for k, v in item.__dict__.items() if not k.startswith('_')}
-                items.append(item_dict)
+        items = [dict(row._mapping) for row in result.items]
         
         return {
             "items": items,
-            "pagination": {
-                "page": result.page,
-                "per_page": result.per_page,
-                "total": result.total,
-                "pages": result.pages,
-                "has_prev": result.has_prev,
-                "has_next": result.has_next,
-                "prev_num": result.prev_num,
-                "next_num": result.next_num
-            }
+            "pagination": result.to_dict()
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error obteniendo datos paginados: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -877,13 +1002,15 @@ async def get_paginated_data(
 # ==================== ENDPOINTS DE COMPRAS_V2 ====================
 
 @app.get("/api/compras-v2/kpis")
-async def get_compras_v2_kpis(
-    mes: Optional[int] = Query(None, description="Filtrar por mes"),
+@endpoint_class("read")
+def get_compras_v2_kpis(
+    mes: Optional[int] = Query(None, ge=1, le=12, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
     proveedor: Optional[str] = Query(None, description="Filtrar por proveedor"),
     material: Optional[str] = Query(None, description="Filtrar por material")
 ):
     """Obtiene KPIs principales de compras_v2 con filtros opcionales"""
+    service = None
     try:
         import time
         start_time = time.time()
@@ -917,10 +1044,15 @@ async def get_compras_v2_kpis(
     except Exception as e:
         logger.error(f"Error obteniendo KPIs de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/debug-precios")
-async def debug_precios():
+@endpoint_class("read")
+def debug_precios():
     """Endpoint de debug para verificar datos de precios"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -986,10 +1118,15 @@ async def debug_precios():
     except Exception as e:
         logger.error(f"Error en debug precios: {str(e)}")
         return {"error": str(e)}
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/debug-pagos")
-async def debug_pagos():
+@endpoint_class("read")
+def debug_pagos():
     """Endpoint de debug para verificar datos de pagos"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1048,10 +1185,15 @@ async def debug_pagos():
     except Exception as e:
         logger.error(f"Error en debug pagos: {str(e)}")
         return {"error": str(e)}
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/debug-relacion")
-async def debug_relacion():
+@endpoint_class("read")
+def debug_relacion():
     """Endpoint de debug para verificar relación entre compras_v2 y materiales"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1100,10 +1242,15 @@ async def debug_relacion():
     except Exception as e:
         logger.error(f"Error en debug relacion: {str(e)}")
         return {"error": str(e)}
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/debug")
-async def debug_compras_v2():
+@endpoint_class("read")
+def debug_compras_v2():
     """Endpoint de debug para verificar estructura de base de datos"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1144,10 +1291,15 @@ async def debug_compras_v2():
     except Exception as e:
         logger.error(f"Error en debug: {str(e)}")
         return {"error": str(e)}
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/test")
-async def test_compras_v2_data():
+@endpoint_class("read")
+def test_compras_v2_data():
     """Endpoint de prueba para verificar datos de compras_v2"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1185,17 +1337,27 @@ async def test_compras_v2_data():
     except Exception as e:
         logger.error(f"Error en test: {str(e)}")
         return {"error": str(e)}
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/data")
-async def get_compras_v2_data(
-    mes: Optional[int] = Query(None, description="Filtrar por mes"),
+@endpoint_class("read")
+def get_compras_v2_data(
+    mes: Optional[int] = Query(None, ge=1, le=12, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
     proveedor: Optional[str] = Query(None, description="Filtrar por proveedor"),
     material: Optional[str] = Query(None, description="Filtrar por material"),
     limit: int = Query(100, ge=1, le=1000, description="Límite de registros"),
-    offset: int = Query(0, ge=0, description="Offset para paginación")
+    offset: int = Query(0, ge=0, description="Offset para paginación (se ignora si hay cursor)"),
+    cursor: Optional[str] = Query(None, description="Cursor de la página siguiente (next_cursor)"),
+    incluir_total: bool = Query(True, description="Calcular el total de compras filtradas")
 ):
-    """Obtiene datos de compras_v2 con filtros opcionales y paginación"""
+    """
+    Obtiene datos de compras_v2 con filtros opcionales y paginación.
+    Con cursor la paginación es por clave (fecha_pedido DESC, imi DESC).
+    """
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1212,25 +1374,38 @@ async def get_compras_v2_data(
         if material:
             filtros['material'] = material
         
-        compras = service.get_compras_simple(limit=limit, offset=offset)
-        total_count = service.get_compras_count(filtros)
+        try:
+            pagina = service.get_compras_pagina(filtros, limit=limit, cursor=cursor, offset=offset)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        total_count = service.get_compras_count(filtros) if incluir_total else None
         
         return {
             "success": True,
-            "compras": compras,
+            "compras": pagina['compras'],
             "total_compras": total_count,
             "limit": limit,
-            "offset": offset,
+            "offset": offset if not cursor else None,
+            "next_cursor": pagina['next_cursor'],
+            "has_more": pagina['has_more'],
             "filtros_aplicados": filtros
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error obteniendo datos de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/materiales/{imi}")
-async def get_materiales_by_compra(imi: int):
+@endpoint_class("read")
+def get_materiales_by_compra(imi: int):
     """Obtiene materiales de una compra específica por IMI"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1247,16 +1422,21 @@ async def get_materiales_by_compra(imi: int):
     except Exception as e:
         logger.error(f"Error obteniendo materiales para compra {imi}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/evolucion-precios")
-async def get_compras_v2_evolucion_precios(
+@endpoint_class("read")
+def get_compras_v2_evolucion_precios(
     material: Optional[str] = Query(None, description="Filtrar por material"),
     moneda: str = Query("USD", description="Moneda para mostrar precios (USD/MXN)"),
-    mes: Optional[int] = Query(None, description="Filtrar por mes"),
+    mes: Optional[int] = Query(None, ge=1, le=12, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
     proveedor: Optional[str] = Query(None, description="Filtrar por proveedor")
 ):
     """Obtiene evolución mensual de precios por kg para compras_v2"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1278,16 +1458,21 @@ async def get_compras_v2_evolucion_precios(
     except Exception as e:
         logger.error(f"Error obteniendo evolución de precios de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/flujo-pagos")
-async def get_compras_v2_flujo_pagos(
-    mes: Optional[int] = Query(None, description="Filtrar por mes"),
+@endpoint_class("read")
+def get_compras_v2_flujo_pagos(
+    mes: Optional[int] = Query(None, ge=1, le=12, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
     proveedor: Optional[str] = Query(None, description="Filtrar por proveedor"),
     material: Optional[str] = Query(None, description="Filtrar por material"),
     moneda: str = Query("USD", description="Moneda para mostrar (USD o MXN)")
 ):
     """Obtiene flujo de pagos de compras_v2 por semana"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1313,11 +1498,15 @@ async def get_compras_v2_flujo_pagos(
     except Exception as e:
         logger.error(f"Error obteniendo flujo de pagos de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/top-proveedores")
-async def get_compras_v2_top_proveedores(
+@endpoint_class("read")
+def get_compras_v2_top_proveedores(
     limite: int = Query(10, description="Número máximo de proveedores a retornar"),
-    mes: Optional[int] = Query(None, description="Filtrar por mes"),
+    mes: Optional[int] = Query(None, ge=1, le=12, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
     db: Session = Depends(get_db)
 ):
@@ -1339,13 +1528,15 @@ async def get_compras_v2_top_proveedores(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/compras-v2/compras-por-material")
-async def get_compras_v2_por_material(
+@endpoint_class("read")
+def get_compras_v2_por_material(
     limite: int = Query(10, description="Número máximo de materiales a retornar"),
-    mes: Optional[int] = Query(None, description="Filtrar por mes"),
+    mes: Optional[int] = Query(None, ge=1, le=12, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
     proveedor: Optional[str] = Query(None, description="Filtrar por proveedor")
 ):
     """Obtiene compras agrupadas por material en compras_v2"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1365,9 +1556,13 @@ async def get_compras_v2_por_material(
     except Exception as e:
         logger.error(f"Error obteniendo compras por material de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/materiales")
-async def get_compras_v2_materiales(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_compras_v2_materiales(db: Session = Depends(get_db)):
     """Obtiene lista de materiales disponibles en compras_v2"""
     try:
         db_service = DatabaseService(db)
@@ -1379,7 +1574,8 @@ async def get_compras_v2_materiales(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/compras-v2/proveedores")
-async def get_compras_v2_proveedores(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_compras_v2_proveedores(db: Session = Depends(get_db)):
     """Obtiene lista de proveedores disponibles en compras_v2"""
     try:
         db_service = DatabaseService(db)
@@ -1391,13 +1587,15 @@ async def get_compras_v2_proveedores(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/compras-v2/aging-cuentas-pagar")
-async def get_compras_v2_aging_cuentas_pagar(
-    mes: Optional[int] = Query(None, description="Filtrar por mes"),
+@endpoint_class("read")
+def get_compras_v2_aging_cuentas_pagar(
+    mes: Optional[int] = Query(None, ge=1, le=12, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
     proveedor: Optional[str] = Query(None, description="Filtrar por proveedor"),
     material: Optional[str] = Query(None, description="Filtrar por material")
 ):
     """Obtiene aging de cuentas por pagar para compras_v2"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1419,10 +1617,15 @@ async def get_compras_v2_aging_cuentas_pagar(
     except Exception as e:
         logger.error(f"Error obteniendo aging de cuentas por pagar de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/materiales")
-async def get_compras_v2_materiales():
+@endpoint_class("read")
+def get_compras_v2_materiales():
     """Obtiene lista de materiales disponibles en compras_v2"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1433,10 +1636,15 @@ async def get_compras_v2_materiales():
     except Exception as e:
         logger.error(f"Error obteniendo materiales de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/proveedores")
-async def get_compras_v2_proveedores():
+@endpoint_class("read")
+def get_compras_v2_proveedores():
     """Obtiene lista de proveedores únicos de compras_v2"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1447,10 +1655,15 @@ async def get_compras_v2_proveedores():
     except Exception as e:
         logger.error(f"Error obteniendo proveedores de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/anios-disponibles")
-async def get_compras_v2_anios_disponibles():
+@endpoint_class("read")
+def get_compras_v2_anios_disponibles():
     """Obtiene lista de años disponibles en compras_v2"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         
@@ -1461,10 +1674,15 @@ async def get_compras_v2_anios_disponibles():
     except Exception as e:
         logger.error(f"Error obteniendo años disponibles de compras_v2: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.post("/api/compras-v2/update-fechas-estimadas")
-async def update_fechas_estimadas():
+@endpoint_class("upload")
+def update_fechas_estimadas():
     """Actualiza las fechas estimadas para todos los registros existentes"""
+    service = None
     try:
         from .compras_v2_service import ComprasV2Service
         from datetime import timedelta
@@ -1518,7 +1736,6 @@ async def update_fechas_estimadas():
         
         if not records:
             cursor.close()
-            conn.close()
             return {"message": "No se encontraron registros para actualizar", "updated": 0, "skipped": 0}
         
         logger.info(f"Encontrados {len(records)} registros para procesar")
@@ -1624,6 +1841,7 @@ async def update_fechas_estimadas():
         
         # Commit todos los cambios
         conn.commit()
+        bump_data_generation("update_fechas_estimadas")
         
         logger.info(f"Actualización completada: {updated_count} actualizados, {skipped_count} sin cambios")
         
@@ -1723,6 +1941,7 @@ async def update_fechas_estimadas():
             
             # Commit los cambios de materiales
             conn.commit()
+            bump_data_generation("update_fechas_estimadas materiales")
             logger.info(f"Actualizados {materiales_updated} materiales con nuevos valores de pu_usd")
             
         except Exception as e:
@@ -1730,7 +1949,6 @@ async def update_fechas_estimadas():
             conn.rollback()
         
         cursor.close()
-        conn.close()
         
         return {
             "message": "Actualización de fechas estimadas y columnas automáticas completada",
@@ -1747,9 +1965,13 @@ async def update_fechas_estimadas():
         import traceback
         logger.error(f"Traceback completo: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error actualizando fechas estimadas: {str(e)}")
+    finally:
+        if service is not None:
+            service.close_connection()
 
 @app.get("/api/compras-v2/download-layout")
-async def download_compras_layout():
+@endpoint_class("read")
+def download_compras_layout():
     """Descarga el layout de Excel para compras_v2"""
     try:
         import pandas as pd
@@ -1863,7 +2085,8 @@ async def download_compras_layout():
 # ==================== ENDPOINTS ADICIONALES (404 FIXES) ====================
 
 @app.get("/api/filtros-disponibles")
-async def get_filtros_disponibles(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_filtros_disponibles(db: Session = Depends(get_db)):
     """Obtiene opciones disponibles para filtros (compatible con frontend)"""
     try:
         db_service = DatabaseService(db)
@@ -1875,7 +2098,8 @@ async def get_filtros_disponibles(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/pedidos-filtro")
-async def get_pedidos_filtro(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_pedidos_filtro(db: Session = Depends(get_db)):
     """Obtiene lista de pedidos para filtros (compatible con frontend)"""
     try:
         db_service = DatabaseService(db)
@@ -1887,7 +2111,8 @@ async def get_pedidos_filtro(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/pedidos/ventas-por-material")
-async def get_ventas_por_material(
+@endpoint_class("read")
+def get_ventas_por_material(
     limite: int = Query(10, description="Número máximo de materiales a retornar"),
     mes: Optional[int] = Query(None, description="Filtrar por mes"),
     año: Optional[int] = Query(None, description="Filtrar por año"),
@@ -1909,7 +2134,8 @@ async def get_ventas_por_material(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/clientes-filtro")
-async def get_clientes_filtro(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_clientes_filtro(db: Session = Depends(get_db)):
     """Obtiene lista de clientes para filtros (compatible con frontend)"""
     try:
         db_service = DatabaseService(db)
@@ -1921,7 +2147,8 @@ async def get_clientes_filtro(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/materiales-filtro")
-async def get_materiales_filtro(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_materiales_filtro(db: Session = Depends(get_db)):
     """Obtiene lista de materiales para filtros (compatible con frontend)"""
     try:
         db_service = DatabaseService(db)
@@ -1933,7 +2160,8 @@ async def get_materiales_filtro(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/archivos-procesados")
-async def get_archivos_procesados(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_archivos_procesados(db: Session = Depends(get_db)):
     """Obtiene lista de archivos procesados (compatible con frontend)"""
     try:
         db_service = DatabaseService(db)
@@ -1945,7 +2173,8 @@ async def get_archivos_procesados(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/data-summary")
-async def get_data_summary(db: Session = Depends(get_db)):
+@endpoint_class("read")
+def get_data_summary(db: Session = Depends(get_db)):
     """Obtiene resumen de datos disponibles (compatible con frontend)"""
     try:
         db_service = DatabaseService(db)
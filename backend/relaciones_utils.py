@@ -0,0 +1,116 @@
+"""
+Cálculo vectorizado de relaciones entre facturación, cobranza y pedidos
+Compartido por ImmermexDataProcessor (data_processor.py), ImmermexExcelProcessor
+(excel_processor.py) y PedidosService (services/pedidos_service.py)
+"""
+
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+def calcular_relaciones_cobranza(facturacion: pd.DataFrame, cobranza: pd.DataFrame) -> pd.DataFrame:
+    """
+    Agrega a cada factura lo cobrado según los pagos relacionados por UUID
+    
+    Los pagos se agrupan una vez por uuid_factura_relacionada (suma de
+    importe_pagado y fecha_pago más reciente) y el resultado se une a las
+    facturas por uuid_factura; dias_cobro y saldo_pendiente se calculan por
+    columna.
+    
+    Args:
+        facturacion: DataFrame de facturación
+        cobranza: DataFrame de cobranza
+    
+    Returns:
+        Copia de facturación con importe_cobrado, fecha_cobro, dias_cobro y
+        saldo_pendiente
+    """
+    pagos = cobranza[['uuid_factura_relacionada', 'importe_pagado', 'fecha_pago']]
+    uuid_pago = pagos['uuid_factura_relacionada']
+    pagos = pagos[uuid_pago.notna() & (uuid_pago != '')]
+    
+    por_uuid = pagos.groupby('uuid_factura_relacionada').agg(
+        importe_cobrado=('importe_pagado', 'sum'),
+        fecha_cobro=('fecha_pago', 'max')
+    )
+    
+    # Unión por UUID (reindex tolera llaves de distinto tipo); facturas sin
+    # UUID o sin pagos quedan sin coincidencia
+    uuid_factura = facturacion['uuid_factura']
+    claves = uuid_factura.where(uuid_factura != '')
+    relacion = por_uuid.reindex(claves.values).set_axis(facturacion.index)
+    
+    facturacion_rel = facturacion.copy()
+    facturacion_rel['importe_cobrado'] = relacion['importe_cobrado'].fillna(0.0).astype(float)
+    facturacion_rel['fecha_cobro'] = pd.to_datetime(relacion['fecha_cobro'], errors='coerce')
+    
+    # Días de cobro (0 si falta alguna fecha o si el pago es anterior a la factura)
+    fecha_factura = pd.to_datetime(facturacion_rel['fecha_factura'], errors='coerce')
+    dias = (facturacion_rel['fecha_cobro'] - fecha_factura).dt.days
+    facturacion_rel['dias_cobro'] = dias.clip(lower=0).fillna(0).astype(int)
+    
+    # Recalcular saldo pendiente
+    facturacion_rel['saldo_pendiente'] = facturacion_rel['monto_total'] - facturacion_rel['importe_cobrado']
+    
+    logger.info(f"Relaciones calculadas: {int(relacion['importe_cobrado'].notna().sum())} de {len(facturacion_rel)} facturas con pagos")
+    return facturacion_rel
+
+def propagar_datos_factura(facturacion: pd.DataFrame, pedidos: pd.DataFrame, folios: pd.Series = None,
+                           campos=('dias_credito', 'fecha_factura'), solo_faltantes=()) -> tuple:
+    """
+    Propaga a los pedidos los campos de la factura con el mismo folio
+    
+    La factura es la fuente de verdad: por cada campo se toma el último valor
+    no vacío de cada folio_factura de facturación y se une a los pedidos por
+    folio. Los pedidos sin valor lo reciben (asignados) y los que tienen un
+    valor distinto se corrigen, salvo que el campo esté en solo_faltantes.
+    
+    Args:
+        facturacion: DataFrame con folio_factura y los campos a propagar
+        pedidos: DataFrame de pedidos
+        folios: folio de factura de cada pedido (por defecto pedidos['folio_factura'])
+        campos: columnas a propagar
+        solo_faltantes: campos que solo se asignan si el pedido no los trae
+    
+    Returns:
+        tuple: (copia de pedidos con los campos propagados,
+                {campo: {'asignados': n, 'corregidos': n}})
+    """
+    if folios is None:
+        folios = pedidos['folio_factura']
+    # Los folios vacíos no deben coincidir con ninguna factura
+    claves = folios.astype(object).where(folios.notna() & (folios != ''), None).values
+    
+    pedidos_rel = pedidos.copy()
+    conteos = {}
+    
+    for campo in campos:
+        if campo in facturacion.columns:
+            fuente = facturacion[['folio_factura', campo]]
+            folio_factura = fuente['folio_factura']
+            fuente = fuente[folio_factura.notna() & (folio_factura != '') & fuente[campo].notna()]
+            por_folio = fuente.drop_duplicates('folio_factura', keep='last').set_index('folio_factura')[campo]
+        else:
+            por_folio = pd.Series(dtype=object)
+        
+        # Unión por folio (reindex tolera llaves de distinto tipo, p. ej. int y float)
+        valor_factura = por_folio.reindex(claves).set_axis(pedidos.index)
+        actual = pedidos_rel[campo] if campo in pedidos_rel.columns else pd.Series(None, index=pedidos.index, dtype=valor_factura.dtype)
+        
+        con_factura = valor_factura.notna()
+        asignar = con_factura & actual.isna()
+        corregir = con_factura & actual.notna() & (actual != valor_factura)
+        if campo in solo_faltantes:
+            corregir = pd.Series(False, index=pedidos.index)
+        
+        propagado = actual.mask(asignar | corregir, valor_factura)
+        if pd.api.types.is_integer_dtype(actual.dtype):
+            propagado = propagado.astype(actual.dtype)
+        pedidos_rel[campo] = propagado
+        
+        conteos[campo] = {'asignados': int(asignar.sum()), 'corregidos': int(corregir.sum())}
+        logger.info(f"{campo} desde facturación: {conteos[campo]['asignados']} asignados, "
+                    f"{conteos[campo]['corregidos']} corregidos ({len(por_folio)} folios con valor)")
+    
+    return pedidos_rel, conteos
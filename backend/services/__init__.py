@@ -6,10 +6,14 @@ from .facturacion_service import FacturacionService
 from .cobranza_service import CobranzaService
 from .pedidos_service import PedidosService
 from .kpi_aggregator import KPIAggregator
+from .bulk_ingestion_service import BulkIngestionService
+from .rollup_service import RollupService
 
 __all__ = [
     'FacturacionService',
     'CobranzaService', 
     'PedidosService',
-    'KPIAggregator'
+    'KPIAggregator',
+    'BulkIngestionService',
+    'RollupService'
 ]
@@ -0,0 +1,119 @@
+"""
+Servicio de ingesta masiva para facturación, cobranza, anticipos y pedidos
+Escribe DataFrames normalizados sin construir objetos ORM
+"""
+
+from sqlalchemy.orm import Session
+from sqlalchemy import Integer, Float, DateTime, Date, Boolean
+import pandas as pd
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+class BulkIngestionService:
+    """
+    Inserta filas por lotes dentro de la transacción de la sesión.
+    
+    En PostgreSQL usa COPY FROM STDIN; en otros motores (SQLite) usa executemany
+    de SQLAlchemy Core. No hace commit: la transacción la cierra el llamador.
+    """
+    
+    # Filas por COPY / executemany
+    CHUNK_SIZE = 5000
+    
+    # Marcador de NULL en el CSV enviado a COPY
+    NULL_MARKER = '\\N'
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def is_postgresql(self) -> bool:
+        """Indica si la sesión está conectada a PostgreSQL"""
+        return self.db.get_bind().dialect.name == 'postgresql'
+    
+    def insert_dataframe(self, model, df: pd.DataFrame) -> int:
+        """Inserta un DataFrame en la tabla del modelo y retorna las filas insertadas"""
+        if df is None or df.empty:
+            return 0
+        
+        df = self._normalize_dataframe(model, df)
+        
+        # Asegurar que lo pendiente en la sesión quede antes de la carga masiva
+        self.db.flush()
+        
+        if self.is_postgresql():
+            self._copy_dataframe(model, df)
+        else:
+            self._executemany_dataframe(model, df)
+        
+        logger.info(f"Ingesta masiva: {len(df)} filas en {model.__tablename__}")
+        return len(df)
+    
+    def insert_records(self, model, records: list) -> int:
+        """Inserta una lista de diccionarios ya normalizados"""
+        if not records:
+            return 0
+        return self.insert_dataframe(model, pd.DataFrame.from_records(records))
+    
+    def _normalize_dataframe(self, model, df: pd.DataFrame) -> pd.DataFrame:
+        """Restringe a columnas del modelo, aplica defaults de Python y ajusta tipos"""
+        table = model.__table__
+        columnas = [col for col in table.columns if col.key in df.columns]
+        df = df[[col.key for col in columnas]].copy()
+        
+        # Defaults del lado de Python (created_at, updated_at, importe_cobrado, ...)
+        for col in table.columns:
+            default = col.default
+            if col.key in df.columns or default is None:
+                continue
+            if default.is_callable:
+                df[col.key] = default.arg(None)
+            elif default.is_scalar:
+                df[col.key] = default.arg
+        
+        for col in table.columns:
+            if col.key not in df.columns:
+                continue
+            if isinstance(col.type, Boolean):
+                continue
+            if isinstance(col.type, Integer):
+                df[col.key] = pd.to_numeric(df[col.key], errors='coerce').round().astype('Int64')
+            elif isinstance(col.type, Float):
+                df[col.key] = pd.to_numeric(df[col.key], errors='coerce')
+            elif isinstance(col.type, (DateTime, Date)):
+                df[col.key] = pd.to_datetime(df[col.key], errors='coerce')
+        
+        return df
+    
+    def _copy_dataframe(self, model, df: pd.DataFrame):
+        """Carga el DataFrame con COPY FROM STDIN por bloques"""
+        columnas = ', '.join(f'"{col}"' for col in df.columns)
+        copy_sql = (
+            f"COPY {model.__tablename__} ({columnas}) FROM STDIN "
+            f"WITH (FORMAT csv, NULL '{self.NULL_MARKER}')"
+        )
+        
+        # Conexión DBAPI de la transacción actual de la sesión
+        cursor = self.db.connection().connection.cursor()
+        try:
+            for inicio in range(0, len(df), self.CHUNK_SIZE):
+                buffer = io.StringIO()
+                df.iloc[inicio:inicio + self.CHUNK_SIZE].to_csv(
+                    buffer, header=False, index=False, na_rep=self.NULL_MARKER
+                )
+                buffer.seek(0)
+                cursor.copy_expert(copy_sql, buffer)
+        finally:
+            cursor.close()
+    
+    def _executemany_dataframe(self, model, df: pd.DataFrame):
+        """Inserta el DataFrame con executemany de SQLAlchemy Core por bloques"""
+        df = df.astype(object).where(df.notna(), None)
+        for inicio in range(0, len(df), self.CHUNK_SIZE):
+            registros = df.iloc[inicio:inicio + self.CHUNK_SIZE].to_dict('records')
+            for registro in registros:
+                for key, value in registro.items():
+                    if isinstance(value, pd.Timestamp):
+                        registro[key] = value.to_pydatetime()
+            self.db.execute(model.__table__.insert(), registros)
@@ -3,8 +3,11 @@ Servicio especializado para operaciones de cobranza
 """
 
 from sqlalchemy.orm import Session
+from sqlalchemy import func, case, and_, or_
 from database import Cobranza
 from utils.validators import DataValidator
+from .bulk_ingestion_service import BulkIngestionService
+import pandas as pd
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,35 +18,38 @@ class CobranzaService:
     def __init__(self, db: Session):
         self.db = db
     
-    def save_cobranzas(self, cobranzas_data: list, archivo_id: int) -> int:
-        """Guarda datos de cobranza"""
-        count = 0
+    def save_cobranzas(self, cobranzas_data, archivo_id: int) -> int:
+        """
+        Guarda datos de cobranza con ingesta masiva (sin objetos ORM).
         
-        for cobranza_data in cobranzas_data:
-            try:
-                fecha_pago = DataValidator.safe_date(cobranza_data.get('fecha_pago'))
-                
-                cobranza = Cobranza(
-                    fecha_pago=fecha_pago,
-                    serie_pago=DataValidator.safe_string(cobranza_data.get('serie_pago', '')),
-                    folio_pago=DataValidator.safe_string(cobranza_data.get('folio_pago', '')),
-                    cliente=DataValidator.safe_string(cobranza_data.get('cliente', '')),
-                    moneda=DataValidator.safe_string(cobranza_data.get('moneda', 'MXN')),
-                    tipo_cambio=DataValidator.safe_float(cobranza_data.get('tipo_cambio', 1.0)),
-                    forma_pago=DataValidator.safe_string(cobranza_data.get('forma_pago', '')),
-                    parcialidad=DataValidator.safe_int(cobranza_data.get('numero_parcialidades', cobranza_data.get('parcialidad', 1))),
-                    importe_pagado=DataValidator.safe_float(cobranza_data.get('importe_pagado', 0)),
-                    uuid_factura_relacionada=DataValidator.safe_string(cobranza_data.get('uuid_relacionado', cobranza_data.get('uuid_factura_relacionada', ''))),
-                    archivo_id=archivo_id
-                )
-                self.db.add(cobranza)
-                count += 1
-            except Exception as e:
-                logger.warning(f"Error guardando cobranza: {str(e)}")
-                continue
+        cobranzas_data es un DataFrame con columnas estándar (o una lista de
+        diccionarios); las conversiones se aplican por columna.
+        """
+        df = DataValidator.as_frame(cobranzas_data)
+        if df.empty:
+            return 0
+        
+        def columna(*nombres):
+            return DataValidator.get_column(df, *nombres)
+        
+        registros = pd.DataFrame({
+            'fecha_pago': DataValidator.safe_date_series(columna('fecha_pago')),
+            'serie_pago': DataValidator.safe_string_series(columna('serie_pago')),
+            'folio_pago': DataValidator.safe_string_series(columna('folio_pago')),
+            'cliente': DataValidator.safe_string_series(columna('cliente')),
+            'moneda': DataValidator.safe_string_series(columna('moneda'), 'MXN'),
+            'tipo_cambio': DataValidator.safe_float_series(columna('tipo_cambio'), 1.0),
+            'forma_pago': DataValidator.safe_string_series(columna('forma_pago')),
+            'parcialidad': DataValidator.safe_int_series(columna('numero_parcialidades', 'parcialidad'), 1),
+            'importe_pagado': DataValidator.safe_float_series(columna('importe_pagado')),
+            'uuid_factura_relacionada': DataValidator.safe_string_series(
+                columna('uuid_relacionado', 'uuid_factura_relacionada')
+            ),
+            'archivo_id': archivo_id
+        })
         
         # No hacer commit aquí - dejar que el método principal maneje la transacción
-        return count
+        return BulkIngestionService(self.db).insert_dataframe(Cobranza, registros)
     
     def get_cobranzas_validas(self, cobranzas: list) -> list:
         """Filtra cobranzas válidas (excluye totales)"""
@@ -62,6 +68,60 @@ class CobranzaService:
             if c.uuid_factura_relacionada in facturas_uuids
         ]
     
+    def _folio_pago_valido(self):
+        """Condición SQL equivalente a DataValidator.validate_folio sobre folio_pago"""
+        folio = func.lower(func.trim(Cobranza.folio_pago))
+        return and_(
+            Cobranza.folio_pago.isnot(None),
+            folio.notin_(['', 'nan', 'none', 'null', 'nat']),
+            ~folio.like('total%'),
+            ~folio.like('suma%'),
+            ~folio.like('subtotal%')
+        )
+    
+    def get_resumen_cobranza(self, uuids_facturas_query) -> dict:
+        """
+        Totales de cobranza calculados en la base de datos.
+        
+        uuids_facturas_query es una subconsulta con los UUIDs de las facturas
+        consideradas para la cobranza relacionada.
+        """
+        relacionada = Cobranza.uuid_factura_relacionada.in_(uuids_facturas_query)
+        resumen = self.db.query(
+            func.sum(Cobranza.importe_pagado).label('cobranza_general_total'),
+            func.sum(case((relacionada, Cobranza.importe_pagado), else_=0)).label('cobranza_total'),
+            func.sum(case(
+                (and_(relacionada, Cobranza.importe_pagado > 0), Cobranza.importe_pagado / 1.16),
+                else_=0
+            )).label('cobranza_sin_iva')
+        ).filter(self._folio_pago_valido()).one()
+        
+        return {
+            'cobranza_total': resumen.cobranza_total or 0,
+            'cobranza_general_total': resumen.cobranza_general_total or 0,
+            'cobranza_sin_iva': resumen.cobranza_sin_iva or 0
+        }
+    
+    def get_cobranzas_para_expectativa(self, uuids_facturas=None, fecha_desde=None, fecha_hasta=None) -> list:
+        """
+        Obtiene solo UUID, fecha e importe de las cobranzas que pueden influir en la
+        expectativa: las de las facturas indicadas y las pagadas dentro del rango.
+        """
+        condiciones = []
+        if uuids_facturas is not None:
+            condiciones.append(Cobranza.uuid_factura_relacionada.in_(uuids_facturas))
+        if fecha_desde is not None and fecha_hasta is not None:
+            condiciones.append(Cobranza.fecha_pago.between(fecha_desde, fecha_hasta))
+        
+        if not condiciones:
+            return []
+        
+        return self.db.query(
+            Cobranza.uuid_factura_relacionada,
+            Cobranza.fecha_pago,
+            Cobranza.importe_pagado
+        ).filter(or_(*condiciones)).all()
+    
     def calculate_cobranza_proporcional(self, facturas: list, pedidos: list, cobranzas: list) -> float:
         """Calcula cobranza proporcional para pedidos filtrados"""
         cobranza_total = 0
@@ -3,10 +3,12 @@ Servicio especializado para operaciones de facturación
 """
 
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, case, and_
 from database import Facturacion
 from utils.validators import DataValidator
+from .bulk_ingestion_service import BulkIngestionService
 from datetime import datetime, timedelta
+import pandas as pd
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,45 +16,49 @@ logger = logging.getLogger(__name__)
 class FacturacionService:
     """Servicio para operaciones relacionadas con facturación"""
     
+    # Máximo de valores por cláusula IN en búsquedas por folio
+    IN_CHUNK_SIZE = 500
+    
     def __init__(self, db: Session):
         self.db = db
     
-    def save_facturas(self, facturas_data: list, archivo_id: int) -> int:
-        """Guarda datos de facturación"""
-        count = 0
+    def save_facturas(self, facturas_data, archivo_id: int) -> int:
+        """
+        Guarda datos de facturación con ingesta masiva (sin objetos ORM).
         
-        for factura_data in facturas_data:
-            try:
-                fecha_factura = DataValidator.safe_date(factura_data.get('fecha_factura'))
-                
-                factura = Facturacion(
-                    serie_factura=DataValidator.safe_string(factura_data.get('serie_factura', '')),
-                    folio_factura=DataValidator.safe_int(factura_data.get('folio_factura', 0)),
-                    fecha_factura=fecha_factura,
-                    cliente=DataValidator.safe_string(factura_data.get('cliente', '')),
-                    agente=DataValidator.safe_string(factura_data.get('agente', '')),
-                    monto_neto=DataValidator.safe_float(factura_data.get('monto_neto', 0)),
-                    monto_total=DataValidator.safe_float(factura_data.get('monto_total', 0)),
-                    saldo_pendiente=DataValidator.safe_float(factura_data.get('saldo_pendiente', 0)),
-                    dias_credito=DataValidator.safe_int(factura_data.get('dias_credito', 30)),
-                    uuid_factura=DataValidator.safe_string(factura_data.get('uuid_factura', '')),
-                    archivo_id=archivo_id,
-                    mes=fecha_factura.month if fecha_factura else None,
-                    año=fecha_factura.year if fecha_factura else None
-                )
-                self.db.add(factura)
-                count += 1
-            except Exception as e:
-                logger.warning(f"Error guardando factura: {str(e)}")
-                continue
+        facturas_data es un DataFrame con columnas estándar (o una lista de
+        diccionarios); las conversiones se aplican por columna.
+        """
+        df = DataValidator.as_frame(facturas_data)
+        if df.empty:
+            return 0
+        
+        def columna(nombre):
+            return DataValidator.get_column(df, nombre)
+        
+        fecha_factura = DataValidator.safe_date_series(columna('fecha_factura'))
+        
+        registros = pd.DataFrame({
+            'serie_factura': DataValidator.safe_string_series(columna('serie_factura')),
+            'folio_factura': DataValidator.safe_int_series(columna('folio_factura'), 0),
+            'fecha_factura': fecha_factura,
+            'cliente': DataValidator.safe_string_series(columna('cliente')),
+            'agente': DataValidator.safe_string_series(columna('agente')),
+            'monto_neto': DataValidator.safe_float_series(columna('monto_neto')),
+            'monto_total': DataValidator.safe_float_series(columna('monto_total')),
+            'saldo_pendiente': DataValidator.safe_float_series(columna('saldo_pendiente')),
+            'dias_credito': DataValidator.safe_int_series(columna('dias_credito'), 30),
+            'uuid_factura': DataValidator.safe_string_series(columna('uuid_factura')),
+            'archivo_id': archivo_id,
+            'mes': fecha_factura.dt.month,
+            'año': fecha_factura.dt.year
+        })
         
         # No hacer commit aquí - dejar que el método principal maneje la transacción
-        return count
+        return BulkIngestionService(self.db).insert_dataframe(Facturacion, registros)
     
-    def get_facturas_by_filtros(self, filtros: dict = None):
-        """Obtiene facturas aplicando filtros"""
-        query = self.db.query(Facturacion)
-        
+    def _apply_filtros(self, query, filtros: dict = None):
+        """Aplica filtros de mes/año/pedidos a una consulta sobre facturación"""
         if filtros:
             # Solo aplicar filtro de mes si también hay año seleccionado
             if filtros.get('mes') and filtros.get('año'):
@@ -68,7 +74,56 @@ class FacturacionService:
                 if folios_pedidos:
                     query = query.filter(Facturacion.folio_factura.in_(folios_pedidos))
         
-        return query.all()
+        return query
+    
+    def _folio_valido(self):
+        """Condición SQL equivalente a DataValidator.validate_folio para folios numéricos"""
+        return and_(Facturacion.folio_factura.isnot(None), Facturacion.folio_factura != 0)
+    
+    def get_facturas_by_filtros(self, filtros: dict = None):
+        """Obtiene facturas aplicando filtros"""
+        return self._apply_filtros(self.db.query(Facturacion), filtros).all()
+    
+    def get_resumen_facturacion(self, filtros: dict = None) -> dict:
+        """Totales de facturación calculados en la base de datos"""
+        valida = self._folio_valido()
+        query = self.db.query(
+            func.count().label('total_registros'),
+            func.sum(case((valida, 1), else_=0)).label('total_facturas'),
+            func.sum(case((valida, Facturacion.monto_total), else_=0)).label('facturacion_total'),
+            func.sum(case((valida, Facturacion.monto_neto), else_=0)).label('facturacion_sin_iva'),
+            func.count(func.distinct(case(
+                (and_(valida, Facturacion.cliente != ''), Facturacion.cliente)
+            ))).label('clientes_unicos')
+        )
+        resumen = self._apply_filtros(query, filtros).one()
+        
+        return {
+            'total_registros': resumen.total_registros or 0,
+            'total_facturas': int(resumen.total_facturas or 0),
+            'facturacion_total': resumen.facturacion_total or 0,
+            'facturacion_sin_iva': resumen.facturacion_sin_iva or 0,
+            'clientes_unicos': resumen.clientes_unicos or 0
+        }
+    
+    def get_uuids_query(self, filtros: dict = None, solo_validas: bool = True):
+        """Subconsulta (SELECT) con los UUIDs de las facturas que cumplen los filtros"""
+        query = self.db.query(Facturacion.uuid_factura).filter(
+            Facturacion.uuid_factura.isnot(None),
+            Facturacion.uuid_factura != ''
+        )
+        if solo_validas:
+            query = query.filter(self._folio_valido())
+        return self._apply_filtros(query, filtros).statement
+    
+    def get_facturas_resumidas_by_filtros(self, filtros: dict = None) -> list:
+        """Obtiene solo folio, UUID y monto de las facturas filtradas"""
+        query = self.db.query(
+            Facturacion.folio_factura,
+            Facturacion.uuid_factura,
+            Facturacion.monto_total
+        )
+        return self._apply_filtros(query, filtros).all()
     
     def get_facturas_validas(self, facturas: list) -> list:
         """Filtra facturas válidas (excluye totales)"""
@@ -77,46 +132,89 @@ class FacturacionService:
             if DataValidator.validate_folio(f.folio_factura)
         ]
     
-    def get_facturas_related_to_pedidos(self, pedidos_filtrados: list) -> list:
-        """Obtiene facturas relacionadas con pedidos filtrados"""
-        facturas_relacionadas = []
+    def get_facturas_por_folio(self, folios) -> dict:
+        """
+        Construye un índice folio -> [facturas] resolviendo todos los folios con
+        consultas IN por bloques. El índice puede reutilizarse entre llamadas.
+        """
+        folios_unicos = list(dict.fromkeys(folio for folio in folios if folio))
+        facturas_por_folio = {}
         
-        for pedido in pedidos_filtrados:
-            if pedido.folio_factura:
-                facturas_folio = self.db.query(Facturacion).filter(
-                    Facturacion.folio_factura == pedido.folio_factura
-                ).all()
-                facturas_relacionadas.extend(facturas_folio)
+        for inicio in range(0, len(folios_unicos), self.IN_CHUNK_SIZE):
+            bloque = folios_unicos[inicio:inicio + self.IN_CHUNK_SIZE]
+            for factura in self.db.query(Facturacion).filter(Facturacion.folio_factura.in_(bloque)).all():
+                facturas_por_folio.setdefault(factura.folio_factura, []).append(factura)
+        
+        return facturas_por_folio
+    
+    def get_facturas_related_to_pedidos(self, pedidos_filtrados: list, facturas_por_folio: dict = None) -> list:
+        """
+        Obtiene facturas relacionadas con pedidos filtrados (sin duplicados por UUID).
+        Si no se recibe el índice folio -> facturas, se construye en lote.
+        """
+        if facturas_por_folio is None:
+            facturas_por_folio = self.get_facturas_por_folio(p.folio_factura for p in pedidos_filtrados)
         
-        # Eliminar duplicados por UUID
+        # Eliminar duplicados por UUID en la misma pasada
         facturas_unicas = {}
-        for factura in facturas_relacionadas:
-            if factura.uuid_factura:
-                facturas_unicas[factura.uuid_factura] = factura
+        for pedido in pedidos_filtrados:
+            if not pedido.folio_factura:
+                continue
+            for factura in facturas_por_folio.get(pedido.folio_factura, []):
+                if factura.uuid_factura:
+                    facturas_unicas[factura.uuid_factura] = factura
         
         return list(facturas_unicas.values())
     
+    def _sumar_aging(self, aging: dict, fecha_factura, dias_credito, monto_pendiente, hoy: datetime):
+        """Acumula un monto pendiente en su rango de antigüedad"""
+        fecha_vencimiento = fecha_factura + timedelta(days=dias_credito or 30)
+        dias_vencidos = (hoy - fecha_vencimiento).days
+        
+        if dias_vencidos <= 30:
+            aging["0-30 dias"] += monto_pendiente
+        elif dias_vencidos <= 60:
+            aging["31-60 dias"] += monto_pendiente
+        elif dias_vencidos <= 90:
+            aging["61-90 dias"] += monto_pendiente
+        else:
+            aging["90+ dias"] += monto_pendiente
+    
     def calculate_aging_cartera(self, facturas: list) -> dict:
         """Calcula aging de cartera por monto pendiente"""
         aging = {"0-30 dias": 0, "31-60 dias": 0, "61-90 dias": 0, "90+ dias": 0}
+        hoy = datetime.now()
         
         for factura in facturas:
             if factura.fecha_factura:
-                dias_credito = factura.dias_credito or 30
-                fecha_vencimiento = factura.fecha_factura + timedelta(days=dias_credito)
-                dias_vencidos = (datetime.now() - fecha_vencimiento).days
-                
                 monto_pendiente = factura.monto_total - (getattr(factura, 'importe_cobrado', 0) or 0)
                 
                 if monto_pendiente > 0:
-                    if dias_vencidos <= 30:
-                        aging["0-30 dias"] += monto_pendiente
-                    elif dias_vencidos <= 60:
-                        aging["31-60 dias"] += monto_pendiente
-                    elif dias_vencidos <= 90:
-                        aging["61-90 dias"] += monto_pendiente
-                    else:
-                        aging["90+ dias"] += monto_pendiente
+                    self._sumar_aging(aging, factura.fecha_factura, factura.dias_credito, monto_pendiente, hoy)
+        
+        return aging
+    
+    def calculate_aging_cartera_by_filtros(self, filtros: dict = None) -> dict:
+        """Calcula aging de cartera agrupando en SQL por fecha y días de crédito"""
+        aging = {"0-30 dias": 0, "31-60 dias": 0, "61-90 dias": 0, "90+ dias": 0}
+        hoy = datetime.now()
+        
+        monto_pendiente = Facturacion.monto_total - func.coalesce(Facturacion.importe_cobrado, 0)
+        query = self.db.query(
+            Facturacion.fecha_factura,
+            Facturacion.dias_credito,
+            func.sum(monto_pendiente).label('monto_pendiente')
+        ).filter(
+            self._folio_valido(),
+            Facturacion.fecha_factura.isnot(None),
+            monto_pendiente > 0
+        )
+        query = self._apply_filtros(query, filtros).group_by(
+            Facturacion.fecha_factura, Facturacion.dias_credito
+        )
+        
+        for fila in query.all():
+            self._sumar_aging(aging, fila.fecha_factura, fila.dias_credito, fila.monto_pendiente, hoy)
         
         return aging
     
@@ -133,3 +231,12 @@ class FacturacionService:
         # Ordenar y tomar top 10
         sorted_clientes = sorted(clientes_facturacion.items(), key=lambda x: x[1], reverse=True)
         return dict(sorted_clientes[:10])
+    
+    def calculate_top_clientes_by_filtros(self, filtros: dict = None, limite: int = 10) -> dict:
+        """Calcula top clientes por facturación con GROUP BY en SQL"""
+        cliente = func.coalesce(func.nullif(Facturacion.cliente, ''), 'Sin cliente')
+        total = func.sum(Facturacion.monto_total)
+        query = self.db.query(cliente.label('cliente'), total.label('total')).filter(self._folio_valido())
+        query = self._apply_filtros(query, filtros).group_by(cliente).order_by(total.desc()).limit(limite)
+        
+        return {fila.cliente: fila.total or 0 for fila in query.all()}
@@ -6,9 +6,14 @@ from sqlalchemy.orm import Session
 from .facturacion_service import FacturacionService
 from .cobranza_service import CobranzaService
 from .pedidos_service import PedidosService
-from database import CFDIRelacionado, Cobranza
+from .rollup_service import RollupService
+from database import CFDIRelacionado
+from sqlalchemy import func
 from utils.logging_config import log_performance
-from utils.cache import cache_kpis, invalidate_data_cache
+from utils.cache import cache_kpis, cache_graficos, invalidate_data_cache
+from compras_v2_filtros import rango_mes_año
+from datetime import datetime, timedelta
+import numpy as np
 import time
 import logging
 
@@ -22,38 +27,50 @@ class KPIAggregator:
         self.facturacion_service = FacturacionService(db)
         self.cobranza_service = CobranzaService(db)
         self.pedidos_service = PedidosService(db)
+        self.rollup_service = RollupService(db)
     
-    @cache_kpis(ttl=300)  # Cache por 5 minutos
+    def _usar_resumenes(self, filtros: dict = None) -> bool:
+        """
+        Los resúmenes mensuales sustituyen a las tablas base cuando no hay filtro
+        de pedidos y ya están poblados (datos cargados antes de existir caen en vivo).
+        """
+        if filtros and filtros.get('pedidos'):
+            return False
+        return self.rollup_service.has_data()
+    
+    @cache_kpis()  # Cache hasta que cambie la generación de datos (máx. 1 hora)
     def calculate_kpis(self, filtros: dict = None) -> dict:
         """
-        Calcula KPIs principales coordinando todos los servicios
+        Calcula KPIs principales coordinando todos los servicios.
+        
+        Los totales se agregan en la base de datos; a Python solo llegan escalares,
+        series cortas para gráficos y las filas necesarias para la expectativa.
         """
         start_time = time.time()
         
         try:
-            # Obtener datos base
-            facturas = self.facturacion_service.get_facturas_by_filtros(filtros)
-            cobranzas = self.db.query(Cobranza).all()
-            anticipos = self.db.query(CFDIRelacionado).all()
-            pedidos = self.pedidos_service.get_pedidos_by_filtros(filtros)
+            # Totales base: resúmenes mensuales si aplican, si no SQL sobre las tablas base
+            if self._usar_resumenes(filtros):
+                resumen_facturas = self.rollup_service.get_resumen_facturacion(filtros)
+            else:
+                resumen_facturas = self.facturacion_service.get_resumen_facturacion(filtros)
+            resumen_pedidos = self.pedidos_service.get_resumen_pedidos(filtros)
             
-            logger.info(f"Datos obtenidos - Facturas: {len(facturas)}, Pedidos: {len(pedidos)}, Cobranzas: {len(cobranzas)}")
+            logger.info(f"Datos agregados - Facturas: {resumen_facturas['total_registros']}, Pedidos: {resumen_pedidos['total_registros']}")
             
             # Si no hay facturas, retornar KPIs por defecto
-            if not facturas:
+            if not resumen_facturas['total_registros']:
                 logger.warning("No se encontraron facturas, retornando KPIs por defecto")
                 return self._get_default_kpis()
             
             # Calcular KPIs según el tipo de filtro
             if filtros and filtros.get('pedidos'):
-                kpis_result = self._calculate_kpis_filtered_by_pedidos(facturas, pedidos, cobranzas, anticipos, filtros)
+                kpis_result = self._calculate_kpis_filtered_by_pedidos(resumen_pedidos, filtros)
                 # La expectativa de cobranza ya se calculó dentro de _calculate_kpis_filtered_by_pedidos
             else:
-                kpis_result = self._calculate_kpis_general(facturas, pedidos, cobranzas, anticipos)
+                kpis_result = self._calculate_kpis_general(resumen_facturas, resumen_pedidos, filtros)
                 # Para KPIs generales, calcular expectativa de cobranza sin filtro proporcional
-                kpis_result['expectativa_cobranza'] = self._calculate_expectativa_cobranza(
-                    facturas, pedidos, anticipos, cobranzas, aplicar_filtro_proporcional=False
-                )
+                kpis_result['expectativa_cobranza'] = self._calculate_expectativa_general(filtros)
             
             return kpis_result
                 
@@ -64,23 +81,68 @@ class KPIAggregator:
             duration = time.time() - start_time
             log_performance("calculate_kpis", duration, f"filtros={filtros}")
     
-    def _calculate_kpis_filtered_by_pedidos(self, facturas: list, pedidos: list, cobranzas: list, anticipos: list, filtros: dict) -> dict:
+    def _sum_anticipos(self, uuids_facturas: list = None) -> float:
+        """Suma anticipos en SQL, opcionalmente solo los de las facturas indicadas"""
+        query = self.db.query(func.sum(CFDIRelacionado.importe_relacion))
+        if uuids_facturas is not None:
+            query = query.filter(CFDIRelacionado.uuid_factura_relacionada.in_(uuids_facturas))
+        return query.scalar() or 0
+    
+    def _calculate_costo_unitario_promedio(self, filtros: dict = None) -> float:
+        """Calcula costo unitario promedio ponderado por kg desde compras_v2"""
+        try:
+            from database import ComprasV2Materiales, ComprasV2
+
+            # Obtener costo promedio ponderado desde compras_v2
+            costo_query = self.db.query(
+                func.sum(ComprasV2Materiales.costo_total_con_iva).label('total_costo'),
+                func.sum(ComprasV2Materiales.kg).label('total_kg')
+            ).join(
+                ComprasV2, ComprasV2.id == ComprasV2Materiales.compra_id
+            ).filter(
+                ComprasV2Materiales.kg > 0,
+                ComprasV2Materiales.costo_total_con_iva > 0
+            )
+
+            # Aplicar filtros de fecha si existen
+            rango = rango_mes_año(filtros.get('mes'), filtros.get('año')) if filtros else None
+            if rango:
+                costo_query = costo_query.filter(
+                    ComprasV2.fecha_pedido >= rango[0],
+                    ComprasV2.fecha_pedido < rango[1]
+                )
+
+            costo_result = costo_query.first()
+
+            if costo_result and costo_result.total_kg and costo_result.total_kg > 0:
+                return costo_result.total_costo / costo_result.total_kg
+            return 0
+
+        except Exception as e:
+            logger.warning(f"Error calculando costo unitario desde compras_v2: {str(e)}")
+            return 0
+    
+    def _calculate_kpis_filtered_by_pedidos(self, resumen_pedidos: dict, filtros: dict) -> dict:
         """Calcula KPIs cuando se filtra por pedidos específicos"""
         
-        # Obtener facturas relacionadas con pedidos
+        # Pedidos filtrados por material (conjunto acotado) y sus facturas
+        pedidos = self.pedidos_service.get_pedidos_by_filtros(filtros)
         facturas_pedidos = self.facturacion_service.get_facturas_related_to_pedidos(pedidos)
         
         # Calcular facturación desde pedidos
-        facturacion_total = sum(p.importe_sin_iva * 1.16 for p in pedidos if p.importe_sin_iva)
-        facturacion_sin_iva = sum(p.importe_sin_iva for p in pedidos if p.importe_sin_iva)
+        facturacion_sin_iva = resumen_pedidos['importe_sin_iva']
+        facturacion_total = facturacion_sin_iva * 1.16
         
         # Contar facturas únicas
-        folios_unicos = len(set(p.folio_factura for p in pedidos if p.folio_factura))
-        total_facturas = folios_unicos
+        total_facturas = resumen_pedidos['folios_unicos']
+        
+        # Solo las cobranzas de las facturas de estos pedidos afectan la expectativa proporcional
+        uuids_facturas = [f.uuid_factura for f in facturas_pedidos if f.uuid_factura]
+        cobranzas = self.cobranza_service.get_cobranzas_para_expectativa(uuids_facturas)
         
         # Calcular expectativa de cobranza primero para obtener cobranza_real consistente
         expectativa_cobranza = self._calculate_expectativa_cobranza(
-            facturas_pedidos, pedidos, anticipos, cobranzas, aplicar_filtro_proporcional=True
+            facturas_pedidos, pedidos, None, cobranzas, aplicar_filtro_proporcional=True
         )
         
         # Calcular cobranza_total sumando cobranza_real de todas las semanas
@@ -90,13 +152,7 @@ class KPIAggregator:
         )
         
         # Calcular anticipos relacionados
-        uuids_facturas = {f.uuid_factura for f in facturas_pedidos if f.uuid_factura and f.uuid_factura.strip()}
-        anticipos_relacionados = [
-            a for a in anticipos 
-            if a.uuid_factura_relacionada in uuids_facturas 
-            and a.uuid_factura_relacionada and a.uuid_factura_relacionada.strip()
-        ]
-        anticipos_total = sum(a.importe_relacion for a in anticipos_relacionados)
+        anticipos_total = self._sum_anticipos([u for u in uuids_facturas if u.strip()])
         
         # Calcular porcentajes
         porcentaje_cobrado = (cobranza_total / facturacion_total * 100) if facturacion_total > 0 else 0
@@ -104,46 +160,12 @@ class KPIAggregator:
         
         # Calcular métricas adicionales
         clientes_unicos = len(set(f.cliente for f in facturas_pedidos if f.cliente))
-        pedidos_unicos = len(set(p.pedido for p in pedidos if p.pedido))
-        toneladas_total = sum(p.kg for p in pedidos)
-        
-        # Calcular precio unitario promedio
-        precios_unitarios = [p.precio_unitario for p in pedidos if p.precio_unitario and p.precio_unitario > 0]
-        precio_unitario_promedio = sum(precios_unitarios) / len(precios_unitarios) if precios_unitarios else 0
+        pedidos_unicos = resumen_pedidos['pedidos_unicos']
+        toneladas_total = resumen_pedidos['kg_total']
+        precio_unitario_promedio = resumen_pedidos['precio_unitario_promedio']
         
         # Calcular costo unitario promedio desde compras_v2
-        try:
-            from database import ComprasV2Materiales, ComprasV2
-            from sqlalchemy import func
-
-            # Obtener costo promedio ponderado desde compras_v2
-            costo_query = self.db.query(
-                func.sum(ComprasV2Materiales.costo_total_con_iva).label('total_costo'),
-                func.sum(ComprasV2Materiales.kg).label('total_kg')
-            ).join(
-                ComprasV2, ComprasV2.id == ComprasV2Materiales.compra_id
-            ).filter(
-                ComprasV2Materiales.kg > 0,
-                ComprasV2Materiales.costo_total_con_iva > 0
-            )
-
-            # Aplicar filtros de fecha si existen
-            if filtros and filtros.get('año'):
-                from sqlalchemy import extract
-                costo_query = costo_query.filter(extract('year', ComprasV2.fecha_pedido) == filtros['año'])
-                if filtros.get('mes'):
-                    costo_query = costo_query.filter(extract('month', ComprasV2.fecha_pedido) == filtros['mes'])
-
-            costo_result = costo_query.first()
-
-            if costo_result and costo_result.total_kg and costo_result.total_kg > 0:
-                costo_unitario_promedio = costo_result.total_costo / costo_result.total_kg
-            else:
-                costo_unitario_promedio = 0
-
-        except Exception as e:
-            logger.warning(f"Error calculando costo unitario desde compras_v2: {str(e)}")
-            costo_unitario_promedio = 0
+        costo_unitario_promedio = self._calculate_costo_unitario_promedio(filtros)
         
         # Calcular utilidad y margen por kg
         utilidad_por_kg = precio_unitario_promedio - costo_unitario_promedio
@@ -155,7 +177,7 @@ class KPIAggregator:
         # Calcular gráficos
         aging_cartera = self.facturacion_service.calculate_aging_cartera(facturas_pedidos)
         top_clientes = self.facturacion_service.calculate_top_clientes(facturas_pedidos)
-        consumo_material = self.pedidos_service.calculate_consumo_material(pedidos)
+        consumo_material = self.pedidos_service.calculate_consumo_material_by_filtros(filtros)
         
         return {
             "facturacion_total": round(facturacion_total, 2),
@@ -184,25 +206,27 @@ class KPIAggregator:
             "ciclo_efectivo": 0
         }
     
-    def _calculate_kpis_general(self, facturas: list, pedidos: list, cobranzas: list, anticipos: list) -> dict:
+    def _calculate_kpis_general(self, resumen_facturas: dict, resumen_pedidos: dict, filtros: dict = None) -> dict:
         """Calcula KPIs generales (sin filtros por pedidos)"""
         
-        # Filtrar facturas válidas
-        facturas_validas = self.facturacion_service.get_facturas_validas(facturas)
+        # Calcular facturación (solo facturas válidas)
+        facturacion_total = resumen_facturas['facturacion_total']
+        facturacion_sin_iva = resumen_facturas['facturacion_sin_iva']
         
-        # Calcular facturación
-        facturacion_total = sum(f.monto_total for f in facturas_validas)
-        facturacion_sin_iva = sum(f.monto_neto for f in facturas_validas)
+        usar_resumenes = self._usar_resumenes(filtros)
         
-        # Calcular cobranza
-        cobranzas_validas = self.cobranza_service.get_cobranzas_validas(cobranzas)
-        cobranzas_relacionadas = self.cobranza_service.get_cobranzas_relacionadas(facturas_validas, cobranzas_validas)
-        
-        cobranza_total = sum(c.importe_pagado for c in cobranzas_relacionadas)
-        cobranza_general_total = sum(c.importe_pagado for c in cobranzas_validas)
+        # Calcular cobranza relacionada con las facturas válidas filtradas
+        if usar_resumenes:
+            resumen_cobranza = self.rollup_service.get_resumen_cobranza(filtros)
+        else:
+            resumen_cobranza = self.cobranza_service.get_resumen_cobranza(
+                self.facturacion_service.get_uuids_query(filtros)
+            )
+        cobranza_total = resumen_cobranza['cobranza_total']
+        cobranza_general_total = resumen_cobranza['cobranza_general_total']
         
         # Calcular anticipos
-        anticipos_total = sum(a.importe_relacion for a in anticipos)
+        anticipos_total = self._sum_anticipos()
         
         # Calcular porcentajes
         porcentaje_cobrado = (cobranza_total / facturacion_total * 100) if facturacion_total > 0 else 0
@@ -210,60 +234,27 @@ class KPIAggregator:
         porcentaje_anticipos = (anticipos_total / facturacion_sin_iva * 100) if facturacion_sin_iva > 0 else 0
         
         # Calcular métricas adicionales
-        total_facturas = len(facturas_validas)
-        clientes_unicos = len(set(f.cliente for f in facturas_validas if f.cliente))
-        pedidos_unicos = len(set(p.pedido for p in pedidos if p.pedido))
-        toneladas_total = sum(p.kg for p in pedidos)
-        
-        # Calcular precio unitario promedio
-        precios_unitarios = [p.precio_unitario for p in pedidos if p.precio_unitario and p.precio_unitario > 0]
-        precio_unitario_promedio = sum(precios_unitarios) / len(precios_unitarios) if precios_unitarios else 0
+        total_facturas = resumen_facturas['total_facturas']
+        clientes_unicos = resumen_facturas['clientes_unicos']
+        pedidos_unicos = resumen_pedidos['pedidos_unicos']
+        toneladas_total = resumen_pedidos['kg_total']
+        precio_unitario_promedio = resumen_pedidos['precio_unitario_promedio']
         
         # Calcular costo unitario promedio desde compras_v2
-        try:
-            from database import ComprasV2Materiales, ComprasV2
-            from sqlalchemy import func
-
-            # Obtener costo promedio ponderado desde compras_v2
-            costo_query = self.db.query(
-                func.sum(ComprasV2Materiales.costo_total_con_iva).label('total_costo'),
-                func.sum(ComprasV2Materiales.kg).label('total_kg')
-            ).join(
-                ComprasV2, ComprasV2.id == ComprasV2Materiales.compra_id
-            ).filter(
-                ComprasV2Materiales.kg > 0,
-                ComprasV2Materiales.costo_total_con_iva > 0
-            )
-
-            # Aplicar filtros de fecha si existen
-            if filtros and filtros.get('año'):
-                from sqlalchemy import extract
-                costo_query = costo_query.filter(extract('year', ComprasV2.fecha_pedido) == filtros['año'])
-                if filtros.get('mes'):
-                    costo_query = costo_query.filter(extract('month', ComprasV2.fecha_pedido) == filtros['mes'])
-
-            costo_result = costo_query.first()
-
-            if costo_result and costo_result.total_kg and costo_result.total_kg > 0:
-                costo_unitario_promedio = costo_result.total_costo / costo_result.total_kg
-            else:
-                costo_unitario_promedio = 0
-
-        except Exception as e:
-            logger.warning(f"Error calculando costo unitario desde compras_v2: {str(e)}")
-            costo_unitario_promedio = 0
+        costo_unitario_promedio = self._calculate_costo_unitario_promedio(filtros)
         
         # Calcular utilidad y margen por kg
         utilidad_por_kg = precio_unitario_promedio - costo_unitario_promedio
         margen_por_kg = (utilidad_por_kg / precio_unitario_promedio * 100) if precio_unitario_promedio > 0 else 0
         
         # Calcular cobranza sin IVA
-        cobranza_sin_iva = sum(c.importe_pagado / 1.16 for c in cobranzas_relacionadas if c.importe_pagado > 0)
+        cobranza_sin_iva = resumen_cobranza['cobranza_sin_iva']
         
         # Calcular gráficos
-        aging_cartera = self.facturacion_service.calculate_aging_cartera(facturas_validas)
-        top_clientes = self.facturacion_service.calculate_top_clientes(facturas_validas)
-        consumo_material = self.pedidos_service.calculate_consumo_material(pedidos)
+        # El aging depende de la fecha actual, siempre se calcula en vivo
+        aging_cartera = self.facturacion_service.calculate_aging_cartera_by_filtros(filtros)
+        top_clientes = self._top_clientes(filtros, usar_resumenes=usar_resumenes)
+        consumo_material = self._consumo_material(filtros, usar_resumenes=usar_resumenes)
         
         return {
             "facturacion_total": round(facturacion_total, 2),
@@ -292,6 +283,59 @@ class KPIAggregator:
             "ciclo_efectivo": 0
         }
     
+    @cache_graficos()
+    def get_top_clientes(self, filtros: dict = None, limite: int = 10) -> dict:
+        """Top clientes por facturación para el gráfico, sin calcular el resto de KPIs"""
+        return self._top_clientes(filtros, limite, self._usar_resumenes(filtros))
+    
+    @cache_graficos()
+    def get_consumo_material(self, filtros: dict = None, limite: int = 10) -> dict:
+        """Consumo por material para el gráfico, sin calcular el resto de KPIs"""
+        return self._consumo_material(filtros, limite, self._usar_resumenes(filtros))
+    
+    def _top_clientes(self, filtros: dict = None, limite: int = 10, usar_resumenes: bool = False) -> dict:
+        if usar_resumenes:
+            return self.rollup_service.get_top_clientes(filtros, limite)
+        return self.facturacion_service.calculate_top_clientes_by_filtros(filtros, limite)
+    
+    def _consumo_material(self, filtros: dict = None, limite: int = 10, usar_resumenes: bool = False) -> dict:
+        if usar_resumenes:
+            return self.rollup_service.get_consumo_material(filtros, limite)
+        return self.pedidos_service.calculate_consumo_material_by_filtros(filtros, limite)
+    
+    def _calculate_expectativa_general(self, filtros: dict = None) -> dict:
+        """
+        Expectativa de cobranza sin filtro proporcional cargando solo columnas
+        proyectadas y las cobranzas que caen en la ventana de semanas o pertenecen
+        a las facturas filtradas.
+        """
+        facturas = self.facturacion_service.get_facturas_resumidas_by_filtros(filtros)
+        pedidos = self.pedidos_service.get_pedidos_para_expectativa(filtros)
+        
+        # Ventana de semanas (holgada) que usará _calculate_expectativa_cobranza
+        fecha_referencia = self._get_fecha_referencia(pedidos)
+        fecha_desde = fecha_referencia - timedelta(weeks=4, days=1)
+        fecha_hasta = fecha_referencia + timedelta(weeks=18, days=1)
+        
+        cobranzas = self.cobranza_service.get_cobranzas_para_expectativa(
+            self.facturacion_service.get_uuids_query(filtros, solo_validas=False),
+            fecha_desde,
+            fecha_hasta
+        )
+        
+        return self._calculate_expectativa_cobranza(
+            facturas, pedidos, None, cobranzas, aplicar_filtro_proporcional=False
+        )
+    
+    def _get_fecha_referencia(self, pedidos: list) -> datetime:
+        """Lunes de la semana de la primera fecha de factura de los pedidos (o hoy)"""
+        fechas_pedidos = [p.fecha_factura for p in pedidos if p.fecha_factura]
+        if fechas_pedidos:
+            fecha_referencia = min(fechas_pedidos)
+            # Ajustar al lunes de esa semana
+            return fecha_referencia - timedelta(days=fecha_referencia.weekday())
+        return datetime.now()
+    
     def _get_default_kpis(self) -> dict:
         """Retorna KPIs por defecto cuando no hay datos"""
         return {
@@ -322,142 +366,140 @@ class KPIAggregator:
         }
     
     def _calculate_expectativa_cobranza(self, facturas: list, pedidos: list, anticipos: list = None, cobranzas: list = None, aplicar_filtro_proporcional: bool = False) -> dict:
-        """Calcula expectativa de cobranza futura basada en pedidos y sus días de crédito"""
-        from datetime import datetime, timedelta
+        """
+        Calcula expectativa de cobranza futura basada en pedidos y sus días de crédito.
         
+        Las fechas de vencimiento y de pago se asignan a su semana en una sola pasada
+        con searchsorted sobre los inicios de semana; las búsquedas de factura por
+        folio/UUID y de lo cobrado por UUID usan índices precalculados.
+        """
         expectativa = {}
         
         logger.info(f"Calculando expectativa de cobranza con {len(pedidos)} pedidos, {len(facturas)} facturas, {len(cobranzas or [])} cobranzas, aplicar_filtro_proporcional={aplicar_filtro_proporcional}")
         
-        # Obtener fecha actual
-        hoy = datetime.now()
-        
-        # Crear diccionarios para búsqueda rápida
-        anticipos_por_factura = {}
-        if anticipos:
-            for anticipo in anticipos:
-                if hasattr(anticipo, 'uuid_factura_relacionada') and anticipo.uuid_factura_relacionada:
-                    anticipos_por_factura[anticipo.uuid_factura_relacionada] = anticipos_por_factura.get(anticipo.uuid_factura_relacionada, 0) + anticipo.importe_relacion
+        # Índices para búsqueda rápida (se conserva la primera factura por folio/UUID)
+        factura_por_folio = {}
+        factura_por_uuid = {}
+        for factura in facturas:
+            factura_por_folio.setdefault(factura.folio_factura, factura)
+            factura_por_uuid.setdefault(factura.uuid_factura, factura)
         
         cobranzas_por_factura = {}
-        if cobranzas:
-            for cobranza in cobranzas:
-                if cobranza.uuid_factura_relacionada:
-                    cobranzas_por_factura[cobranza.uuid_factura_relacionada] = cobranzas_por_factura.get(cobranza.uuid_factura_relacionada, 0) + cobranza.importe_pagado
+        for cobranza in cobranzas or []:
+            if cobranza.uuid_factura_relacionada:
+                cobranzas_por_factura[cobranza.uuid_factura_relacionada] = cobranzas_por_factura.get(cobranza.uuid_factura_relacionada, 0) + cobranza.importe_pagado
         
         # Calcular fecha de referencia basada en los pedidos
-        fechas_pedidos = [p.fecha_factura for p in pedidos if p.fecha_factura]
-        if fechas_pedidos:
-            fecha_referencia = min(fechas_pedidos)
-            # Ajustar al lunes de esa semana
-            dias_hasta_lunes = fecha_referencia.weekday()
-            fecha_referencia = fecha_referencia - timedelta(days=dias_hasta_lunes)
-        else:
-            fecha_referencia = hoy
+        fecha_referencia = self._get_fecha_referencia(pedidos)
         
         logger.info(f"Fecha de referencia para semanas: {fecha_referencia.strftime('%Y-%m-%d')}")
         
-        # Agrupar por semana (4 semanas pasadas + 18 semanas futuras para cubrir créditos de 120 días)
-        for i in range(-4, 18):
-            semana_inicio = fecha_referencia + timedelta(weeks=i)
-            semana_fin = semana_inicio + timedelta(days=6)
-            semana_key = f"Semana {i+5} ({semana_inicio.strftime('%d/%m')} - {semana_fin.strftime('%d/%m')})"
+        # Semanas: 4 pasadas + 18 futuras para cubrir créditos de 120 días
+        offsets_semanas = range(-4, 18)
+        inicios = [fecha_referencia + timedelta(weeks=i) for i in offsets_semanas]
+        inicios_np = np.array(inicios, dtype='datetime64[us]')
+        fines_np = inicios_np + np.timedelta64(6, 'D')
+        num_semanas = len(inicios)
+        
+        # Cobranza esperada: pedidos no cobrados con monto positivo, por semana de vencimiento
+        vencimientos = []
+        montos_pendientes = []
+        for pedido in pedidos:
+            if not pedido.fecha_factura:
+                continue
             
-            cobranza_esperada = 0
-            cobranza_real = 0
-            pedidos_pendientes = 0
-            
-            # Calcular cobranza esperada basada en pedidos que vencen en esa semana
-            for pedido in pedidos:
-                if not pedido.fecha_factura:
-                    continue
+            try:
+                # Calcular fecha de vencimiento usando fecha_factura + dias_credito del pedido
+                fecha_vencimiento = pedido.fecha_factura + timedelta(days=pedido.dias_credito or 0)
+                
+                # Verificar si el pedido ya está cobrado (99% o más de su factura)
+                if pedido.folio_factura:
+                    factura_pedido = factura_por_folio.get(pedido.folio_factura)
+                    if factura_pedido and factura_pedido.uuid_factura and factura_pedido.uuid_factura in cobranzas_por_factura:
+                        if factura_pedido.monto_total > 0:
+                            if cobranzas_por_factura[factura_pedido.uuid_factura] / factura_pedido.monto_total >= 0.99:
+                                continue
                 
-                try:
-                    # Calcular fecha de vencimiento usando fecha_factura + dias_credito del pedido
-                    dias_credito = pedido.dias_credito or 0
-                    fecha_vencimiento = pedido.fecha_factura + timedelta(days=dias_credito)
+                # Solo considerar si hay monto positivo
+                monto_pedido = getattr(pedido, 'importe_sin_iva', 0) or 0
+                if monto_pedido > 0:
+                    vencimientos.append(fecha_vencimiento)
+                    montos_pendientes.append(monto_pedido)
                     
-                    # Si el pedido vence en esta semana
-                    if semana_inicio <= fecha_vencimiento <= semana_fin:
-                        # Verificar si el pedido ya está cobrado
-                        pedido_cobrado = False
-                        if pedido.folio_factura:
-                            # Buscar factura relacionada
-                            factura_pedido = next((f for f in facturas if f.folio_factura == pedido.folio_factura), None)
-                            if factura_pedido and factura_pedido.uuid_factura:
-                                # Buscar cobranzas de esta factura
-                                cobranzas_factura = [c for c in cobranzas or [] if c.uuid_factura_relacionada == factura_pedido.uuid_factura]
-                                if cobranzas_factura:
-                                    total_cobrado_factura = sum(c.importe_pagado for c in cobranzas_factura)
-                                    if factura_pedido.monto_total > 0:
-                                        porcentaje_cobrado = total_cobrado_factura / factura_pedido.monto_total
-                                        if porcentaje_cobrado >= 0.99:  # 99% o más cobrado
-                                            pedido_cobrado = True
-                        
-                        # Solo incluir en cobranza esperada si NO está cobrado
-                        if not pedido_cobrado:
-                            monto_pedido = getattr(pedido, 'importe_sin_iva', 0) or 0
-                            
-                            # Solo considerar si hay monto positivo
-                            if monto_pedido > 0:
-                                cobranza_esperada += monto_pedido
-                                pedidos_pendientes += 1
-                                
-                except Exception as e:
-                    logger.warning(f"Error procesando pedido {pedido.id}: {str(e)}")
-                    continue
+            except Exception as e:
+                logger.warning(f"Error procesando pedido {pedido.id}: {str(e)}")
+                continue
+        
+        cobranza_esperada, pedidos_pendientes = self._sumar_por_semana(
+            vencimientos, montos_pendientes, inicios_np, fines_np, num_semanas
+        )
+        
+        # Cobranza real por semana de pago
+        fechas_pago = []
+        montos_cobrados = []
+        if aplicar_filtro_proporcional:
+            # Monto_Factura × %_Cobrado × %_Proporción_Pedido
+            monto_pedidos_por_folio = {}
+            for pedido in pedidos:
+                monto_pedidos_por_folio[pedido.folio_factura] = monto_pedidos_por_folio.get(pedido.folio_factura, 0) + (pedido.importe_sin_iva or 0)
             
-            # Calcular cobranza real para esta semana
-            if cobranzas:
-                if aplicar_filtro_proporcional:
-                    # Calcular cobranza proporcional basada en la lógica: 
-                    # Monto_Factura × %_Cobrado × %_Proporción_Pedido
-                    for cobranza in cobranzas:
-                        if cobranza.fecha_pago and semana_inicio <= cobranza.fecha_pago <= semana_fin:
-                            uuid_factura = cobranza.uuid_factura_relacionada
-                            if uuid_factura:
-                                # Buscar la factura relacionada
-                                factura_relacionada = next((f for f in facturas if f.uuid_factura == uuid_factura), None)
-                                if factura_relacionada:
-                                    # Calcular el porcentaje cobrado de esta factura
-                                    if factura_relacionada.monto_total > 0:
-                                        porcentaje_cobrado = cobranza.importe_pagado / factura_relacionada.monto_total
-                                    else:
-                                        porcentaje_cobrado = 0
-                                    
-                                    # Calcular la proporción de pedidos filtrados en esta factura
-                                    # Sumar todos los pedidos filtrados que pertenecen a esta factura
-                                    monto_pedidos_filtrados_factura = 0
-                                    for pedido in pedidos:
-                                        if pedido.folio_factura == factura_relacionada.folio_factura:
-                                            monto_pedidos_filtrados_factura += pedido.importe_sin_iva or 0
-                                    
-                                    # Calcular la proporción del pedido en la factura
-                                    if factura_relacionada.monto_total > 0:
-                                        proporcion_pedido = monto_pedidos_filtrados_factura / factura_relacionada.monto_total
-                                    else:
-                                        proporcion_pedido = 0
-                                    
-                                    # Aplicar la fórmula: Monto_Factura × %_Cobrado × %_Proporción_Pedido
-                                    cobranza_proporcional = factura_relacionada.monto_total * porcentaje_cobrado * proporcion_pedido
-                                    cobranza_real += cobranza_proporcional
-                                    
-                                    logger.debug(f"Factura {factura_relacionada.folio_factura}: monto_total=${factura_relacionada.monto_total}, "
-                                               f"porcentaje_cobrado={porcentaje_cobrado:.2%}, proporcion_pedido={proporcion_pedido:.2%}, "
-                                               f"cobranza_proporcional=${cobranza_proporcional:.2f}")
-                else:
-                    # Sin filtro, considerar todas las cobranzas
-                    for cobranza in cobranzas:
-                        if cobranza.fecha_pago and semana_inicio <= cobranza.fecha_pago <= semana_fin:
-                            cobranza_real += cobranza.importe_pagado
+            for cobranza in cobranzas or []:
+                if not cobranza.fecha_pago or not cobranza.uuid_factura_relacionada:
+                    continue
+                factura_relacionada = factura_por_uuid.get(cobranza.uuid_factura_relacionada)
+                if not factura_relacionada:
+                    continue
+                
+                monto_total = factura_relacionada.monto_total
+                porcentaje_cobrado = cobranza.importe_pagado / monto_total if monto_total > 0 else 0
+                monto_pedidos_filtrados_factura = monto_pedidos_por_folio.get(factura_relacionada.folio_factura, 0)
+                proporcion_pedido = monto_pedidos_filtrados_factura / monto_total if monto_total > 0 else 0
+                
+                fechas_pago.append(cobranza.fecha_pago)
+                montos_cobrados.append(monto_total * porcentaje_cobrado * proporcion_pedido)
+        else:
+            # Sin filtro, considerar todas las cobranzas
+            for cobranza in cobranzas or []:
+                if cobranza.fecha_pago:
+                    fechas_pago.append(cobranza.fecha_pago)
+                    montos_cobrados.append(cobranza.importe_pagado)
+        
+        cobranza_real, cobranzas_en_semana = self._sumar_por_semana(
+            fechas_pago, montos_cobrados, inicios_np, fines_np, num_semanas
+        )
+        
+        for i, semana_inicio in zip(range(num_semanas), inicios):
+            esperada = float(cobranza_esperada[i]) if pedidos_pendientes[i] else 0
+            real = float(cobranza_real[i]) if cobranzas_en_semana[i] else 0
             
             # Solo incluir semanas con datos
-            if cobranza_esperada > 0 or cobranza_real > 0:
+            if esperada > 0 or real > 0:
+                semana_fin = semana_inicio + timedelta(days=6)
+                semana_key = f"Semana {offsets_semanas[i]+5} ({semana_inicio.strftime('%d/%m')} - {semana_fin.strftime('%d/%m')})"
                 expectativa[semana_key] = {
-                    'cobranza_esperada': cobranza_esperada,
-                    'cobranza_real': cobranza_real,
-                    'pedidos_pendientes': pedidos_pendientes
+                    'cobranza_esperada': esperada,
+                    'cobranza_real': real,
+                    'pedidos_pendientes': int(pedidos_pendientes[i])
                 }
         
         logger.info(f"Expectativa de cobranza calculada: {len(expectativa)} semanas con datos")
         return expectativa
+    
+    def _sumar_por_semana(self, fechas: list, montos: list, inicios_np, fines_np, num_semanas: int):
+        """
+        Asigna cada fecha a la semana [inicio, inicio + 6 días] que la contiene y
+        retorna (suma de montos, número de registros) por semana.
+        """
+        if not fechas:
+            return np.zeros(num_semanas), np.zeros(num_semanas, dtype=np.int64)
+        
+        fechas_np = np.array(fechas, dtype='datetime64[us]')
+        semana = np.searchsorted(inicios_np, fechas_np, side='right') - 1
+        
+        # Descartar fechas fuera de la ventana o entre el fin de una semana y el inicio de la siguiente
+        dentro = semana >= 0
+        dentro[dentro] = fechas_np[dentro] <= fines_np[semana[dentro]]
+        
+        sumas = np.bincount(semana[dentro], weights=np.asarray(montos, dtype=float)[dentro], minlength=num_semanas)
+        conteos = np.bincount(semana[dentro], minlength=num_semanas)
+        return sumas, conteos
@@ -3,10 +3,15 @@ Servicio especializado para operaciones de pedidos
 """
 
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, case
 from database import Pedido, PedidosCompras, Facturacion
 from utils.validators import DataValidator
+from relaciones_utils import propagar_datos_factura
+from .bulk_ingestion_service import BulkIngestionService
+from .facturacion_service import FacturacionService
 from datetime import datetime
+import numpy as np
+import pandas as pd
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,109 +22,71 @@ class PedidosService:
     def __init__(self, db: Session):
         self.db = db
     
-    def save_pedidos(self, pedidos_data: list, archivo_id: int) -> int:
-        """Guarda datos de pedidos con asignación automática de fechas y días de crédito"""
-        print(f"=== INICIANDO save_pedidos ===")
-        print(f"Total de pedidos recibidos: {len(pedidos_data)}")
-        print(f"Archivo ID: {archivo_id}")
-        logger.info(f"=== INICIANDO save_pedidos ===")
-        logger.info(f"Total de pedidos recibidos: {len(pedidos_data)}")
-        logger.info(f"Archivo ID: {archivo_id}")
-        
-        count = 0
-        
-        # Obtener facturas para asignar fechas y días de crédito automáticamente
-        facturas = self.db.query(Facturacion).all()
-        fechas_por_folio = {}
-        dias_credito_por_folio = {}
-        
-        for factura in facturas:
-            if factura.folio_factura:
-                folio_limpio = str(factura.folio_factura).strip()
-                
-                if factura.fecha_factura:
-                    fechas_por_folio[folio_limpio] = factura.fecha_factura
-                
-                if factura.dias_credito is not None:
-                    dias_credito_por_folio[folio_limpio] = factura.dias_credito
-        
-        fechas_asignadas = 0
-        dias_credito_asignados = 0
-        
-        for pedido_data in pedidos_data:
-            try:
-                # Convertir fechas de forma segura
-                fecha_factura = DataValidator.safe_date(pedido_data.get('fecha_factura'))
-                fecha_pago = DataValidator.safe_date(pedido_data.get('fecha_pago'))
-                
-                # Asignar fecha_factura automáticamente si no existe
-                if not fecha_factura:
-                    folio_factura = pedido_data.get('folio_factura', '')
-                    if folio_factura:
-                        folio_limpio = str(folio_factura).strip()
-                        if folio_limpio in fechas_por_folio:
-                            fecha_factura = fechas_por_folio[folio_limpio]
-                            fechas_asignadas += 1
-                
-                # Asignar días de crédito automáticamente
-                dias_credito_pedido = DataValidator.safe_int(pedido_data.get('dias_credito', 30))
-                folio_factura = pedido_data.get('folio_factura', '')
-                
-                if folio_factura:
-                    folio_limpio = str(folio_factura).strip()
-                    if folio_limpio in dias_credito_por_folio:
-                        dias_credito_pedido = dias_credito_por_folio[folio_limpio]
-                        dias_credito_asignados += 1
-                
-                # Extraer folio_factura numérico de la cadena completa
-                folio_raw = pedido_data.get('folio_factura', '')
-                folio_factura_num = self._extract_numeric_folio(folio_raw)
-                
-                # Ignorar registro si no se puede extraer un folio numérico válido
-                if folio_factura_num is None:
-                    print(f"[SKIP] Saltando pedido - folio_factura no numerico: '{folio_raw}'")
-                    logger.warning(f"Saltando pedido - folio_factura no numérico: '{folio_raw}'")
-                    continue
-                
-                # Obtener IMI de la columna "Pedido"
-                imi = DataValidator.safe_int(pedido_data.get('pedido', 0))
-                
-                # Crear registro en pedidos_compras (tabla optimizada de Supabase)
-                pedido_compras = PedidosCompras(
-                    compra_imi=imi,  # Usar IMI de la columna "Pedido"
-                    folio_factura=folio_factura_num,  # Folio numérico extraído
-                    material_codigo=DataValidator.safe_string(pedido_data.get('material', '')),  # Mapear material a material_codigo
-                    kg=DataValidator.safe_float(pedido_data.get('kg', 0)),
-                    precio_unitario=DataValidator.safe_float(pedido_data.get('precio_unitario', 0)),
-                    importe_sin_iva=DataValidator.safe_float(pedido_data.get('importe_sin_iva', 0)),
-                    importe_con_iva=DataValidator.safe_float(pedido_data.get('importe_sin_iva', 0)) * 1.16,  # Calcular IVA 16%
-                    dias_credito=dias_credito_pedido,
-                    fecha_factura=fecha_factura,
-                    fecha_pago=fecha_pago,
-                    archivo_id=archivo_id
-                )
-                self.db.add(pedido_compras)
-                count += 1
-                
-                # Log cada 10 pedidos para seguimiento
-                if count % 10 == 0:
-                    print(f"[PROGRESS] Procesados {count} pedidos...")
-                    logger.info(f"Procesados {count} pedidos...")
-                    
-            except Exception as e:
-                print(f"[ERROR] Error guardando pedido: {str(e)}")
-                print(f"[ERROR] Datos del pedido que fallo: {pedido_data}")
-                logger.error(f"Error guardando pedido: {str(e)}")
-                logger.error(f"Datos del pedido que falló: {pedido_data}")
-                import traceback
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                continue
+    def save_pedidos(self, pedidos_data, archivo_id: int, facturacion_data=None) -> int:
+        """
+        Guarda datos de pedidos con asignación automática de fechas y días de crédito (ingesta masiva).
+        
+        pedidos_data es un DataFrame con columnas estándar (o una lista de
+        diccionarios); conversiones y asignaciones se aplican por columna.
+        facturacion_data (opcional) es la facturación del mismo archivo: sus
+        folios se resuelven en memoria y solo los demás se buscan en la base.
+        """
+        df = DataValidator.as_frame(pedidos_data)
+        logger.info(f"Guardando {len(df)} pedidos del archivo {archivo_id}")
+        
+        if df.empty:
+            return 0
+        
+        def columna(nombre):
+            return DataValidator.get_column(df, nombre)
+        
+        # Extraer folio_factura numérico de la cadena completa
+        folio_factura_num = self._extract_numeric_folios(columna('folio_factura'))
+        
+        # Facturas de los folios de este lote para asignar fechas y días de crédito automáticamente
+        facturas = self._get_facturas_por_folio(folio_factura_num, facturacion_data)
         
+        # Días de crédito desde la factura (fuente de verdad); fecha_factura solo si no existe
+        pedidos_folio = pd.DataFrame({
+            'dias_credito': DataValidator.safe_int_series(columna('dias_credito'), None),
+            'fecha_factura': DataValidator.safe_date_series(columna('fecha_factura'))
+        })
+        pedidos_folio, conteos = propagar_datos_factura(
+            facturas, pedidos_folio, folios=folio_factura_num, solo_faltantes=('fecha_factura',)
+        )
+        fecha_factura = pedidos_folio['fecha_factura']
+        dias_credito = pedidos_folio['dias_credito'].fillna(30).astype('int64')
+        
+        importe_sin_iva = DataValidator.safe_float_series(columna('importe_sin_iva'))
+        
+        registros = pd.DataFrame({
+            'compra_imi': DataValidator.safe_int_series(columna('pedido'), 0),  # Usar IMI de la columna "Pedido"
+            'folio_factura': folio_factura_num,  # Folio numérico extraído
+            'material_codigo': DataValidator.safe_string_series(columna('material')),  # Mapear material a material_codigo
+            'kg': DataValidator.safe_float_series(columna('kg')),
+            'precio_unitario': DataValidator.safe_float_series(columna('precio_unitario')),
+            'importe_sin_iva': importe_sin_iva,
+            'importe_con_iva': importe_sin_iva * 1.16,  # Calcular IVA 16%
+            'dias_credito': dias_credito,
+            'fecha_factura': fecha_factura,
+            'fecha_pago': DataValidator.safe_date_series(columna('fecha_pago')),
+            'archivo_id': archivo_id
+        })
+        
+        # Ignorar registros sin folio numérico válido
+        sin_folio = folio_factura_num.isna()
+        if sin_folio.any():
+            muestra = columna('folio_factura')[sin_folio].head(5).tolist()
+            logger.warning(f"Saltando {int(sin_folio.sum())} pedidos con folio_factura no numérico, ej: {muestra}")
+            registros = registros[~sin_folio]
+        
+        # Ingesta masiva sin objetos ORM
         # No hacer commit aquí - dejar que el método principal maneje la transacción
+        count = BulkIngestionService(self.db).insert_dataframe(PedidosCompras, registros)
+        
+        fechas_asignadas = conteos['fecha_factura']['asignados']
+        dias_credito_asignados = conteos['dias_credito']['asignados'] + conteos['dias_credito']['corregidos']
         
-        print(f"=== FINALIZANDO save_pedidos ===")
-        print(f"Total de pedidos guardados exitosamente: {count}")
-        logger.info(f"=== FINALIZANDO save_pedidos ===")
         logger.info(f"Total de pedidos guardados exitosamente: {count}")
         if fechas_asignadas > 0:
             logger.info(f"Se asignaron automáticamente {fechas_asignadas} fechas de factura a pedidos_compras")
@@ -128,6 +95,47 @@ class PedidosService:
         
         return count
     
+    def _get_facturas_por_folio(self, folios: pd.Series, facturacion_data=None) -> pd.DataFrame:
+        """
+        folio_factura, fecha_factura y dias_credito de las facturas con los folios indicados.
+        
+        Los folios presentes en facturacion_data (la facturación del mismo archivo,
+        convertida igual que en FacturacionService.save_facturas) se resuelven en
+        memoria; el resto se busca con consultas IN por bloques que solo leen esas
+        tres columnas, en lugar de cargar toda la facturación histórica.
+        """
+        columnas = ['folio_factura', 'fecha_factura', 'dias_credito']
+        pendientes = set(int(folio) for folio in folios.dropna().unique())
+        
+        en_archivo = pd.DataFrame(columns=columnas)
+        facturacion = DataValidator.as_frame(facturacion_data)
+        if not facturacion.empty and pendientes:
+            en_archivo = pd.DataFrame({
+                'folio_factura': DataValidator.safe_int_series(DataValidator.get_column(facturacion, 'folio_factura'), None),
+                'fecha_factura': DataValidator.safe_date_series(DataValidator.get_column(facturacion, 'fecha_factura')),
+                'dias_credito': DataValidator.safe_int_series(DataValidator.get_column(facturacion, 'dias_credito'), 30)
+            })
+            en_archivo = en_archivo[en_archivo['folio_factura'].isin(pendientes)]
+            pendientes -= set(int(folio) for folio in en_archivo['folio_factura'].unique())
+        
+        pendientes = sorted(pendientes)
+        filas = []
+        for inicio in range(0, len(pendientes), FacturacionService.IN_CHUNK_SIZE):
+            bloque = pendientes[inicio:inicio + FacturacionService.IN_CHUNK_SIZE]
+            filas.extend(
+                self.db.query(Facturacion.folio_factura, Facturacion.fecha_factura, Facturacion.dias_credito)
+                .filter(Facturacion.folio_factura.in_(bloque))
+                .all()
+            )
+        en_base = pd.DataFrame([tuple(fila) for fila in filas], columns=columnas)
+        en_base['fecha_factura'] = pd.to_datetime(en_base['fecha_factura'], errors='coerce')
+        
+        logger.info(f"Facturas para los folios de pedidos: {len(en_archivo)} del archivo, "
+                    f"{len(en_base)} de la base ({len(pendientes)} folios consultados)")
+        
+        partes = [parte for parte in (en_base, en_archivo) if not parte.empty]
+        return pd.concat(partes, ignore_index=True) if partes else en_base
+    
     def _extract_numeric_folio(self, folio_raw: str) -> int:
         """Extrae el número de folio de una cadena que contiene texto adicional
         
@@ -135,7 +143,7 @@ class PedidosService:
         """
         if not folio_raw:
             return None
-            
+        
         # Convertir a string y limpiar
         folio_str = str(folio_raw).strip()
         
@@ -154,6 +162,23 @@ class PedidosService:
         
         return None
     
+    def _extract_numeric_folios(self, folios: pd.Series) -> pd.Series:
+        """Versión por columna de _extract_numeric_folio (Int64, NA si no hay folio numérico)"""
+        texto = DataValidator._text_values(folios)
+        es_texto = texto.notna()
+        
+        # Números al inicio del texto, sin comas
+        desde_texto = pd.to_numeric(
+            texto.str.replace(',', '', regex=False).str.extract(r'^(\d+)', expand=False),
+            errors='coerce'
+        )
+        
+        # Valores numéricos: solo los positivos empiezan con dígitos
+        numeros = pd.to_numeric(folios.where(~es_texto), errors='coerce')
+        desde_numero = np.floor(numeros).where(numeros > 0)
+        
+        return desde_numero.where(~es_texto, desde_texto).astype('Int64')
+    
     def _categorize_material(self, material: str) -> str:
         """Categoriza el material basado en su código o nombre"""
         if not material:
@@ -176,7 +201,7 @@ class PedidosService:
             return 'Níquel'
         else:
             return 'Otros Metales'
-
+    
     def _subcategorize_material(self, material: str) -> str:
         """Subcategoriza el material con más detalle"""
         if not material:
@@ -197,17 +222,15 @@ class PedidosService:
             return 'Perfil'
         else:
             return 'General'
-
+    
     def _calculate_trimestre(self, fecha: datetime) -> int:
         """Calcula el trimestre basado en la fecha"""
         if not fecha:
             return None
         return (fecha.month - 1) // 3 + 1
-
-    def get_pedidos_by_filtros(self, filtros: dict = None):
-        """Obtiene pedidos aplicando filtros - ahora usa pedidos_compras de Supabase"""
-        query = self.db.query(PedidosCompras)
-        
+    
+    def _apply_filtros(self, query, filtros: dict = None):
+        """Aplica filtros de mes/año/material a una consulta sobre pedidos_compras"""
         if filtros:
             # Solo aplicar filtro de mes si también hay año seleccionado
             if filtros.get('mes') and filtros.get('año'):
@@ -222,7 +245,48 @@ class PedidosService:
                 pedidos_list = filtros['pedidos']
                 query = query.filter(PedidosCompras.material_codigo.in_(pedidos_list))
         
-        return query.all()
+        return query
+    
+    def get_pedidos_by_filtros(self, filtros: dict = None):
+        """Obtiene pedidos aplicando filtros - ahora usa pedidos_compras de Supabase"""
+        return self._apply_filtros(self.db.query(PedidosCompras), filtros).all()
+    
+    def get_pedidos_para_expectativa(self, filtros: dict = None) -> list:
+        """Obtiene solo las columnas de pedidos_compras que usa la expectativa de cobranza"""
+        query = self.db.query(
+            PedidosCompras.id,
+            PedidosCompras.folio_factura,
+            PedidosCompras.fecha_factura,
+            PedidosCompras.dias_credito,
+            PedidosCompras.importe_sin_iva
+        )
+        return self._apply_filtros(query, filtros).all()
+    
+    def get_resumen_pedidos(self, filtros: dict = None) -> dict:
+        """Totales de pedidos_compras calculados en la base de datos"""
+        precio_valido = PedidosCompras.precio_unitario > 0
+        query = self.db.query(
+            func.count().label('total_registros'),
+            func.sum(PedidosCompras.importe_sin_iva).label('importe_sin_iva'),
+            func.sum(PedidosCompras.kg).label('kg_total'),
+            func.count(func.distinct(case(
+                (PedidosCompras.compra_imi != 0, PedidosCompras.compra_imi)
+            ))).label('pedidos_unicos'),
+            func.count(func.distinct(case(
+                (PedidosCompras.folio_factura != 0, PedidosCompras.folio_factura)
+            ))).label('folios_unicos'),
+            func.avg(case((precio_valido, PedidosCompras.precio_unitario))).label('precio_unitario_promedio')
+        )
+        resumen = self._apply_filtros(query, filtros).one()
+        
+        return {
+            'total_registros': resumen.total_registros or 0,
+            'importe_sin_iva': resumen.importe_sin_iva or 0,
+            'kg_total': resumen.kg_total or 0,
+            'pedidos_unicos': resumen.pedidos_unicos or 0,
+            'folios_unicos': resumen.folios_unicos or 0,
+            'precio_unitario_promedio': resumen.precio_unitario_promedio or 0
+        }
     
     def calculate_consumo_material(self, pedidos: list) -> dict:
         """Calcula consumo por material - ahora usa pedidos_compras"""
@@ -247,10 +311,22 @@ class PedidosService:
         sorted_materiales = sorted(materiales_consumo.items(), key=lambda x: x[1], reverse=True)
         return dict(sorted_materiales[:10])
     
+    def calculate_consumo_material_by_filtros(self, filtros: dict = None, limite: int = 10) -> dict:
+        """Calcula consumo por material con GROUP BY en SQL (código truncado a 7 caracteres)"""
+        material = func.substr(func.trim(PedidosCompras.material_codigo), 1, 7)
+        total_kg = func.sum(PedidosCompras.kg)
+        query = self.db.query(material.label('material'), total_kg.label('kg')).filter(
+            PedidosCompras.material_codigo.isnot(None),
+            func.trim(PedidosCompras.material_codigo) != ''
+        )
+        query = self._apply_filtros(query, filtros).group_by(material).order_by(total_kg.desc()).limit(limite)
+        
+        return {fila.material: fila.kg or 0 for fila in query.all()}
+    
     def get_folios_pedidos(self, pedidos: list) -> list:
         """Obtiene folios únicos de pedidos - ahora usa pedidos_compras"""
         return list(set(p.folio_factura for p in pedidos if p.folio_factura))
-
+    
     def get_top_proveedores(self, limite: int = 10, filtros: dict = None) -> dict:
         """Obtiene top proveedores por monto de compras o pedidos"""
         # Si hay filtro de pedidos específico, calcular desde pedidos
@@ -259,27 +335,27 @@ class PedidosService:
         else:
             # Usar datos de compras_v2
             return self.db_service.get_top_proveedores_compras_v2(limite, filtros)
-
+    
     def _get_top_proveedores_from_pedidos(self, limite: int = 10, filtros: dict = None) -> dict:
         """Obtiene top proveedores calculados desde pedidos (lógica legacy)"""
         # Esta es una implementación simplificada - en un escenario real
         # se calcularía desde los pedidos relacionados
         return {"Proveedor Ejemplo": 10000.0}
-
+    
     def get_top_proveedores_compras_v2(self, limite: int = 10, filtros: dict = None) -> dict:
         """Obtiene top proveedores por monto de compras_v2"""
         return self.db_service.get_top_proveedores_compras_v2(limite, filtros)
-
+    
     def get_ventas_por_material(self, limite: int = 10, filtros: dict = None) -> dict:
         """Obtiene ventas por material desde pedidos"""
         # Los pedidos representan ventas, no compras
         return self._get_ventas_por_material_from_pedidos(limite, filtros)
-
+    
     def _get_ventas_por_material_from_pedidos(self, limite: int = 10, filtros: dict = None) -> dict:
         """Obtiene ventas por material calculadas desde pedidos"""
         try:
             from sqlalchemy import func
-
+            
             # Query para obtener ventas por material desde pedidos
             query = self.db.query(
                 Pedido.material,
@@ -289,7 +365,7 @@ class PedidosService:
                 Pedido.material.isnot(None),
                 Pedido.material != ""
             ).group_by(Pedido.material)
-
+            
             # Aplicar filtros
             if filtros:
                 if filtros.get('mes') and filtros.get('año'):
@@ -301,23 +377,23 @@ class PedidosService:
                 elif filtros.get('año'):
                     from sqlalchemy import extract
                     query = query.filter(extract('year', Pedido.fecha_factura) == filtros['año'])
-
+            
             # Ordenar por total de ventas y limitar
             result = query.order_by(func.sum(Pedido.importe_sin_iva).desc()).limit(limite).all()
-
+            
             return {material: {
                 'total_ventas': float(total or 0),
                 'total_kg': float(total_kg or 0)
             } for material, total, total_kg in result}
-
+        
         except Exception as e:
             logger.error(f"Error obteniendo ventas por material desde pedidos: {str(e)}")
             return {}
-
+    
     def get_compras_por_material_v2(self, limite: int = 10, filtros: dict = None) -> dict:
         """Obtiene compras agrupadas por material en compras_v2"""
         return self.db_service.get_compras_por_material_v2(limite, filtros)
-
+    
     def get_evolucion_precios_compras_v2(self, material: str = None, moneda: str = 'USD') -> list:
         """Obtiene evolución de precios por período desde compras_v2"""
         result = self.db_service.get_evolucion_precios_compras_v2(material, moneda)
@@ -0,0 +1,336 @@
+"""
+Servicio de resúmenes mensuales precalculados de facturación, cobranza y pedidos
+"""
+
+from sqlalchemy.orm import Session
+from sqlalchemy import func, case, and_, or_, cast, insert, select, literal, false, Integer, inspect
+from database import (
+    Facturacion, Cobranza, PedidosCompras,
+    ResumenFacturacionMensual, ResumenCobranzaMensual, ResumenPedidosMensual
+)
+from .facturacion_service import FacturacionService
+from .cobranza_service import CobranzaService
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RollupService:
+    """
+    Mantiene los resúmenes por (archivo_id, año, mes[, cliente, material]) y
+    responde las consultas de KPIs y gráficos sin filtro de pedidos sumando
+    esas filas en lugar de recorrer las tablas base.
+    
+    Facturación y pedidos se recalculan solo para el archivo cargado. La cobranza
+    relacionada depende de las facturas de cualquier archivo, así que se
+    recalculan los pagos del archivo y los de los periodos (año, mes) que tenían
+    o tienen sus facturas; el resto de los periodos no cambia.
+    
+    Los resúmenes son datos derivados: si sus tablas no existen o el recálculo
+    falla, se registra el error, se vacían y los KPIs se calculan en vivo; la
+    carga de datos base no se interrumpe.
+    """
+    
+    TABLAS = (ResumenFacturacionMensual, ResumenCobranzaMensual, ResumenPedidosMensual)
+    
+    def __init__(self, db: Session):
+        self.db = db
+        self.facturacion_service = FacturacionService(db)
+        self.cobranza_service = CobranzaService(db)
+        self._tablas_ok = False
+    
+    def refresh_archivo(self, archivo_id: int) -> bool:
+        """
+        Recalcula los resúmenes de un archivo dentro de la transacción actual
+        (sin commit: lo hace el llamador junto con los datos base).
+        Devuelve False si no se pudieron actualizar.
+        """
+        return self._refrescar(self._refresh_archivo, archivo_id)
+    
+    def refresh_all(self) -> bool:
+        """Reconstruye todos los resúmenes desde las tablas base (sin commit)"""
+        return self._refrescar(self._refresh_all)
+    
+    def tablas_disponibles(self) -> bool:
+        """True si existen las tablas de resúmenes (create_resumen_mensual_tables.sql)"""
+        if not self._tablas_ok:
+            # Con la conexión de la sesión: otra conexión del pool podría ser la misma
+            # (SQLite) y su rollback al devolverla descartaría la carga en curso
+            inspector = inspect(self.db.connection())
+            self._tablas_ok = all(inspector.has_table(t.__tablename__) for t in self.TABLAS)
+        return self._tablas_ok
+    
+    def _refrescar(self, refresh, *args) -> bool:
+        """Ejecuta refresh en un SAVEPOINT; si falla, deja los resúmenes vacíos (KPIs en vivo)"""
+        if not self.tablas_disponibles():
+            logger.warning("Tablas de resúmenes mensuales no encontradas "
+                           "(ejecutar create_resumen_mensual_tables.sql): KPIs en vivo")
+            return False
+        
+        # Los errores de los datos base se propagan al llamador
+        self.db.flush()
+        try:
+            with self.db.begin_nested():
+                refresh(*args)
+            return True
+        except Exception as e:
+            logger.error(f"Error actualizando resúmenes mensuales, KPIs en vivo: {str(e)}")
+            self._vaciar()
+            return False
+    
+    def _vaciar(self):
+        """Vacía los resúmenes para que has_data() sea False hasta la próxima reconstrucción"""
+        try:
+            with self.db.begin_nested():
+                for model in self.TABLAS:
+                    self.db.query(model).delete(synchronize_session=False)
+        except Exception as e:
+            logger.error(f"Error vaciando resúmenes mensuales: {str(e)}")
+    
+    def _refresh_archivo(self, archivo_id: int):
+        start_time = time.time()
+        self.db.flush()
+        
+        # Periodos de las facturas del archivo antes (resumen vigente) y después de la carga
+        periodos = self._periodos_facturacion(archivo_id)
+        
+        self._delete_archivo(archivo_id)
+        self._insert_facturacion(Facturacion.archivo_id == archivo_id)
+        self._insert_pedidos(PedidosCompras.archivo_id == archivo_id)
+        self.refresh_cobranza(archivo_id, periodos)
+        
+        logger.info(f"Resúmenes mensuales actualizados para archivo_id {archivo_id} en {time.time() - start_time:.3f}s")
+    
+    def _refresh_all(self):
+        start_time = time.time()
+        
+        self.db.query(ResumenFacturacionMensual).delete(synchronize_session=False)
+        self.db.query(ResumenPedidosMensual).delete(synchronize_session=False)
+        self._insert_facturacion()
+        self._insert_pedidos()
+        self.refresh_cobranza()
+        
+        logger.info(f"Resúmenes mensuales reconstruidos en {time.time() - start_time:.3f}s")
+    
+    def refresh_cobranza(self, archivo_id: int = None, periodos_afectados: set = None):
+        """
+        Recalcula la cobranza por periodo de la factura relacionada (sin commit).
+        
+        Sin archivo_id se reconstruye completa. Con archivo_id solo se recalculan
+        los pagos relacionados de ese archivo y los de las facturas en
+        periodos_afectados (conjunto de (año, mes)). Los pagos sin factura válida
+        no tienen periodo y dependen de todas las facturas, así que se recalculan
+        siempre (un GROUP BY por archivo de cobranza).
+        """
+        r = ResumenCobranzaMensual
+        if archivo_id is None:
+            self.db.query(r).delete(synchronize_session=False)
+        else:
+            self.db.query(r).filter(or_(
+                r.relacionada.is_(False),
+                r.archivo_id == archivo_id,
+                self._en_periodos(r.año, r.mes, periodos_afectados)
+            )).delete(synchronize_session=False)
+        
+        # Periodos de las facturas válidas con UUID
+        periodos = select(
+            Facturacion.uuid_factura.label('uuid'),
+            Facturacion.año.label('año'),
+            Facturacion.mes.label('mes')
+        ).where(
+            self.facturacion_service._folio_valido(),
+            Facturacion.uuid_factura.isnot(None),
+            Facturacion.uuid_factura != ''
+        ).distinct().subquery()
+        
+        importe_sin_iva = func.sum(case(
+            (Cobranza.importe_pagado > 0, Cobranza.importe_pagado / 1.16), else_=0
+        ))
+        
+        relacionadas = select(
+            Cobranza.archivo_id,
+            periodos.c.año,
+            periodos.c.mes,
+            literal(True),
+            func.sum(Cobranza.importe_pagado),
+            importe_sin_iva
+        ).join(
+            periodos, periodos.c.uuid == Cobranza.uuid_factura_relacionada
+        ).where(
+            self.cobranza_service._folio_pago_valido()
+        ).group_by(Cobranza.archivo_id, periodos.c.año, periodos.c.mes)
+        if archivo_id is not None:
+            relacionadas = relacionadas.where(or_(
+                Cobranza.archivo_id == archivo_id,
+                self._en_periodos(periodos.c.año, periodos.c.mes, periodos_afectados)
+            ))
+        
+        # Pagos sin factura válida: solo cuentan para cobranza_general_total
+        sin_relacionar = select(
+            Cobranza.archivo_id,
+            literal(None, Integer),
+            literal(None, Integer),
+            literal(False),
+            func.sum(Cobranza.importe_pagado),
+            literal(0.0)
+        ).where(
+            self.cobranza_service._folio_pago_valido(),
+            or_(
+                Cobranza.uuid_factura_relacionada.is_(None),
+                Cobranza.uuid_factura_relacionada.notin_(select(periodos.c.uuid))
+            )
+        ).group_by(Cobranza.archivo_id)
+        
+        columnas = ['archivo_id', 'año', 'mes', 'relacionada', 'cobranza_total', 'cobranza_sin_iva']
+        for consulta in (relacionadas, sin_relacionar):
+            self.db.execute(insert(ResumenCobranzaMensual).from_select(columnas, consulta))
+    
+    def has_data(self) -> bool:
+        """
+        True si todos los resúmenes que lee KPIAggregator están poblados (si no, los
+        KPIs se calculan en vivo). Un resumen vacío solo cuenta como poblado si su
+        tabla base también lo está, p. ej. sin pedidos cargados.
+        """
+        if not self.tablas_disponibles():
+            return False
+        if self.db.query(ResumenFacturacionMensual.id).first() is None:
+            return False
+        
+        pares = (
+            (ResumenCobranzaMensual, Cobranza),
+            (ResumenPedidosMensual, PedidosCompras),
+        )
+        for resumen, base in pares:
+            if self.db.query(resumen.id).first() is None and self.db.query(base.id).first() is not None:
+                logger.info(f"{resumen.__tablename__} vacío con datos en {base.__tablename__}: KPIs en vivo")
+                return False
+        return True
+    
+    def _periodos_facturacion(self, archivo_id: int) -> set:
+        """(año, mes) de las facturas del archivo en el resumen vigente y en la tabla base"""
+        r = ResumenFacturacionMensual
+        anteriores = self.db.query(r.año, r.mes).filter(r.archivo_id == archivo_id).distinct()
+        actuales = self.db.query(Facturacion.año, Facturacion.mes).filter(
+            Facturacion.archivo_id == archivo_id
+        ).distinct()
+        return {(año, mes) for año, mes in anteriores.union(actuales).all()}
+    
+    def _en_periodos(self, año_col, mes_col, periodos: set):
+        """Condición (año, mes) ∈ periodos, con NULL como valor comparable"""
+        def igual(columna, valor):
+            return columna.is_(None) if valor is None else columna == valor
+        
+        if not periodos:
+            return false()
+        return or_(*(and_(igual(año_col, año), igual(mes_col, mes)) for año, mes in periodos))
+    
+    def _delete_archivo(self, archivo_id: int):
+        for model in (ResumenFacturacionMensual, ResumenPedidosMensual):
+            self.db.query(model).filter(model.archivo_id == archivo_id).delete(synchronize_session=False)
+    
+    def _insert_facturacion(self, *condiciones):
+        valida = self.facturacion_service._folio_valido()
+        consulta = select(
+            Facturacion.archivo_id,
+            Facturacion.año,
+            Facturacion.mes,
+            Facturacion.cliente,
+            func.count(),
+            func.sum(case((valida, 1), else_=0)),
+            func.sum(case((valida, Facturacion.monto_total), else_=0)),
+            func.sum(case((valida, Facturacion.monto_neto), else_=0))
+        ).where(*condiciones).group_by(
+            Facturacion.archivo_id, Facturacion.año, Facturacion.mes, Facturacion.cliente
+        )
+        columnas = [
+            'archivo_id', 'año', 'mes', 'cliente', 'total_registros', 'total_facturas',
+            'facturacion_total', 'facturacion_sin_iva'
+        ]
+        self.db.execute(insert(ResumenFacturacionMensual).from_select(columnas, consulta))
+    
+    def _insert_pedidos(self, *condiciones):
+        año = cast(func.extract('year', PedidosCompras.fecha_factura), Integer)
+        mes = cast(func.extract('month', PedidosCompras.fecha_factura), Integer)
+        material = func.substr(func.trim(PedidosCompras.material_codigo), 1, 7)
+        consulta = select(
+            PedidosCompras.archivo_id,
+            año,
+            mes,
+            material,
+            func.sum(PedidosCompras.kg),
+            func.sum(PedidosCompras.importe_sin_iva)
+        ).where(
+            PedidosCompras.material_codigo.isnot(None),
+            func.trim(PedidosCompras.material_codigo) != '',
+            *condiciones
+        ).group_by(PedidosCompras.archivo_id, año, mes, material)
+        columnas = ['archivo_id', 'año', 'mes', 'material', 'kg', 'importe_sin_iva']
+        self.db.execute(insert(ResumenPedidosMensual).from_select(columnas, consulta))
+    
+    def _apply_filtros(self, query, model, filtros: dict = None):
+        """Aplica mes/año con la misma semántica que los servicios base"""
+        if filtros:
+            # Solo aplicar filtro de mes si también hay año seleccionado
+            if filtros.get('mes') and filtros.get('año'):
+                query = query.filter(model.mes == filtros['mes'])
+            if filtros.get('año'):
+                query = query.filter(model.año == filtros['año'])
+        return query
+    
+    def get_resumen_facturacion(self, filtros: dict = None) -> dict:
+        """Equivalente a FacturacionService.get_resumen_facturacion"""
+        r = ResumenFacturacionMensual
+        query = self.db.query(
+            func.sum(r.total_registros).label('total_registros'),
+            func.sum(r.total_facturas).label('total_facturas'),
+            func.sum(r.facturacion_total).label('facturacion_total'),
+            func.sum(r.facturacion_sin_iva).label('facturacion_sin_iva'),
+            func.count(func.distinct(case(
+                (and_(r.total_facturas > 0, r.cliente != ''), r.cliente)
+            ))).label('clientes_unicos')
+        )
+        resumen = self._apply_filtros(query, r, filtros).one()
+        
+        return {
+            'total_registros': int(resumen.total_registros or 0),
+            'total_facturas': int(resumen.total_facturas or 0),
+            'facturacion_total': resumen.facturacion_total or 0,
+            'facturacion_sin_iva': resumen.facturacion_sin_iva or 0,
+            'clientes_unicos': resumen.clientes_unicos or 0
+        }
+    
+    def get_resumen_cobranza(self, filtros: dict = None) -> dict:
+        """Equivalente a CobranzaService.get_resumen_cobranza sobre las facturas filtradas"""
+        r = ResumenCobranzaMensual
+        relacionada = self.db.query(
+            func.sum(r.cobranza_total).label('cobranza_total'),
+            func.sum(r.cobranza_sin_iva).label('cobranza_sin_iva')
+        ).filter(r.relacionada.is_(True))
+        relacionada = self._apply_filtros(relacionada, r, filtros).one()
+        
+        general = self.db.query(func.sum(r.cobranza_total)).scalar()
+        
+        return {
+            'cobranza_total': relacionada.cobranza_total or 0,
+            'cobranza_general_total': general or 0,
+            'cobranza_sin_iva': relacionada.cobranza_sin_iva or 0
+        }
+    
+    def get_top_clientes(self, filtros: dict = None, limite: int = 10) -> dict:
+        """Equivalente a FacturacionService.calculate_top_clientes_by_filtros"""
+        r = ResumenFacturacionMensual
+        cliente = func.coalesce(func.nullif(r.cliente, ''), 'Sin cliente')
+        total = func.sum(r.facturacion_total)
+        query = self.db.query(cliente.label('cliente'), total.label('total')).filter(r.total_facturas > 0)
+        query = self._apply_filtros(query, r, filtros).group_by(cliente).order_by(total.desc()).limit(limite)
+        
+        return {fila.cliente: fila.total or 0 for fila in query.all()}
+    
+    def get_consumo_material(self, filtros: dict = None, limite: int = 10) -> dict:
+        """Equivalente a PedidosService.calculate_consumo_material_by_filtros"""
+        r = ResumenPedidosMensual
+        total_kg = func.sum(r.kg)
+        query = self.db.query(r.material.label('material'), total_kg.label('kg'))
+        query = self._apply_filtros(query, r, filtros).group_by(r.material).order_by(total_kg.desc()).limit(limite)
+        
+        return {fila.material: fila.kg or 0 for fila in query.all()}
@@ -0,0 +1,9 @@
+"""
+Configuración de pytest: los módulos del backend se importan como en producción
+(uvicorn corre desde backend/), así que el directorio se agrega al path.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,205 @@
+"""
+Pruebas del caché en memoria (utils/cache.py): LRU/TTL, single-flight, claves
+por método y generación de datos
+"""
+
+import threading
+import time
+
+import pytest
+
+from utils import cache as cache_module
+from utils.cache import (
+    SimpleCache, bump_data_generation, cache, cached, get_data_generation, make_cache_key
+)
+
+@pytest.fixture
+def reloj(monkeypatch):
+    """Reloj controlado para el TTL y el barrido"""
+    ahora = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'time', lambda: ahora[0])
+    return ahora
+
+# --- LRU / TTL ---
+
+def test_desaloja_la_entrada_menos_usada():
+    c = SimpleCache(max_entries=3)
+    for key in 'abc':
+        c.set(key, key.upper())
+    c.get('a')
+
+    c.set('d', 'D')
+
+    assert c.keys() == ['c', 'a', 'd']
+    assert c.get('b') is None
+    assert c.get_stats()['evictions'] == 1
+
+def test_desaloja_por_tamaño_total():
+    c = SimpleCache(max_bytes=6000)
+    for i in range(5):
+        c.set(f'k{i}', 'x' * 2000)
+
+    stats = c.get_stats()
+    assert stats['memory_usage'] <= 6000
+    assert c.keys() == ['k3', 'k4']
+
+def test_valor_mayor_que_el_presupuesto_no_se_guarda():
+    c = SimpleCache(max_bytes=1000)
+    c.set('grande', 'x' * 5000)
+
+    assert c.get('grande') is None
+    assert c.get_stats()['memory_usage'] == 0
+
+def test_reemplazar_una_clave_descuenta_su_tamaño():
+    c = SimpleCache()
+    c.set('k', 'x' * 1000)
+    c.set('k', 'y')
+
+    assert c.get_stats()['memory_usage'] < 1000
+
+def test_expira_por_ttl(reloj):
+    c = SimpleCache(default_ttl=10)
+    c.set('k', 1)
+    reloj[0] += 10
+    assert c.get('k') == 1
+
+    reloj[0] += 1
+    assert c.get('k') is None
+    assert c.get_stats()['expirations'] == 1
+
+def test_barrido_elimina_expiradas_sin_leerlas(reloj):
+    c = SimpleCache(sweep_interval=60)
+    c.set('corta', 1, ttl=5)
+    c.set('larga', 2, ttl=600)
+    reloj[0] += 61
+
+    c.get('larga')
+
+    assert c.keys() == ['larga']
+
+# --- Single-flight ---
+
+def test_llamadas_concurrentes_calculan_una_sola_vez():
+    c = SimpleCache()
+    liberar = threading.Event()
+    llamadas = []
+
+    def calcular():
+        llamadas.append(1)
+        liberar.wait(5)
+        return {'total': 42}
+
+    resultados = []
+    hilos = [
+        threading.Thread(target=lambda: resultados.append(c.get_or_set_with_status('k', calcular)))
+        for _ in range(8)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    # Esperar a que todas las llamadas estén en curso antes de liberar el cálculo
+    limite = time.time() + 5
+    while c.get_stats()['coalesced_requests'] < 7 and time.time() < limite:
+        time.sleep(0.01)
+    liberar.set()
+    for hilo in hilos:
+        hilo.join(5)
+
+    assert len(llamadas) == 1
+    assert [valor for valor, _ in resultados] == [{'total': 42}] * 8
+    assert sorted(estado for _, estado in resultados) == ['coalesced'] * 7 + ['miss']
+    assert c.get_or_set_with_status('k', calcular) == ({'total': 42}, 'hit')
+    assert c.get_stats()['in_flight'] == 0
+
+def test_error_se_propaga_a_quienes_esperan_y_no_se_cachea():
+    c = SimpleCache()
+    empezo = threading.Event()
+    liberar = threading.Event()
+
+    def fallar():
+        empezo.set()
+        liberar.wait(5)
+        raise ValueError('falló')
+
+    errores = []
+
+    def llamar():
+        try:
+            c.get_or_set('k', fallar)
+        except ValueError as e:
+            errores.append(str(e))
+
+    lider = threading.Thread(target=llamar)
+    lider.start()
+    empezo.wait(5)
+    seguidor = threading.Thread(target=llamar)
+    seguidor.start()
+    limite = time.time() + 5
+    while c.get_stats()['coalesced_requests'] < 1 and time.time() < limite:
+        time.sleep(0.01)
+    liberar.set()
+    lider.join(5)
+    seguidor.join(5)
+
+    assert errores == ['falló', 'falló']
+    assert c.get_or_set('k', lambda: 'ok') == 'ok'
+
+def test_none_no_se_cachea():
+    c = SimpleCache()
+    llamadas = []
+
+    for _ in range(2):
+        c.get_or_set('k', lambda: llamadas.append(1))
+
+    assert len(llamadas) == 2
+
+# --- Claves y generación de datos ---
+
+class Servicio:
+    def __init__(self, db=None):
+        self.db = db
+        self.llamadas = 0
+
+    @cached('kpis')
+    def calcular(self, filtros: dict = None):
+        self.llamadas += 1
+        return {'filtros': filtros}
+
+    def otro(self, filtros: dict = None):
+        pass
+
+@pytest.fixture
+def cache_limpio():
+    cache.clear()
+    yield
+    cache.clear()
+
+def test_clave_ignora_instancia_y_filtros_vacios():
+    clave = make_cache_key('kpis', Servicio.calcular, (Servicio('a'),), {'filtros': {'año': 2024, 'mes': None}})
+
+    assert clave == make_cache_key('kpis', Servicio.calcular, (Servicio('b'), {'año': 2024}), {})
+    assert clave != make_cache_key('kpis', Servicio.calcular, (Servicio(),), {'filtros': {'año': 2023}})
+    assert clave != make_cache_key('kpis', Servicio.otro, (Servicio(),), {'filtros': {'año': 2024}})
+    assert make_cache_key('kpis', Servicio.calcular, (Servicio(),), {'filtros': {}}) == \
+        make_cache_key('kpis', Servicio.calcular, (Servicio(),), {})
+    assert clave.startswith(f'kpis:g{get_data_generation()}:')
+
+def test_listas_de_filtros_en_cualquier_orden_comparten_clave():
+    a = make_cache_key('kpis', Servicio.calcular, (Servicio(),), {'filtros': {'pedidos': ['B', 'A']}})
+    b = make_cache_key('kpis', Servicio.calcular, (Servicio(),), {'filtros': {'pedidos': ['A', 'B']}})
+    assert a == b
+
+def test_metodo_cacheado_se_comparte_entre_instancias(cache_limpio):
+    primero, segundo = Servicio(), Servicio()
+
+    assert primero.calcular({'año': 2024}) == segundo.calcular(filtros={'año': 2024})
+    assert (primero.llamadas, segundo.llamadas) == (1, 0)
+
+def test_nueva_generacion_invalida_los_resultados(cache_limpio):
+    servicio = Servicio()
+    servicio.calcular()
+    generacion = get_data_generation()
+
+    assert bump_data_generation('prueba') == generacion + 1
+    assert cache.keys() == []
+    servicio.calcular()
+    assert servicio.llamadas == 2
@@ -0,0 +1,176 @@
+"""
+Pruebas del compilador de filtros de compras_v2 (compras_v2_filtros.py)
+"""
+
+from datetime import date
+
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base
+
+from compras_v2_filtros import compilar_filtros_compras, filtro_texto_orm, rango_mes_año
+
+Base = declarative_base()
+
+class Compra(Base):
+    __tablename__ = 'compras_prueba'
+    id = Column(Integer, primary_key=True)
+    proveedor = Column(String)
+
+def sql_orm(condicion) -> str:
+    """SQL (SQLite) de una condición ORM con los parámetros en línea"""
+    engine = create_engine('sqlite://')
+    return str(condicion.compile(engine, compile_kwargs={'literal_binds': True}))
+
+# --- rango_mes_año ---
+
+def test_rango_mes_y_año():
+    assert rango_mes_año(3, 2024) == (date(2024, 3, 1), date(2024, 4, 1))
+
+def test_rango_solo_año():
+    assert rango_mes_año(None, 2024) == (date(2024, 1, 1), date(2025, 1, 1))
+
+def test_rango_diciembre_pasa_a_enero_del_año_siguiente():
+    assert rango_mes_año(12, 2024) == (date(2024, 12, 1), date(2025, 1, 1))
+
+def test_rango_acepta_texto():
+    assert rango_mes_año('03', '2024') == (date(2024, 3, 1), date(2024, 4, 1))
+
+def test_rango_mes_sin_año_no_es_rango():
+    assert rango_mes_año(3, None) is None
+
+@pytest.mark.parametrize('mes', [0, 13, -1, 'marzo'])
+def test_rango_mes_invalido_no_se_amplia_al_año(mes):
+    with pytest.raises(ValueError):
+        rango_mes_año(mes, 2024)
+
+# --- compilar_filtros_compras: fechas ---
+
+def test_sin_filtros():
+    assert compilar_filtros_compras(None) == ('', [])
+    assert compilar_filtros_compras({}) == ('', [])
+
+def test_mes_y_año_es_rango_semiabierto():
+    sql, params = compilar_filtros_compras({'mes': 3, 'año': 2024})
+    assert sql == " AND c2.fecha_pedido >= %s AND c2.fecha_pedido < %s"
+    assert params == [date(2024, 3, 1), date(2024, 4, 1)]
+
+def test_solo_año():
+    sql, params = compilar_filtros_compras({'año': 2024})
+    assert sql == " AND c2.fecha_pedido >= %s AND c2.fecha_pedido < %s"
+    assert params == [date(2024, 1, 1), date(2025, 1, 1)]
+
+def test_diciembre_pasa_a_enero():
+    _, params = compilar_filtros_compras({'mes': 12, 'año': 2023})
+    assert params == [date(2023, 12, 1), date(2024, 1, 1)]
+
+def test_mes_sin_año_usa_extract():
+    sql, params = compilar_filtros_compras({'mes': 5})
+    assert sql == " AND EXTRACT(MONTH FROM c2.fecha_pedido) = %s"
+    assert params == [5]
+
+def test_mes_sin_año_invalido():
+    with pytest.raises(ValueError):
+        compilar_filtros_compras({'mes': 13})
+
+def test_alias_de_tabla():
+    sql, _ = compilar_filtros_compras({'año': 2024}, alias='c')
+    assert "c.fecha_pedido >= %s" in sql
+
+def test_fecha_desde():
+    sql, params = compilar_filtros_compras({'fecha_desde': '2024-02-10'})
+    assert sql == " AND c2.fecha_pedido >= %s"
+    assert params == [date(2024, 2, 10)]
+
+def test_fecha_hasta_incluye_todo_el_dia():
+    sql, params = compilar_filtros_compras({'fecha_hasta': '2024-02-29'})
+    assert sql == " AND c2.fecha_pedido < %s"
+    assert params == [date(2024, 3, 1)]
+
+def test_fecha_invalida_se_ignora():
+    assert compilar_filtros_compras({'fecha_hasta': 'no-es-fecha'}) == ('', [])
+
+# --- compilar_filtros_compras: proveedor, material y moneda ---
+
+def test_proveedor_texto_libre_usa_ilike():
+    sql, params = compilar_filtros_compras({'proveedor': 'acero'})
+    assert sql == " AND c2.proveedor ILIKE %s"
+    assert params == ['%acero%']
+
+def test_proveedor_del_catalogo_usa_igualdad():
+    sql, params = compilar_filtros_compras(
+        {'proveedor': 'ACERO SA'}, exactos={'proveedor': frozenset({'ACERO SA'})}
+    )
+    assert sql == " AND c2.proveedor = %s"
+    assert params == ['ACERO SA']
+
+def test_material_exists():
+    sql, params = compilar_filtros_compras({'material': 'PL-10'})
+    assert sql == (
+        " AND EXISTS (SELECT 1 FROM compras_v2_materiales m "
+        "WHERE m.compra_imi = c2.imi AND m.material_codigo ILIKE %s)"
+    )
+    assert params == ['%PL-10%']
+
+def test_material_exists_del_catalogo():
+    sql, params = compilar_filtros_compras(
+        {'material': 'PL-10'}, exactos={'material': frozenset({'PL-10'})}
+    )
+    assert "m.material_codigo = %s" in sql
+    assert params == ['PL-10']
+
+def test_material_join():
+    sql, params = compilar_filtros_compras({'material': 'PL-10'}, material='join', material_alias='cm')
+    assert sql == " AND cm.material_codigo ILIKE %s"
+    assert params == ['%PL-10%']
+
+def test_material_none_se_ignora():
+    assert compilar_filtros_compras({'material': 'PL-10'}, material=None) == ('', [])
+
+def test_moneda():
+    sql, params = compilar_filtros_compras({'moneda': 'USD'})
+    assert sql == " AND c2.moneda = %s"
+    assert params == ['USD']
+
+def test_orden_de_parametros():
+    sql, params = compilar_filtros_compras(
+        {'mes': 1, 'año': 2024, 'proveedor': 'acero', 'material': 'PL', 'moneda': 'MXN'},
+        exactos={'material': frozenset({'PL'})}
+    )
+    assert sql.count('%s') == len(params)
+    assert params == [date(2024, 1, 1), date(2024, 2, 1), '%acero%', 'PL', 'MXN']
+
+# --- filtro_texto_orm ---
+
+def test_orm_valor_del_catalogo_usa_igualdad():
+    condicion = filtro_texto_orm(Compra.proveedor, 'ACERO SA', frozenset({'ACERO SA'}))
+    assert sql_orm(condicion) == "compras_prueba.proveedor = 'ACERO SA'"
+
+def test_orm_sqlite_compara_clave_normalizada():
+    condicion = filtro_texto_orm(Compra.proveedor, ' acero sa ', frozenset({'ACERO SA'}), dialecto='sqlite')
+    assert sql_orm(condicion) == "lower(trim(compras_prueba.proveedor)) = 'acero sa'"
+
+def test_orm_texto_libre_usa_contains():
+    condicion = filtro_texto_orm(Compra.proveedor, 'acero', frozenset({'ACERO SA'}))
+    assert 'LIKE' in sql_orm(condicion)
+
+def test_orm_sqlite_texto_libre_busca_prefijo_normalizado():
+    condicion = filtro_texto_orm(Compra.proveedor, ' Acero ', frozenset({'ACERO SA'}), dialecto='sqlite')
+    assert sql_orm(condicion) == (
+        "lower(trim(compras_prueba.proveedor)) >= 'acero' "
+        "AND lower(trim(compras_prueba.proveedor)) < 'acerp'"
+    )
+
+def test_orm_sqlite_prefijo_usa_indice_de_expresion():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        conn.exec_driver_sql(
+            "CREATE INDEX idx_prueba_proveedor_norm ON compras_prueba (lower(trim(proveedor)))"
+        )
+        condicion = filtro_texto_orm(Compra.proveedor, 'acero', dialecto='sqlite')
+        consulta = str(condicion.compile(engine, compile_kwargs={'literal_binds': True}))
+        plan = conn.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN SELECT id FROM compras_prueba WHERE {consulta}"
+        ).fetchall()
+    assert 'idx_prueba_proveedor_norm' in ' '.join(str(fila) for fila in plan)
@@ -0,0 +1,161 @@
+"""
+Pruebas del cálculo de precios de materiales por columnas (_calcular_precios_materiales)
+contra el cálculo por fila que hacía save_compras_v2_materiales antes del upsert masivo.
+"""
+
+import random
+
+import pandas as pd
+import pytest
+
+from compras_v2_service import ComprasV2Service
+
+def precios_por_fila(service, material: dict, compra: dict) -> dict:
+    """
+    Cálculo por material anterior, con floats (la versión con Decimal fallaba al
+    multiplicar por 0.16 o por el tipo de cambio por defecto 20.0).
+    """
+    pu_usd = float(service.calculate_pu_usd(
+        material['pu_divisa'], compra['moneda'],
+        compra['tipo_cambio_real'], compra['tipo_cambio_estimado']
+    ))
+
+    pu_divisa = float(material['pu_divisa'])
+    pu_mxn = float(material['pu_mxn'])
+    if pu_mxn == 0 and pu_divisa > 0:
+        tipo_cambio_efectivo = compra['tipo_cambio_real'] or compra['tipo_cambio_estimado'] or 20.0
+        if compra['moneda'] == 'USD':
+            pu_mxn = pu_divisa * tipo_cambio_efectivo
+
+    porcentaje_gastos = float(compra['porcentaje_gastos_importacion'] or 0)
+    gastos_importacion_mxn = float(compra['gastos_importacion_mxn'] or 0)
+    costo_total_mxn_compra = float(compra['costo_total_mxn'] or 0)
+    if porcentaje_gastos == 0 and gastos_importacion_mxn > 0 and costo_total_mxn_compra > 0:
+        porcentaje_gastos = (gastos_importacion_mxn / costo_total_mxn_compra) * 100
+
+    if material['pu_mxn_importacion'] == 0 and pu_mxn > 0:
+        pu_mxn_importacion = pu_mxn * (1 + porcentaje_gastos / 100)
+    else:
+        pu_mxn_importacion = float(material['pu_mxn_importacion'])
+
+    kg = float(material['kg'])
+    costo_total_mxn = float(material['costo_total_mxn'])
+    if costo_total_mxn == 0 and pu_mxn > 0:
+        costo_total_mxn = kg * pu_mxn
+
+    if material['costo_total_mxn_imporacion'] == 0 and costo_total_mxn > 0:
+        costo_total_mxn_importacion = costo_total_mxn * (1 + porcentaje_gastos / 100)
+    else:
+        costo_total_mxn_importacion = float(material['costo_total_mxn_imporacion'])
+
+    iva = float(material['iva'])
+    if iva == 0 and costo_total_mxn_importacion > 0:
+        iva = costo_total_mxn_importacion * 0.16
+
+    if material['costo_total_con_iva'] == 0:
+        costo_total_con_iva = costo_total_mxn_importacion + iva
+    else:
+        costo_total_con_iva = float(material['costo_total_con_iva'])
+
+    return {
+        'kg': kg,
+        'pu_divisa': pu_divisa,
+        'pu_mxn': pu_mxn,
+        'pu_usd': pu_usd,
+        'costo_total_divisa': float(material['costo_total_divisa']),
+        # Se guardaba el valor del Excel; el calculado solo alimenta la importación
+        'costo_total_mxn': float(material['costo_total_mxn']),
+        'pu_mxn_importacion': pu_mxn_importacion,
+        'costo_total_mxn_imporacion': costo_total_mxn_importacion,
+        'iva': iva,
+        'costo_total_con_iva': costo_total_con_iva,
+    }
+
+def cero_o(rng, a, b):
+    return 0.0 if rng.random() < 0.4 else round(rng.uniform(a, b), 4)
+
+def generar(rng, n: int):
+    compras = {}
+    materiales = []
+    for imi in range(1, n + 1):
+        compras[imi] = {
+            'moneda': rng.choice(['USD', 'MXN', 'EUR']),
+            'tipo_cambio_real': rng.choice([None, 0.0, 1.0, round(rng.uniform(15, 21), 4)]),
+            'tipo_cambio_estimado': rng.choice([None, 0.0, 1.0, round(rng.uniform(15, 21), 4)]),
+            'gastos_importacion_mxn': rng.choice([None, 0.0, round(rng.uniform(100, 5000), 2)]),
+            'porcentaje_gastos_importacion': rng.choice([None, 0.0, round(rng.uniform(1, 30), 4)]),
+            'costo_total_mxn': rng.choice([None, 0.0, round(rng.uniform(1000, 90000), 2)]),
+        }
+        for codigo in range(rng.randint(1, 3)):
+            materiales.append({
+                'compra_id': imi,
+                'material_codigo': f'MAT{codigo}',
+                'kg': cero_o(rng, 1, 5000),
+                'pu_divisa': cero_o(rng, 0.5, 5),
+                'pu_mxn': cero_o(rng, 10, 100),
+                'costo_total_divisa': cero_o(rng, 100, 20000),
+                'costo_total_mxn': cero_o(rng, 1000, 90000),
+                'pu_mxn_importacion': cero_o(rng, 10, 120),
+                'costo_total_mxn_imporacion': cero_o(rng, 1000, 99000),
+                'iva': cero_o(rng, 100, 15000),
+                'costo_total_con_iva': cero_o(rng, 1000, 110000),
+                'compra_imi': imi,
+            })
+    return compras, materiales
+
+def calcular_por_columnas(service, compras: dict, materiales: list) -> pd.DataFrame:
+    """Arma el DataFrame como _guardar_bloque_materiales (material + compra padre)"""
+    filas = []
+    for material in materiales:
+        compra = dict(compras[material['compra_id']])
+        compra['costo_total_mxn_compra'] = compra.pop('costo_total_mxn')
+        filas.append({**material, **compra})
+    return service._calcular_precios_materiales(pd.DataFrame(filas))
+
+@pytest.mark.parametrize('semilla', range(5))
+def test_columnas_igual_que_por_fila(semilla):
+    rng = random.Random(semilla)
+    service = ComprasV2Service()
+    compras, materiales = generar(rng, 60)
+
+    calculados = calcular_por_columnas(service, compras, materiales)
+
+    assert len(calculados) == len(materiales)
+    for material, (_, fila) in zip(materiales, calculados.iterrows()):
+        esperado = precios_por_fila(service, material, compras[material['compra_id']])
+        assert fila['compra_id'] == material['compra_id']
+        assert fila['material_codigo'] == material['material_codigo']
+        assert fila['compra_imi'] == material['compra_imi']
+        for columna, valor in esperado.items():
+            assert fila[columna] == pytest.approx(valor, rel=1e-9, abs=1e-9), (columna, material)
+
+def test_mxn_sin_tipo_de_cambio_conserva_pu_divisa():
+    service = ComprasV2Service()
+    compras = {1: {'moneda': 'MXN', 'tipo_cambio_real': 1.0, 'tipo_cambio_estimado': None,
+                   'gastos_importacion_mxn': None, 'porcentaje_gastos_importacion': None,
+                   'costo_total_mxn': None}}
+    _, materiales = generar(random.Random(0), 1)
+    materiales = [dict(materiales[0], compra_id=1, pu_divisa=50.0)]
+
+    fila = calcular_por_columnas(service, compras, materiales).iloc[0]
+
+    assert fila['pu_usd'] == 50.0
+
+def test_usd_sin_pu_mxn_usa_tipo_de_cambio_por_defecto():
+    service = ComprasV2Service()
+    compras = {1: {'moneda': 'USD', 'tipo_cambio_real': None, 'tipo_cambio_estimado': 0.0,
+                   'gastos_importacion_mxn': 500.0, 'porcentaje_gastos_importacion': 0.0,
+                   'costo_total_mxn': 10000.0}}
+    material = {'compra_id': 1, 'material_codigo': 'A', 'kg': 10.0, 'pu_divisa': 2.0, 'pu_mxn': 0.0,
+                'costo_total_divisa': 20.0, 'costo_total_mxn': 0.0, 'pu_mxn_importacion': 0.0,
+                'costo_total_mxn_imporacion': 0.0, 'iva': 0.0, 'costo_total_con_iva': 0.0,
+                'compra_imi': 1}
+
+    fila = calcular_por_columnas(service, compras, [material]).iloc[0]
+
+    assert fila['pu_mxn'] == pytest.approx(40.0)
+    # 5% de gastos derivado de gastos_importacion_mxn / costo_total_mxn de la compra
+    assert fila['pu_mxn_importacion'] == pytest.approx(42.0)
+    assert fila['costo_total_mxn_imporacion'] == pytest.approx(420.0)
+    assert fila['iva'] == pytest.approx(67.2)
+    assert fila['costo_total_con_iva'] == pytest.approx(487.2)
@@ -0,0 +1,257 @@
+"""
+Pruebas de la carga de compras_v2 por bloques: lectura del Excel en bloques,
+guardado con un SAVEPOINT por bloque y flujo completo de upload_compras_file
+"""
+
+import io
+from datetime import datetime
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+import compras_v2_service
+import compras_v2_upload_service
+from compras_v2_service import ComprasV2Service
+from compras_v2_upload_service import ComprasV2UploadService
+from utils.excel_reader import ExcelWorkbook
+
+ENCABEZADO_COMPRAS = ['IMI', 'Proveedor', 'Fecha Pedido', 'Moneda', 'Dias Credito']
+ENCABEZADO_MATERIALES = ['IMI', 'Material Codigo', 'KG', 'PU Divisa']
+
+def libro_excel(hojas: dict) -> bytes:
+    """Libro .xlsx en memoria: {nombre de hoja: filas (la primera es el encabezado)}"""
+    libro = Workbook()
+    libro.remove(libro.active)
+    for nombre, filas in hojas.items():
+        hoja = libro.create_sheet(nombre)
+        for fila in filas:
+            hoja.append(fila)
+    salida = io.BytesIO()
+    libro.save(salida)
+    return salida.getvalue()
+
+def filas_compras(n: int) -> list:
+    return [ENCABEZADO_COMPRAS] + [
+        [1000 + i, f'Proveedor {i % 3}', datetime(2024, 1 + i % 12, 1 + i % 28), 'USD', 30]
+        for i in range(n)
+    ]
+
+def filas_materiales(n: int) -> list:
+    return [ENCABEZADO_MATERIALES] + [[1000 + i // 2, f'MAT{i:04d}', 100 + i, 1.5] for i in range(n)]
+
+# --- ExcelWorkbook.iter_chunks ---
+
+@pytest.mark.parametrize('chunksize', [1, 4, 10, 23, 100])
+def test_bloques_concatenados_igual_que_la_hoja_completa(chunksize):
+    filas = filas_compras(23) + [[None] * 5, [None] * 5]
+    with ExcelWorkbook(libro_excel({'Compras': filas}), engine='openpyxl') as libro:
+        bloques = list(libro.iter_chunks('Compras', chunksize, dtype=object))
+        completa = libro.parse('Compras')
+
+    assert all(len(bloque) <= chunksize for bloque in bloques)
+    # Las filas vacías al final de la hoja no forman parte del último bloque
+    assert sum(len(bloque) for bloque in bloques) == 23
+    unida = pd.concat(bloques, ignore_index=True)
+    assert list(unida.columns) == ENCABEZADO_COMPRAS
+    assert unida['IMI'].tolist() == completa['IMI'].tolist()
+    assert unida['Proveedor'].tolist() == completa['Proveedor'].tolist()
+
+def test_filas_vacias_intermedias_se_conservan():
+    filas = filas_compras(5)
+    filas[3:3] = [[None] * 5, [None] * 5]
+    with ExcelWorkbook(libro_excel({'Compras': filas + [[None] * 5]}), engine='openpyxl') as libro:
+        bloques = list(libro.iter_chunks('Compras', 2, dtype=object))
+
+    assert [len(bloque) for bloque in bloques] == [2, 2, 2, 1]
+    assert pd.isna(bloques[1]['IMI']).tolist() == [True, True]
+
+def test_hoja_solo_con_encabezado_no_produce_bloques():
+    with ExcelWorkbook(libro_excel({'Compras': [ENCABEZADO_COMPRAS]}), engine='openpyxl') as libro:
+        assert list(libro.iter_chunks('Compras', 10)) == []
+
+# --- _guardar_por_bloques ---
+
+class Conexion:
+    """Conexión que solo registra sentencias, commits y rollbacks"""
+
+    closed = False
+
+    def __init__(self):
+        self.sentencias = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        conexion = self
+
+        class Cursor:
+            def execute(self, sql, params=None):
+                conexion.sentencias.append(sql)
+
+            def close(self):
+                pass
+
+        return Cursor()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+@pytest.fixture
+def servicio(monkeypatch):
+    servicio = ComprasV2Service()
+    servicio.conn = Conexion()
+    servicio.compras_fallidas = []
+    monkeypatch.setattr(compras_v2_service, 'bump_data_generation', lambda motivo: None)
+    return servicio
+
+def generador(bloques: list, leidos: list):
+    for bloque in bloques:
+        leidos.append(len(bloque))
+        yield bloque
+
+def test_consume_los_bloques_uno_a_uno_con_savepoint(servicio):
+    bloques = [[{'imi': i} for i in range(n)] for n in (3, 0, 2, 4)]
+    leidos, guardados, avance = [], [], []
+
+    def guardar_bloque(cursor, bloque):
+        # El bloque siguiente no se lee hasta terminar de guardar el actual
+        assert leidos[-1] == len(bloque)
+        guardados.append(len(bloque))
+        return len(bloque)
+
+    resultado = servicio._guardar_por_bloques(
+        generador(bloques, leidos), guardar_bloque, 'compras', servicio._marcar_compras_fallidas,
+        progreso=lambda fase, filas: avance.append((fase, filas)), filas_previas=10
+    )
+
+    assert resultado == (9, 9)
+    assert guardados == [3, 2, 4]
+    assert avance == [('guardado', 13), ('guardado', 15), ('guardado', 19)]
+    assert servicio.conn.sentencias == ['SAVEPOINT bloque_carga', 'RELEASE SAVEPOINT bloque_carga'] * 3
+    assert servicio.conn.commits == 1
+
+def test_bloque_con_error_se_revierte_y_los_demas_se_guardan(servicio):
+    bloques = [[{'imi': 1}, {'imi': 2}], [{'imi': 3}], [{'imi': 4}]]
+
+    def guardar_bloque(cursor, bloque):
+        if bloque[0]['imi'] == 3:
+            raise RuntimeError('violación de llave')
+        return len(bloque)
+
+    resultado = servicio._guardar_por_bloques(
+        iter(bloques), guardar_bloque, 'compras', servicio._marcar_compras_fallidas
+    )
+
+    assert resultado == (3, 4)
+    assert servicio.compras_fallidas == [{'imi': 3, 'error': 'violación de llave'}]
+    assert servicio.conn.sentencias[2:4] == ['SAVEPOINT bloque_carga', 'ROLLBACK TO SAVEPOINT bloque_carga']
+    assert servicio.conn.commits == 1
+
+def test_error_al_leer_revierte_toda_la_tabla(servicio):
+    def bloques():
+        yield [{'imi': 1}]
+        raise ValueError('archivo dañado')
+
+    with pytest.raises(ValueError):
+        servicio._guardar_por_bloques(bloques(), lambda cursor, bloque: len(bloque), 'compras',
+                                      servicio._marcar_compras_fallidas)
+
+    assert servicio.conn.commits == 0
+    assert servicio.conn.rollbacks == 1
+
+def test_reemplazo_borra_y_guarda_en_una_sola_transaccion(servicio):
+    servicio._guardar_por_bloques(
+        iter([[{'imi': 1}]]), lambda cursor, bloque: len(bloque), 'compras', servicio._marcar_compras_fallidas,
+        antes=lambda cursor: cursor.execute('DELETE FROM compras_v2'), commit=False
+    )
+
+    assert servicio.conn.sentencias[0] == 'DELETE FROM compras_v2'
+    assert servicio.conn.commits == 0
+
+# --- upload_compras_file ---
+
+@pytest.fixture
+def carga(monkeypatch):
+    """Servicio de carga sin base de datos: registra los bloques que recibiría el guardado"""
+    monkeypatch.setattr(compras_v2_upload_service, 'CHUNK_SIZE', 4)
+    servicio = ComprasV2UploadService()
+    servicio.bloques = {'compras': [], 'materiales': []}
+    servicio.estados = []
+
+    def guardar(compras, materiales, archivo_id, progreso, reemplazar=False):
+        filas = 0
+        for tabla, bloques in (('compras', compras), ('materiales', materiales)):
+            for bloque in bloques:
+                servicio.bloques[tabla].append(bloque)
+                filas += len(bloque)
+                if progreso:
+                    progreso('guardado', filas)
+        return {'compras_guardadas': sum(len(b) for b in servicio.bloques['compras']),
+                'materiales_guardados': sum(len(b) for b in servicio.bloques['materiales']),
+                'total_procesados': filas}
+
+    monkeypatch.setattr(servicio.compras_service, 'save_compras_stream', guardar)
+    monkeypatch.setattr(servicio, '_get_proveedores_info',
+                        lambda nombres: pd.DataFrame(columns=['puerto_origen', 'dias_produccion', 'dias_transporte']))
+    monkeypatch.setattr(servicio, '_create_archivo_record', lambda nombre, tamaño, reemplazar: 7)
+    monkeypatch.setattr(servicio, '_update_archivo_status',
+                        lambda archivo_id, estado, registros, error_message=None: servicio.estados.append(
+                            (archivo_id, estado, registros, error_message)))
+    return servicio
+
+def test_carga_completa_por_bloques_acotados(carga):
+    contenido = libro_excel({'Compras Generales': filas_compras(10), 'Materiales Detalle': filas_materiales(9)})
+    avance = []
+
+    resultado = carga.upload_compras_file(contenido, 'compras.xlsx',
+                                          progreso=lambda fase, *args: avance.append((fase,) + args))
+
+    assert resultado['success'], resultado
+    assert [len(b) for b in carga.bloques['compras']] == [4, 4, 2]
+    assert [len(b) for b in carga.bloques['materiales']] == [4, 4, 1]
+    compras = pd.concat(carga.bloques['compras'])
+    assert compras['imi'].tolist() == list(range(1000, 1010))
+    # El índice de cada bloque continúa el del anterior
+    assert compras.index.tolist() == list(range(10))
+    assert pd.concat(carga.bloques['materiales'])['material_codigo'].tolist() == [f'MAT{i:04d}' for i in range(9)]
+
+    assert resultado['kpis'] == {'total_compras': 10, 'total_materiales': 9, 'proveedores_unicos': 3}
+    assert resultado['total_procesados'] == 19
+    assert avance[:3] == [('parseo',), ('validacion', 0, 19), ('guardado', 0)]
+    assert avance[-1] == ('guardado', 19)
+    assert carga.estados == [(7, 'procesado', 19, None)]
+
+def test_filas_invalidas_se_omiten_sin_romper_los_bloques(carga):
+    filas = filas_compras(6)
+    filas[2][0] = None
+    filas[4][4] = 'treinta'
+    contenido = libro_excel({'Compras Generales': filas, 'Materiales Detalle': filas_materiales(2)})
+
+    resultado = carga.upload_compras_file(contenido, 'compras.xlsx')
+
+    assert resultado['success'], resultado
+    assert pd.concat(carga.bloques['compras'])['imi'].tolist() == [1000, 1002, 1004, 1005]
+
+def test_archivo_sin_compras_no_crea_registro(carga, monkeypatch):
+    monkeypatch.setattr(carga, '_create_archivo_record', lambda *args: pytest.fail('no debe crear el archivo'))
+    contenido = libro_excel({'Compras Generales': [ENCABEZADO_COMPRAS], 'Materiales Detalle': filas_materiales(3)})
+
+    resultado = carga.upload_compras_file(contenido, 'compras.xlsx')
+
+    assert resultado == {'success': False, 'error': 'No se encontraron compras válidas en el archivo'}
+    assert carga.bloques == {'compras': [], 'materiales': []}
+
+def test_error_al_guardar_marca_el_archivo_con_error(carga, monkeypatch):
+    def fallar(*args, **kwargs):
+        raise RuntimeError('se perdió la conexión')
+    monkeypatch.setattr(carga.compras_service, 'save_compras_stream', fallar)
+    contenido = libro_excel({'Compras Generales': filas_compras(3), 'Materiales Detalle': filas_materiales(3)})
+
+    resultado = carga.upload_compras_file(contenido, 'compras.xlsx')
+
+    assert resultado == {'success': False, 'error': 'se perdió la conexión'}
+    assert carga.estados == [(7, 'error', 0, 'se perdió la conexión')]
@@ -0,0 +1,159 @@
+"""
+Pruebas del upsert masivo de compras_v2 (_preparar_compra_v2 / _upsert_compras_v2_lote)
+
+El SQL se arma con el execute_values real de psycopg2 y sus adaptadores, sobre un
+cursor que solo registra las sentencias (no hay PostgreSQL en las pruebas).
+"""
+
+import re
+from datetime import date
+from decimal import Decimal
+
+from psycopg2.extensions import adapt
+
+from compras_v2_service import ComprasV2Service
+
+class CursorSQL:
+    """Cursor mínimo para execute_values: mogrify con los adaptadores de psycopg2"""
+
+    class connection:
+        encoding = 'UTF8'
+
+    def __init__(self):
+        self.sentencias = []
+
+    def mogrify(self, template, args):
+        if isinstance(template, bytes):
+            template = template.decode()
+        return (template % tuple(adapt(a).getquoted().decode() for a in args)).encode()
+
+    def execute(self, sql):
+        self.sentencias.append(sql.decode())
+
+    def fetchall(self):
+        return []
+
+def compra_base(**campos):
+    compra = {'imi': 1001, 'proveedor': 'ACME', 'fecha_pedido': date(2024, 1, 5), 'moneda': 'USD'}
+    compra.update(campos)
+    return compra
+
+def upsert(*compras) -> str:
+    service = ComprasV2Service()
+    cursor = CursorSQL()
+    lote = [service._preparar_compra_v2(c) for c in compras]
+    assert service._upsert_compras_v2_lote(cursor, lote) == len(compras)
+    assert len(cursor.sentencias) == 1
+    return cursor.sentencias[0]
+
+def filas_values(sql: str) -> list:
+    """Tuplas del VALUES (texto SQL de cada valor), en orden"""
+    values = sql.split('AS (VALUES ', 1)[1].split(')\n', 1)[0]
+    filas = re.findall(r"\((.*?::timestamp)\)", values)
+    # Separar por comas fuera de comillas y corchetes
+    return [re.findall(r"(?:'[^']*'|ARRAY\[[^\]]*\]|[^,])+", f) for f in filas]
+
+# --- Columnas y tipos ---
+
+def test_columnas_del_staging_en_orden_y_con_su_tipo():
+    sql = upsert(compra_base())
+    columnas = list(ComprasV2Service.COMPRAS_V2_COLUMNAS)
+    lista = ', '.join(columnas)
+
+    assert f"staged (imi, {lista}, campos, ts)" in sql
+    assert f"INSERT INTO compras_v2 AS c (imi, {lista}, created_at, updated_at)" in sql
+
+    valores = [v.strip() for v in filas_values(sql)[0]]
+    assert len(valores) == len(columnas) + 3
+    for valor, tipo in zip(valores[1:-2], ComprasV2Service.COMPRAS_V2_COLUMNAS.values()):
+        assert valor.endswith(f'::{tipo}')
+    assert valores[-2].endswith('::text[]')
+    assert valores[-1].endswith('::timestamp')
+
+def test_valores_siguen_el_orden_de_las_columnas():
+    sql = upsert(compra_base(dias_credito=30, tipo_cambio_real=17.5, puerto_origen='Shanghai'))
+    columnas = list(ComprasV2Service.COMPRAS_V2_COLUMNAS)
+    valores = dict(zip(['imi'] + columnas, (v.strip() for v in filas_values(sql)[0])))
+
+    assert valores['imi'] == '1001'
+    assert valores['proveedor'] == "'ACME'::text"
+    assert valores['puerto_origen'] == "'Shanghai'::text"
+    assert valores['dias_credito'] == '30::integer'
+    assert valores['tipo_cambio_real'] == '17.5::numeric'
+
+# --- NULL y fechas ---
+
+def test_nulos_llevan_tipo_explicito():
+    sql = upsert(compra_base())
+    columnas = list(ComprasV2Service.COMPRAS_V2_COLUMNAS)
+    valores = dict(zip(['imi'] + columnas, (v.strip() for v in filas_values(sql)[0])))
+
+    assert valores['fecha_arribo_real'] == 'NULL::date'
+    assert valores['puerto_origen'] == 'NULL::text'
+    assert valores['dias_transporte'] == 'NULL::integer'
+
+def test_fechas_date_y_texto_se_castean_a_date():
+    sql = upsert(compra_base(fecha_salida_real='2024-02-01', fecha_arribo_real=date(2024, 3, 2)))
+    columnas = list(ComprasV2Service.COMPRAS_V2_COLUMNAS)
+    valores = dict(zip(['imi'] + columnas, (v.strip() for v in filas_values(sql)[0])))
+
+    assert valores['fecha_pedido'] == "'2024-01-05'::date::date"
+    assert valores['fecha_salida_real'] == "'2024-02-01'::date"
+    assert valores['fecha_arribo_real'] == "'2024-03-02'::date::date"
+    # Días calculados con la fecha en texto y la fecha date
+    assert valores['dias_transporte'] == '30::integer'
+
+def test_preparar_convierte_porcentajes_y_decimales():
+    service = ComprasV2Service()
+    preparada = service._preparar_compra_v2(compra_base(anticipo_pct=25, anticipo_monto='100.50'))
+
+    assert preparada['valores']['anticipo_pct'] == Decimal('9.9999')
+    assert preparada['valores']['anticipo_monto'] == Decimal('100.50')
+    # Decimales vacíos se guardan como 0, pero no sobrescriben un registro existente
+    assert preparada['valores']['gastos_importacion_mxn'] == Decimal('0.0')
+    assert 'gastos_importacion_mxn' not in preparada['campos']
+
+# --- ON CONFLICT ---
+
+def test_on_conflict_solo_actualiza_campos_con_dato():
+    service = ComprasV2Service()
+    preparada = service._preparar_compra_v2(compra_base(
+        puerto_origen='', moneda='nan', dias_credito=0,
+        fecha_salida_real=date(2024, 2, 1), fecha_arribo_real=date(2024, 2, 11)
+    ))
+    campos = preparada['campos']
+
+    assert {'proveedor', 'fecha_pedido', 'dias_credito', 'dias_transporte'} <= set(campos)
+    assert 'puerto_origen' not in campos
+    assert 'moneda' not in campos
+    assert 'dias_puerto_planta' not in campos
+    assert 'imi' not in campos
+
+    sql = upsert(compra_base(puerto_origen='', moneda='nan', dias_credito=0))
+    assert "ARRAY['proveedor','fecha_pedido','dias_credito']::text[]" in sql
+
+def test_on_conflict_asigna_cada_columna_con_su_case():
+    sql = upsert(compra_base())
+    columnas = list(ComprasV2Service.COMPRAS_V2_COLUMNAS)
+
+    assert "ON CONFLICT (imi) DO UPDATE SET" in sql
+    set_columnas = re.search(r"DO UPDATE SET \((.*?)\) = \(", sql).group(1)
+    assert [c.strip() for c in set_columnas.split(',')] == columnas + ['updated_at']
+
+    proyeccion = sql.split('SELECT\n', 1)[1].split('FROM staged s', 1)[0]
+    esperadas = [
+        f"CASE WHEN '{col}' = ANY(s.campos) THEN EXCLUDED.{col} ELSE c.{col} END"
+        for col in columnas
+    ] + ['s.ts']
+    assert [e.strip() for e in proyeccion.split(',\n')] == esperadas
+    assert "WHERE s.imi = EXCLUDED.imi" in sql
+    assert "RETURNING imi" in sql
+
+def test_lote_con_varias_compras_en_una_sentencia():
+    sql = upsert(compra_base(imi=1), compra_base(imi=2, proveedor="O'Brien"))
+    filas = filas_values(sql)
+
+    assert [f[0].strip() for f in filas] == ['1', '2']
+    assert "'O''Brien'::text" in sql
+    # Mismo timestamp para created_at/updated_at de todo el lote
+    assert filas[0][-1] == filas[1][-1]
@@ -0,0 +1,132 @@
+"""
+Pruebas de los límites por clase de endpoint (exec_pool.endpoint_class)
+"""
+
+import asyncio
+import inspect
+import threading
+import time
+
+import pytest
+
+import exec_pool
+from exec_pool import EndpointLimiter, endpoint_class, get_execution_stats
+
+class Concurrencia:
+    """Cuenta las llamadas simultáneas dentro del endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.activas = 0
+        self.maximo = 0
+
+    def entrar(self):
+        with self._lock:
+            self.activas += 1
+            self.maximo = max(self.maximo, self.activas)
+
+    def salir(self):
+        with self._lock:
+            self.activas -= 1
+
+@pytest.fixture
+def limites(monkeypatch):
+    """Limitadores nuevos para no mezclar métricas con otras pruebas"""
+    def configurar(**limites_por_clase):
+        for nombre, limite in limites_por_clase.items():
+            monkeypatch.setitem(exec_pool._limiters, nombre, EndpointLimiter(nombre, limite))
+    return configurar
+
+async def en_paralelo(endpoint, n: int):
+    return await asyncio.gather(*(endpoint(i) for i in range(n)))
+
+def test_endpoint_sincrono_respeta_el_limite_y_sale_del_event_loop(limites):
+    limites(upload=1)
+    concurrencia = Concurrencia()
+    hilos = set()
+
+    @endpoint_class('upload')
+    def subir(i):
+        concurrencia.entrar()
+        hilos.add(threading.current_thread().name)
+        time.sleep(0.02)
+        concurrencia.salir()
+        return i
+
+    assert asyncio.run(en_paralelo(subir, 4)) == [0, 1, 2, 3]
+    assert concurrencia.maximo == 1
+    assert threading.main_thread().name not in hilos
+
+    stats = get_execution_stats()['endpoint_classes']['upload']
+    assert stats['limit'] == 1
+    assert stats['requests'] == 4
+    assert stats['max_waiting'] == 3
+    assert stats['active'] == 0 and stats['waiting'] == 0
+
+def test_endpoint_asincrono_respeta_el_limite(limites):
+    limites(read=2)
+    concurrencia = Concurrencia()
+
+    @endpoint_class('read')
+    async def leer(i):
+        concurrencia.entrar()
+        await asyncio.sleep(0.02)
+        concurrencia.salir()
+        return i * 10
+
+    assert asyncio.run(en_paralelo(leer, 6)) == [0, 10, 20, 30, 40, 50]
+    assert concurrencia.maximo == 2
+
+def test_clases_distintas_no_se_bloquean_entre_si(limites):
+    limites(upload=1, read=8)
+    en_carga = threading.Event()
+    liberar = threading.Event()
+
+    @endpoint_class('upload')
+    def subir():
+        en_carga.set()
+        liberar.wait(5)
+        return 'subido'
+
+    @endpoint_class('read')
+    async def leer():
+        return 'leído'
+
+    async def escenario():
+        carga = asyncio.ensure_future(subir())
+        await asyncio.get_running_loop().run_in_executor(None, en_carga.wait, 5)
+        # La lectura responde mientras la carga sigue ocupando su clase
+        lectura = await asyncio.wait_for(leer(), timeout=1)
+        liberar.set()
+        return lectura, await carga
+
+    assert asyncio.run(escenario()) == ('leído', 'subido')
+
+def test_error_libera_el_cupo(limites):
+    limites(upload=1)
+
+    @endpoint_class('upload')
+    def fallar():
+        raise RuntimeError('falló')
+
+    async def escenario():
+        for _ in range(3):
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(fallar(), timeout=1)
+
+    asyncio.run(escenario())
+    assert exec_pool._limiters['upload'].get_stats()['active'] == 0
+
+def test_conserva_la_firma_para_fastapi():
+    def endpoint(archivo_id: int, incluir_total: bool = True, db=None):
+        pass
+
+    decorado = endpoint_class('read')(endpoint)
+
+    assert inspect.signature(decorado) == inspect.signature(endpoint)
+    assert decorado.__name__ == 'endpoint'
+    assert asyncio.iscoroutinefunction(decorado)
+
+def test_clase_desconocida():
+    with pytest.raises(ValueError):
+        endpoint_class('batch')
@@ -0,0 +1,250 @@
+"""
+Pruebas de KPIAggregator: totales agregados en SQL contra el cálculo en Python
+sobre las filas, y expectativa de cobranza por semanas contra el recorrido
+semana por semana anterior.
+"""
+
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, CFDIRelacionado, Cobranza, Facturacion, PedidosCompras
+from services.kpi_aggregator import KPIAggregator
+
+CLIENTES = ['ACME', 'Beta', 'Gamma', '', None]
+MATERIALES = ['MAT0001-A', 'MAT0001-B', 'MAT0002', ' MAT0003 ', '', None]
+FOLIOS_PAGO = ['P-1', 'P-2', 'TOTAL', 'Suma', '', None]
+
+def poblar(db, rng):
+    uuids = []
+    for folio in range(0, 80):
+        año = rng.choice([2023, 2024])
+        mes = rng.randint(1, 12)
+        uuid = rng.choice([f'U{folio}', f'U{folio}', None, ''])
+        if uuid:
+            uuids.append(uuid)
+        db.add(Facturacion(
+            folio_factura=folio, año=año, mes=mes,
+            fecha_factura=datetime(año, mes, rng.randint(1, 28)),
+            cliente=rng.choice(CLIENTES),
+            monto_total=round(rng.uniform(100, 10000), 2),
+            monto_neto=round(rng.uniform(100, 9000), 2),
+            importe_cobrado=rng.choice([0.0, round(rng.uniform(0, 5000), 2)]),
+            dias_credito=rng.choice([None, 15, 30, 60]),
+            uuid_factura=uuid
+        ))
+    for _ in range(120):
+        db.add(Cobranza(
+            folio_pago=rng.choice(FOLIOS_PAGO),
+            fecha_pago=datetime(2024, rng.randint(1, 12), rng.randint(1, 28)),
+            importe_pagado=round(rng.uniform(-50, 3000), 2),
+            uuid_factura_relacionada=rng.choice(uuids + ['OTRO', None])
+        ))
+    for _ in range(20):
+        db.add(CFDIRelacionado(
+            importe_relacion=round(rng.uniform(0, 1000), 2),
+            uuid_factura_relacionada=rng.choice(uuids)
+        ))
+    for _ in range(150):
+        db.add(PedidosCompras(
+            compra_imi=rng.choice([0, rng.randint(1, 40)]),
+            folio_factura=rng.randint(0, 79),
+            material_codigo=rng.choice(MATERIALES),
+            kg=round(rng.uniform(1, 5000), 2),
+            precio_unitario=rng.choice([0.0, round(rng.uniform(10, 90), 2)]),
+            importe_sin_iva=round(rng.uniform(0, 20000), 2),
+            dias_credito=rng.choice([30, 60]),
+            fecha_factura=datetime(2024, rng.randint(1, 12), rng.randint(1, 28))
+        ))
+    db.commit()
+
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    poblar(session, random.Random(7))
+    yield session
+    session.close()
+
+def kpis_en_python(aggregator: KPIAggregator, filtros: dict) -> dict:
+    """KPIs generales calculados sobre todas las filas, como antes de agregarlos en SQL"""
+    fs, cs, ps = aggregator.facturacion_service, aggregator.cobranza_service, aggregator.pedidos_service
+    facturas = fs.get_facturas_validas(fs.get_facturas_by_filtros(filtros))
+    pedidos = ps.get_pedidos_by_filtros(filtros)
+    cobranzas = cs.get_cobranzas_validas(aggregator.db.query(Cobranza).all())
+    relacionadas = cs.get_cobranzas_relacionadas(facturas, cobranzas)
+    precios = [p.precio_unitario for p in pedidos if p.precio_unitario and p.precio_unitario > 0]
+
+    return {
+        'facturacion_total': sum(f.monto_total for f in facturas),
+        'facturacion_sin_iva': sum(f.monto_neto for f in facturas),
+        'cobranza_total': sum(c.importe_pagado for c in relacionadas),
+        'cobranza_general_total': sum(c.importe_pagado for c in cobranzas),
+        'cobranza_sin_iva': sum(c.importe_pagado / 1.16 for c in relacionadas if c.importe_pagado > 0),
+        'anticipos_total': sum(a.importe_relacion for a in aggregator.db.query(CFDIRelacionado).all()),
+        'total_facturas': len(facturas),
+        'clientes_unicos': len({f.cliente for f in facturas if f.cliente}),
+        'pedidos_unicos': len({p.compra_imi for p in pedidos if p.compra_imi}),
+        'toneladas_total': sum(p.kg for p in pedidos) / 1000,
+        'precio_unitario_promedio': sum(precios) / len(precios) if precios else 0,
+        'aging_cartera': fs.calculate_aging_cartera(facturas),
+        'top_clientes': fs.calculate_top_clientes(facturas),
+        'consumo_material': ps.calculate_consumo_material(pedidos),
+    }
+
+@pytest.mark.parametrize('filtros', [None, {'año': 2024}, {'año': 2024, 'mes': 3}])
+def test_kpis_generales_en_sql_igual_que_en_python(db, filtros):
+    aggregator = KPIAggregator(db)
+    resumen_facturas = aggregator.facturacion_service.get_resumen_facturacion(filtros)
+    resumen_pedidos = aggregator.pedidos_service.get_resumen_pedidos(filtros)
+
+    kpis = aggregator._calculate_kpis_general(resumen_facturas, resumen_pedidos, filtros)
+    esperados = kpis_en_python(aggregator, filtros)
+
+    assert esperados['total_facturas'] > 0
+    for clave in ('total_facturas', 'clientes_unicos', 'pedidos_unicos'):
+        assert kpis[clave] == esperados[clave], clave
+    for clave in ('facturacion_total', 'facturacion_sin_iva', 'cobranza_total', 'cobranza_general_total',
+                  'cobranza_sin_iva', 'anticipos_total', 'toneladas_total', 'precio_unitario_promedio'):
+        assert kpis[clave] == pytest.approx(round(esperados[clave], 2), abs=0.011), clave
+    for grafico in ('aging_cartera', 'top_clientes', 'consumo_material'):
+        assert list(kpis[grafico]) == list(esperados[grafico]), grafico
+        assert list(kpis[grafico].values()) == pytest.approx(list(esperados[grafico].values())), grafico
+
+# --- Expectativa de cobranza ---
+
+def expectativa_semana_por_semana(facturas, pedidos, cobranzas, aplicar_filtro_proporcional):
+    """Recorrido anterior: cada semana vuelve a recorrer pedidos, facturas y cobranzas"""
+    expectativa = {}
+    fechas = [p.fecha_factura for p in pedidos if p.fecha_factura]
+    fecha_referencia = min(fechas) - timedelta(days=min(fechas).weekday())
+
+    for i in range(-4, 18):
+        semana_inicio = fecha_referencia + timedelta(weeks=i)
+        semana_fin = semana_inicio + timedelta(days=6)
+        semana_key = f"Semana {i+5} ({semana_inicio.strftime('%d/%m')} - {semana_fin.strftime('%d/%m')})"
+        cobranza_esperada = 0
+        cobranza_real = 0
+        pedidos_pendientes = 0
+
+        for pedido in pedidos:
+            if not pedido.fecha_factura:
+                continue
+            fecha_vencimiento = pedido.fecha_factura + timedelta(days=pedido.dias_credito or 0)
+            if semana_inicio <= fecha_vencimiento <= semana_fin:
+                pedido_cobrado = False
+                if pedido.folio_factura:
+                    factura = next((f for f in facturas if f.folio_factura == pedido.folio_factura), None)
+                    if factura and factura.uuid_factura:
+                        pagos = [c for c in cobranzas if c.uuid_factura_relacionada == factura.uuid_factura]
+                        if pagos and factura.monto_total > 0:
+                            if sum(c.importe_pagado for c in pagos) / factura.monto_total >= 0.99:
+                                pedido_cobrado = True
+                if not pedido_cobrado:
+                    monto = pedido.importe_sin_iva or 0
+                    if monto > 0:
+                        cobranza_esperada += monto
+                        pedidos_pendientes += 1
+
+        for cobranza in cobranzas:
+            if not (cobranza.fecha_pago and semana_inicio <= cobranza.fecha_pago <= semana_fin):
+                continue
+            if not aplicar_filtro_proporcional:
+                cobranza_real += cobranza.importe_pagado
+                continue
+            if not cobranza.uuid_factura_relacionada:
+                continue
+            factura = next((f for f in facturas if f.uuid_factura == cobranza.uuid_factura_relacionada), None)
+            if factura:
+                monto_total = factura.monto_total
+                porcentaje_cobrado = cobranza.importe_pagado / monto_total if monto_total > 0 else 0
+                monto_pedidos = sum(p.importe_sin_iva or 0 for p in pedidos if p.folio_factura == factura.folio_factura)
+                proporcion = monto_pedidos / monto_total if monto_total > 0 else 0
+                cobranza_real += monto_total * porcentaje_cobrado * proporcion
+
+        if cobranza_esperada > 0 or cobranza_real > 0:
+            expectativa[semana_key] = {
+                'cobranza_esperada': cobranza_esperada,
+                'cobranza_real': cobranza_real,
+                'pedidos_pendientes': pedidos_pendientes
+            }
+    return expectativa
+
+def datos_expectativa(rng):
+    inicio = datetime(2024, 1, 1)
+
+    def fecha(dias):
+        return inicio + timedelta(days=rng.randint(0, dias), hours=rng.randint(0, 23), minutes=rng.randint(0, 59))
+
+    facturas = [
+        SimpleNamespace(folio_factura=rng.randint(1, 30), uuid_factura=rng.choice([f'U{i}', None, '']),
+                        monto_total=rng.choice([0.0, round(rng.uniform(100, 5000), 2)]))
+        for i in range(40)
+    ]
+    pedidos = [
+        SimpleNamespace(id=i, folio_factura=rng.choice([None, 0, rng.randint(1, 30)]),
+                        fecha_factura=rng.choice([None, fecha(120)]),
+                        dias_credito=rng.choice([None, 0, 30, 60, 90, 120]),
+                        importe_sin_iva=rng.choice([None, 0.0, -10.0, round(rng.uniform(50, 3000), 2)]))
+        for i in range(150)
+    ]
+    uuids = [f.uuid_factura for f in facturas if f.uuid_factura]
+    cobranzas = [
+        SimpleNamespace(uuid_factura_relacionada=rng.choice(uuids + [None, 'OTRO']),
+                        fecha_pago=rng.choice([None, fecha(200)]),
+                        importe_pagado=round(rng.uniform(0, 6000), 2))
+        for _ in range(120)
+    ]
+    return facturas, pedidos, cobranzas
+
+def assert_expectativa_igual(obtenida, esperada):
+    assert list(obtenida) == list(esperada)
+    for semana, valores in esperada.items():
+        assert obtenida[semana]['pedidos_pendientes'] == valores['pedidos_pendientes'], semana
+        assert obtenida[semana]['cobranza_esperada'] == pytest.approx(valores['cobranza_esperada']), semana
+        assert obtenida[semana]['cobranza_real'] == pytest.approx(valores['cobranza_real']), semana
+
+@pytest.mark.parametrize('semilla', range(10))
+@pytest.mark.parametrize('proporcional', [False, True])
+def test_expectativa_igual_que_recorrido_por_semana(semilla, proporcional):
+    facturas, pedidos, cobranzas = datos_expectativa(random.Random(semilla))
+
+    obtenida = KPIAggregator(None)._calculate_expectativa_cobranza(
+        facturas, pedidos, None, cobranzas, aplicar_filtro_proporcional=proporcional
+    )
+
+    assert obtenida
+    assert_expectativa_igual(obtenida, expectativa_semana_por_semana(facturas, pedidos, cobranzas, proporcional))
+
+@pytest.mark.parametrize('semilla', range(20))
+def test_sumar_por_semana_igual_que_comparar_cada_semana(semilla):
+    rng = random.Random(semilla)
+    referencia = datetime(2024, 1, 1, 9, 30)
+    inicios = [referencia + timedelta(weeks=i) for i in range(-4, 18)]
+    inicios_np = np.array(inicios, dtype='datetime64[us]')
+    fines_np = inicios_np + np.timedelta64(6, 'D')
+    # Incluye fechas fuera de la ventana y en el hueco entre el fin de una semana y el inicio de la siguiente
+    fechas = [referencia + timedelta(days=rng.uniform(-40, 140)) for _ in range(300)]
+    fechas += [inicio + timedelta(days=6, hours=rng.randint(0, 23)) for inicio in inicios[:5]]
+    montos = [round(rng.uniform(-100, 1000), 2) for _ in fechas]
+
+    sumas, conteos = KPIAggregator(None)._sumar_por_semana(fechas, montos, inicios_np, fines_np, len(inicios))
+
+    for i, inicio in enumerate(inicios):
+        fin = inicio + timedelta(days=6)
+        en_semana = [monto for fecha, monto in zip(fechas, montos) if inicio <= fecha <= fin]
+        assert conteos[i] == len(en_semana)
+        assert sumas[i] == pytest.approx(sum(en_semana))
+
+def test_sumar_por_semana_sin_fechas():
+    sumas, conteos = KPIAggregator(None)._sumar_por_semana(
+        [], [], np.array([], dtype='datetime64[us]'), np.array([], dtype='datetime64[us]'), 3
+    )
+    assert sumas.tolist() == [0.0, 0.0, 0.0]
+    assert conteos.tolist() == [0, 0, 0]
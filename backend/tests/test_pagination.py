@@ -0,0 +1,129 @@
+"""
+Pruebas de la paginación por clave (utils/pagination.py)
+"""
+
+import base64
+import json
+import random
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from compras_v2_service import ComprasV2Service
+from database import Base, Cobranza
+from utils.pagination import decode_cursor, encode_cursor, order_for_keyset, paginate, paginate_keyset
+
+def cursor_de(payload) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+# --- encode_cursor / decode_cursor ---
+
+@pytest.mark.parametrize('valores', [
+    ['2024-03-01', 15],
+    [date(2024, 3, 1), 15],
+    [datetime(2024, 3, 1, 12, 30, 5), 7],
+    [None, 3],
+    ['ACME "Ñandú" / ?&=', 1],
+])
+def test_cursor_ida_y_vuelta(valores):
+    cursor = encode_cursor(valores)
+
+    assert '=' not in cursor and '+' not in cursor and '/' not in cursor
+    esperado = [v.isoformat() if isinstance(v, (date, datetime)) else v for v in valores]
+    assert decode_cursor(cursor, 2) == esperado
+
+def test_cursor_valida_tipos_por_posicion():
+    cursor = encode_cursor([date(2024, 3, 1), 15])
+
+    assert decode_cursor(cursor, 2, [(str,), (int,)]) == ['2024-03-01', 15]
+    assert decode_cursor(encode_cursor([None, 15]), 2, [(str, type(None)), (int,)]) == [None, 15]
+
+@pytest.mark.parametrize('cursor', [
+    'no es base64!',
+    cursor_de({'fecha': '2024-03-01'}),
+    cursor_de(['2024-03-01']),
+    cursor_de(['2024-03-01', 15, 'extra']),
+    base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+    '',
+])
+def test_cursor_malformado(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 2)
+
+@pytest.mark.parametrize('valores', [
+    [15, 15],
+    ['2024-03-01', '15'],
+    ['2024-03-01', True],
+    [None, 15],
+    [['2024-03-01'], 15],
+])
+def test_cursor_con_tipos_incorrectos(valores):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor_de(valores), 2, [(str,), (int,)])
+
+@pytest.mark.parametrize('cursor', ['basura', cursor_de(['2024-13-45', 1]), cursor_de([20240301, 1])])
+def test_pagina_de_compras_rechaza_cursor_invalido(cursor):
+    # El cursor se valida antes de abrir la conexión
+    with pytest.raises(ValueError):
+        ComprasV2Service().get_compras_pagina(cursor=cursor)
+
+# --- paginate_keyset ---
+
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    rng = random.Random(3)
+    fechas = [None, datetime(2024, 1, 1)] + [datetime(2024, rng.randint(1, 12), rng.randint(1, 28)) for _ in range(10)]
+    # Fechas repetidas y NULLs: el desempate por id decide el orden
+    session.add_all(Cobranza(fecha_pago=rng.choice(fechas), importe_pagado=i) for i in range(137))
+    session.commit()
+    yield session
+    session.close()
+
+def orden_completo(db) -> list:
+    filas = order_for_keyset(db.query(Cobranza.fecha_pago, Cobranza.id), Cobranza.fecha_pago, Cobranza.id).all()
+    return [fila.id for fila in filas]
+
+@pytest.mark.parametrize('per_page', [1, 7, 50, 137, 200])
+def test_recorrido_por_cursor_igual_al_orden_completo(db, per_page):
+    query = db.query(Cobranza.fecha_pago, Cobranza.id)
+    ids = []
+    cursor = None
+    while True:
+        pagina = paginate_keyset(query, Cobranza.fecha_pago, Cobranza.id, per_page, cursor, max_per_page=200)
+        ids.extend(fila.id for fila in pagina.items)
+        assert pagina.has_next == (pagina.next_cursor is not None)
+        if not pagina.has_next:
+            break
+        cursor = pagina.next_cursor
+        # El cursor sobrevive el viaje por JSON (fechas como texto ISO)
+        assert decode_cursor(cursor, 2)[1] == ids[-1]
+
+    assert ids == orden_completo(db)
+
+def test_primera_pagina_por_offset_continua_por_cursor(db):
+    query = db.query(Cobranza.fecha_pago, Cobranza.id)
+    primera = paginate(order_for_keyset(query, Cobranza.fecha_pago, Cobranza.id), 1, 20, with_total=False)
+    ultima = primera.items[-1]
+    cursor = encode_cursor([ultima.fecha_pago, ultima.id])
+
+    segunda = paginate_keyset(query, Cobranza.fecha_pago, Cobranza.id, 20, cursor, with_total=True)
+
+    assert primera.total is None
+    assert segunda.total == 137
+    assert [f.id for f in primera.items + segunda.items] == orden_completo(db)[:40]
+
+@pytest.mark.parametrize('cursor', [
+    'basura',
+    cursor_de(['2024-13-45T00:00:00', 1]),
+    cursor_de([20240301, 1]),
+    cursor_de(['2024-03-01T00:00:00', '1']),
+    cursor_de(['2024-03-01T00:00:00', None]),
+])
+def test_paginate_keyset_rechaza_cursor_invalido(db, cursor):
+    with pytest.raises(ValueError):
+        paginate_keyset(db.query(Cobranza.fecha_pago, Cobranza.id), Cobranza.fecha_pago, Cobranza.id, 10, cursor)
@@ -0,0 +1,104 @@
+"""
+Pruebas de PedidosService: facturas de los folios del lote y asignación de
+fecha_factura y dias_credito al guardar pedidos
+"""
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, Facturacion, PedidosCompras
+from services.facturacion_service import FacturacionService
+from services.pedidos_service import PedidosService
+
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+def contar_consultas(db) -> list:
+    """Registra las sentencias SELECT sobre facturacion ejecutadas en la sesión"""
+    consultas = []
+
+    @event.listens_for(db.get_bind(), 'before_cursor_execute')
+    def registrar(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and 'FROM facturacion' in statement:
+            consultas.append(parameters)
+
+    return consultas
+
+
+def test_facturas_por_folio_consulta_solo_los_folios_del_lote(db, monkeypatch):
+    db.add_all([
+        Facturacion(folio_factura=folio, fecha_factura=datetime(2024, 1, folio), dias_credito=folio * 10)
+        for folio in range(1, 8)
+    ])
+    db.commit()
+    monkeypatch.setattr(FacturacionService, 'IN_CHUNK_SIZE', 2)
+    consultas = contar_consultas(db)
+
+    facturas = PedidosService(db)._get_facturas_por_folio(pd.Series([1.0, 3.0, np.nan, 5.0, 3.0, 99.0]))
+
+    assert sorted(facturas['folio_factura'].tolist()) == [1, 3, 5]
+    assert sorted(facturas['dias_credito'].tolist()) == [10, 30, 50]
+    assert pd.api.types.is_datetime64_any_dtype(facturas['fecha_factura'])
+    # 4 folios distintos en bloques de 2
+    assert len(consultas) == 2
+
+def test_facturacion_del_archivo_tiene_prioridad_sobre_la_base(db):
+    db.add(Facturacion(folio_factura=100, fecha_factura=datetime(2023, 5, 1), dias_credito=60))
+    db.add(Facturacion(folio_factura=200, fecha_factura=datetime(2023, 6, 1), dias_credito=90))
+    db.commit()
+    consultas = contar_consultas(db)
+
+    facturacion_archivo = [{'folio_factura': '100', 'fecha_factura': '2024-01-15', 'dias_credito': 15}]
+    facturas = PedidosService(db)._get_facturas_por_folio(pd.Series([100, 200]), facturacion_archivo)
+
+    por_folio = facturas.set_index('folio_factura')
+    assert por_folio.loc[100, 'dias_credito'] == 15
+    assert por_folio.loc[100, 'fecha_factura'] == pd.Timestamp('2024-01-15')
+    assert por_folio.loc[200, 'dias_credito'] == 90
+    # El folio del archivo no se consulta en la base
+    assert len(consultas) == 1
+    assert 100 not in consultas[0]
+
+def test_save_pedidos_toma_datos_de_la_factura(db):
+    db.add(Facturacion(folio_factura=29975, fecha_factura=datetime(2023, 5, 1), dias_credito=60))
+    db.add(Facturacion(folio_factura=300, fecha_factura=datetime(2023, 7, 1), dias_credito=45))
+    db.commit()
+
+    pedidos = pd.DataFrame({
+        'pedido': [1, 2, 3, 4],
+        'folio_factura': ['29,975 PT.202506124013IM251849/10', '300', '400', 'sin folio'],
+        'material': ['MAT0001', 'MAT0002', 'MAT0003', 'MAT0004'],
+        'kg': [10, 20, 30, 40],
+        'precio_unitario': [1, 2, 3, 4],
+        'importe_sin_iva': [100.0, 200.0, 300.0, 400.0],
+        'dias_credito': [None, 10, None, None],
+        'fecha_factura': [None, '2024-03-03', None, None],
+    })
+    facturacion_archivo = pd.DataFrame({'folio_factura': [300], 'fecha_factura': ['2024-02-02'], 'dias_credito': [20]})
+
+    guardados = PedidosService(db).save_pedidos(pedidos, archivo_id=7, facturacion_data=facturacion_archivo)
+    db.commit()
+
+    assert guardados == 3
+    filas = {p.folio_factura: p for p in db.query(PedidosCompras).all()}
+    assert sorted(filas) == [300, 400, 29975]
+    assert filas[29975].dias_credito == 60
+    assert filas[29975].fecha_factura == datetime(2023, 5, 1)
+    # Facturación del mismo archivo: corrige días de crédito, conserva la fecha del pedido
+    assert filas[300].dias_credito == 20
+    assert filas[300].fecha_factura == datetime(2024, 3, 3)
+    # Sin factura: 30 días por defecto
+    assert filas[400].dias_credito == 30
+    assert filas[400].fecha_factura is None
+    assert filas[300].importe_con_iva == pytest.approx(232.0)
+    assert all(p.archivo_id == 7 for p in filas.values())
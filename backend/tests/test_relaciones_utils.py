@@ -0,0 +1,70 @@
+"""
+Pruebas de propagar_datos_factura (relaciones_utils.py): datos de la factura
+propagados a los pedidos con el mismo folio
+"""
+
+import numpy as np
+import pandas as pd
+
+from relaciones_utils import propagar_datos_factura
+
+
+def test_folio_float_coincide_con_folio_entero():
+    facturacion = pd.DataFrame({'folio_factura': [100, 200], 'dias_credito': [45, 60]})
+    pedidos = pd.DataFrame({'dias_credito': [None, None, None]})
+    # Folios extraídos del texto: float64 por los NaN
+    folios = pd.Series([100.0, np.nan, 200.0])
+
+    resultado, conteos = propagar_datos_factura(facturacion, pedidos, folios=folios, campos=('dias_credito',))
+
+    assert resultado['dias_credito'].tolist()[0] == 45
+    assert pd.isna(resultado['dias_credito'].tolist()[1])
+    assert resultado['dias_credito'].tolist()[2] == 60
+    assert conteos['dias_credito'] == {'asignados': 2, 'corregidos': 0}
+
+def test_factura_corrige_dias_credito_salvo_solo_faltantes():
+    facturacion = pd.DataFrame({
+        'folio_factura': [1, 2],
+        'dias_credito': [30, 90],
+        'fecha_factura': pd.to_datetime(['2024-01-10', '2024-02-10'])
+    })
+    pedidos = pd.DataFrame({
+        'folio_factura': [1, 2, 3],
+        'dias_credito': [15, None, 20],
+        'fecha_factura': pd.to_datetime(['2024-01-01', None, '2024-03-01'])
+    })
+
+    resultado, conteos = propagar_datos_factura(facturacion, pedidos, solo_faltantes=('fecha_factura',))
+
+    assert resultado['dias_credito'].tolist() == [30, 90, 20]
+    assert conteos['dias_credito'] == {'asignados': 1, 'corregidos': 1}
+    assert resultado['fecha_factura'].tolist() == list(pd.to_datetime(['2024-01-01', '2024-02-10', '2024-03-01']))
+    assert conteos['fecha_factura'] == {'asignados': 1, 'corregidos': 0}
+    # No modifica el DataFrame original
+    assert pedidos['dias_credito'].isna().sum() == 1
+
+def test_usa_el_ultimo_valor_no_vacio_del_folio():
+    facturacion = pd.DataFrame({'folio_factura': [5, 5, 5], 'dias_credito': [10, 20, None]})
+    pedidos = pd.DataFrame({'folio_factura': [5], 'dias_credito': [None]})
+
+    resultado, _ = propagar_datos_factura(facturacion, pedidos, campos=('dias_credito',))
+
+    assert resultado['dias_credito'].tolist() == [20]
+
+def test_folios_vacios_no_coinciden():
+    facturacion = pd.DataFrame({'folio_factura': ['', None, 'A1'], 'dias_credito': [10, 20, 30]})
+    pedidos = pd.DataFrame({'folio_factura': ['', None, 'A1'], 'dias_credito': [None, None, None]})
+
+    resultado, conteos = propagar_datos_factura(facturacion, pedidos, campos=('dias_credito',))
+
+    assert resultado['dias_credito'].isna().tolist() == [True, True, False]
+    assert conteos['dias_credito']['asignados'] == 1
+
+def test_columna_entera_conserva_el_tipo():
+    facturacion = pd.DataFrame({'folio_factura': [1], 'dias_credito': [45.0]})
+    pedidos = pd.DataFrame({'folio_factura': [1, 2], 'dias_credito': pd.Series([30, 30], dtype='int64')})
+
+    resultado, _ = propagar_datos_factura(facturacion, pedidos, campos=('dias_credito',))
+
+    assert resultado['dias_credito'].dtype == 'int64'
+    assert resultado['dias_credito'].tolist() == [45, 30]
@@ -0,0 +1,189 @@
+"""
+Pruebas de RollupService: resúmenes mensuales contra la agregación en vivo sobre
+las tablas base, recálculo por archivo y fallo sin interrumpir la carga
+"""
+
+import random
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import (
+    Base, Cobranza, Facturacion, PedidosCompras, ResumenCobranzaMensual,
+    ResumenFacturacionMensual, ResumenPedidosMensual, clear_data_by_archivo
+)
+from services.kpi_aggregator import KPIAggregator
+from services.rollup_service import RollupService
+
+FILTROS = [None, {'año': 2024}, {'año': 2024, 'mes': 3}, {'año': 2023, 'mes': 11}]
+
+def agregar_archivo(db, rng, archivo_id: int, folio_inicial: int, uuids: list):
+    """Facturas, pagos y pedidos de un archivo; los pagos pueden relacionarse con facturas de otros archivos"""
+    for folio in range(folio_inicial, folio_inicial + 40):
+        año, mes = rng.choice([(2023, 11), (2023, 12), (2024, 3), (2024, 4)])
+        uuid = rng.choice([f'U{folio}', f'U{folio}', None, ''])
+        if uuid:
+            uuids.append(uuid)
+        db.add(Facturacion(
+            folio_factura=folio, archivo_id=archivo_id, año=año, mes=mes,
+            fecha_factura=datetime(año, mes, rng.randint(1, 28)),
+            cliente=rng.choice(['ACME', 'Beta', 'Gamma', 'Delta', '', None]),
+            monto_total=round(rng.uniform(100, 10000), 2),
+            monto_neto=round(rng.uniform(100, 9000), 2),
+            uuid_factura=uuid
+        ))
+    for _ in range(50):
+        db.add(Cobranza(
+            archivo_id=archivo_id,
+            folio_pago=rng.choice(['P-1', 'P-2', 'TOTAL', '', None]),
+            fecha_pago=datetime(2024, rng.randint(1, 12), rng.randint(1, 28)),
+            importe_pagado=round(rng.uniform(-50, 3000), 2),
+            uuid_factura_relacionada=rng.choice(uuids + ['OTRO', None])
+        ))
+    for _ in range(40):
+        año, mes = rng.choice([(2023, 11), (2024, 3), (2024, 4)])
+        db.add(PedidosCompras(
+            archivo_id=archivo_id,
+            compra_imi=rng.randint(1, 40),
+            folio_factura=rng.randint(1, 79),
+            material_codigo=rng.choice(['MAT0001-A', 'MAT0001-B', 'MAT0002', ' MAT0003 ', '', None]),
+            kg=round(rng.uniform(1, 5000), 2),
+            importe_sin_iva=round(rng.uniform(0, 20000), 2),
+            fecha_factura=datetime(año, mes, rng.randint(1, 28))
+        ))
+    db.flush()
+
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.uuids = []
+    rng = random.Random(11)
+    agregar_archivo(session, rng, 1, 0, session.uuids)
+    agregar_archivo(session, rng, 2, 40, session.uuids)
+    session.commit()
+    yield session
+    session.close()
+
+def resumenes(db) -> dict:
+    """Contenido de los resúmenes sin id ni created_at, para comparar recálculos"""
+    def filas(model, columnas):
+        return sorted(
+            (tuple(getattr(fila, c) for c in columnas) for fila in db.query(model).all()),
+            key=repr
+        )
+    return {
+        'facturacion': filas(ResumenFacturacionMensual, ['archivo_id', 'año', 'mes', 'cliente', 'total_registros',
+                                                        'total_facturas', 'facturacion_total', 'facturacion_sin_iva']),
+        'cobranza': filas(ResumenCobranzaMensual, ['archivo_id', 'año', 'mes', 'relacionada',
+                                                   'cobranza_total', 'cobranza_sin_iva']),
+        'pedidos': filas(ResumenPedidosMensual, ['archivo_id', 'año', 'mes', 'material', 'kg', 'importe_sin_iva']),
+    }
+
+def assert_resumenes_iguales(a: dict, b: dict):
+    for tabla in a:
+        assert len(a[tabla]) == len(b[tabla]), tabla
+        for fila_a, fila_b in zip(a[tabla], b[tabla]):
+            assert fila_a == pytest.approx(fila_b), tabla
+
+def assert_igual_que_en_vivo(db):
+    aggregator = KPIAggregator(db)
+    rollup = aggregator.rollup_service
+    fs, cs, ps = aggregator.facturacion_service, aggregator.cobranza_service, aggregator.pedidos_service
+
+    assert rollup.has_data()
+    for filtros in FILTROS:
+        en_vivo = fs.get_resumen_facturacion(filtros)
+        resumen = rollup.get_resumen_facturacion(filtros)
+        assert en_vivo['total_registros'] > 0
+        assert resumen == pytest.approx(en_vivo), filtros
+
+        en_vivo = cs.get_resumen_cobranza(fs.get_uuids_query(filtros))
+        assert rollup.get_resumen_cobranza(filtros) == pytest.approx(en_vivo), filtros
+
+        en_vivo = fs.calculate_top_clientes_by_filtros(filtros)
+        resumen = rollup.get_top_clientes(filtros)
+        assert list(resumen) == list(en_vivo), filtros
+        assert list(resumen.values()) == pytest.approx(list(en_vivo.values())), filtros
+
+        en_vivo = ps.calculate_consumo_material_by_filtros(filtros)
+        resumen = rollup.get_consumo_material(filtros)
+        assert list(resumen) == list(en_vivo), filtros
+        assert list(resumen.values()) == pytest.approx(list(en_vivo.values())), filtros
+
+def test_resumenes_igual_que_agregacion_en_vivo(db):
+    assert not RollupService(db).has_data()
+
+    assert RollupService(db).refresh_all()
+    db.commit()
+
+    assert_igual_que_en_vivo(db)
+
+def test_refresh_archivo_igual_que_reconstruir_todo(db):
+    RollupService(db).refresh_all()
+    db.commit()
+
+    agregar_archivo(db, random.Random(12), 3, 80, db.uuids)
+    assert RollupService(db).refresh_archivo(3)
+    db.commit()
+    incremental = resumenes(db)
+
+    RollupService(db).refresh_all()
+    db.commit()
+    assert_resumenes_iguales(incremental, resumenes(db))
+    assert_igual_que_en_vivo(db)
+
+def test_borrar_archivo_recalcula_sus_resumenes(db):
+    RollupService(db).refresh_all()
+    db.commit()
+
+    assert clear_data_by_archivo(db, 1)
+    incremental = resumenes(db)
+    assert all(fila[0] != 1 for fila in incremental['facturacion'])
+
+    RollupService(db).refresh_all()
+    db.commit()
+    assert_resumenes_iguales(incremental, resumenes(db))
+    assert_igual_que_en_vivo(db)
+
+# --- Fallo sin interrumpir la carga ---
+
+def test_sin_tablas_de_resumen_la_carga_continua(db):
+    for model in RollupService.TABLAS:
+        model.__table__.drop(db.get_bind())
+
+    agregar_archivo(db, random.Random(13), 3, 80, db.uuids)
+    rollup = RollupService(db)
+    assert rollup.refresh_archivo(3) is False
+    db.commit()
+
+    assert db.query(Facturacion).filter(Facturacion.archivo_id == 3).count() == 40
+    assert not rollup.has_data()
+    assert not KPIAggregator(db)._usar_resumenes()
+
+def test_error_al_recalcular_vacia_resumenes_y_conserva_la_carga(db, monkeypatch):
+    RollupService(db).refresh_all()
+    db.commit()
+
+    def fallar(self, *condiciones):
+        raise RuntimeError('falló el resumen')
+    monkeypatch.setattr(RollupService, '_insert_pedidos', fallar)
+
+    agregar_archivo(db, random.Random(13), 3, 80, db.uuids)
+    rollup = RollupService(db)
+    assert rollup.refresh_archivo(3) is False
+    db.commit()
+
+    assert db.query(Facturacion).filter(Facturacion.archivo_id == 3).count() == 40
+    assert db.query(PedidosCompras).filter(PedidosCompras.archivo_id == 3).count() == 40
+    assert all(db.query(model).count() == 0 for model in RollupService.TABLAS)
+    assert not rollup.has_data()
+
+    # La siguiente reconstrucción vuelve a usar los resúmenes
+    monkeypatch.undo()
+    assert RollupService(db).refresh_all()
+    db.commit()
+    assert_igual_que_en_vivo(db)
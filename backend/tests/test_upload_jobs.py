@@ -0,0 +1,160 @@
+"""
+Pruebas de las cargas en segundo plano (upload_jobs.UploadJobManager): fases,
+estado de error, cargas duplicadas e interrumpidas
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import data_processor
+import exec_pool
+import upload_jobs
+from database import ArchivoProcesado, Base
+from database_service import DatabaseService
+from exec_pool import EndpointLimiter, run_blocking
+from upload_jobs import UploadJobManager
+
+@pytest.fixture
+def Session(monkeypatch):
+    """Base SQLite en memoria compartida entre los hilos del pool"""
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    fabrica = sessionmaker(bind=engine)
+    monkeypatch.setattr(upload_jobs, 'SessionLocal', fabrica)
+    monkeypatch.setitem(exec_pool._limiters, 'background', EndpointLimiter('background', 1))
+    # El parseo corre en el pool de hilos: el pool de procesos no ve los reemplazos de la prueba
+    monkeypatch.setattr(upload_jobs, 'run_cpu', run_blocking)
+    return fabrica
+
+@pytest.fixture
+def manager(Session):
+    manager = UploadJobManager()
+    fases = []
+    actualizar = manager._update
+
+    def registrar(job_id, **campos):
+        if 'fase' in campos:
+            fases.append(campos['fase'])
+        actualizar(job_id, **campos)
+
+    manager._update = registrar
+    manager.fases = fases
+    return manager
+
+def procesar(manager, contenido=b'xlsx', nombre='ventas.xlsx') -> dict:
+    alta = manager.submit('immermex', nombre, len(contenido))
+
+    async def ejecutar():
+        manager.start(alta['job_id'], 'immermex', contenido, nombre, False)
+        await manager._tasks[alta['job_id']]
+
+    asyncio.run(ejecutar())
+    return manager.get_job(alta['job_id'])
+
+def parseo_con(monkeypatch, datos: dict):
+    monkeypatch.setattr(data_processor, 'process_excel_from_bytes', lambda contenido, nombre: (datos, {}))
+
+def test_carga_recorre_las_fases_y_termina(manager, monkeypatch):
+    parseo_con(monkeypatch, {'facturacion_clean': [{}] * 3, 'cobranza_clean': [{}] * 2})
+
+    def guardar(self, datos, archivo_info, progreso=None):
+        assert archivo_info['nombre_archivo'] == 'ventas.xlsx'
+        progreso('guardado', 3)
+        progreso('guardado', 5)
+        return {'success': True, 'archivo_id': 99, 'registros_procesados': 5,
+                'desglose': {'facturacion': 3, 'cobranza': 2}}
+    monkeypatch.setattr(DatabaseService, 'save_processed_data', guardar)
+
+    job = procesar(manager)
+
+    assert manager.fases[:3] == ['parseo', 'validacion', 'guardado']
+    assert manager.fases[-1] == 'completado'
+    assert job['estado'] == 'procesado'
+    assert job['fase'] == 'completado'
+    assert job['registros_procesados'] == 5
+    assert job['registros_totales'] == 5
+    assert job['progreso_porcentaje'] == 100.0
+    assert job['error'] is None
+    assert job['resultado'] == {'archivo_id': 99, 'registros_procesados': 5,
+                                'desglose': {'facturacion': 3, 'cobranza': 2}}
+    assert job['inicio_proceso'] and job['fin_proceso']
+    assert manager.active_jobs() == 0
+
+def test_archivo_sin_registros_termina_en_error(manager, monkeypatch):
+    parseo_con(monkeypatch, {'facturacion_clean': [], 'cobranza_clean': []})
+
+    job = procesar(manager)
+
+    assert manager.fases == ['parseo', 'validacion', 'error']
+    assert job['estado'] == 'error'
+    assert job['fase'] == 'error'
+    assert 'no contiene registros' in job['error']
+    assert job['resultado'] is None
+    assert job['fin_proceso']
+
+def test_error_al_guardar_termina_en_error(manager, monkeypatch):
+    parseo_con(monkeypatch, {'facturacion_clean': [{}]})
+    monkeypatch.setattr(DatabaseService, 'save_processed_data',
+                        lambda self, datos, info, progreso=None: {'success': False, 'error': 'sin conexión'})
+
+    job = procesar(manager)
+
+    assert manager.fases[-2:] == ['guardado', 'error']
+    assert job['estado'] == 'error'
+    assert 'sin conexión' in job['error']
+
+def test_excepcion_en_el_parseo_termina_en_error(manager, monkeypatch):
+    def fallar(contenido, nombre):
+        raise ValueError('hoja ilegible')
+    monkeypatch.setattr(data_processor, 'process_excel_from_bytes', fallar)
+
+    job = procesar(manager)
+
+    assert manager.fases == ['parseo', 'error']
+    assert job['estado'] == 'error'
+    assert job['error'] == 'hoja ilegible'
+
+def test_reenviar_carga_activa_devuelve_el_mismo_job(manager):
+    primera = manager.submit('immermex', 'ventas.xlsx', 10)
+    segunda = manager.submit('immermex', 'ventas.xlsx', 10)
+    otra = manager.submit('compras_v2', 'compras.xlsx', 10)
+
+    assert primera == {'job_id': primera['job_id'], 'duplicado': False}
+    assert segunda == {'job_id': primera['job_id'], 'duplicado': True}
+    assert otra['job_id'] != primera['job_id'] and not otra['duplicado']
+    assert manager.get_job(otra['job_id'])['tipo'] == 'compras_v2'
+    assert manager.get_job(primera['job_id'])['fase'] == 'en_cola'
+
+def test_tipo_de_carga_desconocido(manager):
+    with pytest.raises(ValueError):
+        manager.submit('otro', 'x.xlsx', 1)
+
+def test_carga_sin_avance_se_marca_interrumpida(manager, Session):
+    alta = manager.submit('immermex', 'ventas.xlsx', 10)
+    db = Session()
+    db.query(ArchivoProcesado).filter(ArchivoProcesado.id == alta['job_id']).update({
+        'estado': 'en_proceso',
+        'fase': 'guardado',
+        'updated_at': datetime.utcnow() - timedelta(seconds=upload_jobs.JOB_TIMEOUT_SECONDS + 1)
+    })
+    db.commit()
+    db.close()
+
+    job = manager.get_job(alta['job_id'])
+
+    assert job['estado'] == 'error'
+    assert job['fase'] == 'error'
+    assert 'interrumpida' in job['error']
+    # Ya no está activa: reenviar el archivo vuelve a encolarlo
+    assert manager.submit('immermex', 'ventas.xlsx', 10) == {'job_id': alta['job_id'], 'duplicado': False}
+
+def test_carga_reciente_no_se_marca_interrumpida(manager):
+    alta = manager.submit('immermex', 'ventas.xlsx', 10)
+
+    assert manager.get_job(alta['job_id'])['estado'] == 'en_cola'
+    assert manager.get_job(12345) is None
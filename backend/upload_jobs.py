@@ -0,0 +1,308 @@
+"""
+Cargas de archivos en segundo plano.
+
+/api/upload y /api/upload/compras-v2 con en_segundo_plano=true registran la
+carga en archivos_procesados y responden de inmediato con el id del registro
+como job_id. Un worker del mismo proceso ejecuta parseo → validación →
+guardado respetando el límite de la clase 'background' de exec_pool, y va
+actualizando el registro (estado, fase, registros) en una sesión propia, de
+modo que /api/jobs/{id} puede consultar el avance mientras los datos se
+guardan en su propia transacción.
+
+Reenviar un archivo que ya está en cola o en proceso devuelve el mismo job en
+lugar de procesarlo dos veces.
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+import asyncio
+import json
+import os
+import logging
+
+from database import SessionLocal, ArchivoProcesado, engine
+from exec_pool import get_limiter, run_blocking, run_cpu
+
+logger = logging.getLogger(__name__)
+
+TIPOS_CARGA = {
+    'immermex': 'advanced_cleaning',
+    'compras_v2': 'compras_v2_robust'
+}
+
+ESTADOS_ACTIVOS = ('en_cola', 'en_proceso')
+
+# Una carga activa sin actualizaciones durante este tiempo se considera
+# interrumpida (p. ej. el proceso se reinició a mitad de la carga)
+JOB_TIMEOUT_SECONDS = int(os.getenv("UPLOAD_JOB_TIMEOUT", "1800"))
+
+# SQLite bloquea toda la base durante la transacción de guardado: el avance de
+# esa fase solo se guarda en memoria (en PostgreSQL se persiste siempre)
+PERSISTIR_AVANCE_GUARDADO = engine.dialect.name != "sqlite"
+
+class UploadJobManager:
+    """Registro, ejecución y consulta de cargas en segundo plano"""
+    
+    def __init__(self):
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._avance: Dict[int, Dict[str, Any]] = {}  # Último avance de las cargas de este worker
+    
+    def submit(self, tipo: str, nombre_archivo: str, tamaño: int) -> Dict[str, Any]:
+        """
+        Registra la carga en archivos_procesados con estado 'en_cola'.
+        
+        Returns:
+            {'job_id': id, 'duplicado': bool}; duplicado=True si el archivo ya
+            tenía una carga activa (no se debe volver a ejecutar)
+        """
+        if tipo not in TIPOS_CARGA:
+            raise ValueError(f"Tipo de carga desconocido: {tipo}")
+        
+        db = SessionLocal()
+        try:
+            archivo = db.query(ArchivoProcesado).filter(
+                ArchivoProcesado.nombre_archivo == nombre_archivo
+            ).first()
+            
+            if archivo and archivo.estado in ESTADOS_ACTIVOS:
+                if not self._marcar_si_interrumpido(db, archivo):
+                    logger.info(f"Carga de {nombre_archivo} ya activa (job {archivo.id}), no se reenvía")
+                    return {'job_id': archivo.id, 'duplicado': True}
+            
+            if archivo is None:
+                archivo = ArchivoProcesado(nombre_archivo=nombre_archivo)
+                db.add(archivo)
+            
+            archivo.tamaño_archivo = tamaño
+            archivo.algoritmo_usado = TIPOS_CARGA[tipo]
+            archivo.estado = "en_cola"
+            archivo.fase = "en_cola"
+            archivo.registros_procesados = 0
+            archivo.registros_totales = 0
+            archivo.error_message = None
+            archivo.resultado = None
+            archivo.inicio_proceso = None
+            archivo.fin_proceso = None
+            archivo.fecha_procesamiento = datetime.utcnow()
+            archivo.updated_at = datetime.utcnow()
+            db.commit()
+            
+            logger.info(f"Carga {tipo} de {nombre_archivo} en cola (job {archivo.id})")
+            return {'job_id': archivo.id, 'duplicado': False}
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    
+    def start(self, job_id: int, tipo: str, contenido: bytes, nombre_archivo: str, reemplazar_datos: bool):
+        """Programa la ejecución de la carga en el event loop actual"""
+        task = asyncio.get_running_loop().create_task(
+            self._run(job_id, tipo, contenido, nombre_archivo, reemplazar_datos)
+        )
+        # Referencia fuerte mientras corre: el event loop solo guarda referencias débiles
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._terminar(job_id))
+    
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Estado, fase, registros y velocidad de la carga; None si no existe"""
+        db = SessionLocal()
+        try:
+            archivo = db.query(ArchivoProcesado).filter(ArchivoProcesado.id == job_id).first()
+            if archivo is None:
+                return None
+            if archivo.estado in ESTADOS_ACTIVOS:
+                self._marcar_si_interrumpido(db, archivo)
+            job = self._job_dict(archivo)
+            avance = self._avance.get(job_id)
+            if avance and archivo.estado in ESTADOS_ACTIVOS:
+                job.update(self._metricas(archivo, avance))
+            return job
+        finally:
+            db.close()
+    
+    def active_jobs(self) -> int:
+        """Cargas en cola o en proceso en este worker"""
+        return len(self._tasks)
+    
+    def _terminar(self, job_id: int):
+        self._tasks.pop(job_id, None)
+        self._avance.pop(job_id, None)
+    
+    def _marcar_si_interrumpido(self, db, archivo: ArchivoProcesado) -> bool:
+        """Marca como error una carga activa que ya no corre en ningún worker"""
+        if archivo.id in self._tasks:
+            return False
+        ultima = archivo.updated_at or archivo.fecha_procesamiento
+        if ultima and datetime.utcnow() - ultima < timedelta(seconds=JOB_TIMEOUT_SECONDS):
+            return False
+        
+        archivo.estado = "error"
+        archivo.fase = "error"
+        archivo.error_message = "Carga interrumpida: no se registró avance (¿reinicio del servidor?)"
+        archivo.fin_proceso = datetime.utcnow()
+        db.commit()
+        logger.warning(f"Job {archivo.id} ({archivo.nombre_archivo}) marcado como interrumpido")
+        return True
+    
+    def _update(self, job_id: int, **campos):
+        """Actualiza el registro de la carga en una sesión propia"""
+        db = SessionLocal()
+        try:
+            campos['updated_at'] = datetime.utcnow()
+            db.query(ArchivoProcesado).filter(ArchivoProcesado.id == job_id).update(
+                campos, synchronize_session=False
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error actualizando job {job_id}: {str(e)}")
+        finally:
+            db.close()
+    
+    def _progreso(self, job_id: int):
+        """Callback progreso(fase, registros, registros_totales) para los servicios de carga"""
+        def progreso(fase: str, registros: int = 0, registros_totales: int = None):
+            campos = {'fase': fase, 'registros_procesados': registros}
+            if registros_totales is not None:
+                campos['registros_totales'] = registros_totales
+            self._avance.setdefault(job_id, {}).update(campos)
+            
+            if fase != "guardado" or registros == 0 or PERSISTIR_AVANCE_GUARDADO:
+                self._update(job_id, **campos)
+        return progreso
+    
+    async def _run(self, job_id: int, tipo: str, contenido: bytes, nombre_archivo: str, reemplazar_datos: bool):
+        # Las cargas en cola esperan aquí su turno (EXEC_BACKGROUND_CONCURRENCY)
+        async with get_limiter("background"):
+            await run_blocking(self._update, job_id, estado="en_proceso", inicio_proceso=datetime.utcnow())
+            try:
+                if tipo == 'compras_v2':
+                    resultado = await self._run_compras_v2(job_id, contenido, nombre_archivo, reemplazar_datos)
+                else:
+                    resultado = await self._run_immermex(job_id, contenido, nombre_archivo, reemplazar_datos)
+                
+                await run_blocking(
+                    self._update, job_id,
+                    estado="procesado",
+                    fase="completado",
+                    registros_procesados=resultado.get("registros_procesados", 0),
+                    resultado=json.dumps(resultado, default=str),
+                    fin_proceso=datetime.utcnow()
+                )
+                logger.info(f"Job {job_id} ({nombre_archivo}) completado: {resultado.get('registros_procesados', 0)} registros")
+            except Exception as e:
+                logger.error(f"Job {job_id} ({nombre_archivo}) falló: {str(e)}")
+                await run_blocking(
+                    self._update, job_id,
+                    estado="error",
+                    fase="error",
+                    error_message=str(e),
+                    fin_proceso=datetime.utcnow()
+                )
+    
+    async def _run_immermex(self, job_id: int, contenido: bytes, nombre_archivo: str, reemplazar_datos: bool) -> dict:
+        from data_processor import process_excel_from_bytes
+        from database_service import DatabaseService
+        
+        progreso = self._progreso(job_id)
+        
+        await run_blocking(progreso, "parseo")
+        processed_data_dict, _ = await run_cpu(process_excel_from_bytes, contenido, nombre_archivo)
+        
+        # Validación: algo que guardar antes de tocar (o reemplazar) los datos existentes
+        registros_totales = sum(len(data) for data in processed_data_dict.values())
+        await run_blocking(progreso, "validacion", 0, registros_totales)
+        if registros_totales == 0:
+            raise ValueError("El archivo no contiene registros reconocibles en ninguna hoja")
+        
+        archivo_info = {
+            "nombre": nombre_archivo,
+            "tamaño": len(contenido),
+            "nombre_archivo": nombre_archivo,
+            "reemplazar_datos": reemplazar_datos
+        }
+        
+        def guardar():
+            db = SessionLocal()
+            try:
+                progreso("guardado", 0)
+                return DatabaseService(db).save_processed_data(processed_data_dict, archivo_info, progreso=progreso)
+            finally:
+                db.close()
+        
+        result = await run_blocking(guardar)
+        if not result.get("success", True):
+            raise Exception(f"Error guardando datos: {result.get('error', 'Error desconocido')}")
+        
+        return {
+            "archivo_id": result["archivo_id"],
+            "registros_procesados": result["registros_procesados"],
+            "desglose": result["desglose"]
+        }
+    
+    async def _run_compras_v2(self, job_id: int, contenido: bytes, nombre_archivo: str, reemplazar_datos: bool) -> dict:
+        from compras_v2_upload_service import ComprasV2UploadService
+        
+        service = ComprasV2UploadService()
+        result = await run_blocking(
+            service.upload_compras_file, contenido, nombre_archivo, reemplazar_datos,
+            progreso=self._progreso(job_id)
+        )
+        if not result.get("success"):
+            raise Exception(result.get("error", "Error desconocido"))
+        
+        return {
+            "archivo_id": result["archivo_id"],
+            "registros_procesados": result["total_procesados"],
+            "compras_guardadas": result["compras_guardadas"],
+            "compras_omitidas": result["compras_omitidas"],
+            "materiales_guardados": result["materiales_guardados"],
+            "materiales_omitidos": result["materiales_omitidos"],
+            "total_procesados": result["total_procesados"],
+            "total_omitidos": result["total_omitidos"],
+            "kpis": result.get("kpis", {})
+        }
+    
+    def _metricas(self, archivo: ArchivoProcesado, avance: Dict[str, Any]) -> Dict[str, Any]:
+        """Fase, registros, porcentaje y velocidad (avance en memoria sobre lo guardado en la base)"""
+        registros = avance.get('registros_procesados', archivo.registros_procesados) or 0
+        totales = avance.get('registros_totales', archivo.registros_totales) or 0
+        
+        duracion = None
+        velocidad = None
+        if archivo.inicio_proceso:
+            fin = archivo.fin_proceso or datetime.utcnow()
+            duracion = max((fin - archivo.inicio_proceso).total_seconds(), 0.0)
+            if duracion > 0:
+                velocidad = round(registros / duracion, 2)
+        
+        return {
+            "fase": avance.get('fase', archivo.fase),
+            "registros_procesados": registros,
+            "registros_totales": totales,
+            "progreso_porcentaje": round(min(registros / totales, 1.0) * 100, 1) if totales else None,
+            "registros_por_segundo": velocidad,
+            "duracion_segundos": round(duracion, 2) if duracion is not None else None
+        }
+    
+    def _job_dict(self, archivo: ArchivoProcesado) -> Dict[str, Any]:
+        tipo = 'compras_v2' if archivo.algoritmo_usado == TIPOS_CARGA['compras_v2'] else 'immermex'
+        
+        job = {
+            "job_id": archivo.id,
+            "nombre_archivo": archivo.nombre_archivo,
+            "tipo": tipo,
+            "estado": archivo.estado
+        }
+        job.update(self._metricas(archivo, {}))
+        job.update({
+            "fecha_registro": archivo.fecha_procesamiento.isoformat() if archivo.fecha_procesamiento else None,
+            "inicio_proceso": archivo.inicio_proceso.isoformat() if archivo.inicio_proceso else None,
+            "fin_proceso": archivo.fin_proceso.isoformat() if archivo.fin_proceso else None,
+            "error": archivo.error_message,
+            "resultado": json.loads(archivo.resultado) if archivo.resultado else None
+        })
+        return job
+
+upload_jobs = UploadJobManager()
@@ -2,100 +2,361 @@
 Sistema de caché para optimizar consultas frecuentes
 """
 
+import sys
 import time
 import json
 import hashlib
-from typing import Any, Dict, Optional, Callable
+import inspect
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Callable, Tuple
 from functools import wraps
+from sqlalchemy.orm import Session
+from .performance_monitor import performance_monitor
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Marcador interno para distinguir "no está en caché" de un valor None
+_MISSING = object()
+
+def estimate_size(value: Any, _seen: Optional[set] = None) -> int:
+    """Estima en bytes el tamaño de un valor recorriendo contenedores anidados"""
+    if _seen is None:
+        _seen = set()
+    
+    obj_id = id(value)
+    if obj_id in _seen:
+        return 0
+    _seen.add(obj_id)
+    
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _seen) for item in value)
+    elif hasattr(value, '__dict__'):
+        # Atributos públicos del objeto (omite estado interno, p. ej. de SQLAlchemy)
+        size += sum(estimate_size(v, _seen) for k, v in vars(value).items() if not k.startswith('_'))
+    
+    return size
+
+class _Flight:
+    """Cálculo en curso para una clave (single-flight)"""
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
 class SimpleCache:
     """
-    Sistema de caché simple en memoria para optimizar consultas frecuentes
+    Caché en memoria acotada para optimizar consultas frecuentes.
+    
+    Desaloja por LRU al superar max_entries o max_bytes, expira por TTL con un
+    barrido amortizado y agrupa los fallos concurrentes sobre una misma clave en
+    un único cálculo (get_or_set).
     """
     
-    def __init__(self, default_ttl: int = 300):  # 5 minutos por defecto
-        self._cache: Dict[str, Dict[str, Any]] = {}
+    def __init__(self, default_ttl: int = 300, max_entries: int = 1000,
+                 max_bytes: int = 50 * 1024 * 1024, sweep_interval: int = 60):
+        # TTL de 5 minutos, 1000 entradas y 50 MB por defecto; barrido cada minuto
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._in_flight: Dict[str, _Flight] = {}
         self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._total_bytes = 0
+        self._last_sweep = time.time()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._coalesced = 0
     
     def _generate_key(self, prefix: str, *args, **kwargs) -> str:
         """Genera una clave única para el caché"""
         key_data = f"{prefix}:{args}:{sorted(kwargs.items())}"
         return hashlib.md5(key_data.encode()).hexdigest()
     
+    def _remove(self, key: str) -> None:
+        """Quita una entrada y descuenta su tamaño (requiere el lock)"""
+        entry = self._cache.pop(key)
+        self._total_bytes -= entry['size']
+    
+    def _sweep_expired(self, now: float) -> None:
+        """Elimina entradas expiradas como máximo una vez por sweep_interval (requiere el lock)"""
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        
+        expired = [key for key, entry in self._cache.items() if now > entry['expires_at']]
+        for key in expired:
+            self._remove(key)
+        self._expirations += len(expired)
+        if expired:
+            logger.debug(f"Cache sweep: {len(expired)} entradas expiradas eliminadas")
+    
+    def _evict(self) -> None:
+        """Desaloja las entradas menos usadas hasta respetar los límites (requiere el lock)"""
+        while self._cache and (len(self._cache) > self.max_entries or self._total_bytes > self.max_bytes):
+            key = next(iter(self._cache))
+            self._remove(key)
+            self._evictions += 1
+            logger.debug(f"Cache evicted (LRU) key: {key}")
+    
+    def _lookup(self, key: str, now: float) -> Any:
+        """Busca una entrada vigente y la marca como usada (requiere el lock)"""
+        entry = self._cache.get(key)
+        if entry is None:
+            self._misses += 1
+            return _MISSING
+        
+        if now > entry['expires_at']:
+            self._remove(key)
+            self._expirations += 1
+            self._misses += 1
+            return _MISSING
+        
+        self._cache.move_to_end(key)
+        self._hits += 1
+        return entry['value']
+    
     def get(self, key: str) -> Optional[Any]:
         """Obtiene un valor del caché si no ha expirado"""
-        if key not in self._cache:
-            return None
+        with self._lock:
+            now = time.time()
+            self._sweep_expired(now)
+            value = self._lookup(key, now)
         
-        entry = self._cache[key]
-        if time.time() > entry['expires_at']:
-            del self._cache[key]
+        if value is _MISSING:
             return None
         
         logger.debug(f"Cache hit for key: {key}")
-        return entry['value']
+        return value
     
     def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
         """Guarda un valor en el caché"""
         if ttl is None:
             ttl = self.default_ttl
         
-        self._cache[key] = {
-            'value': value,
-            'expires_at': time.time() + ttl,
-            'created_at': time.time()
-        }
-        logger.debug(f"Cache set for key: {key}, TTL: {ttl}s")
+        size = estimate_size(value) + sys.getsizeof(key)
+        if size > self.max_bytes:
+            logger.warning(f"Valor de {size} bytes excede el presupuesto del caché, no se guarda: {key}")
+            return
+        
+        with self._lock:
+            now = time.time()
+            if key in self._cache:
+                self._remove(key)
+            
+            self._cache[key] = {
+                'value': value,
+                'expires_at': now + ttl,
+                'created_at': now,
+                'size': size
+            }
+            self._total_bytes += size
+            
+            self._sweep_expired(now)
+            self._evict()
+        logger.debug(f"Cache set for key: {key}, TTL: {ttl}s, size: {size} bytes")
+    
+    def get_or_set(self, key: str, compute: Callable[[], Any], ttl: Optional[int] = None) -> Any:
+        """
+        Retorna el valor en caché o lo calcula. Si varias llamadas concurrentes fallan
+        sobre la misma clave, solo una ejecuta compute() y las demás esperan su resultado.
+        """
+        value, _ = self.get_or_set_with_status(key, compute, ttl)
+        return value
+    
+    def get_or_set_with_status(self, key: str, compute: Callable[[], Any],
+                               ttl: Optional[int] = None) -> Tuple[Any, str]:
+        """
+        Igual que get_or_set, pero indica cómo se resolvió la llamada: 'hit' (valor en
+        caché), 'miss' (esta llamada ejecutó compute()) o 'coalesced' (esperó el
+        cálculo en curso de otra llamada).
+        """
+        with self._lock:
+            now = time.time()
+            self._sweep_expired(now)
+            value = self._lookup(key, now)
+            if value is not _MISSING:
+                return value, 'hit'
+            
+            flight = self._in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._in_flight[key] = flight
+            else:
+                self._coalesced += 1
+        
+        if not is_leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, 'coalesced'
+        
+        try:
+            flight.value = compute()
+            if flight.value is not None:
+                self.set(key, flight.value, ttl)
+            return flight.value, 'miss'
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight.event.set()
     
     def delete(self, key: str) -> None:
         """Elimina una entrada del caché"""
-        if key in self._cache:
-            del self._cache[key]
-            logger.debug(f"Cache deleted for key: {key}")
+        with self._lock:
+            if key in self._cache:
+                self._remove(key)
+                logger.debug(f"Cache deleted for key: {key}")
+    
+    def keys(self) -> list:
+        """Copia de las claves actuales (de la menos a la más usada)"""
+        with self._lock:
+            return list(self._cache.keys())
     
     def clear(self) -> None:
         """Limpia todo el caché"""
-        self._cache.clear()
+        with self._lock:
+            self._cache.clear()
+            self._total_bytes = 0
         logger.info("Cache cleared")
     
     def get_stats(self) -> Dict[str, Any]:
         """Obtiene estadísticas del caché"""
-        current_time = time.time()
-        active_entries = sum(1 for entry in self._cache.values() 
-                           if current_time <= entry['expires_at'])
-        
-        return {
-            'total_entries': len(self._cache),
-            'active_entries': active_entries,
-            'expired_entries': len(self._cache) - active_entries,
-            'memory_usage': len(str(self._cache))
-        }
+        with self._lock:
+            current_time = time.time()
+            active_entries = sum(1 for entry in self._cache.values() 
+                               if current_time <= entry['expires_at'])
+            total_requests = self._hits + self._misses
+            
+            return {
+                'total_entries': len(self._cache),
+                'active_entries': active_entries,
+                'expired_entries': len(self._cache) - active_entries,
+                'memory_usage': self._total_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / total_requests, 4) if total_requests else 0.0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'coalesced_requests': self._coalesced,
+                'in_flight': len(self._in_flight)
+            }
 
 # Instancia global del caché
 cache = SimpleCache(default_ttl=300)  # 5 minutos
 
+# Generación de datos: cada escritura la incrementa y forma parte de las claves,
+# así los resultados se pueden cachear hasta que cambien los datos.
+#
+# La generación vive en memoria y es POR PROCESO: solo el proceso que hizo la
+# escritura invalida su caché. El servicio asume un único worker de uvicorn
+# (render.yaml arranca con --workers 1). Con varios workers, los demás seguirían
+# sirviendo KPIs en caché de la generación anterior hasta que expire su TTL (1 h
+# para cache_kpis), así que antes de escalar a más workers habría que leer la
+# generación de la base de datos (p. ej. max(archivos_procesados.updated_at)).
+# Las escrituras la incrementan desde la capa de servicios (DatabaseService,
+# ComprasV2Service, ComprasV2UploadService), no desde los modelos.
+_data_generation = 0
+_data_generation_lock = threading.Lock()
+
+def get_data_generation() -> int:
+    """Retorna la generación de datos vigente"""
+    return _data_generation
+
+def bump_data_generation(reason: str = "") -> int:
+    """
+    Incrementa la generación de datos tras una escritura y libera las entradas
+    de generaciones anteriores
+    """
+    global _data_generation
+    with _data_generation_lock:
+        _data_generation += 1
+        generation = _data_generation
+    
+    deleted = invalidate_data_cache()
+    logger.info(f"Generación de datos {generation} ({reason or 'escritura'}): {deleted} entradas de caché liberadas")
+    return generation
+
+
+def _canonicalize(value: Any) -> Any:
+    """
+    Normaliza argumentos para la clave de caché: diccionarios ordenados sin valores
+    None (vacíos equivalen a None) y listas/conjuntos ordenados.
+    """
+    if isinstance(value, dict):
+        items = {str(k): _canonicalize(v) for k, v in value.items() if v is not None}
+        items = {k: v for k, v in items.items() if v is not None}
+        return dict(sorted(items.items())) or None
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_canonicalize(v) for v in value if v is not None]
+        return sorted(items, key=lambda v: json.dumps(v, sort_keys=True, default=str)) or None
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+def _is_context_argument(name: str, value: Any) -> bool:
+    """Indica si un argumento es contexto de la llamada (self/cls, sesión de BD) y no parte de la clave"""
+    if name in ('self', 'cls', 'db'):
+        return True
+    return isinstance(value, Session)
+
+def make_cache_key(prefix: str, func: Callable, args: tuple, kwargs: dict) -> str:
+    """
+    Genera la clave de caché de una llamada: excluye self y la sesión de BD,
+    canonicaliza los filtros e incluye el nombre de la función y la generación de
+    datos. El prefijo queda visible al inicio de la clave para poder invalidar por patrón.
+    """
+    try:
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = bound.arguments
+    except TypeError:
+        arguments = {**{str(i): arg for i, arg in enumerate(args)}, **kwargs}
+    
+    key_args = {
+        name: _canonicalize(value)
+        for name, value in arguments.items()
+        if not _is_context_argument(name, value)
+    }
+    key_data = json.dumps(
+        {'func': func.__qualname__, 'args': key_args},
+        sort_keys=True, default=str
+    )
+    return f"{prefix}:g{get_data_generation()}:{hashlib.md5(key_data.encode()).hexdigest()}"
+
 def cached(prefix: str, ttl: Optional[int] = None):
     """
-    Decorador para cachear el resultado de funciones
+    Decorador para cachear el resultado de funciones y métodos.
+    
+    La clave no depende de la instancia ni de la sesión de BD, por lo que distintas
+    peticiones con los mismos filtros comparten la entrada. Aciertos y fallos se
+    registran por prefijo en el monitor de performance.
     """
     def decorator(func: Callable) -> Callable:
         @wraps(func)
         def wrapper(*args, **kwargs):
             # Generar clave única
-            key = cache._generate_key(prefix, *args, **kwargs)
-            
-            # Intentar obtener del caché
-            cached_result = cache.get(key)
-            if cached_result is not None:
-                return cached_result
-            
-            # Ejecutar función y guardar resultado
-            result = func(*args, **kwargs)
-            cache.set(key, result, ttl)
+            key = make_cache_key(prefix, func, args, kwargs)
             
+            # Obtener del caché o ejecutar la función una sola vez por clave
+            result, status = cache.get_or_set_with_status(key, lambda: func(*args, **kwargs), ttl)
+            performance_monitor.record_cache_operation(
+                prefix, hit=status == 'hit', coalesced=status == 'coalesced'
+            )
             return result
         
         return wrapper
@@ -108,7 +369,7 @@ def invalidate_cache_pattern(pattern: str) -> int:
     deleted_count = 0
     keys_to_delete = []
     
-    for key in cache._cache.keys():
+    for key in cache.keys():
         if pattern in key:
             keys_to_delete.append(key)
     
@@ -120,15 +381,15 @@ def invalidate_cache_pattern(pattern: str) -> int:
     return deleted_count
 
 # Funciones de utilidad para caché específico
-def cache_kpis(ttl: int = 300):
+def cache_kpis(ttl: int = 3600):
     """Decorador específico para KPIs"""
     return cached("kpis", ttl)
 
-def cache_filtros(ttl: int = 600):
-    """Decorador específico para filtros (10 minutos)"""
+def cache_filtros(ttl: int = 3600):
+    """Decorador específico para filtros"""
     return cached("filtros", ttl)
 
-def cache_graficos(ttl: int = 300):
+def cache_graficos(ttl: int = 3600):
     """Decorador específico para gráficos"""
     return cached("graficos", ttl)
 
@@ -0,0 +1,333 @@
+"""
+Lector de libros Excel con un solo parseo por hoja.
+
+Cada hoja se lee una vez como filas de valores crudos. De esas mismas filas
+salen la vista previa para detectar la fila de encabezados y el DataFrame
+final (con el TextParser de pandas, igual que pd.read_excel), en lugar de
+releer el archivo completo por cada hoja o por cada encabezado candidato.
+
+Motores disponibles:
+- calamine: python-calamine (opcional, lector en Rust), el más rápido
+- openpyxl: modo read_only recorriendo solo valores (values_only)
+
+Por defecto se usa calamine si está instalado; EXCEL_READER_ENGINE permite
+forzar 'openpyxl' o 'calamine'.
+
+Para hojas grandes, iter_chunks entrega la hoja en DataFrames de tamaño fijo
+sin guardar las filas del libro en memoria.
+"""
+
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+import io
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+from pandas.errors import EmptyDataError
+from pandas.io.parsers import TextParser
+from openpyxl.cell.cell import ERROR_CODES
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ('calamine', 'openpyxl')
+
+ExcelSource = Union[bytes, str, Path, io.BufferedIOBase, io.BytesIO]
+
+def calamine_available() -> bool:
+    """True si python-calamine está instalado"""
+    try:
+        import python_calamine  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def resolve_engine(engine: Optional[str] = None) -> str:
+    """Motor a usar: el indicado, EXCEL_READER_ENGINE o calamine si está disponible"""
+    engine = (engine or os.getenv("EXCEL_READER_ENGINE", "")).strip().lower()
+    if engine == 'calamine' and not calamine_available():
+        logger.warning("python-calamine no está instalado, usando openpyxl")
+        return 'openpyxl'
+    if engine in ENGINES:
+        return engine
+    return 'calamine' if calamine_available() else 'openpyxl'
+
+def _convert_openpyxl(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value in ERROR_CODES:
+        return np.nan
+    return value
+
+def _convert_calamine(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, date):
+        return pd.Timestamp(value)
+    if isinstance(value, timedelta):
+        return pd.Timedelta(value)
+    return value
+
+def _parse_rows(rows: List[List[Any]], header: Optional[int] = 0, nrows: Optional[int] = None,
+                dtype=None) -> pd.DataFrame:
+    """DataFrame de filas ya convertidas con el TextParser de pandas (como pd.read_excel)"""
+    if not rows:
+        return pd.DataFrame()
+    try:
+        parser = TextParser(rows, header=header, nrows=nrows, skip_blank_lines=False, dtype=dtype)
+        return parser.read(nrows=nrows)
+    except EmptyDataError:
+        return pd.DataFrame()
+
+def _trim_rows(rows: Iterable[Iterable[Any]], convert) -> List[List[Any]]:
+    """
+    Convierte celdas y recorta vacíos finales como get_sheet_data de pandas:
+    sin celdas vacías al final de cada fila, sin filas vacías al final de la
+    hoja y todas las filas con el mismo ancho.
+    """
+    data = []
+    last_row_with_data = -1
+    for row_number, row in enumerate(rows):
+        converted_row = [convert(value) for value in row]
+        while converted_row and converted_row[-1] == "":
+            converted_row.pop()
+        if converted_row:
+            last_row_with_data = row_number
+        data.append(converted_row)
+    
+    data = data[:last_row_with_data + 1]
+    
+    if data:
+        max_width = max(len(data_row) for data_row in data)
+        data = [data_row + [""] * (max_width - len(data_row)) for data_row in data]
+    
+    return data
+
+class ExcelWorkbook:
+    """
+    Libro Excel abierto con el motor elegido.
+    
+    Las filas crudas de cada hoja se guardan tras el primer parseo, de modo que
+    detect_header_row/preview y parse con el encabezado detectado no vuelven a
+    leer el archivo. parse(..., release=True) libera las filas de la hoja.
+    """
+    
+    def __init__(self, source: ExcelSource, engine: Optional[str] = None):
+        self.engine = resolve_engine(engine)
+        self._rows: Dict[str, List[List[Any]]] = {}
+        
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        elif isinstance(source, Path):
+            source = str(source)
+        
+        if self.engine == 'calamine':
+            from python_calamine import CalamineWorkbook
+            
+            if isinstance(source, str):
+                self._book = CalamineWorkbook.from_path(source)
+            else:
+                self._book = CalamineWorkbook.from_filelike(source)
+            self.sheet_names = list(self._book.sheet_names)
+        else:
+            from openpyxl import load_workbook
+            
+            self._book = load_workbook(source, read_only=True, data_only=True, keep_links=False)
+            self.sheet_names = list(self._book.sheetnames)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def close(self):
+        """Cierra el libro y libera las filas en memoria"""
+        self._rows.clear()
+        if self._book is not None and hasattr(self._book, 'close'):
+            self._book.close()
+        self._book = None
+    
+    def sheet_name(self, sheet: Union[str, int]) -> str:
+        """Nombre de la hoja por nombre exacto o posición (ValueError si no existe)"""
+        if isinstance(sheet, int):
+            if 0 <= sheet < len(self.sheet_names):
+                return self.sheet_names[sheet]
+            raise ValueError(f"Worksheet index {sheet} is invalid, {len(self.sheet_names)} worksheets found")
+        if sheet not in self.sheet_names:
+            raise ValueError(f"Worksheet named '{sheet}' not found")
+        return sheet
+    
+    def has_sheet(self, sheet: str) -> bool:
+        """True si el libro tiene una hoja con ese nombre exacto"""
+        return sheet in self.sheet_names
+    
+    def rows(self, sheet: Union[str, int]) -> List[List[Any]]:
+        """Filas crudas de la hoja (se parsea solo la primera vez)"""
+        nombre = self.sheet_name(sheet)
+        if nombre not in self._rows:
+            if self._book is None:
+                raise ValueError("El libro Excel ya fue cerrado")
+            if self.engine == 'calamine':
+                self._rows[nombre] = self._read_calamine(nombre)
+            else:
+                self._rows[nombre] = self._read_openpyxl(nombre)
+        return self._rows[nombre]
+    
+    def preview(self, sheet: Union[str, int], nrows: int = 20) -> pd.DataFrame:
+        """Primeras nrows filas sin encabezado, como pd.read_excel(header=None, nrows=...)"""
+        return self.parse(sheet, header=None, nrows=nrows)
+    
+    def parse(self, sheet: Union[str, int], header: Optional[int] = 0,
+              nrows: Optional[int] = None, release: bool = False) -> pd.DataFrame:
+        """DataFrame de la hoja con la fila de encabezados indicada (como pd.read_excel)"""
+        nombre = self.sheet_name(sheet)
+        data = self.rows(nombre)
+        if release:
+            self._rows.pop(nombre, None)
+        
+        # TextParser consume las filas de encabezado: se le pasa una copia superficial
+        try:
+            return _parse_rows(list(data), header=header, nrows=nrows)
+        except Exception as err:
+            err.args = (f"{err.args[0]} (sheet: {nombre})", *err.args[1:])
+            raise
+    
+    def iter_rows(self, sheet: Union[str, int]) -> Iterator[List[Any]]:
+        """
+        Filas de la hoja una a una, con las celdas ya convertidas y sin recortar.
+        No se guardan en el libro (salvo que la hoja ya estuviera parseada).
+        """
+        nombre = self.sheet_name(sheet)
+        if nombre in self._rows:
+            yield from self._rows[nombre]
+            return
+        if self._book is None:
+            raise ValueError("El libro Excel ya fue cerrado")
+        
+        if self.engine == 'calamine':
+            hoja = self._book.get_sheet_by_name(nombre)
+            fila_inicio, columna_inicio = hoja.start or (0, 0)
+            # iter_rows empieza en la columna de la primera celda con datos
+            columnas_vacias = [""] * columna_inicio
+            filas = iter(hoja.iter_rows())
+            primera = next(filas, None)
+            if primera is None:
+                return
+            # Según la versión de python-calamine, iter_rows empieza en la fila 1 o en
+            # la primera fila con datos; en el segundo caso la primera fila no está
+            # vacía y se anteponen las filas vacías, como openpyxl y parse()
+            if fila_inicio and any(value != "" for value in primera):
+                for _ in range(fila_inicio):
+                    yield list(columnas_vacias)
+            yield columnas_vacias + [_convert_calamine(value) for value in primera]
+            for row in filas:
+                yield columnas_vacias + [_convert_calamine(value) for value in row]
+        else:
+            hoja = self._book[nombre]
+            hoja.reset_dimensions()
+            for row in hoja.iter_rows(values_only=True):
+                yield [_convert_openpyxl(value) for value in row]
+    
+    def iter_chunks(self, sheet: Union[str, int], chunksize: int, header: int = 0,
+                    dtype=None) -> Iterator[pd.DataFrame]:
+        """
+        La hoja en DataFrames de hasta chunksize filas con las columnas de la
+        fila de encabezados (las columnas sin encabezado a su derecha se
+        descartan). La memoria usada es proporcional a chunksize, no al tamaño
+        de la hoja.
+        
+        Cada bloque infiere sus tipos por separado; con dtype=object las celdas
+        conservan su valor original y el resultado no depende del tamaño del bloque.
+        """
+        nombre = self.sheet_name(sheet)
+        filas = self.iter_rows(nombre)
+        
+        encabezado = None
+        for numero, row in enumerate(filas):
+            if numero == header:
+                encabezado = list(row)
+                break
+        if encabezado is None:
+            return
+        while encabezado and encabezado[-1] == "":
+            encabezado.pop()
+        ancho = len(encabezado)
+        if ancho == 0:
+            return
+        
+        bloque = []
+        # Las filas vacías solo se agregan si después hay datos: las del final
+        # de la hoja no forman parte de ningún bloque
+        vacias = 0
+        for row in filas:
+            row = row[:ancho] if len(row) >= ancho else row + [""] * (ancho - len(row))
+            if all(value == "" for value in row):
+                vacias += 1
+                continue
+            for fila in [[""] * ancho for _ in range(vacias)] + [row]:
+                bloque.append(fila)
+                if len(bloque) >= chunksize:
+                    yield _parse_rows([list(encabezado)] + bloque, dtype=dtype)
+                    bloque = []
+            vacias = 0
+        
+        if bloque:
+            yield _parse_rows([list(encabezado)] + bloque, dtype=dtype)
+    
+    def estimate_rows(self, sheet: Union[str, int]) -> Optional[int]:
+        """Filas de la hoja según sus dimensiones (incluye encabezados); None si se desconocen"""
+        nombre = self.sheet_name(sheet)
+        if nombre in self._rows:
+            return len(self._rows[nombre])
+        if self._book is None:
+            return None
+        if self.engine == 'calamine':
+            hoja = self._book.get_sheet_by_name(nombre)
+            return hoja.end[0] + 1 if hoja.end else 0
+        # En modo read_only las dimensiones vienen del archivo y pueden faltar
+        return self._book[nombre].max_row
+    
+    def parse_all(self, sheets: Optional[Iterable[Union[str, int]]] = None,
+                  header: Optional[int] = 0, release: bool = True) -> Dict[str, pd.DataFrame]:
+        """DataFrames de las hojas indicadas (todas por defecto), sin parsear las demás"""
+        nombres = self.sheet_names if sheets is None else [self.sheet_name(sheet) for sheet in sheets]
+        return {nombre: self.parse(nombre, header=header, release=release) for nombre in nombres}
+    
+    def detect_header_row(self, sheet: Union[str, int], keywords: List[str],
+                          min_matches: int = 1, max_rows: int = 20) -> Optional[int]:
+        """
+        Fila (entre las primeras max_rows) con más palabras clave; None si
+        ninguna alcanza min_matches. Usa las filas ya parseadas de la hoja.
+        """
+        preview = self.preview(sheet, nrows=max_rows)
+        keywords = [keyword.lower() for keyword in keywords]
+        best_match = (None, 0)  # (fila, número_de_coincidencias)
+        
+        for idx, row in preview.iterrows():
+            row_str = ' '.join(row.astype(str).fillna('')).lower()
+            matches = sum(1 for keyword in keywords if keyword in row_str)
+            if matches > best_match[1]:
+                best_match = (idx, matches)
+        
+        return best_match[0] if best_match[1] >= min_matches else None
+    
+    def _read_openpyxl(self, nombre: str) -> List[List[Any]]:
+        sheet = self._book[nombre]
+        # Las dimensiones guardadas en el archivo pueden ser incorrectas
+        sheet.reset_dimensions()
+        return _trim_rows(sheet.iter_rows(values_only=True), _convert_openpyxl)
+    
+    def _read_calamine(self, nombre: str) -> List[List[Any]]:
+        sheet = self._book.get_sheet_by_name(nombre)
+        return _trim_rows(sheet.to_python(skip_empty_area=False), _convert_calamine)
+
+def read_excel_sheets(source: ExcelSource, sheets: Optional[Iterable[Union[str, int]]] = None,
+                      engine: Optional[str] = None) -> Dict[str, pd.DataFrame]:
+    """Equivalente a pd.read_excel(source, sheet_name=None) con el lector configurado"""
+    with ExcelWorkbook(source, engine=engine) as libro:
+        return libro.parse_all(sheets)
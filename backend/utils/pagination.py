@@ -2,26 +2,58 @@
 Utilidades de paginación para optimizar consultas grandes
 """
 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Sequence
 from sqlalchemy.orm import Query
-from sqlalchemy import func
+from sqlalchemy import func, and_, or_, Date, DateTime
+from datetime import date, datetime
+import base64
+import json
 import math
 
 class PaginationResult:
-    """Resultado de una consulta paginada"""
+    """Resultado de una consulta paginada (total puede ser None si no se contó)"""
     
-    def __init__(self, items: List[Any], page: int, per_page: int, total: int):
+    def __init__(self, items: List[Any], page: int, per_page: int, total: Optional[int],
+                 has_next: Optional[bool] = None, next_cursor: Optional[str] = None):
         self.items = items
         self.page = page
         self.per_page = per_page
         self.total = total
-        self.pages = math.ceil(total / per_page) if per_page > 0 else 0
+        self.pages = math.ceil(total / per_page) if total is not None and per_page > 0 else None
         self.has_prev = page > 1
-        self.has_next = page < self.pages
+        self.has_next = has_next if has_next is not None else page < (self.pages or 0)
         self.prev_num = page - 1 if self.has_prev else None
         self.next_num = page + 1 if self.has_next else None
+        self.next_cursor = next_cursor
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Metadatos de paginación para la respuesta del API"""
+        return {
+            "page": self.page,
+            "per_page": self.per_page,
+            "total": self.total,
+            "pages": self.pages,
+            "has_prev": self.has_prev,
+            "has_next": self.has_next,
+            "prev_num": self.prev_num,
+            "next_num": self.next_num,
+            "next_cursor": self.next_cursor
+        }
 
-def paginate(query: Query, page: int = 1, per_page: int = 50, max_per_page: int = 100) -> PaginationResult:
+def count_total(query: Query, cache_key: Optional[str] = None) -> int:
+    """
+    Cuenta los elementos de la consulta. Con cache_key el conteo se cachea por
+    generación de datos (se invalida al cargar o borrar datos).
+    """
+    if not cache_key:
+        return query.order_by(None).count()
+    
+    from utils.cache import cache, get_data_generation
+    key = f"pagination_total:g{get_data_generation()}:{cache_key}"
+    return cache.get_or_set(key, lambda: query.order_by(None).count(), ttl=3600)
+
+def paginate(query: Query, page: int = 1, per_page: int = 50, max_per_page: int = 100,
+             with_total: bool = True, total_cache_key: Optional[str] = None) -> PaginationResult:
     """
     Pagina una consulta SQLAlchemy
     
@@ -30,6 +62,9 @@ def paginate(query: Query, page: int = 1, per_page: int = 50, max_per_page: int
         page: Número de página (empezando en 1)
         per_page: Elementos por página
         max_per_page: Máximo elementos por página permitidos
+        with_total: Si es False no se ejecuta COUNT; has_next se obtiene pidiendo
+            una fila de más (total y pages quedan en None)
+        total_cache_key: Clave para cachear el total (ver count_total)
     
     Returns:
         PaginationResult con los elementos paginados
@@ -42,20 +77,104 @@ def paginate(query: Query, page: int = 1, per_page: int = 50, max_per_page: int
     if per_page > max_per_page:
         per_page = max_per_page
     
-    # Contar total de elementos
-    total = query.count()
-    
     # Calcular offset
     offset = (page - 1) * per_page
     
-    # Obtener elementos de la página
-    items = query.offset(offset).limit(per_page).all()
+    # Obtener elementos de la página (+1 para saber si hay siguiente)
+    items = query.offset(offset).limit(per_page + 1).all()
+    has_next = len(items) > per_page
+    items = items[:per_page]
+    
+    # Contar total de elementos solo si se pide
+    total = count_total(query, total_cache_key) if with_total else None
     
     return PaginationResult(
         items=items,
         page=page,
         per_page=per_page,
-        total=total
+        total=total,
+        has_next=has_next
+    )
+
+def _cursor_types(column, nullable: bool) -> tuple:
+    """Tipos JSON aceptados en el cursor para una columna (fechas viajan como texto ISO)"""
+    if isinstance(column.type, (DateTime, Date)):
+        accepted = (str,)
+    else:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = object
+        accepted = (int, float) if python_type is float else (python_type,)
+    return accepted + (type(None),) if nullable else accepted
+
+def _cursor_value(column, value):
+    """Convierte un valor del cursor al tipo de la columna"""
+    if value is not None and isinstance(column.type, (DateTime, Date)):
+        parsed = datetime.fromisoformat(value)
+        return parsed.date() if isinstance(column.type, Date) and not isinstance(column.type, DateTime) else parsed
+    return value
+
+def order_for_keyset(query: Query, sort_column, tiebreak_column) -> Query:
+    """
+    Orden usado por paginate_keyset: sort_column DESC con NULLs primero (el
+    recorrido hacia atrás del índice B-tree en PostgreSQL) y desempate DESC
+    """
+    return query.order_by(sort_column.desc().nulls_first(), tiebreak_column.desc())
+
+def paginate_keyset(query: Query, sort_column, tiebreak_column, per_page: int = 50,
+                    cursor: Optional[str] = None, max_per_page: int = 100,
+                    with_total: bool = False, total_cache_key: Optional[str] = None) -> PaginationResult:
+    """
+    Paginación por clave (seek) sobre (sort_column DESC, tiebreak_column DESC).
+    
+    El costo por página es constante: en lugar de OFFSET se filtra por la clave
+    de la última fila de la página anterior (cursor opaco en next_cursor). La
+    consulta debe proyectar ambas columnas de orden y no debe estar ordenada.
+    Lanza ValueError si el cursor no es válido.
+    """
+    per_page = max(1, min(per_page, max_per_page))
+    base_query = query
+    
+    if cursor:
+        last_sort, last_tiebreak = decode_cursor(
+            cursor, 2, [_cursor_types(sort_column, nullable=True), _cursor_types(tiebreak_column, nullable=False)]
+        )
+        try:
+            last_sort = _cursor_value(sort_column, last_sort)
+        except (TypeError, ValueError):
+            raise ValueError("Cursor de paginación inválido")
+        
+        if last_sort is None:
+            # Seguimos dentro del tramo de NULLs (van primero)
+            query = query.filter(or_(
+                and_(sort_column.is_(None), tiebreak_column < last_tiebreak),
+                sort_column.isnot(None)
+            ))
+        else:
+            query = query.filter(or_(
+                sort_column < last_sort,
+                and_(sort_column == last_sort, tiebreak_column < last_tiebreak)
+            ))
+    
+    items = order_for_keyset(query, sort_column, tiebreak_column).limit(per_page + 1).all()
+    has_next = len(items) > per_page
+    items = items[:per_page]
+    
+    next_cursor = None
+    if has_next:
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, sort_column.key), getattr(last, tiebreak_column.key)])
+    
+    total = count_total(base_query, total_cache_key) if with_total else None
+    
+    return PaginationResult(
+        items=items,
+        page=1,
+        per_page=per_page,
+        total=total,
+        has_next=has_next,
+        next_cursor=next_cursor
     )
 
 def paginate_dict(data: List[Dict[str, Any]], page: int = 1, per_page: int = 50) -> Dict[str, Any]:
@@ -108,3 +227,40 @@ def get_pagination_params(page: Optional[int] = None, per_page: Optional[int] =
     per_page = max(1, min(100, per_page or 50))  # Entre 1 y 100
     
     return page, per_page
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    Codifica la clave de la última fila de una página como cursor opaco
+    (JSON en base64 url-safe; fechas en ISO)
+    """
+    serializable = [value.isoformat() if isinstance(value, (date, datetime)) else value for value in values]
+    payload = json.dumps(serializable, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+def _has_type(value: Any, accepted: tuple) -> bool:
+    """isinstance que no acepta bool como int (JSON distingue true de 1)"""
+    if isinstance(value, bool) and bool not in accepted:
+        return False
+    return isinstance(value, accepted)
+
+def decode_cursor(cursor: str, size: int, types: Optional[Sequence[tuple]] = None) -> List[Any]:
+    """
+    Decodifica un cursor de encode_cursor con `size` valores.
+    
+    types (opcional) indica por posición los tipos aceptados, p. ej.
+    [(str,), (int,)]; incluya type(None) donde el valor pueda ser nulo.
+    Lanza ValueError si el cursor no es válido.
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding).decode('utf-8'))
+    except Exception:
+        raise ValueError("Cursor de paginación inválido")
+    
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Cursor de paginación inválido")
+    
+    if types is not None:
+        if not all(_has_type(value, accepted) for value, accepted in zip(values, types)):
+            raise ValueError("Cursor de paginación inválido")
+    return values
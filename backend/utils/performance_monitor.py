@@ -138,7 +138,9 @@ class PerformanceMonitor:
         self.cache_stats = {
             "hits": 0,
             "misses": 0,
-            "operations": deque(maxlen=100)
+            "coalesced": 0,
+            "operations": deque(maxlen=100),
+            "by_operation": defaultdict(lambda: {"hits": 0, "misses": 0, "coalesced": 0})
         }
         
         # Estado del monitor
@@ -318,19 +320,31 @@ class PerformanceMonitor:
             "success": success
         })
     
-    def record_cache_operation(self, operation: str, hit: bool):
-        """Registra una operación de cache"""
-        if hit:
+    def record_cache_operation(self, operation: str, hit: bool, coalesced: bool = False):
+        """
+        Registra una operación de cache. Las llamadas que esperaron el cálculo en curso
+        de otra (coalesced) se cuentan aparte y no entran en el hit rate.
+        """
+        if coalesced:
+            self.cache_stats["coalesced"] += 1
+            self.cache_stats["by_operation"][operation]["coalesced"] += 1
+        elif hit:
             self.cache_stats["hits"] += 1
+            self.cache_stats["by_operation"][operation]["hits"] += 1
         else:
             self.cache_stats["misses"] += 1
+            self.cache_stats["by_operation"][operation]["misses"] += 1
         
         self.cache_stats["operations"].append({
             "timestamp": datetime.now(timezone.utc),
             "operation": operation,
-            "hit": hit
+            "hit": hit,
+            "coalesced": coalesced
         })
         
+        if coalesced:
+            return
+        
         # Calcular hit rate
         total_operations = self.cache_stats["hits"] + self.cache_stats["misses"]
         if total_operations > 0:
@@ -435,11 +449,23 @@ class PerformanceMonitor:
         if total_operations > 0:
             hit_rate = (self.cache_stats["hits"] / total_operations) * 100
         
+        by_operation = {}
+        for operation, stats in self.cache_stats["by_operation"].items():
+            operation_total = stats["hits"] + stats["misses"]
+            by_operation[operation] = {
+                "hits": stats["hits"],
+                "misses": stats["misses"],
+                "coalesced": stats["coalesced"],
+                "hit_rate": (stats["hits"] / operation_total) * 100 if operation_total > 0 else 0
+            }
+        
         return {
             "hits": self.cache_stats["hits"],
             "misses": self.cache_stats["misses"],
+            "coalesced": self.cache_stats["coalesced"],
             "total_operations": total_operations,
-            "hit_rate": hit_rate
+            "hit_rate": hit_rate,
+            "by_operation": by_operation
         }
     
     def add_alert_callback(self, callback: Callable[[Alert], None]):
@@ -4,6 +4,7 @@ Extrae funciones comunes de validación y conversión de datos
 """
 
 import numpy as np
+import pandas as pd
 import logging
 from datetime import datetime
 from typing import Any, Union, Optional
@@ -144,3 +145,101 @@ class DataValidator:
             return uuid_str
         
         return None
+    
+    # Versiones vectorizadas (por columna) de las conversiones anteriores.
+    # Con default=None conservan los faltantes (NaN/NaT/None) para que el
+    # consumidor aplique su propio valor por defecto.
+    
+    @staticmethod
+    def as_frame(data) -> pd.DataFrame:
+        """DataFrame a partir de un DataFrame o de una lista de diccionarios"""
+        if data is None:
+            return pd.DataFrame()
+        if isinstance(data, pd.DataFrame):
+            return data
+        return pd.DataFrame.from_records(data)
+    
+    @staticmethod
+    def get_column(df: pd.DataFrame, *nombres: str) -> pd.Series:
+        """Primera columna existente entre nombres, o una columna vacía"""
+        for nombre in nombres:
+            if nombre in df.columns:
+                return df[nombre]
+        return pd.Series(None, index=df.index, dtype=object)
+    
+    @staticmethod
+    def _text_values(series: pd.Series) -> pd.Series:
+        """Valores de texto (sin espacios extremos) de la serie; NaN donde no son str"""
+        if series.dtype == object:
+            es_texto = series.map(lambda valor: isinstance(valor, str)).astype(bool)
+            if es_texto.any():
+                return series.where(es_texto).str.strip()
+        return pd.Series(np.nan, index=series.index, dtype=object)
+    
+    @staticmethod
+    def safe_string_series(series: pd.Series, default: Optional[str] = '') -> pd.Series:
+        """Equivalente vectorizado de safe_string"""
+        texto = series.astype(str).str.strip()
+        nulo = series.isna() | texto.str.lower().isin(['nan', 'none', 'null', 'nat', ''])
+        return texto.astype(object).where(~nulo, default)
+    
+    @staticmethod
+    def safe_float_series(series: pd.Series, default: Optional[float] = 0.0) -> pd.Series:
+        """Equivalente vectorizado de safe_float (en texto conserva dígitos, punto, coma y signo)"""
+        if pd.api.types.is_datetime64_any_dtype(series):
+            valores = pd.Series(np.nan, index=series.index)
+        elif series.dtype != object:
+            valores = pd.to_numeric(series, errors='coerce').astype(float)
+        else:
+            texto = DataValidator._text_values(series)
+            es_texto = texto.notna()
+            limpio = texto.str.replace(r'[^\d.,-]', '', regex=True).str.replace(',', '.', regex=False)
+            valores = pd.to_numeric(series.where(~es_texto), errors='coerce').astype(float)
+            valores = valores.where(~es_texto, pd.to_numeric(limpio, errors='coerce'))
+        valores = valores.replace([np.inf, -np.inf], np.nan)
+        return valores if default is None else valores.fillna(default)
+    
+    @staticmethod
+    def safe_int_series(series: pd.Series, default: Optional[int] = 30) -> pd.Series:
+        """Equivalente vectorizado de safe_int (trunca decimales; en texto ignora comas)"""
+        if pd.api.types.is_datetime64_any_dtype(series):
+            valores = pd.Series(np.nan, index=series.index)
+        elif series.dtype != object:
+            valores = pd.to_numeric(series, errors='coerce').astype(float)
+        else:
+            texto = DataValidator._text_values(series)
+            es_texto = texto.notna()
+            limpio = texto.str.replace(',', '', regex=False).str.strip()
+            valores = pd.to_numeric(series.where(~es_texto), errors='coerce').astype(float)
+            valores = valores.where(~es_texto, pd.to_numeric(limpio, errors='coerce'))
+        valores = np.trunc(valores.replace([np.inf, -np.inf], np.nan))
+        if default is None:
+            return valores.astype('Int64')
+        return valores.fillna(default).astype('int64')
+    
+    @staticmethod
+    def safe_date_series(series: pd.Series) -> pd.Series:
+        """
+        Equivalente vectorizado de safe_date: fechas tal cual, texto en formato
+        YYYY-MM-DD o DD/MM/YYYY; números y texto no reconocido quedan en NaT
+        """
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return series
+        if series.dtype != object:
+            return pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+        
+        texto = DataValidator._text_values(series)
+        no_texto = series.where(texto.isna())
+        numerico = pd.to_numeric(no_texto, errors='coerce').notna()
+        fechas = pd.to_datetime(no_texto.where(~numerico), errors='coerce')
+        for formato in ('%Y-%m-%d', '%d/%m/%Y'):
+            fechas = fechas.fillna(pd.to_datetime(texto, format=formato, errors='coerce'))
+        return fechas
+    
+    @staticmethod
+    def dias_credito_series(series: pd.Series) -> pd.Series:
+        """Días de crédito desde texto: 'contado' es 0, si no el primer número (0 si no hay)"""
+        texto = series.astype(str).str.strip().str.lower()
+        dias = pd.to_numeric(texto.str.extract(r'(\d+)', expand=False), errors='coerce')
+        dias = dias.where(~texto.str.contains('contado', regex=False) & series.notna())
+        return dias.fillna(0).astype('int64')
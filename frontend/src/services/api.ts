@@ -164,15 +164,59 @@ class ApiService {
   }
 
   // Archivos
+  // Las cargas se procesan en segundo plano: el backend responde con job_id y
+  // se consulta /jobs/{id} hasta que termina (evita timeouts del proxy)
   async uploadFile(file: File): Promise<{ registros_procesados?: number; [key: string]: any }> {
     const formData = new FormData();
     formData.append('file', file);
 
-    return this.request<{ registros_procesados?: number; [key: string]: any }>('/upload', {
+    const { job_id } = await this.request<{ job_id: number }>('/upload?en_segundo_plano=true', {
       method: 'POST',
       headers: {}, // No Content-Type header for FormData
       body: formData,
     });
+
+    const job = await this.waitForUploadJob(job_id);
+    return { ...job.resultado, job_id, registros_procesados: job.registros_procesados };
+  }
+
+  async getUploadJob(jobId: number): Promise<{
+    estado: string;
+    fase: string | null;
+    registros_procesados: number;
+    registros_totales: number;
+    registros_por_segundo: number | null;
+    error: string | null;
+    resultado: { [key: string]: any } | null;
+    [key: string]: any
+  }> {
+    return this.request(`/jobs/${jobId}`);
+  }
+
+  // Consulta el job con espera creciente (1s, 1.5s, ... hasta 10s) y se rinde
+  // si el job desaparece (404) o no termina antes del plazo
+  private async waitForUploadJob(
+    jobId: number,
+    { initialIntervalMs = 1000, maxIntervalMs = 10000, timeoutMs = 30 * 60 * 1000 } = {}
+  ) {
+    const deadline = Date.now() + timeoutMs;
+    let intervalMs = initialIntervalMs;
+
+    while (Date.now() < deadline) {
+      const job = await this.getUploadJob(jobId).catch((error: unknown) => {
+        if (error instanceof Error && /status: 404\b/.test(error.message)) {
+          throw new Error(`La carga ${jobId} ya no existe en el servidor`);
+        }
+        throw error;
+      });
+      if (job.estado === 'procesado') return job;
+      if (job.estado === 'error') throw new Error(job.error || 'Error procesando archivo');
+
+      await new Promise(resolve => setTimeout(resolve, Math.min(intervalMs, Math.max(0, deadline - Date.now()))));
+      intervalMs = Math.min(intervalMs * 1.5, maxIntervalMs);
+    }
+
+    throw new Error(`La carga ${jobId} no terminó en ${Math.round(timeoutMs / 60000)} minutos`);
   }
 
   // ==================== COMPRAS_V2 ENDPOINTS ====================
@@ -321,16 +365,14 @@ class ApiService {
     console.log('🚀 COMPRAS_V2: Enviando archivo a endpoint /upload/compras-v2');
     console.log('📁 Archivo:', file.name, 'Tamaño:', file.size);
 
-    return this.request<{ 
-      compras_guardadas?: number; 
-      materiales_guardados?: number;
-      total_procesados?: number;
-      [key: string]: any 
-    }>('/upload/compras-v2', {
+    const { job_id } = await this.request<{ job_id: number }>('/upload/compras-v2?en_segundo_plano=true', {
       method: 'POST',
       headers: {}, // No Content-Type header for FormData
       body: formData,
     });
+
+    const job = await this.waitForUploadJob(job_id);
+    return { ...job.resultado, job_id };
   }
 
   async downloadComprasV2Layout(): Promise<Blob> {